@@ -0,0 +1,281 @@
+"""
+Analytics Service - Pre-aggregated analytics rollups for Loopync
+Writes bump small per-user counters (daily + lifetime) as they happen;
+periodic aggregation jobs reconcile them against the source collections and
+derive per-tribe and platform-wide daily docs. Dashboards read O(days) rollup
+documents instead of scanning posts, reels or transactions.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PLATFORM_KEY = "all"
+
+# Days of daily docs the rollup job recomputes on every run
+ROLLUP_DAYS = 2
+
+# Counters kept per user (daily and lifetime)
+CONTENT_METRICS = [
+    "posts", "reels",
+    "postLikes", "reelLikes",
+    "postComments", "reelComments",
+    "postShares", "reelShares",
+    "postViews", "reelViews",
+]
+WALLET_METRICS = [
+    "walletSpent", "walletAdded", "walletPayments", "walletTransactions",
+    "spendVenues", "spendEvents", "spendOther",
+    "creditsEarned",
+]
+
+
+def day_key(ts: Optional[datetime] = None) -> str:
+    return (ts or datetime.now(timezone.utc)).strftime("%Y-%m-%d")
+
+
+def day_keys(days: int) -> List[str]:
+    """The last `days` day keys, oldest first (today included)"""
+    today = datetime.now(timezone.utc)
+    return [day_key(today - timedelta(days=n)) for n in range(days - 1, -1, -1)]
+
+
+def spend_category(txn: dict) -> str:
+    """Spending bucket of a payment (kept in step with _SPEND_CATEGORY_EXPR)"""
+    venue_name = ((txn.get("metadata") or {}).get("venueName") or "").lower()
+    if "café" in venue_name or "restaurant" in venue_name:
+        return "spendVenues"
+    if "ticket" in venue_name or "event" in venue_name:
+        return "spendEvents"
+    return "spendOther"
+
+
+def wallet_metrics(txn: dict) -> Dict[str, float]:
+    """Counter increments for one wallet transaction"""
+    amount = txn.get("amount", 0) or 0
+    metrics = {"walletTransactions": 1}
+    if txn.get("type") == "payment":
+        metrics.update({"walletSpent": amount, "walletPayments": 1, spend_category(txn): amount})
+    elif txn.get("type") == "topup":
+        metrics["walletAdded"] = amount
+    return metrics
+
+
+def _sum(field: str) -> dict:
+    return {"$sum": {"$ifNull": [f"${field}", 0]}}
+
+
+def _stat(stat: str, legacy: str) -> dict:
+    """A content counter, falling back to the legacy field (array length or number)"""
+    return {"$ifNull": [f"$stats.{stat}", {"$cond": [
+        {"$isArray": f"${legacy}"}, {"$size": f"${legacy}"}, {"$ifNull": [f"${legacy}", 0]}
+    ]}]}
+
+
+_VENUE_NAME = {"$toLower": {"$ifNull": ["$metadata.venueName", ""]}}
+
+_SPEND_CATEGORY_EXPR = {"$switch": {"branches": [
+    {"case": {"$regexMatch": {"input": _VENUE_NAME, "regex": "café|restaurant"}}, "then": "venues"},
+    {"case": {"$regexMatch": {"input": _VENUE_NAME, "regex": "ticket|event"}}, "then": "events"},
+], "default": "other"}}
+
+
+def _merge(into: str, on: List[str]) -> dict:
+    return {"$merge": {"into": into, "on": on, "whenMatched": "merge", "whenNotMatched": "insert"}}
+
+
+class AnalyticsService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== WRITE PATH =====
+
+    async def record(self, user_id: str, metrics: Dict[str, float], at: Optional[datetime] = None) -> None:
+        """Bump a user's counters for today and lifetime"""
+        metrics = {k: v for k, v in metrics.items() if v}
+        if not user_id or not metrics:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        await self.db.analytics_daily.update_one(
+            {"scope": "user", "key": user_id, "day": day_key(at)},
+            {"$inc": metrics, "$set": {"updatedAt": now}},
+            upsert=True
+        )
+        await self.db.analytics_totals.update_one(
+            {"scope": "user", "key": user_id},
+            {"$inc": metrics, "$set": {"updatedAt": now}},
+            upsert=True
+        )
+
+    # ===== AGGREGATION JOBS =====
+
+    async def rollup_days(self, days: int = ROLLUP_DAYS) -> Dict[str, int]:
+        """
+        Recompute recent daily docs: per-user content counts from the source
+        collections, then tribe and platform days from the per-user days.
+        """
+        keys = day_keys(days)
+        since = keys[0]
+        now = datetime.now(timezone.utc).isoformat()
+
+        for collection, field in (("posts", "posts"), ("reels", "reels")):
+            await self.db[collection].aggregate([
+                {"$match": {"createdAt": {"$gte": since}}},
+                {"$group": {
+                    "_id": {"key": "$authorId", "day": {"$substrCP": ["$createdAt", 0, 10]}},
+                    field: {"$sum": 1}
+                }},
+                {"$project": {"_id": 0, "scope": "user", "key": "$_id.key", "day": "$_id.day",
+                              field: 1, "updatedAt": now}},
+                _merge("analytics_daily", ["scope", "key", "day"])
+            ]).to_list(None)
+
+        content_sums = {m: _sum(f"d.{m}") for m in CONTENT_METRICS}
+        active = {"$sum": {"$cond": [
+            {"$gt": [{"$add": [{"$ifNull": ["$d.posts", 0]}, {"$ifNull": ["$d.reels", 0]}]}, 0]}, 1, 0
+        ]}}
+
+        # Tribe day = sum of its members' days
+        await self.db.tribes.aggregate([
+            {"$project": {"_id": 0, "id": 1, "members": 1}},
+            {"$lookup": {
+                "from": "analytics_daily",
+                "localField": "members",
+                "foreignField": "key",
+                "pipeline": [
+                    {"$match": {"scope": "user", "day": {"$gte": since}}},
+                    {"$project": {"_id": 0, "key": 1, "day": 1, **{m: 1 for m in CONTENT_METRICS}}}
+                ],
+                "as": "d"
+            }},
+            {"$unwind": "$d"},
+            {"$group": {
+                "_id": {"key": "$id", "day": "$d.day"},
+                **content_sums,
+                "activeMembers": active,
+                "contributors": {"$push": {"$cond": [
+                    {"$gt": [{"$ifNull": ["$d.posts", 0]}, 0]},
+                    {"userId": "$d.key", "posts": "$d.posts"},
+                    "$$REMOVE"
+                ]}}
+            }},
+            {"$project": {"_id": 0, "scope": "tribe", "key": "$_id.key", "day": "$_id.day",
+                          **{m: 1 for m in CONTENT_METRICS}, "activeMembers": 1, "contributors": 1,
+                          "updatedAt": now}},
+            _merge("analytics_daily", ["scope", "key", "day"])
+        ]).to_list(None)
+
+        # Platform day = sum of all users' days
+        await self.db.analytics_daily.aggregate([
+            {"$match": {"scope": "user", "day": {"$gte": since}}},
+            {"$project": {"_id": 0, "day": 1, "d": "$$ROOT"}},
+            {"$group": {"_id": "$day", **content_sums, "activeUsers": active}},
+            {"$project": {"_id": 0, "scope": "platform", "key": PLATFORM_KEY, "day": "$_id",
+                          **{m: 1 for m in CONTENT_METRICS}, "activeUsers": 1, "updatedAt": now}},
+            _merge("analytics_daily", ["scope", "key", "day"])
+        ]).to_list(None)
+
+        return {"days": len(keys)}
+
+    async def rebuild_totals(self) -> Dict[str, int]:
+        """Recompute lifetime per-user and platform totals from the source collections"""
+        now = datetime.now(timezone.utc).isoformat()
+        into = _merge("analytics_totals", ["scope", "key"])
+
+        def by_author(prefix: str, comments: str, shares: str, views: str) -> list:
+            return [
+                {"$group": {
+                    "_id": "$authorId",
+                    f"{prefix}s": {"$sum": 1},
+                    f"{prefix}Likes": {"$sum": _stat("likes", "likedBy")},
+                    f"{prefix}Comments": {"$sum": _stat(comments, "comments")},
+                    f"{prefix}Shares": {"$sum": _stat("shares", shares)},
+                    f"{prefix}Views": {"$sum": _stat("views", views)},
+                }},
+                {"$match": {"_id": {"$ne": None}}},
+                {"$addFields": {"scope": "user", "key": "$_id", "updatedAt": now}},
+                {"$project": {"_id": 0}},
+                into
+            ]
+
+        await self.db.posts.aggregate(by_author("post", "replies", "shares", "views")).to_list(None)
+        await self.db.reels.aggregate(by_author("reel", "comments", "shares", "views")).to_list(None)
+
+        await self.db.wallet_transactions.aggregate([
+            {"$addFields": {"category": _SPEND_CATEGORY_EXPR,
+                            "amount": {"$ifNull": ["$amount", 0]},
+                            "isPayment": {"$eq": ["$type", "payment"]}}},
+            {"$group": {
+                "_id": "$userId",
+                "walletTransactions": {"$sum": 1},
+                "walletPayments": {"$sum": {"$cond": ["$isPayment", 1, 0]}},
+                "walletSpent": {"$sum": {"$cond": ["$isPayment", "$amount", 0]}},
+                "walletAdded": {"$sum": {"$cond": [{"$eq": ["$type", "topup"]}, "$amount", 0]}},
+                **{f"spend{c.title()}": {"$sum": {"$cond": [
+                    {"$and": ["$isPayment", {"$eq": ["$category", c]}]}, "$amount", 0
+                ]}} for c in ("venues", "events", "other")},
+            }},
+            {"$match": {"_id": {"$ne": None}}},
+            {"$addFields": {"scope": "user", "key": "$_id", "updatedAt": now}},
+            {"$project": {"_id": 0}},
+            into
+        ]).to_list(None)
+
+        await self.db.loop_credits.aggregate([
+            {"$match": {"type": "earn"}},
+            {"$group": {"_id": "$userId", "creditsEarned": {"$sum": "$amount"}}},
+            {"$match": {"_id": {"$ne": None}}},
+            {"$addFields": {"scope": "user", "key": "$_id", "updatedAt": now}},
+            {"$project": {"_id": 0}},
+            into
+        ]).to_list(None)
+
+        await self.db.analytics_totals.aggregate([
+            {"$match": {"scope": "user"}},
+            {"$group": {"_id": None, "users": {"$sum": 1},
+                        **{m: _sum(m) for m in CONTENT_METRICS + WALLET_METRICS}}},
+            {"$project": {"_id": 0, "scope": "platform", "key": PLATFORM_KEY,
+                          **{m: 1 for m in CONTENT_METRICS + WALLET_METRICS}, "updatedAt": now}},
+            into
+        ]).to_list(None)
+
+        users = await self.db.analytics_totals.count_documents({"scope": "user"})
+        logger.info(f"✅ Analytics totals rebuilt for {users} users")
+        return {"users": users}
+
+    # ===== READ PATH =====
+
+    async def totals(self, scope: str, key: str) -> Dict:
+        doc = await self.db.analytics_totals.find_one({"scope": scope, "key": key}, {"_id": 0}) or {}
+        return {**{m: 0 for m in CONTENT_METRICS + WALLET_METRICS}, **doc}
+
+    async def daily(self, scope: str, key: str, days: int) -> List[Dict]:
+        """Daily rollup docs for the last `days` days (oldest first)"""
+        return await self.db.analytics_daily.find(
+            {"scope": scope, "key": key, "day": {"$gte": day_keys(days)[0]}}, {"_id": 0}
+        ).sort("day", 1).to_list(days)
+
+    @staticmethod
+    def window(docs: List[Dict], metrics: List[str] = CONTENT_METRICS) -> Dict[str, float]:
+        """Sum daily docs over their window"""
+        return {m: sum(d.get(m, 0) or 0 for d in docs) for m in metrics}
+
+    @staticmethod
+    def top_contributors(docs: List[Dict], limit: int = 5) -> List[Dict]:
+        counts: Dict[str, int] = defaultdict(int)
+        for d in docs:
+            for c in d.get("contributors", []):
+                counts[c["userId"]] += c.get("posts", 0) or 0
+        ranked = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+        return [{"userId": uid, "postCount": count} for uid, count in ranked[:limit]]
+
+    async def active_users(self, days: int) -> int:
+        """Distinct users who posted a post or reel in the window"""
+        active = await self.db.analytics_daily.distinct("key", {
+            "scope": "user", "day": {"$gte": day_keys(days)[0]},
+            "$or": [{"posts": {"$gt": 0}}, {"reels": {"$gt": 0}}]
+        })
+        return len(active)
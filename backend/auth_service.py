@@ -9,14 +9,25 @@ from datetime import datetime, timezone
 from passlib.context import CryptContext
 from typing import Optional
 
+from performance import principals_cache
+from cpu_offload import bcrypt_pool
+from search_service import SearchService
+
 logger = logging.getLogger(__name__)
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# The slice of a user that authenticated requests carry (see get_principal)
+PRINCIPAL_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "role": 1,
+    "isVerified": 1, "verificationStatus": 1, "accountType": 1, "tokenVersion": 1,
+}
+
 class AuthService:
     def __init__(self, db):
         self.db = db
+        self.search = SearchService(db)
     
     def hash_password(self, password: str) -> str:
         """Hash a password using bcrypt"""
@@ -26,6 +37,14 @@ class AuthService:
         """Verify a password against its hash"""
         return pwd_context.verify(plain_password, hashed_password)
     
+    async def hash_password_async(self, password: str) -> str:
+        """hash_password on the bcrypt pool, keeping the event loop free"""
+        return await bcrypt_pool.run(self.hash_password, password)
+    
+    async def verify_password_async(self, plain_password: str, hashed_password: str) -> bool:
+        """verify_password on the bcrypt pool, keeping the event loop free"""
+        return await bcrypt_pool.run(self.verify_password, plain_password, hashed_password)
+    
     async def create_user(self, email: str, password: str, name: str, handle: str = None, phone: str = None) -> dict:
         """Create a new user account"""
         # Check if email already exists
@@ -51,7 +70,7 @@ class AuthService:
                 counter += 1
         
         # Hash password
-        hashed_password = self.hash_password(password)
+        hashed_password = await self.hash_password_async(password)
         
         # Create user document
         user = {
@@ -79,6 +98,10 @@ class AuthService:
         # Insert into MongoDB
         await self.db.users.insert_one(user)
         logger.info(f"✅ Created new user: {email} (ID: {user_id})")
+        try:
+            await self.search.index("users", user)
+        except Exception as e:
+            logger.warning(f"Search indexing failed for user {user_id}: {e}")
         
         # Remove password from return object
         user.pop('password', None)
@@ -94,7 +117,7 @@ class AuthService:
             return None
         
         # Verify password
-        if not self.verify_password(password, user.get('password', '')):
+        if not await self.verify_password_async(password, user.get('password', '')):
             logger.warning(f"❌ Login failed: Invalid password - {email}")
             return None
         
@@ -122,6 +145,28 @@ class AuthService:
         user = await self.db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
         return user
     
+    async def get_principal(self, user_id: str, token_version: int = 0) -> Optional[dict]:
+        """
+        Slim, briefly cached identity for an authenticated request.
+        Returns None for unknown users and for tokens issued before the last revocation.
+        """
+        key = f"principal:{user_id}"
+        principal = await principals_cache.get(key)
+        if principal is None:
+            principal = await self.db.users.find_one({"id": user_id}, PRINCIPAL_PROJECTION)
+            if not principal:
+                return None
+            await principals_cache.set(key, principal)
+        if principal.get("tokenVersion", 0) != token_version:
+            return None
+        return dict(principal)
+    
+    async def revoke_sessions(self, user_id: str) -> None:
+        """Invalidate every token issued to a user so far (password change, suspension)"""
+        await self.db.users.update_one({"id": user_id}, {"$inc": {"tokenVersion": 1}})
+        await principals_cache.delete(f"principal:{user_id}")
+        logger.info(f"🔒 Sessions revoked for user: {user_id}")
+    
     async def get_user_by_email(self, email: str) -> Optional[dict]:
         """Get user by email"""
         user = await self.db.users.find_one({"email": email.lower()}, {"_id": 0, "password": 0})
@@ -134,16 +179,17 @@ class AuthService:
             return False
         
         # Verify old password
-        if not self.verify_password(old_password, user.get('password', '')):
+        if not await self.verify_password_async(old_password, user.get('password', '')):
             return False
         
         # Hash and update new password
-        hashed_password = self.hash_password(new_password)
+        hashed_password = await self.hash_password_async(new_password)
         await self.db.users.update_one(
             {"id": user_id},
             {"$set": {"password": hashed_password, "updatedAt": datetime.now(timezone.utc).isoformat()}}
         )
         
+        await self.revoke_sessions(user_id)
         logger.info(f"✅ Password updated for user: {user_id}")
         return True
     
@@ -154,11 +200,12 @@ class AuthService:
             return False
         
         # Hash and update password
-        hashed_password = self.hash_password(new_password)
+        hashed_password = await self.hash_password_async(new_password)
         await self.db.users.update_one(
             {"id": user["id"]},
             {"$set": {"password": hashed_password, "updatedAt": datetime.now(timezone.utc).isoformat()}}
         )
+        await self.revoke_sessions(user["id"])
         
         logger.info(f"✅ Password reset for user: {email}")
         return True
@@ -0,0 +1,72 @@
+"""
+Background Jobs - Periodic maintenance tasks for Loopync
+Runs async jobs on an interval inside the API process. A lease document in
+MongoDB makes sure only one worker runs a given job per interval.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+_tasks: Dict[str, asyncio.Task] = {}
+_last_runs: Dict[str, Dict] = {}
+
+
+async def acquire_lease(db, name: str, seconds: int) -> bool:
+    """Take the named lease if it is free or expired (atomic across workers)"""
+    now = time.time()
+    try:
+        result = await db.job_leases.update_one(
+            {"_id": name, "until": {"$lt": now}},
+            {"$set": {"until": now + seconds, "acquiredAt": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        return result.modified_count == 1 or result.upserted_id is not None
+    except DuplicateKeyError:
+        # Lease exists and is still held by another worker
+        return False
+
+
+async def _run_forever(db, name: str, interval: int, job: Callable[[], Awaitable], initial_delay: int):
+    await asyncio.sleep(initial_delay)
+    while True:
+        try:
+            if await acquire_lease(db, name, max(1, interval - 1)):
+                started = time.perf_counter()
+                result = await job()
+                _last_runs[name] = {
+                    "at": datetime.now(timezone.utc).isoformat(),
+                    "seconds": round(time.perf_counter() - started, 3),
+                    "result": result
+                }
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background job {name} failed: {e}")
+            _last_runs[name] = {"at": datetime.now(timezone.utc).isoformat(), "error": str(e)}
+        await asyncio.sleep(interval)
+
+
+def start_periodic(db, name: str, interval: int, job: Callable[[], Awaitable], initial_delay: int = 5) -> None:
+    """Schedule `job` every `interval` seconds (one worker at a time)"""
+    if name in _tasks:
+        return
+    _tasks[name] = asyncio.create_task(_run_forever(db, name, interval, job, initial_delay))
+    logger.info(f"✅ Background job scheduled: {name} every {interval}s")
+
+
+async def stop_all() -> None:
+    for task in _tasks.values():
+        task.cancel()
+    await asyncio.gather(*_tasks.values(), return_exceptions=True)
+    _tasks.clear()
+
+
+def job_stats() -> Dict[str, Dict]:
+    return dict(_last_runs)
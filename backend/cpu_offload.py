@@ -0,0 +1,185 @@
+"""
+CPU Offload - Bounded worker pools for blocking work in Loopync
+bcrypt hashing, QR rendering and image encoding block the event loop for tens
+to hundreds of milliseconds. OffloadPool runs such calls on a thread or
+process pool; an asyncio semaphore caps how many run at once, callers beyond
+that wait on the loop (visible as queue depth), and a full queue is rejected
+with PoolSaturatedError instead of growing without bound.
+"""
+
+import os
+import time
+import base64
+import asyncio
+import logging
+from io import BytesIO
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from metrics import Histogram, escape_label, histogram_lines
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturatedError(RuntimeError):
+    def __init__(self, pool: str):
+        super().__init__(f"{pool} worker pool is saturated")
+        self.pool = pool
+
+
+class OffloadPool:
+    """
+    `max_workers` calls run concurrently; up to `max_queue` more wait for a slot.
+    Process pools need picklable, module-level functions.
+    """
+
+    def __init__(self, name: str, kind: str = "thread", max_workers: int = 4, max_queue: int = 256):
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.running = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait = Histogram()
+        self.run_time = Histogram()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=f"offload-{self.name}")
+        return self._executor
+
+    async def run(self, fn: Callable, *args):
+        """Run fn(*args) off the event loop; raises PoolSaturatedError when the queue is full"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        if self._semaphore.locked() and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise PoolSaturatedError(self.name)
+
+        queued_at = time.perf_counter()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        started = time.perf_counter()
+        self.wait.observe(started - queued_at)
+        self.running += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self.run_time.observe(time.perf_counter() - started)
+            self._semaphore.release()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "running": self.running,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait": self.wait.summary(),
+            "run": self.run_time.summary(),
+        }
+
+
+# ===== POOLS =====
+
+# bcrypt releases the GIL, so threads give real parallelism
+bcrypt_pool = OffloadPool("bcrypt", "thread", max_workers=int(os.environ.get("BCRYPT_WORKERS", 4)), max_queue=512)
+# QR and image encoding are mostly pure Python / GIL-bound - use processes
+qr_pool = OffloadPool("qr", "process", max_workers=int(os.environ.get("QR_WORKERS", 2)), max_queue=256)
+image_pool = OffloadPool("image", "process", max_workers=int(os.environ.get("IMAGE_WORKERS", 2)), max_queue=64)
+
+POOLS = [bcrypt_pool, qr_pool, image_pool]
+
+
+def pool_stats() -> Dict[str, Dict]:
+    return {pool.name: pool.stats for pool in POOLS}
+
+
+def shutdown_pools() -> None:
+    for pool in POOLS:
+        pool.shutdown()
+
+
+def prometheus() -> str:
+    lines = []
+    for name, help_text, attr in (
+        ("loopync_offload_running", "Calls running in each CPU offload pool", "running"),
+        ("loopync_offload_queued", "Calls waiting for a CPU offload pool slot", "queued"),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{pool="{escape_label(p.name)}"}} {getattr(p, attr)}' for p in POOLS]
+
+    lines += [
+        "# HELP loopync_offload_calls_total CPU offload calls by outcome",
+        "# TYPE loopync_offload_calls_total counter",
+    ]
+    for p in POOLS:
+        for outcome in ("completed", "failed", "rejected"):
+            lines.append(f'loopync_offload_calls_total{{pool="{escape_label(p.name)}",outcome="{outcome}"}} '
+                         f'{getattr(p, outcome)}')
+
+    for name, help_text, attr in (
+        ("loopync_offload_wait_seconds", "Time calls spent queued for a CPU offload pool", "wait"),
+        ("loopync_offload_run_seconds", "Time calls spent running in a CPU offload pool", "run_time"),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for p in POOLS:
+            lines += histogram_lines(name, f'pool="{escape_label(p.name)}"', getattr(p, attr))
+    return "\n".join(lines) + "\n"
+
+
+# ===== WORKER FUNCTIONS =====
+
+def render_qr_codes(payloads: List[str]) -> List[str]:
+    """PNG data URLs for a batch of QR payloads (runs in a worker process)"""
+    import qrcode
+
+    images = []
+    for data in payloads:
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=10,
+            border=4,
+        )
+        qr.add_data(data)
+        qr.make(fit=True)
+        img = qr.make_image(fill_color="black", back_color="white")
+
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        images.append(f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}")
+    return images
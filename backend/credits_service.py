@@ -0,0 +1,192 @@
+"""
+Credits Service - Loop Credits ledger and materialized balances for Loopync
+Every earn/spend appends an immutable entry to the loop_credits ledger and
+moves the user's credit_balances document with one conditional $inc, so
+balance reads are O(1) and concurrent spends can never overdraw. A periodic
+reconciliation job re-derives balances from the ledger and repairs drift.
+"""
+
+import uuid
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from performance import paginate_keyset
+
+logger = logging.getLogger(__name__)
+
+# Balances written this recently are skipped by reconciliation (their ledger entry may be in flight)
+RECONCILE_GRACE_SECONDS = 60
+
+# The periodic job re-checks users with ledger activity in this window
+RECONCILE_LOOKBACK_HOURS = 2
+
+RECONCILE_BATCH_SIZE = 1000
+
+BALANCE_FIELDS = {"_id": 0, "balance": 1, "earned": 1, "spent": 1, "updatedAt": 1}
+
+
+class InsufficientCreditsError(ValueError):
+    def __init__(self, balance: int, amount: int):
+        super().__init__(f"Insufficient credits: balance {balance}, needed {amount}")
+        self.balance = balance
+        self.amount = amount
+
+
+class CreditsService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== WRITE PATH =====
+
+    async def earn(self, user_id: str, amount: int, source: str, description: str = "") -> Dict:
+        """Credit a user; returns the ledger entry (with balanceAfter)"""
+        if amount <= 0:
+            raise ValueError("Credit amount must be positive")
+        balance = await self._apply(user_id, {"balance": amount, "earned": amount})
+        return await self._append(user_id, amount, "earn", source, description, balance)
+
+    async def spend(self, user_id: str, amount: int, source: str, description: str = "") -> Dict:
+        """Debit a user only if the balance covers it (atomic); raises InsufficientCreditsError"""
+        if amount <= 0:
+            raise ValueError("Credit amount must be positive")
+        balance = await self._apply(
+            user_id, {"balance": -amount, "spent": amount}, guard={"balance": {"$gte": amount}}
+        )
+        if balance is None:
+            current = await self.balance(user_id)
+            raise InsufficientCreditsError(current["balance"], amount)
+        return await self._append(user_id, amount, "spend", source, description, balance)
+
+    async def _apply(self, user_id: str, inc: Dict[str, int], guard: Optional[dict] = None) -> Optional[Dict]:
+        """
+        Move the materialized balance; materializes it first for users who predate it.
+        None only when the balance exists and the guard still fails on the retried update.
+        """
+        async def guarded_inc():
+            return await self.db.credit_balances.find_one_and_update(
+                {"userId": user_id, **(guard or {})},
+                {"$inc": inc, "$set": {"updatedAt": datetime.now(timezone.utc).isoformat()}},
+                projection=BALANCE_FIELDS,
+                return_document=ReturnDocument.AFTER
+            )
+
+        doc = await guarded_inc()
+        if doc is None:
+            # A missing balance or a guard miss: make sure the document exists (whether
+            # we or a concurrent request create it), then decide on the retried update
+            if await self.db.credit_balances.find_one({"userId": user_id}, {"_id": 1}) is None:
+                await self._materialize(user_id)
+            doc = await guarded_inc()
+        return doc
+
+    async def _append(self, user_id: str, amount: int, kind: str, source: str,
+                      description: str, balance: Dict) -> Dict:
+        entry = {
+            "id": str(uuid.uuid4()),
+            "userId": user_id,
+            "amount": amount,
+            "type": kind,
+            "source": source,
+            "description": description,
+            "balanceAfter": balance["balance"],
+            "createdAt": datetime.now(timezone.utc).isoformat(),
+        }
+        await self.db.loop_credits.insert_one(entry)
+        entry.pop("_id", None)
+        return entry
+
+    async def _materialize(self, user_id: str) -> bool:
+        """Create the balance from the ledger if missing; False if it already existed"""
+        totals = (await self._ledger_totals([user_id])).get(user_id, {"earned": 0, "spent": 0})
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            result = await self.db.credit_balances.update_one(
+                {"userId": user_id},
+                {"$setOnInsert": {
+                    "userId": user_id,
+                    "balance": totals["earned"] - totals["spent"],
+                    "earned": totals["earned"],
+                    "spent": totals["spent"],
+                    "createdAt": now,
+                    "updatedAt": now,
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent request materialized it first
+            return True
+        return result.upserted_id is not None
+
+    # ===== READ PATH =====
+
+    async def balance(self, user_id: str) -> Dict[str, int]:
+        doc = await self.db.credit_balances.find_one({"userId": user_id}, BALANCE_FIELDS)
+        if doc is None:
+            await self._materialize(user_id)
+            doc = await self.db.credit_balances.find_one({"userId": user_id}, BALANCE_FIELDS) or {}
+        return {k: doc.get(k, 0) for k in ("balance", "earned", "spent")}
+
+    async def history(self, user_id: str, cursor: Optional[str] = None, limit: int = 20) -> tuple:
+        """One keyset page of ledger entries, newest first: (entries, next_cursor)"""
+        return await paginate_keyset(self.db.loop_credits, {"userId": user_id}, cursor=cursor, limit=limit)
+
+    # ===== RECONCILIATION =====
+
+    async def _ledger_totals(self, user_ids: Optional[List[str]] = None) -> Dict[str, Dict[str, int]]:
+        pipeline = [{"$match": {"userId": {"$in": user_ids}}}] if user_ids is not None else []
+        pipeline.append({"$group": {
+            "_id": "$userId",
+            "earned": {"$sum": {"$cond": [{"$eq": ["$type", "earn"]}, "$amount", 0]}},
+            "spent": {"$sum": {"$cond": [{"$eq": ["$type", "spend"]}, "$amount", 0]}},
+        }})
+        rows = await self.db.loop_credits.aggregate(pipeline).to_list(None)
+        return {r["_id"]: {"earned": r["earned"], "spent": r["spent"]} for r in rows if r["_id"]}
+
+    async def reconcile(self, lookback_hours: Optional[int] = RECONCILE_LOOKBACK_HOURS) -> Dict[str, int]:
+        """
+        Re-derive balances from the ledger and repair drift. With lookback_hours,
+        only users with recent ledger activity are checked; None checks everyone.
+        """
+        if lookback_hours is None:
+            user_ids = await self.db.loop_credits.distinct("userId")
+        else:
+            since = (datetime.now(timezone.utc) - timedelta(hours=lookback_hours)).isoformat()
+            user_ids = await self.db.loop_credits.distinct("userId", {"createdAt": {"$gte": since}})
+
+        grace = (datetime.now(timezone.utc) - timedelta(seconds=RECONCILE_GRACE_SECONDS)).isoformat()
+        checked = repaired = 0
+        for start in range(0, len(user_ids), RECONCILE_BATCH_SIZE):
+            batch = [u for u in user_ids[start:start + RECONCILE_BATCH_SIZE] if u]
+            totals = await self._ledger_totals(batch)
+            balances = {b["userId"]: b for b in await self.db.credit_balances.find(
+                {"userId": {"$in": batch}}, {**BALANCE_FIELDS, "userId": 1}
+            ).to_list(None)}
+
+            for user_id, t in totals.items():
+                checked += 1
+                doc = balances.get(user_id)
+                if doc is None:
+                    await self._materialize(user_id)
+                    continue
+                expected = {"balance": t["earned"] - t["spent"], "earned": t["earned"], "spent": t["spent"]}
+                if all(doc.get(k) == v for k, v in expected.items()) or doc.get("updatedAt", "") > grace:
+                    continue
+                # Only repair if nothing wrote the balance since we read it
+                result = await self.db.credit_balances.update_one(
+                    {"userId": user_id, "updatedAt": doc.get("updatedAt")},
+                    {"$set": {**expected, "reconciledAt": datetime.now(timezone.utc).isoformat()}}
+                )
+                if result.modified_count:
+                    repaired += 1
+                    logger.warning(
+                        f"⚠️ Credits drift repaired for {user_id}: "
+                        f"{doc.get('balance')} -> {expected['balance']}"
+                    )
+
+        if repaired:
+            logger.info(f"✅ Credits reconciled: {checked} checked, {repaired} repaired")
+        return {"checked": checked, "repaired": repaired}
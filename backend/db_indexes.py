@@ -0,0 +1,413 @@
+"""
+Database Indexes - Declarative index manifest for Loopync
+Every index the app relies on is declared once in INDEX_MANIFEST. At startup
+the manifest is diffed against the live indexes (all collections
+concurrently) and only missing indexes are built. Indexes present in the
+database but absent from the manifest, or declared with different options,
+are reported as drift, never dropped automatically.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple, Union
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Collections indexed at the same time
+APPLY_CONCURRENCY = 8
+
+# Options that make two indexes on the same keys different
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds")
+
+KeySpec = Union[str, Tuple[str, int]]
+
+
+def ix(*keys: KeySpec, **options) -> Dict:
+    """One manifest entry: ix("userId", ("createdAt", -1), unique=True)"""
+    return {
+        "keys": [(k, 1) if isinstance(k, str) else (k[0], k[1]) for k in keys],
+        "options": options,
+    }
+
+
+INDEX_MANIFEST: Dict[str, List[Dict]] = {
+    # ===== USERS & SOCIAL GRAPH =====
+    "users": [
+        ix("id", unique=True),
+        ix("email", unique=True, sparse=True),  # sparse allows null values
+        ix("handle", unique=True, sparse=True),
+        ix("friends"),
+        ix("friendRequestsSent"),
+        ix("friendRequestsReceived"),
+        ix("followers"),
+        ix("following"),
+        ix("highFanout", sparse=True),  # Fan-out-on-read authors
+    ],
+    "friendships": [
+        ix("userId1", ("createdAt", -1)),  # Keyset pagination, both sides
+        ix("userId2", ("createdAt", -1)),
+        ix("userId1", "userId2"),  # Pair lookups / unfriend
+    ],
+    "follow_requests": [
+        ix("id", unique=True),
+        ix("toUserId", "status"),
+        ix("fromUserId", "toUserId", "status"),
+    ],
+    "user_blocks": [
+        ix("blockerId", "blockedId"),
+        ix("blockedId"),
+    ],
+    "user_mutes": [
+        ix("muterId", "mutedId"),
+    ],
+    "taste_dna": [
+        ix("userId", unique=True),
+    ],
+
+    # ===== CONTENT =====
+    "posts": [
+        ix("id", unique=True),
+        ix("authorId"),
+        ix(("createdAt", -1)),
+        ix("authorId", ("createdAt", -1)),
+        ix(("createdAt", -1), ("id", -1)),  # Keyset pagination
+        ix("likes"),
+        ix("likedBy"),
+        ix("hashtags", ("createdAt", -1)),  # Hashtag feed
+        ix(("likeCount", -1)),
+        ix(("engagementScore", -1), ("createdAt", -1)),  # Trending top-N
+        ix(("engagementScore", -1), ("id", -1)),  # For You keyset paging
+        ix("authorId", ("stats.likes", -1)),  # Creator top posts
+    ],
+    "reels": [
+        ix("id", unique=True),
+        ix("authorId"),
+        ix(("createdAt", -1)),
+        ix(("createdAt", -1), ("id", -1)),
+        ix(("viewCount", -1)),
+        ix(("engagementScore", -1), ("createdAt", -1)),
+        ix("authorId", ("stats.likes", -1)),
+    ],
+    "comments": [
+        ix("id", unique=True),
+        ix("postId", ("createdAt", -1)),
+        ix("reelId", ("createdAt", -1)),
+    ],
+    "shares": [
+        ix("contentId", "contentType"),
+    ],
+    "timelines": [
+        ix("userId", unique=True),
+        ix("entries.postId"),  # For removing deleted posts
+    ],
+    "vibe_capsules": [
+        ix("id", unique=True),
+        ix("authorId"),
+        ix(("createdAt", -1)),
+        ix("authorId", ("expiresAt", -1)),
+        ix("expiresAt", expireAfterSeconds=0),  # 24h stories
+    ],
+
+    # ===== MEDIA =====
+    "media_files": [
+        ix("id", unique=True),
+    ],
+    "media.files": [
+        ix("metadata.sha256", unique=True),  # Upload dedupe - one blob per content hash
+    ],
+    "media_variants": [
+        ix("sourceSha256", "name", "format", unique=True),
+    ],
+
+    # ===== SEARCH / TRENDING / ANALYTICS =====
+    "search_postings": [
+        ix("t", "k", ("tf", -1), "d"),  # Per-term reads, highest weight first
+        ix("k", "d"),
+    ],
+    "search_terms": [
+        ix("k", "t", unique=True),
+    ],
+    "search_docs": [
+        ix("k", "d", unique=True),
+    ],
+    "search_stats": [
+        ix("k", unique=True),
+    ],
+    "search_generations": [
+        ix("k", unique=True),
+    ],
+    "hashtag_buckets": [
+        ix("tag", "bucket", unique=True),
+        ix("expiresAt", expireAfterSeconds=0),
+    ],
+    "hashtag_trends": [
+        ix("tag", unique=True),
+        ix(("logScore", -1)),
+    ],
+    "analytics_daily": [
+        ix("scope", "key", "day", unique=True),
+        ix("scope", "day"),
+    ],
+    "analytics_totals": [
+        ix("scope", "key", unique=True),
+    ],
+
+    # ===== MESSAGING & CALLS =====
+    "dm_threads": [
+        ix("id", unique=True),
+        ix("user1Id"),
+        ix("user2Id"),
+        ix(("lastMessageAt", -1)),
+        ix("user1Id", ("lastMessageAt", -1), ("id", -1)),  # Keyset pagination
+        ix("user2Id", ("lastMessageAt", -1), ("id", -1)),
+    ],
+    "dm_messages": [
+        ix("id", unique=True),
+        ix("threadId"),
+        ix(("createdAt", -1)),
+    ],
+    "threads": [
+        ix("participants"),
+        ix("participants", ("lastMessageAt", -1)),
+    ],
+    "messages": [
+        ix("threadId", ("createdAt", -1)),
+    ],
+    "message_reads": [
+        ix("threadId", "userId"),
+    ],
+    "calls": [
+        ix("id", unique=True),
+        ix("callerId"),
+        ix("recipientId"),
+        ix(("startedAt", -1)),
+    ],
+    "notifications": [
+        ix("id", unique=True),
+        ix("userId"),
+        ix(("createdAt", -1)),
+        ix("userId", ("createdAt", -1)),
+        ix("userId", ("createdAt", -1), ("id", -1)),  # Keyset pagination
+        ix("userId", "read"),
+        ix("userId", "groupKey", "read"),
+        # One open coalescing group per (user, target) - concurrent upserts can't duplicate it
+        ix("userId", "openGroup", unique=True, partialFilterExpression={"openGroup": {"$exists": True}}),
+    ],
+    "notification_counters": [
+        ix("userId", unique=True),
+    ],
+
+    # ===== COMMUNITIES & PLACES =====
+    "tribes": [
+        ix("id", unique=True),
+        ix("members"),
+        ix("category"),
+    ],
+    "vibe_rooms": [
+        ix("id", unique=True),
+    ],
+    "events": [
+        ix("id", unique=True),
+    ],
+    "event_tickets": [
+        ix("id", unique=True),
+        ix("userId", ("purchasedAt", -1)),
+        ix("eventId", "userId", "status"),
+        ix("transactionId", sparse=True),  # Idempotent booking replays
+    ],
+    "venues": [
+        ix("id", unique=True),
+        ix("type"),
+    ],
+    "checkins": [
+        ix("id", unique=True),
+        ix("venueId", "status"),
+        ix("userId", "status"),
+    ],
+
+    # ===== WALLET & COMMERCE =====
+    "wallet_transactions": [
+        ix("userId", ("createdAt", -1)),
+        ix("id", unique=True),
+        # Idempotency keys are unique per user; entries without a key are not indexed
+        ix("userId", "idempotencyKey", unique=True,
+           partialFilterExpression={"idempotencyKey": {"$exists": True}}),
+        ix("status", "createdAt", partialFilterExpression={"status": "pending"}),  # Pending recovery
+    ],
+    "loop_credits": [
+        ix("userId", ("createdAt", -1)),
+        ix("userId", ("createdAt", -1), ("id", -1)),  # Ledger keyset pagination
+        ix(("createdAt", -1)),  # Reconciliation lookback
+    ],
+    "credit_balances": [
+        ix("userId", unique=True),
+    ],
+    "user_analytics": [
+        ix("userId"),
+    ],
+    "orders": [
+        ix("id", unique=True),
+        ix("userId", ("createdAt", -1)),
+    ],
+    "request_profiles": [
+        ix("id", unique=True),
+        ix(("createdAt", -1), ("id", -1)),  # Keyset listing
+        ix("route", ("createdAt", -1), ("id", -1)),
+        ix("expiresAt", expireAfterSeconds=0),
+    ],
+    "marketplace_orders": [
+        ix("id", unique=True),
+        ix("userId", ("createdAt", -1)),
+    ],
+    "cart": [
+        ix("userId", "productId"),
+    ],
+    "digital_products": [
+        ix("id", unique=True),
+        ix("category"),
+        ix(("downloadCount", -1)),
+        ix(("createdAt", -1), ("id", -1)),
+    ],
+
+    # ===== STUDENTS & PROJECTS =====
+    "student_profiles": [
+        ix("userId", unique=True),
+        ix("skills"),
+        ix("collegeName"),
+        ix("graduationYear"),
+        ix("userCategory"),
+    ],
+    "certifications": [
+        ix("id", unique=True),
+        ix("userId"),
+        ix("skills"),
+        ix(("createdAt", -1)),
+    ],
+    "projects": [
+        ix("id", unique=True),
+        ix("userId"),
+        ix("skills"),
+        ix("status"),
+        ix("isStartup"),
+        ix(("createdAt", -1)),
+        ix("isPublic", ("createdAt", -1), ("id", -1)),  # Keyset pagination
+    ],
+    "reputation": [
+        ix("userId"),
+    ],
+    "team_posts": [
+        ix("id", unique=True),
+        ix("userId"),
+        ix("status"),
+        ix("requiredSkills"),
+        ix(("createdAt", -1)),
+    ],
+    "saved_projects": [
+        ix("userId", "projectId", unique=True),
+    ],
+    "verification_requests": [
+        ix("status"),
+    ],
+}
+
+
+def _key_tuple(keys) -> Tuple:
+    # Directions may come back as floats; "text"/"2dsphere" etc. stay strings
+    return tuple((field, d if isinstance(d, str) else int(d)) for field, d in keys)
+
+
+def _options(spec: Dict) -> Dict:
+    return {opt: spec[opt] for opt in COMPARED_OPTIONS if spec.get(opt) is not None and spec.get(opt) is not False}
+
+
+async def diff_collection(db, collection: str, wanted: List[Dict]) -> Dict:
+    """Compare one collection's live indexes with its manifest entries"""
+    live = await db[collection].index_information()
+    live_by_keys = {
+        _key_tuple(info["key"]): (name, _options(info))
+        for name, info in live.items() if name != "_id_"
+    }
+    wanted_keys = set()
+    missing, mismatched = [], []
+    for entry in wanted:
+        keys = _key_tuple(entry["keys"])
+        wanted_keys.add(keys)
+        if keys not in live_by_keys:
+            missing.append(entry)
+            continue
+        name, live_options = live_by_keys[keys]
+        if live_options != _options(entry["options"]):
+            mismatched.append({"name": name, "live": live_options, "manifest": _options(entry["options"])})
+    extra = [name for keys, (name, _) in live_by_keys.items() if keys not in wanted_keys]
+    return {"missing": missing, "mismatched": mismatched, "extra": extra}
+
+
+async def diff_indexes(db, manifest: Dict[str, List[Dict]] = INDEX_MANIFEST) -> Dict[str, Dict]:
+    """Drift report for every collection in the manifest (only collections with drift are returned)"""
+    collections = list(manifest)
+    results = await asyncio.gather(*(diff_collection(db, c, manifest[c]) for c in collections))
+    report = {}
+    for collection, diff in zip(collections, results):
+        if diff["missing"] or diff["mismatched"] or diff["extra"]:
+            report[collection] = {
+                "missing": [[list(k) for k in e["keys"]] for e in diff["missing"]],
+                "mismatched": diff["mismatched"],
+                "extra": diff["extra"],
+            }
+    return report
+
+
+async def _apply_collection(db, collection: str, wanted: List[Dict], semaphore: asyncio.Semaphore) -> Dict:
+    async with semaphore:
+        diff = await diff_collection(db, collection, wanted)
+        created, failed = [], []
+        if diff["missing"]:
+            models = [IndexModel(e["keys"], **e["options"]) for e in diff["missing"]]
+            try:
+                # One createIndexes command per collection
+                created = await db[collection].create_indexes(models)
+            except OperationFailure:
+                # A conflicting spec fails the whole command - retry one by one
+                for model in models:
+                    try:
+                        created += await db[collection].create_indexes([model])
+                    except OperationFailure as e:
+                        failed.append(f"{model.document['name']}: {e}")
+        return {"created": created, "failed": failed, "mismatched": diff["mismatched"], "extra": diff["extra"]}
+
+
+async def apply_indexes(db, manifest: Dict[str, List[Dict]] = INDEX_MANIFEST) -> Dict:
+    """Build every missing manifest index, collections in parallel"""
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(APPLY_CONCURRENCY)
+    collections = list(manifest)
+    results = await asyncio.gather(
+        *(_apply_collection(db, c, manifest[c], semaphore) for c in collections),
+        return_exceptions=True
+    )
+
+    summary = {"created": 0, "failed": {}, "drift": {}}
+    for collection, result in zip(collections, results):
+        if isinstance(result, Exception):
+            summary["failed"][collection] = [str(result)]
+            continue
+        summary["created"] += len(result["created"])
+        if result["failed"]:
+            summary["failed"][collection] = result["failed"]
+        if result["mismatched"] or result["extra"]:
+            summary["drift"][collection] = {"mismatched": result["mismatched"], "extra": result["extra"]}
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+
+    for collection, errors in summary["failed"].items():
+        logger.warning(f"⚠️ Index build failed on {collection}: {errors}")
+    for collection, drift in summary["drift"].items():
+        logger.warning(f"⚠️ Index drift on {collection}: {drift}")
+    logger.info(
+        f"✅ Index manifest applied: {summary['created']} created across "
+        f"{len(collections)} collections in {summary['seconds']}s"
+    )
+    return summary
@@ -0,0 +1,127 @@
+"""
+Engagement Service - Precomputed, time-decayed engagement scores for Loopync
+engagementScore = scoreBase + log10(max(weighted engagement, 1)), where
+scoreBase grows linearly with creation time. Newer content therefore wins
+unless older content has proportionally more engagement, and scores never need
+re-decaying, so trending / For You is a single indexed top-N read.
+"""
+
+import math
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Seconds of recency worth one order of magnitude (10x) of engagement
+SCORE_GRAVITY_SECONDS = 45000
+
+# Landmark keeping scoreBase small
+SCORE_EPOCH = 1704067200  # 2024-01-01T00:00:00Z
+
+# Engagement weights per stats field
+ENGAGEMENT_WEIGHTS = {
+    "posts": {"likes": 1, "replies": 2, "quotes": 2, "shares": 2, "reposts": 3},
+    "reels": {"likes": 1, "comments": 2, "shares": 3, "views": 0.1},
+}
+
+# Window the background job rescores and trending reads from
+TRENDING_WINDOW_DAYS = 7
+RESCORE_BATCH_SIZE = 500
+
+
+def score_base(created_at: Optional[str]) -> float:
+    try:
+        ts = datetime.fromisoformat(created_at)
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return 0.0
+    return (ts.timestamp() - SCORE_EPOCH) / SCORE_GRAVITY_SECONDS
+
+
+def engagement(kind: str, stats: Optional[dict]) -> float:
+    stats = stats or {}
+    return sum(w * max(0, stats.get(f) or 0) for f, w in ENGAGEMENT_WEIGHTS[kind].items())
+
+
+def compute_score(kind: str, doc: dict) -> float:
+    return score_base(doc.get("createdAt")) + math.log10(max(engagement(kind, doc.get("stats")), 1))
+
+
+def _score_pipeline(kind: str) -> list:
+    """Recompute engagementScore server-side from the document's own stats"""
+    weighted = [
+        {"$multiply": [w, {"$max": [0, {"$ifNull": [f"$stats.{f}", 0]}]}]}
+        for f, w in ENGAGEMENT_WEIGHTS[kind].items()
+    ]
+    return [{"$set": {"engagementScore": {"$add": [
+        "$scoreBase",
+        {"$log10": {"$max": [{"$add": weighted}, 1]}}
+    ]}}}]
+
+
+class EngagementService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== WRITE PATH =====
+
+    async def init(self, kind: str, doc: dict) -> None:
+        """Set scoreBase/engagementScore on newly created content"""
+        base = score_base(doc.get("createdAt"))
+        doc["scoreBase"] = base
+        doc["engagementScore"] = compute_score(kind, doc)
+        await self.db[kind].update_one(
+            {"id": doc["id"]},
+            {"$set": {"scoreBase": base, "engagementScore": doc["engagementScore"]}}
+        )
+
+    async def refresh(self, kind: str, doc_id: str) -> None:
+        """Recompute one document's score after its stats changed (single round trip)"""
+        result = await self.db[kind].update_one(
+            {"id": doc_id, "scoreBase": {"$exists": True}}, _score_pipeline(kind)
+        )
+        if result.matched_count == 0:
+            # Legacy document without scoreBase
+            doc = await self.db[kind].find_one({"id": doc_id}, {"_id": 0, "id": 1, "createdAt": 1})
+            if doc:
+                await self.db[kind].update_one(
+                    {"id": doc_id}, [{"$set": {"scoreBase": score_base(doc.get("createdAt"))}}] + _score_pipeline(kind)
+                )
+
+    async def rescore(self, kind: str, days: int = TRENDING_WINDOW_DAYS) -> int:
+        """Background job: recompute scores for recent content (repairs drift, backfills legacy docs)"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        window = {"createdAt": {"$gte": cutoff}}
+
+        # scoreBase depends only on createdAt, so backfilling it can't race a refresh()
+        ops: List[UpdateOne] = []
+        async for doc in self.db[kind].find(
+            {**window, "scoreBase": {"$exists": False}}, {"_id": 0, "id": 1, "createdAt": 1}
+        ).batch_size(RESCORE_BATCH_SIZE):
+            ops.append(UpdateOne({"id": doc["id"]}, {"$set": {"scoreBase": score_base(doc.get("createdAt"))}}))
+            if len(ops) >= RESCORE_BATCH_SIZE:
+                await self.db[kind].bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            await self.db[kind].bulk_write(ops, ordered=False)
+
+        # The database computes each score from the document's stats as they are now
+        result = await self.db[kind].update_many(window, _score_pipeline(kind))
+        return result.matched_count
+
+    async def rescore_all(self) -> Dict[str, int]:
+        return {kind: await self.rescore(kind) for kind in ENGAGEMENT_WEIGHTS}
+
+    # ===== READ PATH =====
+
+    async def top(self, kind: str, limit: int = 20, query: Optional[dict] = None,
+                  days: int = TRENDING_WINDOW_DAYS) -> List[Dict]:
+        """Highest-scoring recent content - one indexed read"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        return await self.db[kind].find(
+            {**(query or {}), "createdAt": {"$gte": cutoff}}, {"_id": 0}
+        ).sort([("engagementScore", -1), ("createdAt", -1)]).limit(limit).to_list(limit)
@@ -0,0 +1,158 @@
+"""
+Image Pipeline - Responsive image derivatives for Loopync
+Generates resized WebP/JPEG variants (thumb/feed/full) for uploaded images on
+the image offload pool, stores them content-addressed in the media store, and
+picks the best variant for a request from ?w= and the Accept header.
+"""
+
+import logging
+from io import BytesIO
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from cpu_offload import image_pool
+
+logger = logging.getLogger(__name__)
+
+# Variant name -> max width in pixels (aspect ratio preserved, never upscaled).
+# The original is always kept; "full" only caps the size of re-encoded copies.
+VARIANT_WIDTHS = {"thumb": 160, "feed": 720, "full": 1440}
+VARIANT_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+VARIANT_QUALITY = {"webp": 80, "jpeg": 82}
+
+# Sources above this size are served as-is rather than decoded in memory
+MAX_SOURCE_BYTES = 25 * 1024 * 1024
+
+# Animated/vector formats are left untouched
+DERIVABLE_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp"}
+
+def render_variants(data: bytes) -> List[Dict]:
+    """
+    Decode an image and encode every variant (runs in a worker process).
+    Returns [{name, format, width, height, scaled, data}]; `scaled` is False
+    for variants at the source's own width.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(data)) as src:
+        img = ImageOps.exif_transpose(src)
+        if img.mode in ("RGBA", "LA", "P"):
+            # WebP keeps transparency; only JPEG is flattened onto white
+            img = img.convert("RGBA")
+            flat = Image.new("RGB", img.size, (255, 255, 255))
+            flat.paste(img, mask=img.getchannel("A"))
+            sources = {"webp": img, "jpeg": flat}
+        else:
+            img = img.convert("RGB")
+            sources = {"webp": img, "jpeg": img}
+
+        variants = []
+        for name, max_width in VARIANT_WIDTHS.items():
+            scaled = img.width > max_width
+            height = max(1, round(img.height * max_width / img.width)) if scaled else img.height
+            for fmt in VARIANT_FORMATS:
+                resized = sources[fmt]
+                if scaled:
+                    resized = resized.resize((max_width, height), Image.LANCZOS)
+                out = BytesIO()
+                resized.save(out, format=fmt.upper(), quality=VARIANT_QUALITY[fmt], optimize=True)
+                variants.append({
+                    "name": name,
+                    "format": fmt,
+                    "width": resized.width,
+                    "height": resized.height,
+                    "scaled": scaled,
+                    "data": out.getvalue()
+                })
+        return variants
+
+
+def is_derivable(media_doc: dict) -> bool:
+    return (media_doc.get("content_type") in DERIVABLE_TYPES
+            and media_doc.get("storage_type") == "gridfs"
+            and media_doc.get("file_size", 0) <= MAX_SOURCE_BYTES)
+
+
+class ImagePipeline:
+    def __init__(self, db, media_store):
+        self.db = db
+        self.media_store = media_store
+
+    async def generate(self, media_doc: dict) -> List[Dict]:
+        """
+        Build (or reuse) variants for a media document and attach them to it.
+        Variants are keyed by the source hash, so re-uploads of the same image
+        reuse the already-rendered set.
+        """
+        if not is_derivable(media_doc):
+            return []
+
+        source_sha = media_doc["sha256"]
+        variants = await self.db.media_variants.find(
+            {"sourceSha256": source_sha}, {"_id": 0}
+        ).to_list(len(VARIANT_WIDTHS) * len(VARIANT_FORMATS))
+
+        if not variants:
+            try:
+                data = await self.media_store.read_all(media_doc["blob_id"])
+                rendered = await image_pool.run(render_variants, data)
+            except Exception as e:
+                logger.warning(f"⚠️ Image derivatives failed for {media_doc['id']}: {e}")
+                return []
+
+            now = datetime.now(timezone.utc).isoformat()
+            for item in rendered:
+                blob = await self.media_store.save_bytes(item["data"], VARIANT_FORMATS[item["format"]])
+                variants.append({
+                    "sourceSha256": source_sha,
+                    "name": item["name"],
+                    "format": item["format"],
+                    "width": item["width"],
+                    "height": item["height"],
+                    "scaled": item["scaled"],
+                    "blobId": blob["blobId"],
+                    "sha256": blob["sha256"],
+                    "size": blob["size"],
+                    "createdAt": now
+                })
+            for v in variants:
+                await self.db.media_variants.update_one(
+                    {"sourceSha256": source_sha, "name": v["name"], "format": v["format"]},
+                    {"$setOnInsert": v},
+                    upsert=True
+                )
+
+        slim = [{k: v.get(k) for k in ("name", "format", "width", "height", "scaled", "blobId", "sha256", "size")}
+                for v in variants]
+        await self.db.media_files.update_one({"id": media_doc["id"]}, {"$set": {"variants": slim}})
+        logger.info(f"✅ Image variants ready for {media_doc['id']} ({len(slim)})")
+        return slim
+
+
+def select_variant(variants: List[Dict], width: Optional[int], accept: Optional[str],
+                   source_type: Optional[str] = None) -> Optional[Dict]:
+    """
+    Pick the smallest downscaled variant at least `width` wide, in WebP when
+    the client accepts it. Without a width (or wider than every downscaled
+    variant) only a full-resolution WebP re-encode of a non-WebP original is
+    used. Returns None to serve the original.
+    """
+    if not variants:
+        return None
+    webp = "image/webp" in (accept or "")
+    if not width and not webp:
+        return None
+
+    fmt = "webp" if webp else "jpeg"
+    candidates = sorted((v for v in variants if v["format"] == fmt), key=lambda v: v["width"])
+    if width:
+        for v in candidates:
+            # Variants stored before `scaled` was recorded count as downscaled
+            if v.get("scaled", True) and v["width"] >= width:
+                return v
+
+    if webp and source_type != "image/webp":
+        for v in candidates:
+            if v.get("scaled") is False:
+                return v
+    return None
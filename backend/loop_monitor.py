@@ -0,0 +1,222 @@
+"""
+Loop Monitor - Event-loop lag and stall detection for Loopync
+A heartbeat task measures how late the loop schedules it (loop lag). A
+watchdog thread notices when the heartbeat is overdue, samples the loop
+thread's Python stack and the request it is serving, and every lag above
+the threshold is recorded as a stall with the route it blocked in and its
+most common stack. Switchable at runtime; when disabled nothing runs.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+from metrics import Histogram, escape_label, histogram_lines
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_ENABLED = os.environ.get("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+
+# Heartbeat period and the lag that counts as a stall (seconds)
+HEARTBEAT_INTERVAL = 0.1
+STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD_MS", 100)) / 1000
+
+# How often the watchdog samples the loop thread while it is blocked
+SAMPLE_INTERVAL = 0.02
+
+# Frames kept per stack sample (innermost)
+STACK_DEPTH = 12
+
+MAX_RECENT_STALLS = 100
+MAX_SAMPLES_PER_STALL = 250
+
+
+class LoopMonitor:
+    def __init__(self, threshold: float = STALL_THRESHOLD, interval: float = HEARTBEAT_INTERVAL):
+        self.enabled = False
+        self.threshold = threshold
+        self.interval = interval
+
+        self.lag = Histogram()
+        self.stall_count = 0
+        self.stall_seconds = 0.0
+        self.by_route: Dict[str, Dict] = {}
+        self.recent: deque = deque(maxlen=MAX_RECENT_STALLS)
+
+        # Request scopes by the task serving them (maintained by LoopMonitorMiddleware)
+        self.active: Dict[asyncio.Task, dict] = {}
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._last_beat = 0.0
+        self._samples: List[tuple] = []
+        self._samples_lock = threading.Lock()
+
+    # ===== LIFECYCLE =====
+
+    def start(self) -> None:
+        """Start monitoring the running loop (call from inside it)"""
+        if self.enabled:
+            return
+        self.enabled = True
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        # A fresh event per start, so a watchdog from before a quick stop/start still exits
+        self._stop = threading.Event()
+        self._heartbeat_task = self._loop.create_task(self._heartbeat(), name="loop-monitor-heartbeat")
+        self._watchdog = threading.Thread(target=self._watch, args=(self._stop,),
+                                          name="loop-monitor-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"✅ Loop monitor started (stall threshold {self.threshold * 1000:.0f}ms)")
+
+    def stop(self) -> None:
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        self._watchdog = None
+        self.active.clear()
+
+    def configure(self, enabled: Optional[bool] = None, threshold_ms: Optional[float] = None) -> Dict:
+        """Runtime switch (admin endpoint); must be called from the loop"""
+        if threshold_ms is not None:
+            self.threshold = max(threshold_ms, 1) / 1000
+        if enabled is True:
+            self.start()
+        elif enabled is False:
+            self.stop()
+        return {"enabled": self.enabled, "threshold_ms": round(self.threshold * 1000, 1)}
+
+    # ===== DETECTION =====
+
+    async def _heartbeat(self):
+        while True:
+            scheduled = time.monotonic()
+            self._last_beat = scheduled
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - scheduled - self.interval, 0.0)
+            self.lag.observe(lag)
+            with self._samples_lock:
+                samples, self._samples = self._samples, []
+            if lag >= self.threshold:
+                self._record_stall(lag, samples)
+
+    def _watch(self, stop: threading.Event):
+        """Watchdog thread: sample the loop thread's stack while the heartbeat is overdue"""
+        while not stop.wait(SAMPLE_INTERVAL):
+            overdue = time.monotonic() - self._last_beat - self.interval
+            if overdue < self.threshold / 2:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = tuple(
+                f"{os.path.basename(f.filename)}:{f.lineno} {f.name}"
+                for f in traceback.extract_stack(frame, limit=STACK_DEPTH)
+            )
+            sample = (self._current_label(), stack)
+            with self._samples_lock:
+                if len(self._samples) < MAX_SAMPLES_PER_STALL:
+                    self._samples.append(sample)
+
+    def _current_label(self) -> str:
+        task = asyncio.current_task(self._loop)
+        if task is None:
+            return "callback"
+        scope = self.active.get(task)
+        if scope is None:
+            return f"task:{task.get_name()}"
+        route = getattr(scope.get("route"), "path", None) or scope.get("path", "")
+        return f"{scope.get('method', '')} {route}"
+
+    def _record_stall(self, lag: float, samples: List[tuple]) -> None:
+        labels = Counter(label for label, _ in samples)
+        stacks = Counter(stack for _, stack in samples)
+        route = labels.most_common(1)[0][0] if labels else "unknown"
+        stack, hits = stacks.most_common(1)[0] if stacks else ((), 0)
+
+        stall = {
+            "at": time.time(),
+            "lag_ms": round(lag * 1000, 1),
+            "route": route,
+            "samples": len(samples),
+            "stack": list(stack),
+            "stack_share": round(hits / len(samples), 2) if samples else 0,
+        }
+        self.stall_count += 1
+        self.stall_seconds += lag
+        entry = self.by_route.setdefault(route, {"stalls": 0, "seconds": 0.0, "max_ms": 0.0})
+        entry["stalls"] += 1
+        entry["seconds"] += lag
+        entry["max_ms"] = max(entry["max_ms"], stall["lag_ms"])
+        self.recent.append(stall)
+
+        logger.warning("⚠️ Event loop stall " + json.dumps({
+            "lag_ms": stall["lag_ms"], "route": route, "frame": stack[-1] if stack else None,
+        }))
+
+    # ===== REPORTING =====
+
+    def summary(self) -> Dict:
+        top = sorted(self.by_route.items(), key=lambda kv: kv[1]["seconds"], reverse=True)[:10]
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": round(self.threshold * 1000, 1),
+            "lag": self.lag.summary(),
+            "stalls": self.stall_count,
+            "stall_seconds": round(self.stall_seconds, 3),
+            "top_routes": [{"route": r, **v, "seconds": round(v["seconds"], 3)} for r, v in top],
+        }
+
+    def snapshot(self, limit: int = 20) -> Dict:
+        return {**self.summary(), "recent": list(self.recent)[-limit:][::-1]}
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP loopync_event_loop_lag_seconds Event loop scheduling delay",
+            "# TYPE loopync_event_loop_lag_seconds histogram",
+        ]
+        lines += histogram_lines("loopync_event_loop_lag_seconds", 'loop="main"', self.lag)
+        lines += [
+            "# HELP loopync_event_loop_stalls_total Event loop stalls above the threshold by route",
+            "# TYPE loopync_event_loop_stalls_total counter",
+        ]
+        for route, v in sorted(self.by_route.items()):
+            lines.append(f'loopync_event_loop_stalls_total{{route="{escape_label(route)}"}} {v["stalls"]}')
+        return "\n".join(lines) + "\n"
+
+
+class LoopMonitorMiddleware:
+    """Pure ASGI middleware: tells the monitor which request each task is serving"""
+
+    def __init__(self, app, monitor: LoopMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.monitor.enabled:
+            return await self.app(scope, receive, send)
+        task = asyncio.current_task()
+        self.monitor.active[task] = scope
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.monitor.active.pop(task, None)
+
+
+# Global monitor (started at app startup when LOOP_MONITOR_ENABLED)
+loop_monitor = LoopMonitor()
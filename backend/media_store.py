@@ -0,0 +1,141 @@
+"""
+Media Store - Chunked, content-addressed media storage for Loopync
+Uploads are streamed into GridFS in fixed-size chunks and deduplicated by
+SHA-256 (unique across the bucket); reads (including HTTP Range requests) only touch the chunks they need.
+"""
+
+import hashlib
+import logging
+from typing import AsyncIterator, Optional, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+MEDIA_BUCKET = "media"
+CHUNK_SIZE = 255 * 1024          # GridFS chunk size (default, fits well under 16MB docs)
+READ_SIZE = 1024 * 1024          # Bytes pulled from the upload per step
+STREAM_SIZE = 256 * 1024         # Bytes sent per response body part
+
+
+class MediaTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured size limit"""
+
+    def __init__(self, size: int, max_bytes: int):
+        self.size = size
+        self.max_bytes = max_bytes
+        super().__init__(f"File too large ({size / (1024 * 1024):.2f}MB+). "
+                         f"Maximum size is {max_bytes // (1024 * 1024)}MB")
+
+
+def parse_range_header(range_header: Optional[str], file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range "bytes=start-end" / "bytes=-suffix" header.
+    Returns an inclusive (start, end) tuple, or None when absent/unsatisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes=") or file_size <= 0:
+        return None
+    spec = range_header[len("bytes="):].split(",")[0].strip()
+    start_s, _, end_s = spec.partition("-")
+    try:
+        if not start_s:
+            # Suffix range: last N bytes
+            length = int(end_s)
+            if length <= 0:
+                return None
+            return max(0, file_size - length), file_size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size or end < start:
+        return None
+    return start, min(end, file_size - 1)
+
+
+class MediaStore:
+    def __init__(self, db, bucket_name: str = MEDIA_BUCKET):
+        self.db = db
+        self.files = db[f"{bucket_name}.files"]
+        self.chunks = db[f"{bucket_name}.chunks"]
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name, chunk_size_bytes=CHUNK_SIZE)
+
+    async def save_upload(self, upload, max_bytes: int) -> dict:
+        """
+        Stream an UploadFile into GridFS without holding it in memory.
+        Identical content is stored once; returns blob metadata
+        ({blobId, sha256, size, deduped}).
+        """
+        # Pass 1: hash and size-check (Starlette spools large uploads to disk)
+        digest = hashlib.sha256()
+        size = 0
+        while True:
+            chunk = await upload.read(READ_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise MediaTooLargeError(size, max_bytes)
+            digest.update(chunk)
+        sha256 = digest.hexdigest()
+
+        existing = await self.files.find_one({"metadata.sha256": sha256}, {"_id": 1})
+        if existing:
+            logger.info(f"Media dedupe hit {sha256[:12]} ({size} bytes)")
+            return {"blobId": str(existing["_id"]), "sha256": sha256, "size": size, "deduped": True}
+
+        # Pass 2: stream the spooled file into GridFS chunk by chunk
+        await upload.seek(0)
+        blob_id, deduped = await self._put(sha256, upload.file, upload.content_type)
+        return {"blobId": blob_id, "sha256": sha256, "size": size, "deduped": deduped}
+
+    async def save_bytes(self, data: bytes, content_type: str) -> dict:
+        """Store an in-memory blob (e.g. a generated derivative), deduplicated by hash"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        existing = await self.files.find_one({"metadata.sha256": sha256}, {"_id": 1})
+        if existing:
+            return {"blobId": str(existing["_id"]), "sha256": sha256, "size": len(data), "deduped": True}
+
+        blob_id, deduped = await self._put(sha256, data, content_type)
+        return {"blobId": blob_id, "sha256": sha256, "size": len(data), "deduped": deduped}
+
+    async def _put(self, sha256: str, source, content_type: Optional[str]) -> Tuple[str, bool]:
+        """
+        Upload under a file id we choose, so a concurrent upload of the same
+        content (rejected by the unique metadata.sha256 index) can drop its
+        own chunks and reuse the winner. Returns (blobId, deduped).
+        """
+        file_id = ObjectId()
+        try:
+            await self.bucket.upload_from_stream_with_id(
+                file_id, sha256, source, metadata={"sha256": sha256, "contentType": content_type}
+            )
+        except DuplicateKeyError:
+            await self.chunks.delete_many({"files_id": file_id})
+            existing = await self.files.find_one({"metadata.sha256": sha256}, {"_id": 1})
+            if existing is None:
+                raise
+            logger.info(f"Media dedupe race {sha256[:12]}, reusing existing blob")
+            return str(existing["_id"]), True
+        return str(file_id), False
+
+    async def read_all(self, blob_id: str) -> bytes:
+        """Read a whole blob into memory (only for bounded-size blobs)"""
+        grid_out = await self.bucket.open_download_stream(ObjectId(blob_id))
+        return await grid_out.read()
+
+    async def stream(self, blob_id: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Yield bytes start..end (inclusive) reading only the chunks that cover them"""
+        grid_out = await self.bucket.open_download_stream(ObjectId(blob_id))
+        if end is None:
+            end = grid_out.length - 1
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await grid_out.read(min(STREAM_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
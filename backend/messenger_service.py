@@ -4,6 +4,7 @@ Handles: DMs, Real-time messaging, Audio/Video calls, Media sharing, AI assistan
 """
 
 import os
+import re
 import uuid
 import logging
 from datetime import datetime, timezone
@@ -12,6 +13,7 @@ from fastapi import HTTPException
 from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+from performance import get_user_loader
 
 logger = logging.getLogger(__name__)
 
@@ -169,11 +171,12 @@ class MessengerService:
             "participants": user_id
         }, {"_id": 0}).sort("lastMessageAt", -1).to_list(100)
         
-        # Enrich with participant info
-        for thread in threads:
+        # Enrich with participant info (one batched lookup)
+        other_ids = [[p for p in t["participants"] if p != user_id][0] for t in threads]
+        other_users = await get_user_loader(self.db).load_many(other_ids)
+        for thread, other_user_id in zip(threads, other_ids):
             # Get other participant
-            other_user_id = [p for p in thread["participants"] if p != user_id][0]
-            other_user = await self.db.users.find_one({"id": other_user_id}, {"_id": 0})
+            other_user = other_users.get(other_user_id)
             
             if other_user:
                 thread["otherUser"] = {
@@ -207,8 +210,9 @@ class MessengerService:
         messages.reverse()
         
         # Enrich with sender info
+        senders = await get_user_loader(self.db).load_many([m["senderId"] for m in messages])
         for message in messages:
-            sender = await self.db.users.find_one({"id": message["senderId"]}, {"_id": 0})
+            sender = senders.get(message["senderId"])
             if sender:
                 message["sender"] = {
                     "id": sender["id"],
@@ -353,13 +357,14 @@ class MessengerService:
         # Search messages
         messages = await self.db.messages.find({
             "threadId": {"$in": thread_ids},
-            "text": {"$regex": query, "$options": "i"},
+            "text": {"$regex": re.escape(query), "$options": "i"},
             "deleted": {"$ne": True}
         }, {"_id": 0}).sort("createdAt", -1).limit(limit).to_list(limit)
         
         # Enrich with sender info
+        senders = await get_user_loader(self.db).load_many([m["senderId"] for m in messages])
         for message in messages:
-            sender = await self.db.users.find_one({"id": message["senderId"]}, {"_id": 0})
+            sender = senders.get(message["senderId"])
             if sender:
                 message["sender"] = {
                     "id": sender["id"],
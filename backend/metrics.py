@@ -0,0 +1,336 @@
+"""
+Metrics - Per-route latency histograms and MongoDB command instrumentation for Loopync
+An ASGI middleware times every request against its route template, and a
+pymongo command listener attributes each database round trip to the request
+that issued it and to a normalized query shape. Exposed as JSON via
+/api/performance/stats and as Prometheus text via /api/performance/metrics.
+"""
+
+import json
+import time
+import bisect
+import threading
+from typing import Dict, List, Tuple
+
+from pymongo import monitoring
+
+from performance import current_request_stats
+
+# Histogram bucket upper bounds (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Cap on distinct query shapes tracked (new shapes beyond this are counted as "other")
+MAX_QUERY_SHAPES = 500
+
+# Per-request command log cap while a request is being profiled
+MAX_PROFILED_COMMANDS = 200
+
+# Commands that are driver housekeeping, not application queries
+IGNORED_COMMANDS = {
+    "hello", "ismaster", "isMaster", "ping", "buildinfo", "buildInfo", "endSessions",
+    "saslStart", "saslContinue", "getnonce", "authenticate", "killCursors",
+}
+
+# Where each command keeps its filter
+_FILTER_FIELDS = {
+    "find": "filter", "count": "query", "distinct": "query", "findAndModify": "query",
+}
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (Prometheus-compatible)"""
+
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def summary(self) -> Dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 2) if self.count else 0,
+            "p50_ms": round(self.quantile(0.50) * 1000, 2),
+            "p95_ms": round(self.quantile(0.95) * 1000, 2),
+            "p99_ms": round(self.quantile(0.99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class RouteStats:
+    __slots__ = ("latency", "statuses", "db_commands", "db_seconds", "response_bytes")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses: Dict[str, int] = {}
+        self.db_commands = 0
+        self.db_seconds = 0.0
+        self.response_bytes = 0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.routes: Dict[Tuple[str, str], RouteStats] = {}
+        self.shapes: Dict[Tuple[str, str, str], Histogram] = {}
+        self.commands: Dict[Tuple[str, str], Histogram] = {}
+        # Command callbacks arrive on Motor's executor threads
+        self._lock = threading.Lock()
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float,
+                        db_commands: int, db_seconds: float, response_bytes: int) -> None:
+        stats = self.routes.get((method, route))
+        if stats is None:
+            stats = self.routes.setdefault((method, route), RouteStats())
+        stats.latency.observe(seconds)
+        status_class = f"{status // 100}xx"
+        stats.statuses[status_class] = stats.statuses.get(status_class, 0) + 1
+        stats.db_commands += db_commands
+        stats.db_seconds += db_seconds
+        stats.response_bytes += response_bytes
+
+    def observe_command(self, command: str, collection: str, shape: str, seconds: float) -> None:
+        with self._lock:
+            key = (command, collection)
+            if key not in self.commands:
+                self.commands[key] = Histogram()
+            self.commands[key].observe(seconds)
+
+            shape_key = (command, collection, shape)
+            if shape_key not in self.shapes:
+                if len(self.shapes) >= MAX_QUERY_SHAPES:
+                    shape_key = (command, collection, "other")
+                self.shapes.setdefault(shape_key, Histogram())
+            self.shapes[shape_key].observe(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.routes.clear()
+            self.shapes.clear()
+            self.commands.clear()
+
+    # ===== JSON =====
+
+    def route_snapshot(self, limit: int = 25) -> List[Dict]:
+        """Routes ordered by total time spent in them"""
+        ranked = sorted(self.routes.items(), key=lambda kv: kv[1].latency.sum, reverse=True)
+        return [{
+            "method": method,
+            "route": route,
+            **stats.latency.summary(),
+            "total_s": round(stats.latency.sum, 3),
+            "statuses": dict(stats.statuses),
+            "db_calls_per_request": round(stats.db_commands / max(stats.latency.count, 1), 2),
+            "db_ms_per_request": round(stats.db_seconds / max(stats.latency.count, 1) * 1000, 2),
+            "bytes_per_response": round(stats.response_bytes / max(stats.latency.count, 1)),
+        } for (method, route), stats in ranked[:limit]]
+
+    def query_snapshot(self, limit: int = 20) -> List[Dict]:
+        """Query shapes ordered by their slowest observed p95"""
+        with self._lock:
+            items = list(self.shapes.items())
+        ranked = sorted(items, key=lambda kv: kv[1].quantile(0.95), reverse=True)
+        return [{
+            "command": command, "collection": collection, "shape": shape, **hist.summary()
+        } for (command, collection, shape), hist in ranked[:limit]]
+
+    # ===== PROMETHEUS =====
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP loopync_http_request_duration_seconds Request latency by route",
+            "# TYPE loopync_http_request_duration_seconds histogram",
+        ]
+        for (method, route), stats in sorted(self.routes.items()):
+            labels = f'method="{escape_label(method)}",route="{escape_label(route)}"'
+            lines += histogram_lines("loopync_http_request_duration_seconds", labels, stats.latency)
+
+        lines += [
+            "# HELP loopync_http_responses_total Responses by route and status class",
+            "# TYPE loopync_http_responses_total counter",
+        ]
+        for (method, route), stats in sorted(self.routes.items()):
+            for status_class, n in sorted(stats.statuses.items()):
+                lines.append(
+                    f'loopync_http_responses_total{{method="{escape_label(method)}",route="{escape_label(route)}",'
+                    f'status="{status_class}"}} {n}'
+                )
+
+        for name, help_text, attr in (
+            ("loopync_http_db_commands_total", "MongoDB round trips issued by route", "db_commands"),
+            ("loopync_http_db_seconds_total", "Time spent in MongoDB by route", "db_seconds"),
+            ("loopync_http_response_bytes_total", "Response body bytes serialized by route", "response_bytes"),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (method, route), stats in sorted(self.routes.items()):
+                lines.append(
+                    f'{name}{{method="{escape_label(method)}",route="{escape_label(route)}"}} {_num(getattr(stats, attr))}'
+                )
+
+        lines += [
+            "# HELP loopync_mongo_command_duration_seconds MongoDB command latency by collection",
+            "# TYPE loopync_mongo_command_duration_seconds histogram",
+        ]
+        with self._lock:
+            commands = sorted(self.commands.items())
+        for (command, collection), hist in commands:
+            labels = f'command="{escape_label(command)}",collection="{escape_label(collection)}"'
+            lines += histogram_lines("loopync_mongo_command_duration_seconds", labels, hist)
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _num(value: float) -> str:
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+def histogram_lines(name: str, labels: str, hist: Histogram) -> List[str]:
+    lines, cumulative = [], 0
+    for bound, n in zip(LATENCY_BUCKETS, hist.counts):
+        cumulative += n
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+    lines.append(f"{name}_sum{{{labels}}} {_num(hist.sum)}")
+    lines.append(f"{name}_count{{{labels}}} {hist.count}")
+    return lines
+
+
+# ===== QUERY SHAPES =====
+
+def _shape(value):
+    """Keep field names and operators, drop the literal values"""
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_shape(v) for v in value[:1]] if value and isinstance(value[0], dict) else "?"
+    return "?"
+
+
+def query_shape(command_name: str, command: dict) -> str:
+    """Normalized, value-free description of a command's filter and sort"""
+    if command_name in _FILTER_FIELDS:
+        query = command.get(_FILTER_FIELDS[command_name]) or {}
+    elif command_name in ("update", "delete"):
+        ops = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        query = ops[0].get("q") or {}
+    elif command_name == "aggregate":
+        stages = command.get("pipeline") or []
+        query = next((s["$match"] for s in stages if "$match" in s), {})
+        stages_desc = ",".join(next(iter(s)) for s in stages)
+        return json.dumps({"pipeline": stages_desc, "match": _shape(query)}, sort_keys=True, default=str)
+    else:
+        return command_name
+    shape = {"filter": _shape(query)}
+    if command.get("sort"):
+        shape["sort"] = dict(command["sort"])
+    return json.dumps(shape, sort_keys=True, default=str)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command; charges it to the current request and its query shape"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._inflight: Dict[Tuple, Tuple[str, str, str]] = {}
+
+    def started(self, event):
+        name = event.command_name
+        if name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(name)
+        if name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            return
+        try:
+            shape = query_shape(name, event.command)
+        except Exception:
+            shape = name
+        self._inflight[(event.connection_id, event.request_id)] = (name, collection, shape)
+
+    def _finish(self, event):
+        key = self._inflight.pop((event.connection_id, event.request_id), None)
+        if key is None:
+            return
+        seconds = event.duration_micros / 1_000_000
+        self.registry.observe_command(*key, seconds)
+        stats = current_request_stats()
+        if stats is not None:
+            stats.db_commands += 1
+            stats.db_seconds += seconds
+            if stats.commands is not None and len(stats.commands) < MAX_PROFILED_COMMANDS:
+                stats.commands.append((*key, seconds))
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+
+class RequestMetricsMiddleware:
+    """Pure ASGI middleware: latency, status, DB calls and response bytes per route template"""
+
+    def __init__(self, app, registry: MetricsRegistry, on_request=None):
+        self.app = app
+        self.registry = registry
+        self.on_request = on_request
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        body_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal status, body_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                body_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the (shared) scope
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            stats = current_request_stats()
+            self.registry.observe_request(
+                scope.get("method", "GET"), route, status, time.perf_counter() - started,
+                stats.db_commands if stats else 0, stats.db_seconds if stats else 0.0, body_bytes
+            )
+            if self.on_request:
+                self.on_request()
+
+
+# Global registry and listener (the listener is passed to AsyncIOMotorClient)
+metrics_registry = MetricsRegistry()
+mongo_command_listener = MongoCommandListener(metrics_registry)
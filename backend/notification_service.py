@@ -0,0 +1,336 @@
+"""
+Notification Service - Batched notification pipeline for Loopync
+Request handlers enqueue notifications and return; a background worker
+batch-writes them, coalesces bursts on the same target ("X and 41 others
+liked your post") into one document, stores an actor snapshot on each
+notification so reads need no hydration, and keeps a per-user unread counter.
+"""
+
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Batching
+BATCH_SIZE = 500
+FLUSH_INTERVAL_SECONDS = 0.25
+MAX_QUEUE_SIZE = 50000
+
+# Coalescing: unread notifications of these types on the same target merge.
+# A group stays open (openGroup set, unique per user) until it is read, goes
+# quiet for COALESCE_WINDOW or fills up; the next burst then starts a new one.
+COALESCE_WINDOW = timedelta(hours=6)
+MAX_GROUP_ACTORS = 1000
+RECENT_ACTORS = 3
+COALESCE_VERBS = {
+    "post_like": "liked your post",
+    "reel_like": "liked your reel",
+    "new_follower": "started following you",
+}
+
+ACTOR_FIELDS = ("id", "name", "handle", "avatar", "isVerified")
+ACTOR_PROJECTION = {"_id": 0, **{f: 1 for f in ACTOR_FIELDS}}
+
+# Never returned to clients
+HIDDEN_FIELDS = {"_id": 0, "actorIds": 0, "openGroup": 0}
+
+
+def actor_snapshot(user: Optional[dict]) -> Optional[dict]:
+    """The slice of a user embedded in notifications"""
+    if not user:
+        return None
+    return {
+        "id": user.get("id", ""),
+        "name": user.get("name", "Unknown"),
+        "handle": user.get("handle", "user"),
+        "avatar": user.get("avatar", ""),
+        "isVerified": user.get("isVerified", False),
+    }
+
+
+def group_key(doc: dict) -> Optional[str]:
+    """Coalescing key, or None if the notification stands alone"""
+    if doc.get("type") not in COALESCE_VERBS or not doc.get("fromUserId"):
+        return None
+    return f"{doc['type']}:{doc.get('contentType', '')}:{doc.get('contentId', '')}"
+
+
+def _coalesce_update(docs: List[dict], now: str) -> list:
+    """Pipeline update folding a burst (newest first) into the open group document"""
+    latest = docs[0]
+    actors = list({d["fromUser"]["id"]: d["fromUser"] for d in docs}.values())[:RECENT_ACTORS]
+    actor_ids = list(dict.fromkeys(d["fromUserId"] for d in docs))
+    verb = COALESCE_VERBS[latest["type"]]
+    name = latest["fromUser"]["name"]
+    return [
+        {"$set": {
+            "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+            "type": latest["type"],
+            "groupKey": latest["groupKey"],
+            # Open groups are unread by construction (reading one closes it)
+            "read": {"$ifNull": ["$read", False]},
+            "contentType": latest.get("contentType", ""),
+            "contentId": latest.get("contentId", ""),
+            "link": {"$literal": latest.get("link", "")},
+            "payload": {"$literal": latest.get("payload", {})},
+            "actorIds": {"$setUnion": [{"$ifNull": ["$actorIds", []]}, {"$literal": actor_ids}]},
+            "actors": {"$slice": [{"$concatArrays": [
+                {"$literal": actors},
+                {"$filter": {
+                    "input": {"$ifNull": ["$actors", []]},
+                    "cond": {"$not": [{"$in": ["$$this.id", {"$literal": actor_ids}]}]}
+                }}
+            ]}, RECENT_ACTORS]},
+            "fromUser": {"$literal": latest["fromUser"]},
+            "fromUserId": latest["fromUserId"],
+            "fromUserName": {"$literal": name},
+            "fromUserAvatar": {"$literal": latest["fromUser"]["avatar"]},
+            "createdAt": now,
+            "updatedAt": now,
+        }},
+        {"$set": {"actorCount": {"$size": "$actorIds"}}},
+        {"$set": {"message": {"$cond": [
+            {"$gt": ["$actorCount", 1]},
+            {"$concat": [
+                {"$literal": name}, " and ", {"$toString": {"$subtract": ["$actorCount", 1]}},
+                {"$cond": [{"$eq": ["$actorCount", 2]}, " other ", " others "]}, {"$literal": verb}
+            ]},
+            {"$literal": f"{name} {verb}"}
+        ]}}},
+    ]
+
+
+class NotificationPipeline:
+    def __init__(self, db, emit: Optional[Callable[[str, str, dict], Awaitable]] = None):
+        self.db = db
+        self.emit = emit
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"enqueued": 0, "written": 0, "coalesced": 0, "batches": 0, "dropped": 0}
+
+    # ===== PRODUCER =====
+
+    def enqueue(self, notification: dict, emit: bool = False) -> None:
+        """Queue a notification for the next batch (never blocks the request)"""
+        self.start()
+        notification = dict(notification)
+        notification.pop("_id", None)
+        notification.setdefault("id", str(uuid.uuid4()))
+        notification.setdefault("read", False)
+        notification.setdefault("createdAt", datetime.now(timezone.utc).isoformat())
+        try:
+            self._queue.put_nowait((notification, emit))
+            self.stats["enqueued"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning(f"Notification queue full, dropping {notification.get('type')} for {notification.get('userId')}")
+
+    # ===== WORKER =====
+
+    def start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Let the worker flush whatever is queued, then stop it"""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Notification queue not drained on shutdown ({self._queue.qsize()} left)")
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+
+    def _drain(self, limit: int) -> List[Tuple[dict, bool]]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                # Let a burst accumulate so it is written (and coalesced) together
+                await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+                batch += self._drain(BATCH_SIZE - 1)
+                await self._flush(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification batch of {len(batch)} failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[Tuple[dict, bool]]) -> None:
+        if not batch:
+            return
+        docs = [doc for doc, _ in batch]
+        emit_to = {doc["id"] for doc, emit in batch if emit}
+        await self._attach_actors(docs)
+
+        singles: List[dict] = []
+        groups: Dict[Tuple[str, str], List[dict]] = defaultdict(list)
+        for doc in docs:
+            key = group_key(doc) if doc.get("fromUser") else None
+            if key:
+                groups[(doc["userId"], key)].append(doc)
+            else:
+                singles.append(doc)
+
+        new_unread: Dict[str, int] = defaultdict(int)
+        if singles:
+            await self.db.notifications.insert_many(singles, ordered=False)
+            for doc in singles:
+                doc.pop("_id", None)
+                if not doc.get("read"):
+                    new_unread[doc["userId"]] += 1
+
+        group_list = list(groups.items())
+        if group_list:
+            now = datetime.now(timezone.utc)
+            since = (now - COALESCE_WINDOW).isoformat()
+            # Close groups that went quiet or filled up so the upsert starts a new one
+            await self.db.notifications.bulk_write([
+                UpdateOne(
+                    {"userId": user_id, "openGroup": key,
+                     "$or": [{"createdAt": {"$lt": since}}, {"actorCount": {"$gte": MAX_GROUP_ACTORS}}]},
+                    {"$unset": {"openGroup": ""}}
+                ) for (user_id, key), _ in group_list
+            ], ordered=False)
+            # (userId, openGroup) is unique, so concurrent workers fold into one document
+            result = await self.db.notifications.bulk_write([
+                UpdateOne(
+                    {"userId": user_id, "openGroup": key},
+                    # Newest first within the burst
+                    _coalesce_update(sorted(group, key=lambda d: d["createdAt"], reverse=True), now.isoformat()),
+                    upsert=True
+                ) for (user_id, key), group in group_list
+            ], ordered=False)
+            for index in result.upserted_ids:
+                new_unread[group_list[index][0][0]] += 1
+            self.stats["coalesced"] += len(docs) - len(singles) - len(group_list)
+
+        if new_unread:
+            await self.db.notification_counters.bulk_write([
+                UpdateOne({"userId": user_id}, {"$inc": {"unread": n}}, upsert=True)
+                for user_id, n in new_unread.items()
+            ], ordered=False)
+
+        self.stats["written"] += len(singles) + len(group_list)
+        self.stats["batches"] += 1
+
+        if self.emit:
+            await self._emit(singles, group_list, emit_to)
+
+    async def _attach_actors(self, docs: List[dict]) -> None:
+        """Embed actor snapshots (one users query per batch)"""
+        for doc in docs:
+            if doc.get("fromUser") or doc.get("fromUserId"):
+                continue
+            payload = doc.get("payload") or {}
+            actor = payload.get("fromUser") or payload.get("sender")
+            if isinstance(actor, dict) and actor.get("id"):
+                doc["fromUser"] = actor_snapshot(actor)
+                doc["fromUserId"] = actor["id"]
+
+        missing = {d["fromUserId"] for d in docs if d.get("fromUserId") and not d.get("fromUser")}
+        users = {}
+        if missing:
+            users = {u["id"]: u async for u in self.db.users.find({"id": {"$in": list(missing)}}, ACTOR_PROJECTION)}
+        for doc in docs:
+            if doc.get("fromUserId") and not doc.get("fromUser"):
+                doc["fromUser"] = actor_snapshot(users.get(doc["fromUserId"]) or {
+                    "id": doc["fromUserId"], "name": doc.get("fromUserName") or "Unknown",
+                    "avatar": doc.get("fromUserAvatar", "")
+                })
+            if doc.get("fromUser"):
+                doc["fromUserName"] = doc.get("fromUserName") or doc["fromUser"]["name"]
+                doc["fromUserAvatar"] = doc.get("fromUserAvatar") or doc["fromUser"]["avatar"]
+            key = group_key(doc)
+            if key:
+                doc["groupKey"] = key
+
+    async def _emit(self, singles: List[dict], group_list: list, emit_to: set) -> None:
+        for doc in singles:
+            if doc["id"] in emit_to:
+                await self.emit(doc["userId"], "notification", doc)
+        wanted = [(user_id, key) for (user_id, key), group in group_list
+                  if any(d["id"] in emit_to for d in group)]
+        if not wanted:
+            return
+        async for doc in self.db.notifications.find(
+            {"$or": [{"userId": u, "openGroup": k} for u, k in wanted]}, HIDDEN_FIELDS
+        ):
+            if (doc["userId"], doc["groupKey"]) in wanted:
+                wanted.remove((doc["userId"], doc["groupKey"]))
+                await self.emit(doc["userId"], "notification", doc)
+
+    # ===== READ STATE / UNREAD COUNTER =====
+
+    async def unread_count(self, user_id: str) -> int:
+        counter = await self.db.notification_counters.find_one({"userId": user_id}, {"_id": 0, "unread": 1})
+        if counter is None:
+            return await self.recount(user_id)
+        return max(0, counter.get("unread", 0))
+
+    async def recount(self, user_id: str) -> int:
+        """Reset the counter from the notifications themselves"""
+        unread = await self.db.notifications.count_documents({"userId": user_id, "read": False})
+        await self.db.notification_counters.update_one(
+            {"userId": user_id}, {"$set": {"unread": unread}}, upsert=True
+        )
+        return unread
+
+    async def _decrement(self, user_id: str) -> None:
+        await self.db.notification_counters.update_one(
+            {"userId": user_id},
+            [{"$set": {"unread": {"$max": [0, {"$subtract": [{"$ifNull": ["$unread", 0]}, 1]}]}}}]
+        )
+
+    async def mark_read(self, notification_id: str) -> bool:
+        doc = await self.db.notifications.find_one_and_update(
+            {"id": notification_id, "read": False},
+            {"$set": {"read": True, "readAt": datetime.now(timezone.utc).isoformat()},
+             "$unset": {"openGroup": ""}},
+            projection={"_id": 0, "userId": 1}
+        )
+        if doc:
+            await self._decrement(doc["userId"])
+        return doc is not None
+
+    async def mark_all_read(self, user_id: str) -> int:
+        result = await self.db.notifications.update_many(
+            {"userId": user_id, "read": False},
+            {"$set": {"read": True, "readAt": datetime.now(timezone.utc).isoformat()},
+             "$unset": {"openGroup": ""}}
+        )
+        await self.recount(user_id)
+        return result.modified_count
+
+    async def delete(self, notification_id: str) -> bool:
+        doc = await self.db.notifications.find_one_and_delete(
+            {"id": notification_id}, projection={"_id": 0, "userId": 1, "read": 1}
+        )
+        if doc and not doc.get("read"):
+            await self._decrement(doc["userId"])
+        return doc is not None
+
+    async def delete_for_content(self, content_type: str, content_id: str) -> int:
+        """Drop notifications about deleted content, keeping unread counters right"""
+        query = {"contentId": content_id, "contentType": content_type}
+        affected = await self.db.notifications.distinct("userId", {**query, "read": False})
+        result = await self.db.notifications.delete_many(query)
+        for user_id in affected:
+            await self.recount(user_id)
+        return result.deleted_count
@@ -4,11 +4,15 @@ Handles caching, query optimization, and high-throughput operations
 Designed for 30k+ users and 100k+ requests/minute
 """
 
+import os
 import asyncio
 import time
 import hashlib
 import json
-from typing import Optional, List, Dict, Any, Callable
+import base64
+import contextvars
+import uuid
+from typing import Optional, List, Dict, Any, Awaitable, Callable
 from functools import wraps
 from datetime import datetime, timezone, timedelta
 from collections import OrderedDict
@@ -16,76 +20,347 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-# ========== IN-MEMORY LRU CACHE ==========
+# ========== TWO-TIER CACHE ==========
+# L1: per-process LRU (no locks - every operation completes without awaiting,
+# so it is atomic on the event loop). L2: shared Redis, attached at startup via
+# start_cache_tier(); when absent the caches behave as plain L1 caches.
+# Deletes/clears are broadcast over pub/sub so every worker drops its L1 copy.
+# Groups of keys that are invalidated together (feed pages, list pages) are
+# written with a tag; delete_tag() drops them by an explicit key set instead of
+# a SCAN over the keyspace.
+
+CACHE_INVALIDATION_CHANNEL = "loopync:cache:invalidate"
+CACHE_NODE_ID = uuid.uuid4().hex
+
+_cache_redis = None
+_cache_listener: Optional[asyncio.Task] = None
+
+# Invalidation listener reconnect backoff (seconds)
+CACHE_LISTENER_BACKOFF_MIN = 0.5
+CACHE_LISTENER_BACKOFF_MAX = 30.0
+_cache_registry: Dict[str, "LRUCache"] = {}
+
+
+def _dumps(value: Any) -> bytes:
+    try:
+        import orjson
+        return orjson.dumps(value)
+    except ImportError:
+        return json.dumps(value).encode()
+
+
+def _loads(data) -> Any:
+    try:
+        import orjson
+        return orjson.loads(data)
+    except ImportError:
+        return json.loads(data)
+
+
 class LRUCache:
-    """Thread-safe LRU Cache with TTL support"""
+    """Two-tier LRU cache with TTL: in-process L1 + optional shared Redis L2"""
     
-    def __init__(self, max_size: int = 10000, default_ttl: int = 300):
+    def __init__(self, max_size: int = 10000, default_ttl: int = 300, name: Optional[str] = None):
         self.max_size = max_size
         self.default_ttl = default_ttl
+        self.name = name or f"cache{len(_cache_registry)}"
         self.cache: OrderedDict = OrderedDict()
         self.expiry: Dict[str, float] = {}
-        self._lock = asyncio.Lock()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._tags: Dict[str, set] = {}
+        self._key_tags: Dict[str, str] = {}
+        self.metrics = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "sets": 0,
+                        "evictions": 0, "invalidations": 0, "coalesced": 0, "l2_errors": 0}
+        _cache_registry[self.name] = self
+    
+    # ----- L1 (synchronous, never yields to the loop) -----
+    def _l1_get(self, key: str) -> Optional[Any]:
+        if key not in self.cache:
+            return None
+        if time.time() > self.expiry.get(key, 0):
+            self._l1_forget(key)
+            return None
+        self.cache.move_to_end(key)
+        return self.cache[key]
+    
+    def _l1_forget(self, key: str) -> None:
+        self.cache.pop(key, None)
+        self.expiry.pop(key, None)
+        tag = self._key_tags.pop(key, None)
+        if tag is not None:
+            members = self._tags.get(tag)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del self._tags[tag]
+    
+    def _l1_set(self, key: str, value: Any, ttl: int, tag: Optional[str] = None) -> None:
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        while len(self.cache) >= self.max_size and key not in self.cache:
+            oldest_key = next(iter(self.cache))
+            self._l1_forget(oldest_key)
+            self.metrics["evictions"] += 1
+        self.cache[key] = value
+        self.expiry[key] = time.time() + ttl
+        if tag is not None:
+            self._key_tags[key] = tag
+            self._tags.setdefault(tag, set()).add(key)
+    
+    def _l1_delete_prefix(self, prefix: str) -> int:
+        keys = [k for k in self.cache if k.startswith(prefix)]
+        for key in keys:
+            self._l1_forget(key)
+        return len(keys)
+    
+    def _l1_drop(self, op: str, key: str = "", members: List[str] = ()) -> None:
+        """Apply an invalidation locally (also used for remote broadcasts)"""
+        if op == "del":
+            self._l1_forget(key)
+        elif op == "tag":
+            # Keys tagged here plus the shared tag set (copies loaded from L2 carry no tag)
+            for member in list(self._tags.get(key, ())) + list(members):
+                self._l1_forget(member)
+        elif op == "prefix":
+            self._l1_delete_prefix(key)
+        elif op == "clear":
+            self.cache.clear()
+            self.expiry.clear()
+            self._tags.clear()
+            self._key_tags.clear()
+    
+    def _l2_key(self, key: str) -> str:
+        return f"cache:{self.name}:{key}"
     
+    def _l2_tag_key(self, tag: str) -> str:
+        return f"cachetag:{self.name}:{tag}"
+    
+    # ----- Public interface -----
     async def get(self, key: str) -> Optional[Any]:
-        async with self._lock:
-            if key not in self.cache:
-                return None
-            
-            # Check expiry
-            if key in self.expiry and time.time() > self.expiry[key]:
-                del self.cache[key]
-                del self.expiry[key]
-                return None
-            
-            # Move to end (most recently used)
-            self.cache.move_to_end(key)
-            return self.cache[key]
-    
-    async def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
-        async with self._lock:
-            ttl = ttl or self.default_ttl
-            
-            # Remove oldest if at capacity
-            while len(self.cache) >= self.max_size:
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
-                self.expiry.pop(oldest_key, None)
-            
-            self.cache[key] = value
-            self.expiry[key] = time.time() + ttl
+        value = self._l1_get(key)
+        if value is not None:
+            self.metrics["l1_hits"] += 1
+            return value
+        
+        if _cache_redis is not None:
+            try:
+                pipe = _cache_redis.pipeline(transaction=False)
+                pipe.get(self._l2_key(key))
+                pipe.pttl(self._l2_key(key))
+                data, pttl = await pipe.execute()
+                if data is not None:
+                    value = _loads(data)
+                    ttl = max(1, int(pttl / 1000)) if pttl and pttl > 0 else self.default_ttl
+                    self._l1_set(key, value, min(ttl, self.default_ttl))
+                    self.metrics["l2_hits"] += 1
+                    return value
+            except Exception as e:
+                self.metrics["l2_errors"] += 1
+                logger.debug(f"L2 get failed for {self.name}:{key}: {e}")
+        
+        self.metrics["misses"] += 1
+        return None
+    
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None, tag: Optional[str] = None) -> None:
+        """Store a value; keys written with a tag can be dropped together by delete_tag()"""
+        ttl = ttl or self.default_ttl
+        self._l1_set(key, value, ttl, tag)
+        self.metrics["sets"] += 1
+        if _cache_redis is not None:
+            try:
+                if tag is None:
+                    await _cache_redis.set(self._l2_key(key), _dumps(value), ex=ttl)
+                else:
+                    # The tag set lives as long as its newest member
+                    pipe = _cache_redis.pipeline(transaction=False)
+                    pipe.set(self._l2_key(key), _dumps(value), ex=ttl)
+                    pipe.sadd(self._l2_tag_key(tag), self._l2_key(key))
+                    pipe.expire(self._l2_tag_key(tag), ttl)
+                    await pipe.execute()
+            except Exception as e:
+                self.metrics["l2_errors"] += 1
+                logger.debug(f"L2 set failed for {self.name}:{key}: {e}")
+    
+    async def get_or_set(self, key: str, loader: Callable, ttl: Optional[int] = None,
+                         tag: Optional[str] = None) -> Any:
+        """
+        Return the cached value or compute it with `loader()`. Concurrent misses
+        for the same key share one loader call (single-flight). The load runs in
+        its own task, so a cancelled caller doesn't cancel it for the others.
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+        
+        task = self._inflight.get(key)
+        if task is not None:
+            self.metrics["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(self._load(key, loader, ttl, tag))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._load_done(key, t))
+        return await asyncio.shield(task)
+    
+    async def _load(self, key: str, loader: Callable, ttl: Optional[int], tag: Optional[str]) -> Any:
+        value = await loader()
+        if value is not None:
+            await self.set(key, value, ttl, tag)
+        return value
+    
+    def _load_done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark retrieved so a failure nobody waited on isn't logged as unretrieved
+        if not task.cancelled():
+            task.exception()
     
     async def delete(self, key: str) -> None:
-        async with self._lock:
-            self.cache.pop(key, None)
-            self.expiry.pop(key, None)
+        await self._invalidate("del", key)
+    
+    async def delete_tag(self, tag: str) -> None:
+        """Delete every key written with this tag"""
+        await self._invalidate("tag", tag)
     
     async def delete_pattern(self, pattern: str) -> int:
-        """Delete all keys matching pattern (simple prefix match)"""
-        async with self._lock:
-            keys_to_delete = [k for k in self.cache if k.startswith(pattern)]
-            for key in keys_to_delete:
-                del self.cache[key]
-                self.expiry.pop(key, None)
-            return len(keys_to_delete)
+        """
+        Delete all keys matching pattern (simple prefix match).
+        SCANs the shared tier - prefer tags for anything on a request path.
+        """
+        count = self._l1_delete_prefix(pattern)
+        await self._invalidate("prefix", pattern, local=False)
+        return count
     
     async def clear(self) -> None:
-        async with self._lock:
-            self.cache.clear()
-            self.expiry.clear()
+        await self._invalidate("clear")
+    
+    async def _invalidate(self, op: str, key: str = "", local: bool = True) -> None:
+        if local:
+            self._l1_drop(op, key)
+        self.metrics["invalidations"] += 1
+        if _cache_redis is None:
+            return
+        members = []
+        try:
+            if op == "del":
+                await _cache_redis.delete(self._l2_key(key))
+            elif op == "tag":
+                # Read and drop the tag set atomically so new members aren't lost
+                pipe = _cache_redis.pipeline(transaction=True)
+                pipe.smembers(self._l2_tag_key(key))
+                pipe.delete(self._l2_tag_key(key))
+                l2_members, _ = await pipe.execute()
+                if l2_members:
+                    await _cache_redis.delete(*l2_members)
+                    prefix = len(self._l2_key(""))
+                    members = [
+                        (m.decode() if isinstance(m, bytes) else m)[prefix:] for m in l2_members
+                    ]
+                    self._l1_drop("tag", key, members)
+            else:
+                match = self._l2_key(key) + "*" if op == "prefix" else self._l2_key("*")
+                batch = []
+                async for l2_key in _cache_redis.scan_iter(match=match, count=500):
+                    batch.append(l2_key)
+                    if len(batch) >= 500:
+                        await _cache_redis.delete(*batch)
+                        batch = []
+                if batch:
+                    await _cache_redis.delete(*batch)
+            await _cache_redis.publish(CACHE_INVALIDATION_CHANNEL, _dumps(
+                {"origin": CACHE_NODE_ID, "ns": self.name, "op": op, "key": key, "members": members}
+            ))
+        except Exception as e:
+            self.metrics["l2_errors"] += 1
+            logger.warning(f"⚠️ Cache invalidation broadcast failed for {self.name}: {e}")
     
-    def stats(self) -> Dict[str, int]:
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.metrics["l1_hits"] + self.metrics["l2_hits"] + self.metrics["misses"]
+        hits = self.metrics["l1_hits"] + self.metrics["l2_hits"]
         return {
             "size": len(self.cache),
-            "max_size": self.max_size
+            "max_size": self.max_size,
+            "hit_rate": f"{(hits / lookups * 100) if lookups else 0:.1f}%",
+            **self.metrics
         }
 
 
+async def _listen_for_invalidations() -> None:
+    """
+    Drop L1 entries invalidated by other workers. Resubscribes with backoff
+    when the connection drops; L1 is cleared after a reconnect because any
+    invalidations sent while disconnected were missed.
+    """
+    backoff = CACHE_LISTENER_BACKOFF_MIN
+    reconnecting = False
+    while True:
+        pubsub = _cache_redis.pubsub()
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            if reconnecting:
+                for cache in _cache_registry.values():
+                    cache._l1_drop("clear")
+                logger.info("✅ Cache invalidation listener reconnected")
+            backoff = CACHE_LISTENER_BACKOFF_MIN
+            reconnecting = True
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                try:
+                    event = _loads(message["data"])
+                    if event.get("origin") == CACHE_NODE_ID:
+                        continue
+                    cache = _cache_registry.get(event.get("ns"))
+                    if cache is not None:
+                        cache._l1_drop(event.get("op"), event.get("key", ""), event.get("members", ()))
+                except Exception as e:
+                    logger.warning(f"⚠️ Bad cache invalidation message: {e}")
+            raise ConnectionError("invalidation subscription closed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reconnecting = True
+            logger.warning(f"⚠️ Cache invalidation listener disconnected ({e}), retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, CACHE_LISTENER_BACKOFF_MAX)
+        finally:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+
+async def start_cache_tier(redis_url: Optional[str]) -> None:
+    """Attach the shared L2 and subscribe to invalidations (no-op without a URL)"""
+    global _cache_redis, _cache_listener
+    if not redis_url or _cache_redis is not None:
+        return
+    import redis.asyncio as aioredis
+    _cache_redis = aioredis.from_url(redis_url)
+    _cache_listener = asyncio.create_task(_listen_for_invalidations())
+    logger.info("✅ Cache tier: L1 in-process + L2 Redis with pub/sub invalidation")
+
+
+async def stop_cache_tier() -> None:
+    global _cache_redis, _cache_listener
+    if _cache_listener is not None:
+        _cache_listener.cancel()
+        _cache_listener = None
+    if _cache_redis is not None:
+        await _cache_redis.close()
+        _cache_redis = None
+
+
+def cache_stats() -> Dict[str, Dict]:
+    """Per-namespace cache metrics"""
+    return {name: cache.stats() for name, cache in _cache_registry.items()}
+
+
 # Global cache instances
-posts_cache = LRUCache(max_size=5000, default_ttl=60)  # Posts cached for 1 minute
-users_cache = LRUCache(max_size=10000, default_ttl=300)  # Users cached for 5 minutes
-trending_cache = LRUCache(max_size=100, default_ttl=120)  # Trending cached for 2 minutes
-feed_cache = LRUCache(max_size=2000, default_ttl=30)  # Feed cached for 30 seconds
+posts_cache = LRUCache(max_size=5000, default_ttl=60, name="posts")  # Posts cached for 1 minute
+users_cache = LRUCache(max_size=10000, default_ttl=300, name="users")  # Users cached for 5 minutes
+trending_cache = LRUCache(max_size=100, default_ttl=120, name="trending")  # Trending cached for 2 minutes
+feed_cache = LRUCache(max_size=2000, default_ttl=30, name="feed")  # Feed cached for 30 seconds
+principals_cache = LRUCache(max_size=20000, default_ttl=60, name="principals")  # Auth principals cached for 1 minute
 
 
 # ========== CACHE DECORATORS ==========
@@ -101,16 +376,8 @@ def cached(cache: LRUCache, prefix: str, ttl: Optional[int] = None):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             key = f"{prefix}:{cache_key(*args, **kwargs)}"
-            
-            # Try to get from cache
-            cached_value = await cache.get(key)
-            if cached_value is not None:
-                return cached_value
-            
-            # Execute function and cache result
-            result = await func(*args, **kwargs)
-            await cache.set(key, result, ttl)
-            return result
+            # Cache hit, or one shared execution for concurrent misses
+            return await cache.get_or_set(key, lambda: func(*args, **kwargs), ttl)
         return wrapper
     return decorator
 
@@ -165,13 +432,8 @@ async def batch_enrich_posts(db, posts: List[Dict]) -> List[Dict]:
     if not posts:
         return posts
     
-    # Collect all author IDs
-    author_ids = list(set(p.get("authorId") for p in posts if p.get("authorId")))
-    
-    # Batch fetch all authors
-    authors_map = await batch_get_users(db, author_ids, {
-        "id": 1, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1
-    })
+    # Batch fetch all authors through the request's user loader
+    authors_map = await get_user_loader(db).load_many([p.get("authorId") for p in posts])
     
     # Enrich posts
     for post in posts:
@@ -187,10 +449,7 @@ async def batch_enrich_comments(db, comments: List[Dict]) -> List[Dict]:
     if not comments:
         return comments
     
-    author_ids = list(set(c.get("authorId") for c in comments if c.get("authorId")))
-    authors_map = await batch_get_users(db, author_ids, {
-        "id": 1, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1
-    })
+    authors_map = await get_user_loader(db).load_many([c.get("authorId") for c in comments])
     
     for comment in comments:
         author_id = comment.get("authorId")
@@ -200,6 +459,288 @@ async def batch_enrich_comments(db, comments: List[Dict]) -> List[Dict]:
     return comments
 
 
+# ========== REQUEST-SCOPED USER LOADER ==========
+# Shared projection for every embedded user snapshot (authors, peers, actors)
+USER_SUMMARY_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1,
+    "isVerified": 1, "bio": 1, "online": 1, "accountType": 1
+}
+
+# Requests issuing more user queries than this are logged as likely N+1 regressions
+USER_QUERY_WARN_THRESHOLD = 5
+
+
+class RequestStats:
+    """Per-request query counters, reported by the request middleware"""
+
+    def __init__(self):
+        self.user_queries = 0
+        self.users_loaded = 0
+        self.loader: Optional["UserLoader"] = None
+        # Filled in by the MongoDB command listener (metrics.py)
+        self.db_commands = 0
+        self.db_seconds = 0.0
+        # Set to a list while the request is profiled (request_profiler.py)
+        self.commands: Optional[list] = None
+
+
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def begin_request_stats() -> RequestStats:
+    """Start a fresh stats scope for the current request"""
+    stats = RequestStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+class UserLoader:
+    """
+    DataLoader-style user hydrator.
+    All load() calls made in the same event-loop tick are coalesced into a
+    single $in query; results are memoized for the rest of the request.
+    """
+
+    def __init__(self, db, stats: Optional[RequestStats] = None):
+        self.db = db
+        self.stats = stats
+        self._results: Dict[str, Optional[Dict]] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._scheduled = False
+        # Strong references to in-flight fetches (the loop only keeps weak ones)
+        self._fetches: set = set()
+
+    def _enqueue(self, user_id: str) -> asyncio.Future:
+        future = self._pending.get(user_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            if user_id in self._results:
+                future.set_result(self._results[user_id])
+                return future
+            self._pending[user_id] = future
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(self._dispatch)
+        return future
+
+    async def load(self, user_id: Optional[str]) -> Optional[Dict]:
+        """Load one user; returns a copy so callers can mutate it safely"""
+        if not user_id:
+            return None
+        if user_id in self._results:
+            user = self._results[user_id]
+        else:
+            user = await self._enqueue(user_id)
+        return dict(user) if user else None
+
+    async def load_many(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """Load several users at once; returns user_id -> user copy for the ones found"""
+        unique_ids = [uid for uid in dict.fromkeys(user_ids) if uid]
+        users = await asyncio.gather(*(self._enqueue(uid) for uid in unique_ids))
+        return {uid: dict(user) for uid, user in zip(unique_ids, users) if user}
+
+    def _dispatch(self) -> None:
+        batch = self._pending
+        self._pending = {}
+        self._scheduled = False
+        task = asyncio.ensure_future(self._fetch(batch))
+        self._fetches.add(task)
+        task.add_done_callback(self._fetches.discard)
+
+    async def _fetch(self, batch: Dict[str, asyncio.Future]) -> None:
+        found: Dict[str, Dict] = {}
+        try:
+            missing = []
+            for uid in batch:
+                cached_user = await users_cache.get(f"user_summary:{uid}")
+                if cached_user is not None:
+                    found[uid] = cached_user
+                else:
+                    missing.append(uid)
+
+            if missing:
+                if self.stats:
+                    self.stats.user_queries += 1
+                async for user in self.db.users.find({"id": {"$in": missing}}, USER_SUMMARY_PROJECTION):
+                    found[user["id"]] = user
+                    await users_cache.set(f"user_summary:{user['id']}", user, ttl=300)
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.stats:
+            self.stats.users_loaded += len(found)
+        for uid, future in batch.items():
+            user = found.get(uid)
+            self._results[uid] = user
+            if not future.done():
+                future.set_result(user)
+
+
+def get_user_loader(db) -> UserLoader:
+    """Return the current request's user loader (or a standalone one outside requests)"""
+    stats = _request_stats.get()
+    if stats is None:
+        return UserLoader(db)
+    if stats.loader is None:
+        stats.loader = UserLoader(db, stats)
+    return stats.loader
+
+
+async def attach_users(db, items: List[Dict], id_key: str = "authorId", out_key: str = "author") -> List[Dict]:
+    """Set items[out_key] to the user snapshot for items[id_key] using one batched lookup"""
+    if not items:
+        return items
+    users_map = await get_user_loader(db).load_many([item.get(id_key) for item in items])
+    for item in items:
+        item[out_key] = users_map.get(item.get(id_key))
+    return items
+
+
+# ========== KEYSET (CURSOR) PAGINATION ==========
+class InvalidCursorError(ValueError):
+    """Raised when a client sends a malformed pagination cursor"""
+
+
+def encode_cursor(doc: Dict, sort_field: str = "createdAt") -> str:
+    """Encode an opaque cursor from the (sort_field, id) keyset of a document"""
+    raw = json.dumps([doc.get(sort_field), doc.get("id")], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    """
+    Decode an opaque cursor into (sort_value, id).
+    Empty and legacy integer cursors ("0") mean the first page.
+    """
+    if not cursor or cursor == "0":
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return value, doc_id
+    except Exception:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+
+
+def keyset_filter(query: Dict, cursor: Optional[str], sort_field: str = "createdAt") -> Dict:
+    """Combine a base query with the keyset condition for descending (sort_field, id) order"""
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        return query
+
+    value, doc_id = decoded
+    conditions = [
+        {sort_field: {"$lt": value}},
+        {sort_field: value, "id": {"$lt": doc_id}}
+    ]
+    if value is not None:
+        # Missing/null values sort last in descending order and never match $lt
+        conditions.append({sort_field: None})
+    after = {"$or": conditions}
+    return {"$and": [query, after]} if query else after
+
+
+async def paginate_keyset(
+    collection,
+    query: Dict,
+    projection: Dict = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    sort_field: str = "createdAt"
+) -> tuple:
+    """
+    Fetch one page ordered by (sort_field desc, id desc).
+    Returns (items, next_cursor) - next_cursor is None on the last page.
+    Cost is independent of page depth, unlike skip().
+    """
+    projection = projection if projection is not None else {"_id": 0}
+    items = await collection.find(
+        keyset_filter(query, cursor, sort_field), projection
+    ).sort([(sort_field, -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1], sort_field)
+    return items, next_cursor
+
+
+# ========== CONCURRENT QUERIES ==========
+# Per-query timeout for gather_queries (seconds)
+QUERY_TIMEOUT = float(os.environ.get("QUERY_TIMEOUT_MS", 5000)) / 1000
+
+
+class QueryTimeoutError(asyncio.TimeoutError):
+    """A required query in gather_queries ran past its timeout"""
+
+    def __init__(self, name: str, timeout: float):
+        super().__init__(f"Query '{name}' timed out after {timeout * 1000:.0f}ms")
+        self.name = name
+        self.timeout = timeout
+
+
+class GatherResult(dict):
+    """Results by query name; `failed` lists the optional queries that fell back"""
+
+    def __init__(self):
+        super().__init__()
+        self.failed: List[str] = []
+
+
+async def gather_queries(
+    queries: Dict[str, Awaitable],
+    fallbacks: Optional[Dict[str, Any]] = None,
+    timeout: float = QUERY_TIMEOUT
+) -> GatherResult:
+    """
+    Run independent queries concurrently, so a handler waits for the slowest
+    one instead of their sum. Each query gets its own timeout. Queries named in
+    `fallbacks` are optional: if they fail or time out, their fallback value is
+    used and they are listed in result.failed. A failing required query cancels
+    the others and its error is raised (QueryTimeoutError for timeouts). No
+    query outlives the call.
+    """
+    fallbacks = fallbacks or {}
+    tasks = {asyncio.ensure_future(asyncio.wait_for(aw, timeout)): name for name, aw in queries.items()}
+    result = GatherResult()
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                name = tasks[task]
+                error = task.exception()
+                if error is None:
+                    result[name] = task.result()
+                elif name in fallbacks:
+                    logger.warning(f"⚠️ Optional query '{name}' failed, using fallback: {error!r}")
+                    result[name] = fallbacks[name]
+                    result.failed.append(name)
+                elif isinstance(error, asyncio.TimeoutError):
+                    raise QueryTimeoutError(name, timeout) from error
+                else:
+                    raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return result
+
+
 # ========== OPTIMIZED QUERIES ==========
 async def get_feed_optimized(db, user_id: str, skip: int = 0, limit: int = 20) -> List[Dict]:
     """
@@ -229,7 +770,7 @@ async def get_feed_optimized(db, user_id: str, skip: int = 0, limit: int = 20) -
     posts = await batch_enrich_posts(db, posts)
     
     # Cache result
-    await feed_cache.set(cache_key, posts, ttl=30)
+    await feed_cache.set(cache_key, posts, ttl=30, tag=f"feed:{user_id}")
     
     return posts
 
@@ -244,17 +785,17 @@ async def get_trending_posts_optimized(db, limit: int = 20) -> List[Dict]:
     if cached:
         return cached
     
-    # Get trending posts (most liked in last 24 hours)
-    cutoff = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+    # Get trending posts (precomputed, time-decayed engagementScore)
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
     
     posts = await db.posts.find(
         {"createdAt": {"$gte": cutoff}},
         {"_id": 0}
-    ).sort("likeCount", -1).limit(limit).to_list(limit)
+    ).sort([("engagementScore", -1), ("createdAt", -1)]).limit(limit).to_list(limit)
     
     posts = await batch_enrich_posts(db, posts)
     
-    await trending_cache.set(cache_key, posts, ttl=120)
+    await trending_cache.set(cache_key, posts, ttl=120, tag="trending")
     
     return posts
 
@@ -263,7 +804,9 @@ async def get_trending_posts_optimized(db, limit: int = 20) -> List[Dict]:
 async def invalidate_user_cache(user_id: str) -> None:
     """Invalidate all caches related to a user"""
     await users_cache.delete(f"user:{user_id}")
-    await feed_cache.delete_pattern(f"feed:{user_id}")
+    await users_cache.delete(f"user_summary:{user_id}")
+    await principals_cache.delete(f"principal:{user_id}")
+    await feed_cache.delete_tag(f"feed:{user_id}")
 
 
 async def invalidate_post_cache(post_id: str = None, author_id: str = None) -> None:
@@ -271,9 +814,9 @@ async def invalidate_post_cache(post_id: str = None, author_id: str = None) -> N
     if post_id:
         await posts_cache.delete(f"post:{post_id}")
     if author_id:
-        await feed_cache.delete_pattern(f"feed:{author_id}")
-    # Clear trending as it might be affected
-    await trending_cache.clear()
+        await feed_cache.delete_tag(f"feed:{author_id}")
+    # Drop trending as it might be affected
+    await trending_cache.delete_tag("trending")
 
 
 # ========== RESPONSE COMPRESSION ==========
@@ -292,31 +835,43 @@ class PerformanceMonitor:
     
     def __init__(self):
         self.request_count = 0
-        self.cache_hits = 0
-        self.cache_misses = 0
         self.start_time = time.time()
+        self.user_queries = 0
+        self.users_loaded = 0
+        self.max_user_queries = {"path": None, "count": 0}
     
     def record_request(self):
         self.request_count += 1
     
-    def record_cache_hit(self):
-        self.cache_hits += 1
-    
-    def record_cache_miss(self):
-        self.cache_misses += 1
+    def record_request_queries(self, path: str, stats: "RequestStats"):
+        """Accumulate a finished request's user-query counters"""
+        self.user_queries += stats.user_queries
+        self.users_loaded += stats.users_loaded
+        if stats.user_queries > self.max_user_queries["count"]:
+            self.max_user_queries = {"path": path, "count": stats.user_queries}
+        if stats.user_queries > USER_QUERY_WARN_THRESHOLD:
+            logger.warning(f"⚠️ {path} issued {stats.user_queries} user queries (possible N+1)")
     
     def get_stats(self) -> Dict:
         uptime = time.time() - self.start_time
         rps = self.request_count / uptime if uptime > 0 else 0
-        hit_rate = self.cache_hits / (self.cache_hits + self.cache_misses) if (self.cache_hits + self.cache_misses) > 0 else 0
+        caches = cache_stats()
+        cache_hits = sum(c["l1_hits"] + c["l2_hits"] for c in caches.values())
+        cache_misses = sum(c["misses"] for c in caches.values())
+        hit_rate = cache_hits / (cache_hits + cache_misses) if (cache_hits + cache_misses) > 0 else 0
         
         return {
             "uptime_seconds": round(uptime, 2),
             "total_requests": self.request_count,
             "requests_per_second": round(rps, 2),
             "cache_hit_rate": f"{hit_rate * 100:.1f}%",
-            "cache_hits": self.cache_hits,
-            "cache_misses": self.cache_misses,
+            "cache_hits": cache_hits,
+            "cache_misses": cache_misses,
+            "user_queries": self.user_queries,
+            "users_loaded": self.users_loaded,
+            "max_user_queries_per_request": self.max_user_queries,
+            "cache_tier": "l1+l2" if _cache_redis is not None else "l1",
+            "caches": caches,
             "posts_cache": posts_cache.stats(),
             "users_cache": users_cache.stats(),
             "feed_cache": feed_cache.stats()
@@ -327,65 +882,8 @@ class PerformanceMonitor:
 perf_monitor = PerformanceMonitor()
 
 
-# ========== DATABASE INDEX RECOMMENDATIONS ==========
-RECOMMENDED_INDEXES = [
-    {"collection": "posts", "index": [("authorId", 1), ("createdAt", -1)]},
-    {"collection": "posts", "index": [("createdAt", -1)]},
-    {"collection": "posts", "index": [("likeCount", -1)]},
-    {"collection": "posts", "index": [("hashtags", 1)]},
-    {"collection": "users", "index": [("id", 1)], "unique": True},
-    {"collection": "users", "index": [("email", 1)], "unique": True},
-    {"collection": "users", "index": [("handle", 1)]},
-    {"collection": "threads", "index": [("participants", 1)]},
-    {"collection": "messages", "index": [("threadId", 1), ("createdAt", -1)]},
-    {"collection": "notifications", "index": [("userId", 1), ("createdAt", -1)]},
-    {"collection": "tribes", "index": [("id", 1)]},
-    {"collection": "capsules", "index": [("authorId", 1), ("expiresAt", -1)]},
-]
-
-
+# ========== DATABASE INDEXES ==========
 async def ensure_indexes(db) -> None:
-    """Create recommended indexes for optimal performance"""
-    for idx_config in RECOMMENDED_INDEXES:
-        collection = idx_config["collection"]
-        index = idx_config["index"]
-        unique = idx_config.get("unique", False)
-        
-        try:
-            await db[collection].create_index(index, unique=unique, background=True)
-            logger.info(f"Created index on {collection}: {index}")
-        except Exception as e:
-            logger.warning(f"Index creation warning for {collection}: {e}")
-
-
-# ========== RATE LIMITING ==========
-class RateLimiter:
-    """Simple in-memory rate limiter"""
-    
-    def __init__(self, requests_per_minute: int = 100000):
-        self.requests_per_minute = requests_per_minute
-        self.requests: Dict[str, List[float]] = {}
-        self._lock = asyncio.Lock()
-    
-    async def is_allowed(self, client_id: str) -> bool:
-        """Check if request is allowed"""
-        async with self._lock:
-            now = time.time()
-            minute_ago = now - 60
-            
-            # Clean old requests
-            if client_id in self.requests:
-                self.requests[client_id] = [t for t in self.requests[client_id] if t > minute_ago]
-            else:
-                self.requests[client_id] = []
-            
-            # Check limit
-            if len(self.requests[client_id]) >= self.requests_per_minute:
-                return False
-            
-            self.requests[client_id].append(now)
-            return True
-
-
-# Global rate limiter - 100k+ requests per minute
-rate_limiter = RateLimiter(requests_per_minute=100000)
+    """Create missing indexes (the manifest lives in db_indexes.INDEX_MANIFEST)"""
+    from db_indexes import apply_indexes
+    await apply_indexes(db)
@@ -0,0 +1,152 @@
+"""
+Presence Service - Realtime presence registry for Loopync
+Tracks which Socket.IO sids belong to which user (several devices per user)
+with a reverse sid -> userId index. The in-process store serves a single
+worker and tests; the Redis store is shared by every worker/node.
+"""
+
+import os
+import logging
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Redis key layout
+USER_SIDS_KEY = "presence:user:{}"   # SET of sids for a user
+SID_USER_KEY = "presence:sid:{}"     # STRING userId for a sid
+ONLINE_USERS_KEY = "presence:online"  # SET of user ids with at least one sid
+
+# A sid whose node died without a disconnect expires after this long
+# unless it is refreshed by a client heartbeat or other socket activity
+PRESENCE_SID_TTL = int(os.environ.get("PRESENCE_SID_TTL", 24 * 3600))
+
+# Pub/sub channel shared by all Socket.IO nodes
+SOCKETIO_CHANNEL = os.environ.get("SOCKETIO_CHANNEL", "loopync-socketio")
+
+
+class LocalPresenceStore:
+    """In-process presence store (single worker, dev and tests)"""
+
+    def __init__(self):
+        self._user_sids: Dict[str, Set[str]] = {}
+        self._sid_user: Dict[str, str] = {}
+
+    async def add(self, user_id: str, sid: str) -> None:
+        self._sid_user[sid] = user_id
+        self._user_sids.setdefault(user_id, set()).add(sid)
+
+    async def remove(self, sid: str) -> Optional[str]:
+        """Drop a sid, returning the user it belonged to"""
+        user_id = self._sid_user.pop(sid, None)
+        if user_id is not None:
+            sids = self._user_sids.get(user_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._user_sids[user_id]
+        return user_id
+
+    async def touch(self, sid: str, user_id: Optional[str] = None) -> None:
+        if user_id is not None and sid not in self._sid_user:
+            await self.add(user_id, sid)
+
+    async def get_user(self, sid: str) -> Optional[str]:
+        return self._sid_user.get(sid)
+
+    async def get_sids(self, user_id: str) -> Set[str]:
+        return set(self._user_sids.get(user_id, ()))
+
+    async def is_online(self, user_id: str) -> bool:
+        return bool(self._user_sids.get(user_id))
+
+    async def online_users(self) -> List[str]:
+        return list(self._user_sids.keys())
+
+
+class RedisPresenceStore:
+    """Presence store shared across workers via Redis"""
+
+    def __init__(self, redis, sid_ttl: int = PRESENCE_SID_TTL):
+        self.redis = redis
+        self.sid_ttl = sid_ttl
+
+    async def add(self, user_id: str, sid: str) -> None:
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(SID_USER_KEY.format(sid), user_id, ex=self.sid_ttl)
+        pipe.sadd(USER_SIDS_KEY.format(user_id), sid)
+        pipe.sadd(ONLINE_USERS_KEY, user_id)
+        await pipe.execute()
+
+    async def remove(self, sid: str) -> Optional[str]:
+        """Drop a sid, returning the user it belonged to"""
+        user_id = await self.redis.getdel(SID_USER_KEY.format(sid))
+        if user_id is None:
+            return None
+        user_id = _decode(user_id)
+        await self.redis.srem(USER_SIDS_KEY.format(user_id), sid)
+        await self._drop_if_offline(user_id)
+        return user_id
+
+    async def touch(self, sid: str, user_id: Optional[str] = None) -> None:
+        """
+        Refresh a live sid's TTL. If the sid already expired while its socket
+        stayed connected, re-register it for user_id.
+        """
+        refreshed = await self.redis.expire(SID_USER_KEY.format(sid), self.sid_ttl)
+        if not refreshed and user_id is not None:
+            await self.add(user_id, sid)
+
+    async def get_user(self, sid: str) -> Optional[str]:
+        user_id = await self.redis.get(SID_USER_KEY.format(sid))
+        return _decode(user_id) if user_id is not None else None
+
+    async def get_sids(self, user_id: str) -> Set[str]:
+        sids = [_decode(s) for s in await self.redis.smembers(USER_SIDS_KEY.format(user_id))]
+        if not sids:
+            return set()
+
+        # Prune sids left behind by nodes that died without a disconnect
+        owners = await self.redis.mget([SID_USER_KEY.format(s) for s in sids])
+        live = {sid for sid, owner in zip(sids, owners) if owner is not None}
+        stale = [sid for sid in sids if sid not in live]
+        if stale:
+            await self.redis.srem(USER_SIDS_KEY.format(user_id), *stale)
+            await self._drop_if_offline(user_id)
+        return live
+
+    async def is_online(self, user_id: str) -> bool:
+        return bool(await self.get_sids(user_id))
+
+    async def online_users(self) -> List[str]:
+        return [_decode(u) for u in await self.redis.smembers(ONLINE_USERS_KEY)]
+
+    async def _drop_if_offline(self, user_id: str) -> None:
+        if not await self.redis.scard(USER_SIDS_KEY.format(user_id)):
+            await self.redis.srem(ONLINE_USERS_KEY, user_id)
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def create_presence_store(redis_url: Optional[str] = None):
+    """Redis-backed store when a URL is configured, in-process otherwise"""
+    if not redis_url:
+        return LocalPresenceStore()
+
+    import redis.asyncio as aioredis
+    logger.info("✅ Presence store: Redis")
+    return RedisPresenceStore(aioredis.from_url(redis_url, decode_responses=True))
+
+
+def create_client_manager(redis_url: Optional[str] = None):
+    """
+    Socket.IO client manager. With Redis, emits to a room are published on a
+    shared channel so users connected to other workers still receive them.
+    """
+    if not redis_url:
+        return None
+
+    import socketio
+    logger.info(f"✅ Socket.IO client manager: Redis pub/sub ({SOCKETIO_CHANNEL})")
+    return socketio.AsyncRedisManager(redis_url, channel=SOCKETIO_CHANNEL)
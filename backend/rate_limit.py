@@ -0,0 +1,303 @@
+"""
+Rate Limit Service - GCRA rate limiting with per-route policies for Loopync
+Each client key holds a single number (its theoretical arrival time), so memory
+is O(1) per client and a check is O(1). Decisions are made in-process without
+locks (checks never await), or atomically in Redis when REDIS_URL is set so all
+workers share one budget. The ASGI middleware rejects over-limit requests
+before routing, body parsing or any database work.
+"""
+
+import os
+import math
+import time
+import hashlib
+import logging
+import ipaddress
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.routing import compile_path
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_KEY_PREFIX = "loopync:ratelimit:"
+
+# Local store is swept of fully-recovered keys every SWEEP_INTERVAL checks once it holds SWEEP_MIN_KEYS
+SWEEP_INTERVAL = 1024
+SWEEP_MIN_KEYS = 10000
+
+# Distinct throttled keys remembered for the stats endpoint
+MAX_TRACKED_KEYS = 1000
+
+# Proxies whose X-Forwarded-For is believed (comma-separated IPs or CIDRs); empty = use the peer address
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(p.strip(), strict=False)
+    for p in os.environ.get("TRUSTED_PROXIES", "").split(",") if p.strip()
+]
+
+
+class RatePolicy:
+    """`rate` requests per `period` seconds, allowing bursts of up to `burst`"""
+
+    def __init__(self, name: str, rate: int, period: float = 60, burst: Optional[int] = None, key: str = "user"):
+        self.name = name
+        self.rate = rate
+        self.period = period
+        self.burst = burst or rate
+        self.key = key  # "ip" or "user" (verified bearer token subject, falling back to ip)
+        self.emission = period / rate
+        self.window = self.emission * self.burst
+
+
+POLICIES: Dict[str, RatePolicy] = {p.name: p for p in [
+    RatePolicy("auth", rate=10, burst=10, key="ip"),
+    RatePolicy("signup", rate=5, burst=5, key="ip"),
+    RatePolicy("uploads", rate=20, burst=5),
+    RatePolicy("search", rate=60, burst=20),
+    RatePolicy("dm_send", rate=60, burst=20),
+    RatePolicy("friend_requests", rate=30, burst=10),
+]}
+
+# (method, route template, policy) - templates as registered under /api
+ROUTE_POLICIES: List[Tuple[str, str, str]] = [
+    ("POST", "/api/auth/login", "auth"),
+    ("POST", "/api/auth/change-password", "auth"),
+    ("POST", "/api/auth/verify-email", "auth"),
+    ("POST", "/api/auth/resend-verification", "auth"),
+    ("POST", "/api/auth/forgot-password", "auth"),
+    ("POST", "/api/auth/verify-reset-code", "auth"),
+    ("POST", "/api/auth/reset-password", "auth"),
+    ("POST", "/api/auth/signup", "signup"),
+
+    ("POST", "/api/upload", "uploads"),
+    ("POST", "/api/videos/upload", "uploads"),
+    ("POST", "/api/verification/upload-document", "uploads"),
+
+    ("GET", "/api/search", "search"),
+    ("GET", "/api/search/all", "search"),
+    ("GET", "/api/search/verified", "search"),
+    ("GET", "/api/users/search", "search"),
+    ("GET", "/api/messenger/search", "search"),
+    ("GET", "/api/music/search", "search"),
+    ("GET", "/api/trainers/search", "search"),
+
+    ("POST", "/api/dm/thread", "dm_send"),
+    ("POST", "/api/dm/threads/{threadId}/messages", "dm_send"),
+    ("POST", "/api/dm/{threadId}/messages", "dm_send"),
+    ("POST", "/api/messenger/send", "dm_send"),
+    ("POST", "/api/messenger/start", "dm_send"),
+
+    ("POST", "/api/friends/request", "friend_requests"),
+    ("POST", "/api/friend-requests", "friend_requests"),
+    ("POST", "/api/users/{userId}/follow", "friend_requests"),
+    ("POST", "/api/users/{userId}/follow-request", "friend_requests"),
+]
+
+# Atomic GCRA step; uses the Redis clock so every worker agrees on "now"
+_GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local emission = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + emission
+local ahead = new_tat - now
+if ahead > window then
+    return {0, tostring(ahead - window)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil(ahead * 1000))
+return {1, tostring(window - ahead)}
+"""
+
+
+class RateLimiter:
+    def __init__(self, policies: Dict[str, RatePolicy] = POLICIES):
+        self.policies = policies
+        self._tat: Dict[str, float] = {}
+        self._checks = 0
+        self._redis = None
+        self._script = None
+        self.counts: Dict[str, Dict[str, int]] = {name: {"allowed": 0, "throttled": 0} for name in policies}
+        self.throttled_keys: Dict[str, int] = {}
+        self.redis_errors = 0
+
+    # ===== LIFECYCLE =====
+
+    async def start(self, redis_url: Optional[str]) -> None:
+        """Share budgets across workers through Redis (no-op without a URL)"""
+        if not redis_url or self._redis is not None:
+            return
+        import redis.asyncio as aioredis
+        self._redis = aioredis.from_url(redis_url)
+        self._script = self._redis.register_script(_GCRA_SCRIPT)
+        logger.info("✅ Rate limiter: shared GCRA state in Redis")
+
+    async def stop(self) -> None:
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+            self._script = None
+
+    # ===== DECISIONS =====
+
+    def _check_local(self, key: str, policy: RatePolicy) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tat = max(self._tat.get(key, now), now)
+        ahead = tat + policy.emission - now
+        if ahead > policy.window:
+            return False, ahead - policy.window
+        self._tat[key] = tat + policy.emission
+
+        self._checks += 1
+        if self._checks % SWEEP_INTERVAL == 0 and len(self._tat) >= SWEEP_MIN_KEYS:
+            self._tat = {k: v for k, v in self._tat.items() if v > now}
+        return True, policy.window - ahead
+
+    async def check(self, policy_name: str, client_key: str) -> Tuple[bool, float]:
+        """(allowed, seconds) - seconds is the retry delay when throttled, else the remaining budget"""
+        policy = self.policies[policy_name]
+        key = f"{policy_name}:{client_key}"
+        if self._script is not None:
+            try:
+                allowed, seconds = await self._script(keys=[RATE_LIMIT_KEY_PREFIX + key],
+                                                      args=[policy.emission, policy.window])
+                allowed, seconds = bool(int(allowed)), float(seconds)
+            except Exception as e:
+                # Degrade to per-worker limits rather than failing open or closed
+                self.redis_errors += 1
+                logger.warning(f"⚠️ Rate limiter Redis error, using local state: {e}")
+                allowed, seconds = self._check_local(key, policy)
+        else:
+            allowed, seconds = self._check_local(key, policy)
+
+        self.counts[policy_name]["allowed" if allowed else "throttled"] += 1
+        if not allowed and (key in self.throttled_keys or len(self.throttled_keys) < MAX_TRACKED_KEYS):
+            self.throttled_keys[key] = self.throttled_keys.get(key, 0) + 1
+        return allowed, seconds
+
+    # ===== METRICS =====
+
+    @property
+    def stats(self) -> Dict:
+        top = sorted(self.throttled_keys.items(), key=lambda kv: kv[1], reverse=True)[:10]
+        return {
+            "backend": "redis" if self._redis is not None else "local",
+            "tracked_keys": len(self._tat),
+            "redis_errors": self.redis_errors,
+            "policies": {name: {"rate": f"{p.rate}/{int(p.period)}s", "burst": p.burst, **self.counts[name]}
+                         for name, p in self.policies.items()},
+            "top_throttled": [{"key": mask_key(k), "throttled": n} for k, n in top],
+        }
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP loopync_rate_limit_decisions_total Rate limiter decisions by policy",
+            "# TYPE loopync_rate_limit_decisions_total counter",
+        ]
+        for name, counts in sorted(self.counts.items()):
+            for decision, n in sorted(counts.items()):
+                lines.append(f'loopync_rate_limit_decisions_total{{policy="{name}",decision="{decision}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+
+# ===== CLIENT IDENTITY =====
+
+def _trusted(address: str, proxies) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_ip(scope, trusted_proxies=None) -> str:
+    """
+    The peer address, unless the peer is a trusted proxy: then the right-most
+    X-Forwarded-For hop that is not itself a trusted proxy.
+    """
+    proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    if not proxies or not _trusted(peer, proxies):
+        return peer
+    for name, value in scope.get("headers", []):
+        if name == b"x-forwarded-for":
+            for hop in reversed(value.decode("latin-1").split(",")):
+                hop = hop.strip()
+                if hop and not _trusted(hop, proxies):
+                    return hop
+    return peer
+
+
+def client_key(scope, policy: RatePolicy, identify: Optional[Callable[[str], Optional[str]]] = None) -> str:
+    """Verified user id for "user" policies (via `identify`, token -> user id or None), else the client ip"""
+    if policy.key == "user" and identify is not None:
+        for name, value in scope.get("headers", []):
+            if name == b"authorization" and value[:7].lower() == b"bearer ":
+                user_id = identify(value[7:].decode("latin-1"))
+                if user_id:
+                    return "u:" + user_id
+                break
+    return "ip:" + client_ip(scope)
+
+
+def mask_key(key: str) -> str:
+    """policy:kind:digest - stats name hot keys without exposing ips or user ids"""
+    policy, _, rest = key.partition(":")
+    kind, _, identity = rest.partition(":")
+    return f"{policy}:{kind}:{hashlib.sha256(identity.encode()).hexdigest()[:12]}"
+
+
+class RateLimitMiddleware:
+    """Pure ASGI middleware applying ROUTE_POLICIES before the request reaches the router"""
+
+    def __init__(self, app, limiter: RateLimiter, routes: List[Tuple[str, str, str]] = ROUTE_POLICIES,
+                 identify: Optional[Callable[[str], Optional[str]]] = None):
+        self.app = app
+        self.limiter = limiter
+        self.identify = identify
+        self.exact: Dict[Tuple[str, str], RatePolicy] = {}
+        self.patterns: List[Tuple[str, object, RatePolicy]] = []
+        for method, template, policy_name in routes:
+            policy = limiter.policies[policy_name]
+            if "{" in template:
+                self.patterns.append((method, compile_path(template)[0], policy))
+            else:
+                self.exact[(method, template)] = policy
+
+    def _policy_for(self, method: str, path: str) -> Optional[RatePolicy]:
+        policy = self.exact.get((method, path.rstrip("/") or "/"))
+        if policy is not None:
+            return policy
+        for route_method, regex, route_policy in self.patterns:
+            if route_method == method and regex.match(path):
+                return route_policy
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        policy = self._policy_for(scope["method"], scope["path"])
+        if policy is None:
+            return await self.app(scope, receive, send)
+
+        allowed, seconds = await self.limiter.check(policy.name, client_key(scope, policy, self.identify))
+        if allowed:
+            return await self.app(scope, receive, send)
+
+        body = b'{"detail":"Too many requests, please slow down"}'
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(seconds))).encode()),
+                (b"x-ratelimit-policy", f"{policy.name};r={policy.rate};w={int(policy.period)};b={policy.burst}".encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+# Global rate limiter (shared state attached at startup via start())
+rate_limiter = RateLimiter()
@@ -0,0 +1,281 @@
+"""
+Request Profiler - Opt-in wall-clock profiles of individual requests for Loopync
+A request is profiled when it carries a valid signed X-Profile header (issued
+by an admin) or is picked by the runtime sampling rate. While it runs, a
+sampler thread records every few milliseconds either the loop thread's stack
+(the request's task is executing) or the task's coroutine await chain (it is
+waiting on I/O), so the profile covers wall-clock time across awaits. The
+profile - top frames, folded stacks, MongoDB calls, route and latency - is
+stored in request_profiles for admins to list and download.
+"""
+
+import os
+import sys
+import hmac
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+import traceback
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from performance import current_request_stats
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+
+# Sampler period (seconds)
+SAMPLE_INTERVAL = 0.005
+
+# Sampled (not header-requested) profiles are only kept for requests at least this slow
+PROFILE_MIN_MS = float(os.environ.get("PROFILE_MIN_MS", 200))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+PROFILE_RETENTION_DAYS = 7
+MAX_CONCURRENT_PROFILES = 8
+MAX_STACK_DEPTH = 40
+MAX_FOLDED_STACKS = 500
+MAX_MONGO_CALLS = 200
+TOP_FRAMES = 30
+
+# Listing fields (the stacks are only returned by the download endpoint)
+SUMMARY_FIELDS = {"_id": 0, "folded": 0, "topFrames": 0, "mongo.calls": 0, "expiresAt": 0}
+
+
+def _frame_label(filename: str, lineno: int, name: str) -> str:
+    return f"{name} ({os.path.basename(filename)}:{lineno})"
+
+
+class _Profile:
+    __slots__ = ("task", "started", "stacks", "on_loop", "awaiting")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.started = time.perf_counter()
+        self.stacks: Counter = Counter()
+        self.on_loop = 0
+        self.awaiting = 0
+
+
+class RequestProfiler:
+    def __init__(self, db, secret: str, sample_rate: float = PROFILE_SAMPLE_RATE, min_ms: float = PROFILE_MIN_MS):
+        self.db = db
+        self._secret = secret.encode()
+        self.sample_rate = sample_rate
+        self.min_ms = min_ms
+        self.active: Dict[asyncio.Task, _Profile] = {}
+        self.stored = 0
+        self.skipped = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    # ===== OPT-IN =====
+
+    def issue_token(self, ttl_seconds: int = 600) -> Dict:
+        """Value for the X-Profile header, valid for ttl_seconds"""
+        expires = int(time.time()) + ttl_seconds
+        signature = hmac.new(self._secret, str(expires).encode(), hashlib.sha256).hexdigest()
+        return {"header": "X-Profile", "value": f"{expires}.{signature}", "expiresAt": expires}
+
+    def _valid_token(self, value: bytes) -> bool:
+        expires, _, signature = value.decode("latin-1").partition(".")
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        expected = hmac.new(self._secret, expires.encode(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature, expected)
+
+    def trigger_for(self, scope) -> Optional[str]:
+        for name, value in scope.get("headers", []):
+            if name == PROFILE_HEADER:
+                return "header" if self._valid_token(value) else None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def configure(self, sample_rate: Optional[float] = None, min_ms: Optional[float] = None) -> Dict:
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if min_ms is not None:
+            self.min_ms = max(min_ms, 0.0)
+        return {"sampleRate": self.sample_rate, "minMs": self.min_ms,
+                "active": len(self.active), "stored": self.stored, "skipped": self.skipped}
+
+    # ===== SAMPLING =====
+
+    def begin(self) -> Optional[_Profile]:
+        """Start profiling the current task (None when too many profiles are already running)"""
+        if len(self.active) >= MAX_CONCURRENT_PROFILES:
+            self.skipped += 1
+            return None
+        task = asyncio.current_task()
+        profile = _Profile(task)
+        with self._lock:
+            self.active[task] = profile
+            if self._sampler is None:
+                self._loop = asyncio.get_running_loop()
+                self._loop_thread_id = threading.get_ident()
+                self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+                self._sampler.start()
+        return profile
+
+    def _sample_loop(self):
+        """Runs only while at least one request is being profiled"""
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            with self._lock:
+                if not self.active:
+                    self._sampler = None
+                    return
+                profiles = list(self.active.items())
+            try:
+                running = asyncio.current_task(self._loop)
+                thread_frame = None
+                for task, profile in profiles:
+                    if task is running:
+                        if thread_frame is None:
+                            thread_frame = sys._current_frames().get(self._loop_thread_id)
+                        stack = self._thread_stack(thread_frame)
+                        profile.on_loop += 1
+                    else:
+                        stack = self._await_stack(task)
+                        profile.awaiting += 1
+                    if stack:
+                        with self._lock:
+                            profile.stacks[stack] += 1
+            except Exception as e:
+                # Frames can disappear under us; a lost sample is harmless
+                logger.debug(f"Profiler sample skipped: {e}")
+
+    @staticmethod
+    def _thread_stack(frame) -> tuple:
+        """Loop-thread stack below the event loop's own frames, outermost first"""
+        if frame is None:
+            return ()
+        frames = traceback.extract_stack(frame, limit=MAX_STACK_DEPTH)
+        start = 0
+        for i, f in enumerate(frames):
+            if f.name == "_run" and os.path.basename(f.filename) == "events.py":
+                start = i + 1
+        return tuple(_frame_label(f.filename, f.lineno, f.name) for f in frames[start:])
+
+    @staticmethod
+    def _await_stack(task: asyncio.Task) -> tuple:
+        """The suspended task's coroutine chain, outermost first; the innermost is marked [await]"""
+        labels = []
+        coro = task.get_coro()
+        while coro is not None and len(labels) < MAX_STACK_DEPTH:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is not None:
+                labels.append(_frame_label(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        if labels:
+            labels[-1] += " [await]"
+        return tuple(labels)
+
+    # ===== STORAGE =====
+
+    async def finish(self, profile: _Profile, scope, status: int, trigger: str, mongo_calls: List) -> None:
+        with self._lock:
+            self.active.pop(profile.task, None)
+        latency_ms = (time.perf_counter() - profile.started) * 1000
+        if trigger == "sampled" and latency_ms < self.min_ms:
+            return
+
+        with self._lock:
+            stacks = dict(profile.stacks)
+        samples = sum(stacks.values())
+        self_counts, total_counts = Counter(), Counter()
+        for stack, n in stacks.items():
+            self_counts[stack[-1]] += n
+            for label in set(stack):
+                total_counts[label] += n
+        interval_ms = SAMPLE_INTERVAL * 1000
+        top_frames = [{
+            "frame": label,
+            "selfSamples": n,
+            "totalSamples": total_counts[label],
+            "selfMs": round(n * interval_ms, 1),
+        } for label, n in self_counts.most_common(TOP_FRAMES)]
+
+        calls = [{"command": c, "collection": coll, "shape": shape, "ms": round(s * 1000, 2)}
+                 for c, coll, shape, s in mongo_calls[:MAX_MONGO_CALLS]]
+        now = datetime.now(timezone.utc)
+        doc = {
+            "id": str(uuid.uuid4()),
+            "method": scope.get("method"),
+            "route": getattr(scope.get("route"), "path", None) or "unmatched",
+            "path": scope.get("path"),
+            "query": scope.get("query_string", b"").decode("latin-1")[:500],
+            "status": status,
+            "latencyMs": round(latency_ms, 2),
+            "trigger": trigger,
+            "samples": samples,
+            "onLoopMs": round(profile.on_loop * interval_ms, 1),
+            "awaitingMs": round(profile.awaiting * interval_ms, 1),
+            "sampleIntervalMs": interval_ms,
+            "topFrames": top_frames,
+            "folded": [{"stack": ";".join(stack), "samples": n}
+                       for stack, n in Counter(stacks).most_common(MAX_FOLDED_STACKS)],
+            "mongo": {
+                "count": len(mongo_calls),
+                "totalMs": round(sum(c[3] for c in mongo_calls) * 1000, 2),
+                "calls": calls,
+            },
+            "createdAt": now.isoformat(),
+            # A BSON date - the TTL index ignores strings
+            "expiresAt": now + timedelta(days=PROFILE_RETENTION_DAYS),
+        }
+        try:
+            await self.db.request_profiles.insert_one(doc)
+            self.stored += 1
+            logger.info(f"🔬 Profiled {doc['method']} {doc['route']} in {doc['latencyMs']}ms ({trigger})")
+        except Exception as e:
+            logger.warning(f"⚠️ Storing request profile failed: {e}")
+
+    def to_folded(self, doc: Dict) -> str:
+        """Brendan Gregg's folded format (flamegraph.pl, speedscope)"""
+        return "".join(f"{f['stack'].replace(' ', '_')} {f['samples']}\n" for f in doc.get("folded", []))
+
+
+class RequestProfilerMiddleware:
+    """Pure ASGI middleware: profiles opted-in requests end to end"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trigger = self.profiler.trigger_for(scope)
+        profile = self.profiler.begin() if trigger else None
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        stats = current_request_stats()
+        if stats is not None:
+            stats.commands = []
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            mongo_calls = stats.commands if stats is not None else []
+            if stats is not None:
+                stats.commands = None
+            await self.profiler.finish(profile, scope, status, trigger, mongo_calls or [])
@@ -12,6 +12,7 @@ import os
 import logging
 
 from .deps import get_db, get_current_user, security
+from cpu_offload import bcrypt_pool
 
 logger = logging.getLogger(__name__)
 
@@ -57,11 +58,12 @@ class ResetPasswordRequest(BaseModel):
     newPassword: str
 
 
-def create_access_token(user_id: str) -> str:
-    """Create a JWT access token for a user"""
+def create_access_token(user_id: str, token_version: int = 0) -> str:
+    """Create a JWT access token for a user (`ver` is checked against the user's tokenVersion)"""
     expiration = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
         'sub': user_id,
+        'ver': token_version,
         'exp': expiration,
         'iat': datetime.now(timezone.utc)
     }
@@ -97,7 +99,7 @@ async def signup(request: Request, req: SignupRequest):
             phone=req.phone
         )
         
-        token = create_access_token(user['id'])
+        token = create_access_token(user['id'], user.get('tokenVersion', 0))
         logger.info(f"✅ New user signed up: {req.email}")
         
         return {
@@ -131,7 +133,7 @@ async def login(request: Request, req: LoginRequest):
         if req.email == 'demo@loopync.com':
             user = await _setup_demo_user(db, auth_service, user)
         
-        token = create_access_token(user['id'])
+        token = create_access_token(user['id'], user.get('tokenVersion', 0))
         
         return {
             "token": token,
@@ -167,7 +169,7 @@ async def _setup_demo_user(db, auth_service, user: dict) -> dict:
                     "handle": test_user_data["handle"],
                     "name": test_user_data["name"],
                     "email": test_user_data["email"],
-                    "password": auth_service.hash_password(test_user_data["password"]),
+                    "password": await auth_service.hash_password_async(test_user_data["password"]),
                     "avatar": f"https://api.dicebear.com/7.x/avataaars/svg?seed={test_user_data['handle']}",
                     "isVerified": True,
                     "online": False,
@@ -210,10 +212,20 @@ async def _setup_demo_user(db, auth_service, user: dict) -> dict:
     return user
 
 
+async def _revoke_sessions(db, user_id: str) -> None:
+    from auth_service import AuthService
+    await AuthService(db).revoke_sessions(user_id)
+
+
 @router.get("/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
     """Get the current authenticated user's profile"""
-    return current_user
+    from auth_service import AuthService
+    
+    user = await AuthService(get_db()).get_user_by_id(current_user["id"])
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
 
 
 @router.post("/change-password")
@@ -226,14 +238,15 @@ async def change_password(data: ChangePasswordRequest):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if not bcrypt.verify(data.currentPassword, user.get("password", "")):
+    if not await bcrypt_pool.run(bcrypt.verify, data.currentPassword, user.get("password", "")):
         raise HTTPException(status_code=401, detail="Current password is incorrect")
     
-    new_password_hash = bcrypt.hash(data.newPassword)
+    new_password_hash = await bcrypt_pool.run(bcrypt.hash, data.newPassword)
     await db.users.update_one(
         {"id": data.userId},
         {"$set": {"password": new_password_hash}}
     )
+    await _revoke_sessions(db, data.userId)
     
     return {"success": True, "message": "Password changed successfully"}
 
@@ -355,7 +368,7 @@ async def reset_password(data: ResetPasswordRequest):
         if datetime.now(timezone.utc) > expires:
             raise HTTPException(status_code=400, detail="Reset code has expired")
     
-    new_password_hash = bcrypt.hash(data.newPassword)
+    new_password_hash = await bcrypt_pool.run(bcrypt.hash, data.newPassword)
     
     await db.users.update_one(
         {"email": data.email},
@@ -365,5 +378,6 @@ async def reset_password(data: ResetPasswordRequest):
             "resetPasswordExpires": None
         }}
     )
+    await _revoke_sessions(db, user["id"])
     
     return {"success": True, "message": "Password reset successfully"}
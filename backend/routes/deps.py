@@ -15,16 +15,20 @@ security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET')
 JWT_ALGORITHM = 'HS256'
 
-def verify_token(token: str) -> Optional[str]:
-    """Verify a JWT token and return the user_id if valid"""
+def decode_token(token: str) -> Optional[dict]:
+    """Verify a JWT token and return its claims if valid"""
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload.get('sub')
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+def verify_token(token: str) -> Optional[str]:
+    """Verify a JWT token and return the user_id if valid"""
+    claims = decode_token(token)
+    return claims.get('sub') if claims else None
+
 # Database instance - will be set by main server
 _db: Optional[AsyncIOMotorDatabase] = None
 
@@ -40,22 +44,18 @@ def get_db() -> AsyncIOMotorDatabase:
     return _db
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    """Dependency to get the current authenticated user"""
+    """Dependency to get the current authenticated principal (slim and cached, see AuthService.get_principal)"""
     from auth_service import AuthService
     
-    token = credentials.credentials
-    user_id = verify_token(token)
-    
-    if not user_id:
+    claims = decode_token(credentials.credentials)
+    if not claims or not claims.get('sub'):
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     
-    db = get_db()
-    # Get user from MongoDB
-    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    principal = await AuthService(get_db()).get_principal(claims['sub'], claims.get('ver', 0))
+    if not principal:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
     
-    return user
+    return principal
 
 async def get_optional_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> Optional[dict]:
     """Optional user dependency - doesn't require authentication"""
@@ -2,7 +2,7 @@
 Reels routes for Loopync API
 Handles short-form video content (reels/shorts)
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime, timezone
@@ -10,6 +10,7 @@ import uuid
 import logging
 
 from .deps import get_db
+from performance import paginate_keyset
 
 logger = logging.getLogger(__name__)
 
@@ -30,15 +31,20 @@ class CommentCreate(BaseModel):
 
 
 @router.get("")
-async def get_reels(limit: int = 50, skip: int = 0, userId: str = None):
-    """Get reels for the feed"""
+async def get_reels(response: Response, limit: int = 50, skip: int = 0, userId: str = None, cursor: Optional[str] = None):
+    """Get reels for the feed (pass cursor for keyset paging, see X-Next-Cursor header)"""
     db = get_db()
     
     query = {}
     if userId:
         query["authorId"] = userId
     
-    reels = await db.reels.find(query, {"_id": 0}).sort("createdAt", -1).skip(skip).to_list(limit)
+    if cursor is not None or skip == 0:
+        reels, next_cursor = await paginate_keyset(db.reels, query, cursor=cursor, limit=limit)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+    else:
+        reels = await db.reels.find(query, {"_id": 0}).sort("createdAt", -1).skip(skip).to_list(limit)
     
     for reel in reels:
         author = await db.users.find_one({"id": reel.get("authorId")}, {"_id": 0, "password": 0})
@@ -0,0 +1,350 @@
+"""
+Search Service - Inverted-index search for Loopync
+Tokenizes searchable fields into a postings collection (with edge n-gram
+prefixes for names and handles), ranks matches with BM25 and is kept up to
+date incrementally as documents are written. Document frequencies live in
+search_terms, so scores do not depend on how many postings a query reads.
+
+Every type's index lives under a generation key ("k"); search_generations
+records the active one. A rebuild writes a fresh generation alongside it and
+switches over in one update, so searches never see a half-built index.
+"""
+
+import re
+import math
+import asyncio
+import logging
+import unicodedata
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import InsertOne, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Edge n-gram range for prefix (search-as-you-type) fields
+PREFIX_MIN = 2
+PREFIX_MAX = 15
+
+# Cap on postings read per query term (highest term weight first)
+MAX_POSTINGS_PER_TERM = 5000
+
+REINDEX_BATCH_SIZE = 500
+
+# A type is rebuilt by backfill() when its indexed count drifts this far from the source
+BACKFILL_STALE_RATIO = 0.05
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is",
+    "it", "of", "on", "or", "the", "to", "was", "with"
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Searchable types: source collection, weighted fields, prefix-indexed fields
+SEARCH_TYPES = {
+    "users": {
+        "collection": "users",
+        "fields": {"name": 3.0, "handle": 3.0, "bio": 0.5},
+        "prefix": ["name", "handle"],
+    },
+    "posts": {
+        "collection": "posts",
+        "fields": {"text": 1.0, "hashtags": 2.0},
+        "prefix": ["hashtags"],
+    },
+    "tribes": {
+        "collection": "tribes",
+        "fields": {"name": 3.0, "description": 1.0, "tags": 1.5},
+        "prefix": ["name"],
+    },
+    "venues": {
+        "collection": "venues",
+        "fields": {"name": 3.0, "description": 1.0, "location": 1.0},
+        "prefix": ["name"],
+    },
+    "events": {
+        "collection": "events",
+        "fields": {"name": 3.0, "description": 1.0, "venue": 1.0, "location": 1.0},
+        "prefix": ["name"],
+    },
+    "products": {
+        "collection": "products",
+        "fields": {"name": 3.0, "description": 1.0, "tags": 1.5},
+        "prefix": ["name"],
+    },
+    "digitalProducts": {
+        "collection": "digital_products",
+        "fields": {"title": 3.0, "description": 1.0, "tags": 1.5},
+        "prefix": ["title"],
+    },
+}
+
+
+def tokenize(text) -> List[str]:
+    """Lowercase, strip accents and split into alphanumeric tokens"""
+    if not text:
+        return []
+    if isinstance(text, (list, tuple)):
+        text = " ".join(str(t) for t in text if t)
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _TOKEN_RE.findall(text) if t not in STOPWORDS and len(t) <= 40]
+
+
+def edge_ngrams(token: str) -> List[str]:
+    return [token[:n] for n in range(PREFIX_MIN, min(len(token), PREFIX_MAX) + 1)]
+
+
+def build_postings(kind: str, doc: dict) -> Tuple[Dict[str, float], int]:
+    """Weighted term frequencies ("w:" words, "p:" prefixes) and document length"""
+    config = SEARCH_TYPES[kind]
+    weights: Dict[str, float] = defaultdict(float)
+    length = 0
+    for field, weight in config["fields"].items():
+        tokens = tokenize(doc.get(field))
+        length += len(tokens)
+        for token in tokens:
+            weights[f"w:{token}"] += weight
+            if field in config["prefix"]:
+                for gram in edge_ngrams(token):
+                    key = f"p:{gram}"
+                    weights[key] = max(weights[key], weight)
+    return weights, length
+
+
+class SearchService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== GENERATIONS =====
+
+    async def _write_keys(self, kind: str) -> List[str]:
+        """The active generation, plus the one being built during a reindex"""
+        gen = await self.db.search_generations.find_one({"k": kind}, {"_id": 0})
+        if not gen:
+            # Indexes built before generations existed are keyed by the type itself
+            return [kind]
+        return [gen["active"]] + ([gen["building"]] if gen.get("building") else [])
+
+    async def _active_keys(self, kinds: List[str]) -> Dict[str, str]:
+        keys = {kind: kind for kind in kinds}
+        async for gen in self.db.search_generations.find({"k": {"$in": kinds}}, {"_id": 0, "k": 1, "active": 1}):
+            keys[gen["k"]] = gen["active"]
+        return keys
+
+    async def _drop_generation(self, key: str) -> None:
+        await self.db.search_postings.delete_many({"k": key})
+        await self.db.search_docs.delete_many({"k": key})
+        await self.db.search_terms.delete_many({"k": key})
+        await self.db.search_stats.delete_one({"k": key})
+
+    # ===== WRITE PATH =====
+
+    async def _update_term_stats(self, key: str, added, removed) -> None:
+        ops = [UpdateOne({"k": key, "t": t}, {"$inc": {"df": 1}}, upsert=True) for t in added]
+        ops += [UpdateOne({"k": key, "t": t}, {"$inc": {"df": -1}}) for t in removed]
+        if ops:
+            await self.db.search_terms.bulk_write(ops, ordered=False)
+
+    async def _indexed_terms(self, key: str, doc_id: str) -> set:
+        return {p["t"] async for p in self.db.search_postings.find({"k": key, "d": doc_id}, {"_id": 0, "t": 1})}
+
+    async def index(self, kind: str, doc: dict) -> None:
+        """(Re)index one document; safe to call on every create/update"""
+        weights, length = build_postings(kind, doc)
+        for key in await self._write_keys(kind):
+            await self._index_into(key, doc["id"], weights, length)
+
+    async def _index_into(self, key: str, doc_id: str, weights: Dict[str, float], length: int) -> None:
+        old_terms = await self._indexed_terms(key, doc_id)
+
+        previous = await self.db.search_docs.find_one_and_update(
+            {"k": key, "d": doc_id},
+            {"$set": {"len": length, "indexedAt": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        old_length = previous.get("len", 0) if previous else 0
+        await self.db.search_stats.update_one(
+            {"k": key},
+            {"$inc": {"docs": 0 if previous else 1, "totalLen": length - old_length}},
+            upsert=True
+        )
+
+        await self.db.search_postings.delete_many({"k": key, "d": doc_id})
+        if weights:
+            await self.db.search_postings.bulk_write(
+                [InsertOne({"t": term, "k": key, "d": doc_id, "tf": tf, "dl": length})
+                 for term, tf in weights.items()],
+                ordered=False
+            )
+        await self._update_term_stats(key, weights.keys() - old_terms, old_terms - weights.keys())
+
+    async def remove(self, kind: str, doc_id: str) -> None:
+        keys = await self._write_keys(kind)
+        if len(keys) > 1:
+            # The rebuild may already have read this document; it drops it before switching
+            await self.db.search_generations.update_one({"k": kind}, {"$addToSet": {"removed": doc_id}})
+        for key in keys:
+            await self._remove_from(key, doc_id)
+
+    async def _remove_from(self, key: str, doc_id: str) -> None:
+        previous = await self.db.search_docs.find_one_and_delete({"k": key, "d": doc_id})
+        if previous:
+            await self.db.search_stats.update_one(
+                {"k": key}, {"$inc": {"docs": -1, "totalLen": -previous.get("len", 0)}}
+            )
+        old_terms = await self._indexed_terms(key, doc_id)
+        await self.db.search_postings.delete_many({"k": key, "d": doc_id})
+        await self._update_term_stats(key, (), old_terms)
+
+    async def reindex(self, kind: str) -> int:
+        """Rebuild the index for one type into a new generation, then switch to it"""
+        key = f"{kind}:{uuid.uuid4().hex[:12]}"
+        # From here on, index()/remove() also write to the new generation
+        superseded = await self.db.search_generations.find_one_and_update(
+            {"k": kind}, {"$set": {"building": key, "removed": []}, "$setOnInsert": {"active": kind}}, upsert=True
+        )
+        if superseded and superseded.get("building"):
+            # An earlier rebuild that never switched (or is about to lose the race)
+            await self._drop_generation(superseded["building"])
+
+        config = SEARCH_TYPES[kind]
+        collection = self.db[config["collection"]]
+        projection = {"_id": 0, "id": 1, **{f: 1 for f in config["fields"]}}
+        count = 0
+        async for doc in collection.find({}, projection).batch_size(REINDEX_BATCH_SIZE):
+            if doc.get("id"):
+                weights, length = build_postings(kind, doc)
+                await self._index_into(key, doc["id"], weights, length)
+                count += 1
+
+        # Documents deleted while the scan was running may have been indexed after their removal
+        gen = await self.db.search_generations.find_one({"k": kind, "building": key}, {"_id": 0, "removed": 1})
+        removed = (gen or {}).get("removed") or []
+        if removed:
+            remaining = set(await collection.distinct("id", {"id": {"$in": removed}}))
+            for doc_id in set(removed) - remaining:
+                await self._remove_from(key, doc_id)
+
+        previous = await self.db.search_generations.find_one_and_update(
+            {"k": kind, "building": key},
+            {"$set": {"active": key}, "$unset": {"building": "", "removed": ""}}
+        )
+        if not previous:
+            # A concurrent rebuild took over; its generation wins
+            await self._drop_generation(key)
+            logger.warning(f"⚠️ Search rebuild for {kind} superseded, discarded {count} docs")
+            return count
+        await self._drop_generation(previous.get("active", kind))
+        logger.info(f"✅ Search index rebuilt for {kind} ({count} docs)")
+        return count
+
+    async def backfill(self, stale_ratio: float = BACKFILL_STALE_RATIO) -> Dict[str, int]:
+        """Rebuild the types whose index is empty or has drifted from the source collection"""
+        rebuilt = {}
+        active = await self._active_keys(list(SEARCH_TYPES))
+        for kind, config in SEARCH_TYPES.items():
+            source = await self.db[config["collection"]].estimated_document_count()
+            if not source:
+                continue
+            stats = await self.db.search_stats.find_one({"k": active[kind]}, {"_id": 0, "docs": 1})
+            indexed = stats.get("docs", 0) if stats else 0
+            # An index built before search_terms existed has no document frequencies
+            has_terms = await self.db.search_terms.find_one({"k": active[kind]}, {"_id": 1}) is not None
+            if not indexed or not has_terms or abs(source - indexed) > max(source * stale_ratio, 10):
+                rebuilt[kind] = await self.reindex(kind)
+        await self.db.search_terms.delete_many({"df": {"$lte": 0}})
+        return rebuilt
+
+    # ===== READ PATH =====
+
+    async def search(self, q: str, kinds: Optional[List[str]] = None, limit: int = 20,
+                     skip: int = 0) -> Dict:
+        """
+        Rank documents of each requested type against the query.
+        Returns {"ids": {kind: [docId, ...]}, "facets": {kind: totalMatches}}.
+        """
+        kinds = [k for k in (kinds or SEARCH_TYPES) if k in SEARCH_TYPES]
+        tokens = list(dict.fromkeys(tokenize(q)))
+        if not tokens or not kinds:
+            return {"ids": {k: [] for k in kinds}, "facets": {k: 0 for k in kinds}}
+
+        # Each query token matches the whole word, or a prefix on prefix fields
+        terms = [f"w:{t}" for t in tokens] + [f"p:{t[:PREFIX_MAX]}" for t in tokens if len(t) >= PREFIX_MIN]
+        active = await self._active_keys(kinds)
+        keys = list(active.values())
+        kind_of = {key: kind for kind, key in active.items()}
+        # Very common terms are capped at their highest-weighted postings
+        per_term = await asyncio.gather(*(
+            self.db.search_postings.find(
+                {"t": term, "k": {"$in": keys}},
+                {"_id": 0, "t": 1, "k": 1, "d": 1, "tf": 1, "dl": 1}
+            ).sort([("tf", -1), ("d", 1)]).limit(MAX_POSTINGS_PER_TERM).to_list(MAX_POSTINGS_PER_TERM)
+            for term in terms
+        ))
+        postings = [{**p, "k": kind_of[p["k"]]} for chunk in per_term for p in chunk]
+        truncated = {term for term, chunk in zip(terms, per_term) if len(chunk) >= MAX_POSTINGS_PER_TERM}
+
+        stats = {kind_of[s["k"]]: s async for s in self.db.search_stats.find({"k": {"$in": keys}}, {"_id": 0})}
+        df: Dict[Tuple[str, str], int] = {
+            (kind_of[s["k"]], s["t"]): s["df"]
+            async for s in self.db.search_terms.find({"k": {"$in": keys}, "t": {"$in": terms}}, {"_id": 0})
+        }
+        # Postings written before term stats existed
+        counted: Dict[Tuple[str, str], int] = defaultdict(int)
+        for p in postings:
+            counted[(p["k"], p["t"])] += 1
+        for key, n in counted.items():
+            df[key] = max(df.get(key, 0), n)
+
+        # Per document: best score per query token, then summed
+        token_scores: Dict[Tuple[str, str], Dict[str, float]] = defaultdict(dict)
+        for p in postings:
+            kind, term = p["k"], p["t"]
+            token = term[2:]
+            s = stats.get(kind, {})
+            n = max(s.get("docs", 0), df[(kind, term)])
+            avgdl = (s.get("totalLen", 0) / n) if n else 1.0
+            idf = math.log(1 + (n - df[(kind, term)] + 0.5) / (df[(kind, term)] + 0.5))
+            norm = p["tf"] + BM25_K1 * (1 - BM25_B + BM25_B * p.get("dl", 0) / max(avgdl, 1.0))
+            score = idf * p["tf"] * (BM25_K1 + 1) / norm
+            if term.startswith("p:"):
+                # Prefix matches rank just below whole-word matches
+                score *= 0.8
+                token = next((t for t in tokens if t[:PREFIX_MAX] == token), token)
+            per_token = token_scores[(kind, p["d"])]
+            per_token[token] = max(per_token.get(token, 0.0), score)
+
+        ranked: Dict[str, List[Tuple[int, float, str]]] = defaultdict(list)
+        for (kind, doc_id), per_token in token_scores.items():
+            # Documents matching more query tokens always outrank partial matches
+            ranked[kind].append((len(per_token), sum(per_token.values()), doc_id))
+
+        ids, facets = {}, {}
+        for kind in kinds:
+            hits = sorted(ranked.get(kind, []), reverse=True)
+            # With a capped term, every document containing it still matches
+            facets[kind] = max([len(hits)] + [df.get((kind, t), 0) for t in truncated])
+            ids[kind] = [doc_id for _, _, doc_id in hits[skip:skip + limit]]
+        return {"ids": ids, "facets": facets}
+
+    async def search_ids(self, kind: str, q: str, limit: int = 1000) -> List[str]:
+        """Ranked ids for a single type (for combining with other filters)"""
+        result = await self.search(q, [kind], limit=limit)
+        return result["ids"][kind]
+
+    async def hydrate(self, kind: str, ids: List[str], projection: Optional[dict] = None) -> List[Dict]:
+        """Fetch documents for ranked ids, preserving rank order"""
+        if not ids:
+            return []
+        collection = self.db[SEARCH_TYPES[kind]["collection"]]
+        docs = await collection.find({"id": {"$in": ids}}, projection or {"_id": 0}).to_list(len(ids))
+        by_id = {d["id"]: d for d in docs}
+        return [by_id[i] for i in ids if i in by_id]
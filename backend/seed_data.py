@@ -8,6 +8,8 @@ import os
 from datetime import datetime, timezone
 import uuid
 
+from search_service import SearchService
+
 # MongoDB connection
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'test_loopync')
@@ -467,6 +469,9 @@ async def seed_database():
         
         print(f"📹 Inserted {videos_inserted} videos")
         
+        # The cleared products are still in the search index; rebuild it from the new ones
+        await SearchService(db).reindex("products")
+        
         print("\n✅ Database seeding completed successfully!")
         print(f"   - Products: {products_inserted}")
         print(f"   - Videos: {videos_inserted}")
@@ -1,16 +1,16 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Body, UploadFile, File, Depends, Request, Form
-from fastapi.responses import Response, ORJSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Body, UploadFile, File, Depends, Request, Form, BackgroundTasks, Header
+from fastapi.responses import Response, ORJSONResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 import socketio
+from pymongo import ReturnDocument, UpdateOne
 import os
+import re
+import json
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr, field_validator
@@ -21,24 +21,42 @@ import shutil
 import random
 import razorpay
 import jwt
-import qrcode
 import base64
 from io import BytesIO
-import io
-from PIL import Image
 
 # Performance optimization imports
 from performance import (
     posts_cache, users_cache, trending_cache, feed_cache,
     batch_get_users, batch_enrich_posts, batch_enrich_comments,
     get_feed_optimized, get_trending_posts_optimized,
-    invalidate_user_cache, invalidate_post_cache,
-    perf_monitor, ensure_indexes, rate_limiter
+    invalidate_user_cache, invalidate_post_cache, start_cache_tier, stop_cache_tier,
+    perf_monitor, ensure_indexes,
+    paginate_keyset, encode_cursor, InvalidCursorError, gather_queries, QueryTimeoutError,
+    get_user_loader, attach_users, begin_request_stats
 )
 
 # Import the Google Sheets database module
 from messenger_service import MessengerService, SendMessageRequest, AIMessageRequest, UpdateReadStatusRequest
 from auth_service import AuthService
+from timeline_service import TimelineService
+from search_service import SearchService, SEARCH_TYPES
+from trending_service import TrendingService, extract_hashtags, normalize_tag
+from engagement_service import EngagementService
+from analytics_service import AnalyticsService, PLATFORM_KEY, wallet_metrics
+from metrics import RequestMetricsMiddleware, metrics_registry, mongo_command_listener
+from rate_limit import RateLimitMiddleware, rate_limiter
+from credits_service import CreditsService, InsufficientCreditsError
+from wallet_service import WalletService, InsufficientFundsError, WalletNotFoundError, IdempotencyConflictError
+import cpu_offload
+from cpu_offload import PoolSaturatedError, qr_pool, render_qr_codes, bcrypt_pool
+from loop_monitor import LoopMonitorMiddleware, loop_monitor, LOOP_MONITOR_ENABLED
+from request_profiler import RequestProfiler, RequestProfilerMiddleware, SUMMARY_FIELDS as PROFILE_SUMMARY_FIELDS
+from notification_service import NotificationPipeline, actor_snapshot, HIDDEN_FIELDS as NOTIFICATION_FIELDS
+import background_jobs
+from db_indexes import apply_indexes, diff_indexes
+from presence_service import create_presence_store, create_client_manager
+from media_store import MediaStore, MediaTooLargeError, parse_range_header
+from image_pipeline import ImagePipeline, is_derivable, select_variant
 from verification_models import (
     VerificationRequest, VerificationRequestCreate, VerificationReview,
     Page, PageCreate, PageUpdate, AccountType, VerificationStatus,
@@ -72,7 +90,8 @@ client = AsyncIOMotorClient(
     connectTimeoutMS=30000,   # Connection timeout (increased for Atlas)
     socketTimeoutMS=45000,    # Socket timeout for operations
     retryWrites=True,         # Retry failed writes
-    retryReads=True           # Retry failed reads
+    retryReads=True,          # Retry failed reads
+    event_listeners=[mongo_command_listener]  # Per-command timing and query shapes
 )
 db = client[os.environ['DB_NAME']]
 
@@ -101,12 +120,33 @@ app = FastAPI(
     default_response_class=ORJSONResponse
 )
 
+# Per-route latency histograms, DB round trips and response sizes.
+# Registered before GZip so it sits inside it and counts uncompressed bytes.
+app.add_middleware(RequestMetricsMiddleware, registry=metrics_registry, on_request=perf_monitor.record_request)
+
+# Lets the loop monitor attribute event-loop stalls to the request that caused them
+app.add_middleware(LoopMonitorMiddleware, monitor=loop_monitor)
+
+# Opt-in per-request profiles (signed X-Profile header or runtime sampling rate)
+request_profiler = RequestProfiler(db, secret=os.environ.get("PROFILE_SECRET") or JWT_SECRET)
+app.add_middleware(RequestProfilerMiddleware, profiler=request_profiler)
+
 # Add GZip compression for faster data transfer (especially on 3G/4G)
 app.add_middleware(GZipMiddleware, minimum_size=500)
 
+# Per-route rate limits (see rate_limit.ROUTE_POLICIES) - rejects before routing or body parsing.
+# "user" budgets are keyed on the verified token subject (verify_token, defined with the JWT utilities).
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter, identify=lambda token: verify_token(token))
+
+# Shared realtime backend (Redis pub/sub + presence) when REDIS_URL is set;
+# without it Socket.IO and presence stay in-process (single worker)
+REDIS_URL = os.environ.get('REDIS_URL')
+presence = create_presence_store(REDIS_URL)
+
 # Create Socket.IO server
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=create_client_manager(REDIS_URL),
     cors_allowed_origins='*',  # In production, restrict this
     logger=True,
     engineio_logger=True
@@ -115,10 +155,36 @@ sio = socketio.AsyncServer(
 # Create Socket.IO ASGI app (this will be mounted)
 sio_asgi_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
-# Rate Limiter for API protection (100K users scalability)
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+@app.exception_handler(InvalidCursorError)
+async def invalid_cursor_handler(request: Request, exc: InvalidCursorError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(QueryTimeoutError)
+async def query_timeout_handler(request: Request, exc: QueryTimeoutError):
+    logger.warning(f"⚠️ {request.method} {request.url.path}: {exc}")
+    return JSONResponse(status_code=504, content={"detail": "Request timed out, please retry"})
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request: Request, exc: PoolSaturatedError):
+    return JSONResponse(status_code=503, content={"detail": "Server busy, please retry"}, headers={"Retry-After": "1"})
+
+# Per-request query accounting - backs the user loader and flags N+1 regressions
+@app.middleware("http")
+async def request_query_stats(request: Request, call_next):
+    stats = begin_request_stats()
+    response = await call_next(request)
+    perf_monitor.record_request_queries(request.url.path, stats)
+    response.headers["X-User-Queries"] = str(stats.user_queries)
+    response.headers["X-DB-Calls"] = str(stats.db_commands)
+    return response
+
+# Header carrying the opaque keyset cursor for list endpoints that return bare arrays
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    """Expose the next-page cursor without changing list response bodies"""
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
 
 # Health check endpoint for Kubernetes
 @app.get("/health")
@@ -133,9 +199,6 @@ async def health_check():
 
 api_router = APIRouter(prefix="/api")
 
-# Store connected clients: {userId: sid}
-connected_clients = {}
-
 # Create uploads directory
 UPLOAD_DIR = Path("/app/backend/uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
@@ -521,6 +584,7 @@ class LoopCredit(BaseModel):
     type: str  # earn, spend
     source: str  # post, checkin, challenge, event, purchase
     description: str = ""
+    balanceAfter: Optional[int] = None  # Materialized balance right after this entry
     createdAt: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class CheckIn(BaseModel):
@@ -643,6 +707,7 @@ class FriendRequest(BaseModel):
 
 class Friendship(BaseModel):
     model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     userId1: str
     userId2: str
     createdAt: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
@@ -668,6 +733,8 @@ class DMThread(BaseModel):
     user2Id: str
     createdAt: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     lastMessageAt: Optional[str] = None
+    lastMessage: Optional[dict] = None  # Snapshot of the newest message (see record_dm_thread_message)
+    unreadCount: dict = Field(default_factory=dict)  # {userId: unread messages}
 
 class DMMessage(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -746,53 +813,73 @@ razorpay_client = razorpay.Client(auth=(razorpay_key, razorpay_secret))
 
 # ===== JWT TOKEN UTILITIES =====
 
-def create_access_token(user_id: str) -> str:
-    """Create a JWT access token for a user"""
+def create_access_token(user_id: str, token_version: int = 0) -> str:
+    """Create a JWT access token for a user (`ver` is checked against the user's tokenVersion)"""
     expiration = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
         'sub': user_id,
+        'ver': token_version,
         'exp': expiration,
         'iat': datetime.now(timezone.utc)
     }
     token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return token
 
-def verify_token(token: str) -> Optional[str]:
-    """Verify a JWT token and return the user_id if valid"""
+def decode_token(token: str) -> Optional[dict]:
+    """Verify a JWT token and return its claims if valid"""
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload.get('sub')
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+def verify_token(token: str) -> Optional[str]:
+    """Verify a JWT token and return the user_id if valid"""
+    claims = decode_token(token)
+    return claims.get('sub') if claims else None
+
+async def authenticate_token(token: str) -> Optional[dict]:
+    """Principal for a token, or None if it is invalid, expired or revoked"""
+    claims = decode_token(token)
+    if not claims or not claims.get('sub'):
+        return None
+    return await auth_service.get_principal(claims['sub'], claims.get('ver', 0))
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    """Dependency to get the current authenticated user"""
-    token = credentials.credentials
-    user_id = verify_token(token)
-    
-    if not user_id:
+    """
+    Dependency to get the current authenticated principal: id, name, handle, avatar,
+    role and verification flags (cached briefly, no per-request user fetch).
+    Handlers needing the full profile load it with auth_service.get_user_by_id.
+    """
+    principal = await authenticate_token(credentials.credentials)
+    if not principal:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
-    
-    # Get user from MongoDB via auth_service
-    user = await auth_service.get_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
+    return principal
+
+async def require_admin(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    """Dependency for admin-only endpoints: the bearer token's user must be an admin"""
+    user_id = verify_token(credentials.credentials)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if not await verify_admin(user_id):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user_id
 
 # ===== WEBSOCKET HELPERS =====
 
 async def emit_to_user(user_id: str, event: str, data: dict):
-    """Emit event to a specific user if they're connected"""
-    if user_id in connected_clients:
-        sid = connected_clients[user_id]
-        await sio.emit(event, data, room=sid)
-        logging.info(f"✅ Emitted '{event}' to user {user_id} (sid: {sid})")
-    else:
-        logging.warning(f"⚠️ User {user_id} not found in connected_clients. Cannot emit '{event}'. Connected users: {list(connected_clients.keys())}")
-    return user_id in connected_clients
+    """Emit event to every device of a user, on whichever node they're connected"""
+    if await presence.is_online(user_id):
+        # Personal room fans out across sids and, via the client manager, across nodes
+        await sio.emit(event, data, room=f"user:{user_id}")
+        logging.info(f"✅ Emitted '{event}' to user {user_id}")
+        return True
+    logging.warning(f"⚠️ User {user_id} is not connected. Cannot emit '{event}'")
+    return False
+
+# Initialize Notification Pipeline (batched writes, coalescing, unread counters)
+notification_pipeline = NotificationPipeline(db, emit=emit_to_user)
 
 # Initialize Messenger Service
 messenger_service = MessengerService(db, emit_to_user)
@@ -800,6 +887,110 @@ messenger_service = MessengerService(db, emit_to_user)
 # Initialize Auth Service
 auth_service = AuthService(db)
 
+# Chunked GridFS media storage + responsive image variants
+media_store = MediaStore(db)
+image_pipeline = ImagePipeline(db, media_store)
+
+# Initialize Timeline Service (materialized home feeds)
+timeline_service = TimelineService(db)
+
+async def fan_out_to_timelines(post: dict):
+    """Push a new post into follower timelines without failing the write"""
+    try:
+        await timeline_service.fan_out_post(post)
+    except Exception as e:
+        logger.warning(f"Timeline fan-out failed for post {post.get('id')}: {e}")
+
+# Initialize Search Service (inverted index + BM25)
+search_service = SearchService(db)
+
+# Hydration projections for search results
+SEARCH_PROJECTIONS = {"users": {"_id": 0, "password": 0}}
+
+async def index_for_search(kind: str, doc: dict):
+    """Keep the search index in step with a write without failing it"""
+    try:
+        await search_service.index(kind, doc)
+    except Exception as e:
+        logger.warning(f"Search indexing failed for {kind} {doc.get('id')}: {e}")
+
+# Initialize Trending Service (incremental hashtag counters)
+trending_service = TrendingService(db)
+
+async def record_post_hashtags(post: dict):
+    """Normalize a new post's hashtags and count them for trending without failing the write"""
+    try:
+        tags = extract_hashtags(post.get("text", ""), post.get("hashtags", []))
+        if tags != post.get("hashtags", []):
+            post["hashtags"] = tags
+            await db.posts.update_one({"id": post["id"]}, {"$set": {"hashtags": tags}})
+        await trending_service.record(tags, post.get("createdAt"))
+    except Exception as e:
+        logger.warning(f"Hashtag counting failed for post {post.get('id')}: {e}")
+
+# Initialize Engagement Service (precomputed trending scores)
+engagement_service = EngagementService(db)
+
+async def refresh_engagement(kind: str, doc_id: str):
+    """Recompute a post/reel engagementScore after a stats change without failing the write"""
+    try:
+        await engagement_service.refresh(kind, doc_id)
+    except Exception as e:
+        logger.warning(f"Engagement score refresh failed for {kind} {doc_id}: {e}")
+
+# Initialize Analytics Service (daily / lifetime rollups)
+analytics_service = AnalyticsService(db)
+
+async def track_analytics(user_id: str, metrics: dict):
+    """Bump a user's analytics counters without failing the write"""
+    try:
+        await analytics_service.record(user_id, metrics)
+    except Exception as e:
+        logger.warning(f"Analytics counters failed for user {user_id}: {e}")
+
+# Initialize Credits Service (Loop Credits ledger + materialized balances)
+credits_service = CreditsService(db)
+
+# Initialize Wallet Service (guarded debits + idempotency keys)
+wallet_service = WalletService(db)
+
+async def charge_wallet(user_id: str, amount: float, description: str, metadata: Optional[dict] = None,
+                        idempotency_key: Optional[str] = None, insufficient_detail: str = "Insufficient balance",
+                        operation: Optional[str] = None) -> dict:
+    """
+    Debit a wallet for a payment, mapping wallet errors to HTTP errors.
+    `operation` describes the request (endpoint + what is bought) so a reused
+    Idempotency-Key for anything else is rejected with 409.
+    """
+    try:
+        txn = await wallet_service.debit(user_id, amount, "payment", description, metadata, idempotency_key, operation)
+    except InsufficientFundsError:
+        raise HTTPException(status_code=400, detail=insufficient_detail)
+    except WalletNotFoundError:
+        raise HTTPException(status_code=404, detail="User not found")
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not txn["replayed"]:
+        await track_analytics(user_id, wallet_metrics(txn))
+    return txn
+
+async def search_user_ids(q: str, limit: int) -> List[str]:
+    """Ranked user ids for a query; a full email address also matches its account exactly"""
+    ids = await search_service.search_ids("users", q, limit)
+    if "@" in q:
+        match = await db.users.find_one({"email": q.strip().lower()}, {"_id": 0, "id": 1})
+        if match:
+            ids = [match["id"]] + [i for i in ids if i != match["id"]][:limit - 1]
+    return ids
+
+async def unindex_for_search(kind: str, doc_id: str):
+    try:
+        await search_service.remove(kind, doc_id)
+    except Exception as e:
+        logger.warning(f"Search unindexing failed for {kind} {doc_id}: {e}")
+
 async def emit_to_thread(thread_id: str, event: str, data: dict, exclude_user: str = None):
     """Emit event to all users in a thread"""
     # Get thread participants
@@ -826,6 +1017,124 @@ async def is_blocked(blocker: str, blocked: str) -> bool:
     block = await db.user_blocks.find_one({"blockerId": blocker, "blockedId": blocked}, {"_id": 0})
     return block is not None
 
+# ===== DM THREAD DENORMALIZATION =====
+# dm_threads carry a lastMessage snapshot and a per-participant unreadCount map,
+# so the inbox is a single paginated query instead of 4 lookups per thread.
+# A thread without unreadCount predates the counters and is backfilled once.
+
+DM_LAST_MESSAGE_FIELDS = ("id", "senderId", "text", "mediaUrl", "mediaType", "mimeType", "createdAt", "editedAt")
+
+def dm_message_snapshot(message: dict) -> dict:
+    """Slim copy of a DM message stored on its thread as lastMessage"""
+    return {k: message.get(k) for k in DM_LAST_MESSAGE_FIELDS}
+
+async def record_dm_thread_message(thread_id: str, message: dict, recipient_id: str):
+    """Atomically set lastMessage and bump the recipient's unread counter"""
+    summary = {
+        "lastMessage": dm_message_snapshot(message),
+        "lastMessageAt": message["createdAt"]
+    }
+    result = await db.dm_threads.update_one(
+        {"id": thread_id, "unreadCount": {"$exists": True}},
+        {"$set": summary, "$inc": {f"unreadCount.{recipient_id}": 1}}
+    )
+    if result.matched_count == 0:
+        # Legacy thread - leave the counters missing so the backfill counts this message too
+        await db.dm_threads.update_one({"id": thread_id}, {"$set": summary})
+
+async def backfill_dm_thread_summary(thread: dict) -> dict:
+    """Compute lastMessage/unreadCount for a thread created before denormalization"""
+    last_message_docs = await db.messages.find(
+        {"threadId": thread["id"], "deletedAt": None},
+        {"_id": 0}
+    ).sort("createdAt", -1).limit(1).to_list(1)
+    last_message = dm_message_snapshot(last_message_docs[0]) if last_message_docs else None
+    
+    unread = {}
+    for uid in (thread["user1Id"], thread["user2Id"]):
+        query = {"threadId": thread["id"], "senderId": {"$ne": uid}, "deletedAt": None}
+        receipt = await db.message_reads.find_one({"threadId": thread["id"], "userId": uid}, {"_id": 0})
+        if receipt and receipt.get("readAt"):
+            query["createdAt"] = {"$gt": receipt["readAt"]}
+        unread[uid] = await db.messages.count_documents(query)
+    
+    await db.dm_threads.update_one(
+        {"id": thread["id"], "unreadCount": {"$exists": False}},
+        {"$set": {"lastMessage": last_message, "unreadCount": unread}}
+    )
+    thread["lastMessage"] = last_message
+    thread["unreadCount"] = unread
+    return thread
+
+async def merge_legacy_dm_messages(batch_size: int = 500) -> int:
+    """Move shares written to the old dm_messages collection into messages"""
+    moved = 0
+    while True:
+        batch = await db.dm_messages.find({}, {"_id": 0}).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        await db.messages.bulk_write(
+            [UpdateOne({"id": m["id"]}, {"$setOnInsert": m}, upsert=True) for m in batch],
+            ordered=False
+        )
+        await db.dm_messages.delete_many({"id": {"$in": [m["id"] for m in batch]}})
+        moved += len(batch)
+    if moved:
+        logger.info(f"📨 Merged {moved} legacy dm_messages into messages")
+    return moved
+
+# ===== ATOMIC ENGAGEMENT TOGGLES =====
+# Likes/reposts/follows are toggled with conditional $addToSet/$pull + $inc on a
+# single document, so each tap is one round trip and counters stay exact under
+# concurrency. The embedded arrays are the only copy of each relationship.
+
+TOGGLE_RETRIES = 3
+
+async def toggle_array_member(collection, doc_id: str, field: str, member: str,
+                              counter: Optional[str] = None, projection: Optional[dict] = None):
+    """
+    Atomically add `member` to `field` if absent, else remove it, moving `counter`
+    by +/-1 in the same update. Returns (added, doc_after), or (None, None) if the
+    document doesn't exist.
+    """
+    projection = projection or {"_id": 0, "id": 1}
+    for _ in range(TOGGLE_RETRIES):
+        for added, cond, update in (
+            (True, {"$ne": member}, {"$addToSet": {field: member}}),
+            (False, member, {"$pull": {field: member}}),
+        ):
+            if counter:
+                update["$inc"] = {counter: 1 if added else -1}
+            doc = await collection.find_one_and_update(
+                {"id": doc_id, field: cond},
+                update,
+                projection=projection,
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is not None:
+                return added, doc
+        # Both conditions missed: either a concurrent toggle flipped the state
+        # between the two attempts, or the document doesn't exist
+        if not await collection.find_one({"id": doc_id}, {"_id": 1}):
+            break
+    return None, None
+
+async def set_follow(follower_id: str, target_id: str, follow: bool) -> bool:
+    """Idempotently add or remove a follow on both users; returns True if it changed"""
+    if follow:
+        result = await db.users.update_one(
+            {"id": follower_id, "following": {"$ne": target_id}},
+            {"$addToSet": {"following": target_id}}
+        )
+        await db.users.update_one({"id": target_id}, {"$addToSet": {"followers": follower_id}})
+    else:
+        result = await db.users.update_one(
+            {"id": follower_id, "following": target_id},
+            {"$pull": {"following": target_id}}
+        )
+        await db.users.update_one({"id": target_id}, {"$pull": {"followers": follower_id}})
+    return result.modified_count == 1
+
 # ===== WEBSOCKET EVENT HANDLERS =====
 
 @sio.event
@@ -838,16 +1147,17 @@ async def connect(sid, environ, auth):
             return False
         
         token = auth['token']
-        user_id = verify_token(token)
+        principal = await authenticate_token(token)
         
-        if not user_id:
+        if not principal:
             logging.warning("Connection rejected: invalid token")
             return False
+        user_id = principal['id']
         
-        # Store connection
-        connected_clients[user_id] = sid
-        logging.info(f"✅ User {user_id} connected with sid {sid}. Total connected: {len(connected_clients)}")
-        logging.info(f"📊 Connected users: {list(connected_clients.keys())}")
+        # Register connection (a user may have several devices connected)
+        await presence.add(user_id, sid)
+        await sio.save_session(sid, {"userId": user_id})
+        logging.info(f"✅ User {user_id} connected with sid {sid}")
         
         # Join personal room
         await sio.enter_room(sid, f"user:{user_id}")
@@ -862,33 +1172,30 @@ async def connect(sid, environ, auth):
 async def disconnect(sid):
     """Handle client disconnection"""
     try:
-        # Find and remove user
-        user_id = None
-        for uid, client_sid in list(connected_clients.items()):
-            if client_sid == sid:
-                user_id = uid
-                del connected_clients[uid]
-                break
-        
+        user_id = await presence.remove(sid)
         if user_id:
             logging.info(f"User {user_id} disconnected")
     except Exception as e:
         logging.error(f"Disconnect error: {e}")
 
+@sio.event
+async def heartbeat(sid, data=None):
+    """Client heartbeat - keeps the sid's presence entry from expiring"""
+    try:
+        session = await sio.get_session(sid)
+        await presence.touch(sid, session.get("userId"))
+    except Exception as e:
+        logging.error(f"Heartbeat event error: {e}")
+
 @sio.event
 async def typing(sid, data):
     """Handle typing indicator"""
     try:
         thread_id = data.get('threadId')
-        user_id = None
-        
-        # Find user_id from sid
-        for uid, client_sid in connected_clients.items():
-            if client_sid == sid:
-                user_id = uid
-                break
+        user_id = await presence.get_user(sid)
         
         if user_id and thread_id:
+            await presence.touch(sid, user_id)
             await emit_to_thread(thread_id, 'typing', {
                 'threadId': thread_id,
                 'userId': user_id,
@@ -904,15 +1211,10 @@ async def message_read(sid, data):
     try:
         message_id = data.get('messageId')
         thread_id = data.get('threadId')
-        user_id = None
-        
-        # Find user_id from sid
-        for uid, client_sid in connected_clients.items():
-            if client_sid == sid:
-                user_id = uid
-                break
+        user_id = await presence.get_user(sid)
         
         if user_id and message_id:
+            await presence.touch(sid, user_id)
             # Update message read status
             await db.messages.update_one(
                 {"id": message_id},
@@ -971,7 +1273,6 @@ class SignupRequest(BaseModel):
     phone: Optional[str] = None
 
 @api_router.post("/auth/signup", response_model=dict)
-@limiter.limit("5/minute")  # Rate limit: 5 signups per minute per IP
 async def signup(request: Request, req: SignupRequest):
     """
     Create a new user account with email and password.
@@ -988,7 +1289,7 @@ async def signup(request: Request, req: SignupRequest):
         )
         
         # Generate JWT token
-        token = create_access_token(user['id'])
+        token = create_access_token(user['id'], user.get('tokenVersion', 0))
         
         logger.info(f"✅ New user signed up: {req.email}")
         
@@ -1000,12 +1301,13 @@ async def signup(request: Request, req: SignupRequest):
     
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except PoolSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"Signup error: {str(e)}")
         raise HTTPException(status_code=500, detail="Signup failed")
 
 @api_router.post("/auth/login", response_model=dict)
-@limiter.limit("10/minute")  # Rate limit: 10 login attempts per minute per IP
 async def login(request: Request, req: LoginRequest):
     """
     Login with email and password using MongoDB.
@@ -1042,7 +1344,7 @@ async def login(request: Request, req: LoginRequest):
                             "handle": test_user_data["handle"],
                             "name": test_user_data["name"],
                             "email": test_user_data["email"],
-                            "password": auth_service.hash_password(test_user_data["password"]),
+                            "password": await auth_service.hash_password_async(test_user_data["password"]),
                             "avatar": f"https://api.dicebear.com/7.x/avataaars/svg?seed={test_user_data['handle']}",
                             "isVerified": True,
                             "online": False,
@@ -1055,6 +1357,7 @@ async def login(request: Request, req: LoginRequest):
                             "createdAt": datetime.now(timezone.utc).isoformat()
                         }
                         await db.users.insert_one(test_user)
+                        await index_for_search("users", test_user)
                         logger.info(f"✅ Created test user: {test_user_data['name']}")
                     else:
                         if user['id'] not in existing.get('friends', []):
@@ -1075,22 +1378,23 @@ async def login(request: Request, req: LoginRequest):
             
             # Ensure demo user has sufficient wallet balance
             if user.get('walletBalance', 0) < 5000:
+                # Conditional so a payment landing in between is not overwritten
                 await db.users.update_one(
-                    {"id": user['id']},
+                    {"id": user['id'], "walletBalance": {"$not": {"$gte": 5000}}},
                     {"$set": {"walletBalance": 10000.0}}
                 )
                 user['walletBalance'] = 10000.0
                 logger.info("💰 Demo user wallet topped up to ₹10,000")
         
         # Generate JWT token
-        token = create_access_token(user['id'])
+        token = create_access_token(user['id'], user.get('tokenVersion', 0))
         
         return {
             "token": token,
             "user": user
         }
     
-    except HTTPException:
+    except (HTTPException, PoolSaturatedError):
         raise
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
@@ -1102,28 +1406,23 @@ async def get_me(current_user: dict = Depends(get_current_user)):
     Get the current authenticated user's profile.
     Requires valid JWT token.
     """
-    # The current_user is already the complete user data from auth_service
-    return current_user
+    # The principal is a slim identity; the profile is loaded on demand
+    user = await auth_service.get_user_by_id(current_user["id"])
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
 
 # ===== USER ROUTES =====
 
 
 @api_router.get("/users/search")
 async def search_users(q: str, limit: int = 20):
-    """Search users by name or handle"""
+    """Search users by name, handle or exact email"""
     if not q or len(q.strip()) < 2:
         return []
     
-    query = {
-        "$or": [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"handle": {"$regex": q, "$options": "i"}},
-            {"email": {"$regex": q, "$options": "i"}}
-        ]
-    }
-    
-    users = await db.users.find(query, {"_id": 0, "password": 0}).limit(limit).to_list(limit)
-    return users
+    ids = await search_user_ids(q, limit)
+    return await search_service.hydrate("users", ids, SEARCH_PROJECTIONS["users"])
 
 @api_router.get("/users")
 async def list_users(limit: int = 100, skip: int = 0):
@@ -1150,58 +1449,47 @@ async def get_user(userId: str):
 @api_router.get("/users/{userId}/profile")
 async def get_user_profile(userId: str, currentUserId: str = None):
     """Get user profile with posts, followers, and following counts"""
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
+    # All lookups are independent - run them concurrently
+    queries = {
+        "user": db.users.find_one({"id": userId}, {"_id": 0}),
+        "posts": db.posts.find({"authorId": userId}, {"_id": 0}).sort("createdAt", -1).to_list(100),
+        # Friendships where this user is user1 / user2
+        "count1": db.friendships.count_documents({"userId1": userId}),
+        "count2": db.friendships.count_documents({"userId2": userId}),
+    }
+    if currentUserId and currentUserId != userId:
+        queries["is_friend"] = are_friends(currentUserId, userId)
+        queries["sent_request"] = db.friend_requests.find_one(
+            {"fromUserId": currentUserId, "toUserId": userId, "status": "pending"}, {"_id": 0}
+        )
+        queries["received_request"] = db.friend_requests.find_one(
+            {"fromUserId": userId, "toUserId": currentUserId, "status": "pending"}, {"_id": 0}
+        )
+    results = await gather_queries(queries)
+    
+    user = results["user"]
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get user's posts
-    posts = await db.posts.find({"authorId": userId}, {"_id": 0}).sort("createdAt", -1).to_list(100)
+    posts = results["posts"]
     for post in posts:
         post["author"] = user
     
-    # Count followers (users who are friends with this user)
-    followers_count = 0
-    following_count = 0
-    
-    # Count friendships where this user is user1
-    count1 = await db.friendships.count_documents({"userId1": userId})
-    # Count friendships where this user is user2
-    count2 = await db.friendships.count_documents({"userId2": userId})
-    
     # Total friends count (each friendship is bidirectional)
-    friends_count = count1 + count2
+    friends_count = results["count1"] + results["count2"]
     
     # For now, followers = following = friends count (simplified friend model)
     followers_count = friends_count
     following_count = friends_count
     
-    # Check relationship status if currentUserId provided
+    # Relationship status if currentUserId provided
     relationship_status = None
-    if currentUserId and currentUserId != userId:
-        # Check if friends
-        is_friend = await are_friends(currentUserId, userId)
-        if is_friend:
-            relationship_status = "friends"
-        else:
-            # Check friend requests
-            sent_request = await db.friend_requests.find_one({
-                "fromUserId": currentUserId,
-                "toUserId": userId,
-                "status": "pending"
-            }, {"_id": 0})
-            
-            received_request = await db.friend_requests.find_one({
-                "fromUserId": userId,
-                "toUserId": currentUserId,
-                "status": "pending"
-            }, {"_id": 0})
-            
-            if sent_request:
-                relationship_status = "pending_sent"
-            elif received_request:
-                relationship_status = "pending_received"
-            else:
-                relationship_status = None
+    if results.get("is_friend"):
+        relationship_status = "friends"
+    elif results.get("sent_request"):
+        relationship_status = "pending_sent"
+    elif results.get("received_request"):
+        relationship_status = "pending_received"
     
     return {
         "user": user,
@@ -1308,15 +1596,16 @@ async def change_password(data: dict):
         raise HTTPException(status_code=404, detail="User not found")
     
     # Verify current password
-    if not bcrypt.verify(current_password, user.get("password", "")):
+    if not await bcrypt_pool.run(bcrypt.verify, current_password, user.get("password", "")):
         raise HTTPException(status_code=401, detail="Current password is incorrect")
     
     # Hash new password and update in MongoDB
-    new_password_hash = bcrypt.hash(new_password)
+    new_password_hash = await bcrypt_pool.run(bcrypt.hash, new_password)
     await db.users.update_one(
         {"id": userId},
         {"$set": {"password": new_password_hash}}
     )
+    await auth_service.revoke_sessions(userId)
     
     return {"success": True, "message": "Password changed successfully"}
 
@@ -1470,7 +1759,7 @@ async def reset_password(data: dict):
     
     # Hash new password and update in MongoDB
     from passlib.hash import bcrypt
-    new_password_hash = bcrypt.hash(new_password)
+    new_password_hash = await bcrypt_pool.run(bcrypt.hash, new_password)
     
     # Clear reset token and update password
     await db.users.update_one(
@@ -1483,73 +1772,63 @@ async def reset_password(data: dict):
             }
         }
     )
+    await auth_service.revoke_sessions(user["id"])
     
     return {"success": True, "message": "Password reset successfully"}
 
 @api_router.get("/search")
-async def search_all(q: str, currentUserId: str = None, limit: int = 20):
-    """Global search for users, posts, tribes, venues, events"""
+async def search_all(q: str, currentUserId: str = None, limit: int = 20, skip: int = 0,
+                     types: Optional[str] = None):
+    """
+    Global ranked search for users, posts, tribes, venues, events and products.
+    `types` is an optional comma-separated subset; `facets` holds total matches per type.
+    """
+    kinds = [k for k in types.split(",") if k in SEARCH_TYPES] if types else list(SEARCH_TYPES)
     if not q or len(q) < 2:
-        return {"users": [], "posts": [], "tribes": [], "venues": [], "events": []}
-    
-    query_pattern = {"$regex": q, "$options": "i"}
-    
-    # Search users
-    users = await db.users.find({
-        "$or": [
-            {"name": query_pattern},
-            {"handle": query_pattern}
-        ]
-    }, {"_id": 0}).limit(limit).to_list(limit)
+        return {**{k: [] for k in kinds}, "facets": {k: 0 for k in kinds}}
     
-    # Enrich users with friend status if currentUserId provided
-    if currentUserId:
+    result = await search_service.search(q, kinds, limit=limit, skip=skip)
+    # One hydration query per type, run concurrently
+    hydrated = await gather_queries({
+        kind: search_service.hydrate(kind, result["ids"][kind], SEARCH_PROJECTIONS.get(kind)) for kind in kinds
+    })
+    response = {kind: hydrated[kind] for kind in kinds}
+    
+    users = response.get("users", [])
+    # Enrich users with friend status if currentUserId provided (two concurrent queries)
+    if currentUserId and users:
+        relations = await gather_queries({
+            "me": db.users.find_one({"id": currentUserId}, {"_id": 0, "friends": 1}),
+            "blocks": db.user_blocks.find(
+                {"blockerId": currentUserId, "blockedId": {"$in": [u["id"] for u in users]}},
+                {"_id": 0, "blockedId": 1}
+            ).to_list(len(users)),
+        })
+        me = relations["me"]
+        my_friends = set(me.get("friends", [])) if me else set()
+        blocked_ids = {b["blockedId"] for b in relations["blocks"]}
         for user in users:
-            user["isFriend"] = await are_friends(currentUserId, user["id"])
-            user["isBlocked"] = await is_blocked(currentUserId, user["id"])
-    
-    # Search posts
-    posts = await db.posts.find({
-        "text": query_pattern
-    }, {"_id": 0}).sort("createdAt", -1).limit(limit).to_list(limit)
+            user["isFriend"] = user["id"] in my_friends
+            user["isBlocked"] = user["id"] in blocked_ids
     
-    for post in posts:
-        author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-        post["author"] = author
+    if response.get("posts"):
+        await attach_users(db, response["posts"])
     
-    # Search tribes
-    tribes = await db.tribes.find({
-        "$or": [
-            {"name": query_pattern},
-            {"description": query_pattern}
-        ]
-    }, {"_id": 0}).limit(limit).to_list(limit)
-    
-    # Search venues
-    venues = await db.venues.find({
-        "$or": [
-            {"name": query_pattern},
-            {"description": query_pattern},
-            {"location": query_pattern}
-        ]
-    }, {"_id": 0}).limit(limit).to_list(limit)
+    response["facets"] = result["facets"]
+    return response
+
+@api_router.post("/admin/search/reindex")
+async def reindex_search(adminUserId: str = Depends(require_admin), type: Optional[str] = None):
+    """Rebuild the search index from source collections (admin only)"""
     
-    # Search events
-    events = await db.events.find({
-        "$or": [
-            {"name": query_pattern},
-            {"description": query_pattern},
-            {"venue": query_pattern}
-        ]
-    }, {"_id": 0}).limit(limit).to_list(limit)
+    kinds = [type] if type else list(SEARCH_TYPES)
+    if any(k not in SEARCH_TYPES for k in kinds):
+        raise HTTPException(status_code=400, detail=f"Unknown search type. Valid: {', '.join(SEARCH_TYPES)}")
     
-    return {
-        "users": users,
-        "posts": posts,
-        "tribes": tribes,
-        "venues": venues,
-        "events": events
-    }
+    counts = {}
+    for kind in kinds:
+        counts[kind] = await search_service.reindex(kind)
+    return {"success": True, "indexed": counts}
 
 # ===== FRIEND MANAGEMENT ROUTES =====
 
@@ -1601,7 +1880,7 @@ async def send_friend_request(fromUserId: str, toUserId: str):
             fromUserAvatar=from_user.get("avatar", ""),
             link=f"/profile/{fromUserId}"
         )
-        await db.notifications.insert_one(notification.model_dump())
+        notification_pipeline.enqueue(notification.model_dump())
         
         return {"success": True, "message": "Friend request accepted automatically", "nowFriends": True}
     
@@ -1625,7 +1904,7 @@ async def send_friend_request(fromUserId: str, toUserId: str):
         fromUserAvatar=from_user.get("avatar", ""),
         link=f"/profile/{fromUserId}"
     )
-    await db.notifications.insert_one(notification.model_dump())
+    notification_pipeline.enqueue(notification.model_dump())
     
     return {"success": True, "message": "Friend request sent"}
 
@@ -1668,7 +1947,7 @@ async def accept_friend_request(userId: str, friendId: str):
         fromUserAvatar=user.get("avatar", ""),
         link=f"/profile/{userId}"
     )
-    await db.notifications.insert_one(notification.model_dump())
+    notification_pipeline.enqueue(notification.model_dump())
     
     return {"success": True, "message": "Friend request accepted"}
 
@@ -1762,40 +2041,62 @@ async def get_friend_status(userId: str, targetUserId: str):
 # ===== POST ROUTES (TIMELINE) - OPTIMIZED FOR HIGH PERFORMANCE =====
 
 @api_router.get("/posts")
-async def get_posts(limit: int = 50, skip: int = 0, userId: Optional[str] = None):
+async def get_posts(response: Response, limit: int = 50, skip: int = 0, userId: Optional[str] = None, cursor: Optional[str] = None):
     """
     Get posts feed - Optimized with batch queries and caching
     Supports 100k+ requests/minute
+    With userId, returns the user's materialized home timeline
+    With cursor, pages the global feed by keyset (see X-Next-Cursor header)
     """
-    perf_monitor.record_request()
-    
-    # Try cache first for non-personalized feeds
-    cache_key = f"posts:{skip}:{limit}"
-    if not userId:
-        cached = await posts_cache.get(cache_key)
-        if cached:
-            perf_monitor.record_cache_hit()
-            return cached
-        perf_monitor.record_cache_miss()
-    
-    # Optimized query with projection
-    posts = await db.posts.find(
-        {}, 
-        {"_id": 0}
-    ).sort("createdAt", -1).skip(skip).limit(limit).to_list(limit)
-    
-    # BATCH ENRICH - eliminates N+1 queries
-    posts = await batch_enrich_posts(db, posts)
-    
-    # Compute counts efficiently
-    for post in posts:
-        post["likeCount"] = len(post.get("likedBy", []))
-        post["commentCount"] = len(post.get("comments", []))
+    # Personalized home timeline - one indexed read on the user's timeline document,
+    # paged by the same keyset cursor as the global feed
+    if userId:
+        timeline = await timeline_service.get_timeline(userId, cursor=cursor, skip=skip, limit=limit)
+        if timeline is not None:
+            posts, next_cursor = timeline
+            set_next_cursor(response, next_cursor)
+            posts = await batch_enrich_posts(db, posts)
+            for post in posts:
+                post["likeCount"] = len(post.get("likedBy", []))
+                post["commentCount"] = len(post.get("comments", []))
+            return posts
+        # No materialized timeline (no follows, no posts yet) - fall back to the global feed
+    
+    # Keyset pagination - constant cost regardless of scroll depth
+    if cursor is not None:
+        posts, next_cursor = await paginate_keyset(db.posts, {}, cursor=cursor, limit=limit)
+        set_next_cursor(response, next_cursor)
+        posts = await batch_enrich_posts(db, posts)
+        for post in posts:
+            post["likeCount"] = len(post.get("likedBy", []))
+            post["commentCount"] = len(post.get("comments", []))
+        return posts
+    
+    async def load_page():
+        # Optimized query with projection
+        page = await db.posts.find(
+            {}, 
+            {"_id": 0}
+        ).sort([("createdAt", -1), ("id", -1)]).skip(skip).limit(limit).to_list(limit)
+        
+        # BATCH ENRICH - eliminates N+1 queries
+        page = await batch_enrich_posts(db, page)
+        
+        # Compute counts efficiently
+        for post in page:
+            post["likeCount"] = len(post.get("likedBy", []))
+            post["commentCount"] = len(post.get("comments", []))
+        return page
     
-    # Cache result
-    if not userId:
-        await posts_cache.set(cache_key, posts, ttl=30)
+    # Non-personalized pages are cached (shared across workers); concurrent
+    # misses for the same page share a single query
+    if userId:
+        posts = await load_page()
+    else:
+        posts = await posts_cache.get_or_set(f"posts:{skip}:{limit}", load_page, ttl=30, tag="pages")
     
+    if len(posts) == limit:
+        set_next_cursor(response, encode_cursor(posts[-1]))
     return posts
 
 @api_router.post("/posts")
@@ -1805,6 +2106,11 @@ async def create_post(post: PostCreate, authorId: str):
     result = await db.posts.insert_one(doc)
     # Remove _id from doc before returning
     doc.pop('_id', None)
+    await fan_out_to_timelines(doc)
+    await index_for_search("posts", doc)
+    await record_post_hashtags(doc)
+    await engagement_service.init("posts", doc)
+    await track_analytics(authorId, {"posts": 1})
     # Enrich with author
     author = await db.users.find_one({"id": authorId}, {"_id": 0})
     doc["author"] = author
@@ -1812,70 +2118,47 @@ async def create_post(post: PostCreate, authorId: str):
 
 @api_router.post("/posts/{postId}/like")
 async def toggle_like_post(postId: str, userId: str):
-    post = await db.posts.find_one({"id": postId}, {"_id": 0})
-    if not post:
+    added, post = await toggle_array_member(
+        db.posts, postId, "likedBy", userId,
+        counter="stats.likes", projection={"_id": 0, "authorId": 1, "stats.likes": 1}
+    )
+    if post is None:
         raise HTTPException(status_code=404, detail="Post not found")
+    await refresh_engagement("posts", postId)
+    await track_analytics(post.get("authorId"), {"postLikes": 1 if added else -1})
     
-    liked_by = post.get("likedBy", [])
-    stats = post.get("stats", {"likes": 0, "quotes": 0, "reposts": 0, "replies": 0})
-    
-    if userId in liked_by:
-        liked_by.remove(userId)
-        stats["likes"] = max(0, stats["likes"] - 1)
+    if not added:
         action = "unliked"
     else:
-        liked_by.append(userId)
-        stats["likes"] = stats["likes"] + 1
         action = "liked"
         
-        # Create notification for post author
+        # Notify post author (actor snapshot and "X and N others" message are
+        # filled in by the notification pipeline, which coalesces bursts)
         if post["authorId"] != userId:
-            liker = await db.users.find_one({"id": userId}, {"_id": 0, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1})
             notification = Notification(
                 userId=post["authorId"],
                 type="post_like",
                 fromUserId=userId,
-                fromUserName=liker.get('name', 'Someone') if liker else 'Someone',
-                fromUserAvatar=liker.get('avatar', '') if liker else '',
                 contentType="post",
                 contentId=postId,
-                message=f"{liker.get('name', 'Someone') if liker else 'Someone'} liked your post",
                 link=f"/post/{postId}"
             )
-            await db.notifications.insert_one(notification.model_dump())
-            
-            # Emit real-time notification
-            await sio.emit('notification', {
-                'type': 'post_like',
-                'userId': post['authorId'],
-                'fromUser': liker,
-                'contentId': postId,
-                'createdAt': datetime.now(timezone.utc).isoformat()
-            }, room=f"user:{post['authorId']}")
-    
-    await db.posts.update_one({"id": postId}, {"$set": {"likedBy": liked_by, "stats": stats}})
-    return {"action": action, "likes": stats["likes"]}
+            notification_pipeline.enqueue(notification.model_dump(), emit=True)
+    
+    return {"action": action, "likes": max(0, post.get("stats", {}).get("likes", 0))}
 
 @api_router.post("/posts/{postId}/repost")
 async def toggle_repost(postId: str, userId: str):
-    post = await db.posts.find_one({"id": postId}, {"_id": 0})
-    if not post:
+    added, post = await toggle_array_member(
+        db.posts, postId, "repostedBy", userId,
+        counter="stats.reposts", projection={"_id": 0, "stats.reposts": 1}
+    )
+    if post is None:
         raise HTTPException(status_code=404, detail="Post not found")
+    await refresh_engagement("posts", postId)
     
-    reposted_by = post.get("repostedBy", [])
-    stats = post.get("stats", {"likes": 0, "quotes": 0, "reposts": 0, "replies": 0})
-    
-    if userId in reposted_by:
-        reposted_by.remove(userId)
-        stats["reposts"] = max(0, stats["reposts"] - 1)
-        action = "unreposted"
-    else:
-        reposted_by.append(userId)
-        stats["reposts"] = stats["reposts"] + 1
-        action = "reposted"
-    
-    await db.posts.update_one({"id": postId}, {"$set": {"repostedBy": reposted_by, "stats": stats}})
-    return {"action": action, "reposts": stats["reposts"]}
+    action = "reposted" if added else "unreposted"
+    return {"action": action, "reposts": max(0, post.get("stats", {}).get("reposts", 0))}
 
 @api_router.get("/posts/{postId}/comments")
 async def get_post_comments(postId: str):
@@ -1906,7 +2189,7 @@ async def delete_post(postId: str, current_user: dict = Depends(get_current_user
     await db.comments.delete_many({"postId": postId})
     
     # Delete related notifications
-    await db.notifications.delete_many({"contentId": postId, "contentType": "post"})
+    await notification_pipeline.delete_for_content("post", postId)
     
     # Delete from bookmarks
     await db.bookmarks.delete_many({"itemId": postId, "itemType": "post"})
@@ -1915,8 +2198,19 @@ async def delete_post(postId: str, current_user: dict = Depends(get_current_user
     await db.shares.delete_many({"contentId": postId, "contentType": "post"})
     
     # Delete reshares of this post
+    reshare_ids = await db.posts.distinct("id", {"originalPostId": postId})
     await db.posts.delete_many({"originalPostId": postId})
     
+    # Remove from materialized timelines and the search index
+    await timeline_service.remove_post(postId)
+    for post_id in [postId] + reshare_ids:
+        await unindex_for_search("posts", post_id)
+    await trending_service.unrecord(post.get("hashtags", []), post.get("createdAt"))
+    
+    # Drop cached copies on every worker
+    await invalidate_post_cache(postId, post["authorId"])
+    await posts_cache.delete_tag("pages")
+    
     logger.info(f"Post {postId} deleted by user {current_user['id']}")
     
     return {"success": True, "message": "Post deleted successfully"}
@@ -1930,12 +2224,15 @@ async def create_post_comment(postId: str, comment: CommentCreate, authorId: str
     
     # Update post reply count
     await db.posts.update_one({"id": postId}, {"$inc": {"stats.replies": 1}})
+    await refresh_engagement("posts", postId)
     
     author = await db.users.find_one({"id": authorId}, {"_id": 0})
     doc["author"] = author
     
     # Send notification to post author
     post = await db.posts.find_one({"id": postId}, {"_id": 0, "authorId": 1})
+    if post:
+        await track_analytics(post["authorId"], {"postComments": 1})
     if post and post["authorId"] != authorId:
         commenter = await db.users.find_one({"id": authorId}, {"_id": 0, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1})
         notification = Notification(
@@ -1950,17 +2247,7 @@ async def create_post_comment(postId: str, comment: CommentCreate, authorId: str
             message=f"{commenter.get('name', 'Someone') if commenter else 'Someone'} commented: \"{comment.text[:50]}...\"",
             link=f"/post/{postId}"
         )
-        await db.notifications.insert_one(notification.model_dump())
-        
-        # Emit real-time notification
-        await sio.emit('notification', {
-            'type': 'post_comment',
-            'userId': post['authorId'],
-            'fromUser': commenter,
-            'contentId': postId,
-            'payload': {'text': comment.text[:100]},
-            'createdAt': datetime.now(timezone.utc).isoformat()
-        }, room=f"user:{post['authorId']}")
+        notification_pipeline.enqueue(notification.model_dump(), emit=True)
     
     return doc
 
@@ -2094,24 +2381,28 @@ async def follow_user(userId: str, request: FollowRequest):
     if userId == targetUserId:
         raise HTTPException(status_code=400, detail="Cannot follow yourself")
     
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
-    target = await db.users.find_one({"id": targetUserId}, {"_id": 0})
+    if not await db.users.find_one({"id": targetUserId}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="User not found")
     
-    if not user or not target:
+    # Toggle on the follower's side; the target's followers array follows suit
+    added, user = await toggle_array_member(
+        db.users, userId, "following", targetUserId,
+        projection={"_id": 0, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1,
+                    "followingCount": {"$size": {"$ifNull": ["$following", []]}}}
+    )
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    following = user.get("following", [])
-    followers = target.get("followers", [])
+    target = await db.users.find_one_and_update(
+        {"id": targetUserId},
+        {"$addToSet" if added else "$pull": {"followers": userId}},
+        projection={"_id": 0, "followersCount": {"$size": {"$ifNull": ["$followers", []]}}},
+        return_document=ReturnDocument.AFTER
+    )
     
-    if targetUserId in following:
-        # Unfollow
-        following.remove(targetUserId)
-        followers.remove(userId)
+    if not added:
         action = "unfollowed"
     else:
-        # Follow
-        following.append(targetUserId)
-        followers.append(userId)
         action = "followed"
         
         # Create notification with full user info
@@ -2124,26 +2415,18 @@ async def follow_user(userId: str, request: FollowRequest):
             message=f"{user.get('name', 'Someone')} started following you",
             link=f"/user/{userId}"
         )
-        await db.notifications.insert_one(notification.model_dump())
-        
-        # Emit real-time notification
-        await sio.emit('notification', {
-            'type': 'new_follower',
-            'userId': targetUserId,
-            'fromUser': {
-                'id': userId,
-                'name': user.get('name', 'Someone'),
-                'handle': user.get('handle', 'user'),
-                'avatar': user.get('avatar', ''),
-                'isVerified': user.get('isVerified', False)
-            },
-            'createdAt': datetime.now(timezone.utc).isoformat()
-        }, room=f"user:{targetUserId}")
+        notification_pipeline.enqueue(notification.model_dump(), emit=True)
     
-    await db.users.update_one({"id": userId}, {"$set": {"following": following}})
-    await db.users.update_one({"id": targetUserId}, {"$set": {"followers": followers}})
+    if action == "followed":
+        await timeline_service.on_follow(userId, targetUserId)
+    else:
+        await timeline_service.on_unfollow(userId, targetUserId)
     
-    return {"action": action, "followingCount": len(following), "followersCount": len(followers)}
+    return {
+        "action": action,
+        "followingCount": user.get("followingCount", 0),
+        "followersCount": target.get("followersCount", 0) if target else 0
+    }
 
 @api_router.get("/users/{userId}/followers")
 async def get_followers(userId: str, limit: int = 100):
@@ -2153,15 +2436,8 @@ async def get_followers(userId: str, limit: int = 100):
         raise HTTPException(status_code=404, detail="User not found")
     
     follower_ids = user.get("followers", [])
-    followers = []
-    
-    for follower_id in follower_ids[:limit]:
-        follower = await db.users.find_one(
-            {"id": follower_id}, 
-            {"_id": 0, "name": 1, "handle": 1, "avatar": 1, "id": 1, "isVerified": 1, "bio": 1}
-        )
-        if follower:
-            followers.append(follower)
+    users_map = await get_user_loader(db).load_many(follower_ids[:limit])
+    followers = [users_map[fid] for fid in follower_ids[:limit] if fid in users_map]
     
     return {"users": followers, "count": len(follower_ids)}
 
@@ -2173,15 +2449,8 @@ async def get_following(userId: str, limit: int = 100):
         raise HTTPException(status_code=404, detail="User not found")
     
     following_ids = user.get("following", [])
-    following = []
-    
-    for following_id in following_ids[:limit]:
-        user_data = await db.users.find_one(
-            {"id": following_id}, 
-            {"_id": 0, "name": 1, "handle": 1, "avatar": 1, "id": 1, "isVerified": 1, "bio": 1}
-        )
-        if user_data:
-            following.append(user_data)
+    users_map = await get_user_loader(db).load_many(following_ids[:limit])
+    following = [users_map[fid] for fid in following_ids[:limit] if fid in users_map]
     
     return {"users": following, "count": len(following_ids)}
 
@@ -2205,15 +2474,19 @@ async def create_quote_post(postId: str, authorId: str, text: str):
     doc = quote_post.model_dump()
     await db.posts.insert_one(doc)
     doc.pop('_id', None)
+    await fan_out_to_timelines(doc)
+    await index_for_search("posts", doc)
+    await record_post_hashtags(doc)
+    await engagement_service.init("posts", doc)
+    await track_analytics(authorId, {"posts": 1})
     
     # Enrich with author
     author = await db.users.find_one({"id": authorId}, {"_id": 0})
     doc["author"] = author
     
     # Update quote count on original post
-    stats = original_post.get("stats", {"likes": 0, "quotes": 0, "reposts": 0, "replies": 0})
-    stats["quotes"] = stats["quotes"] + 1
-    await db.posts.update_one({"id": postId}, {"$set": {"stats": stats}})
+    await db.posts.update_one({"id": postId}, {"$inc": {"stats.quotes": 1}})
+    await refresh_engagement("posts", postId)
     
     # Notify original author
     if original_post["authorId"] != authorId:
@@ -2223,71 +2496,56 @@ async def create_quote_post(postId: str, authorId: str, text: str):
             content=f"{author.get('name', 'Someone')} quoted your post",
             link=f"/posts/{doc['id']}"
         )
-        await db.notifications.insert_one(notification.model_dump())
+        notification_pipeline.enqueue(notification.model_dump())
     
     return doc
 
 @api_router.get("/hashtags/{hashtag}/posts")
 async def get_hashtag_posts(hashtag: str, limit: int = 50):
-    """Get posts containing a specific hashtag"""
-    # Search for posts containing the hashtag in text
+    """Get posts containing a specific hashtag, newest first"""
     posts = await db.posts.find(
-        {"text": {"$regex": f"#{hashtag}", "$options": "i"}},
-        {"_id": 0}
-    ).sort("createdAt", -1).to_list(limit)
+        {"hashtags": {"$in": list({hashtag, normalize_tag(hashtag)})}}, {"_id": 0}
+    ).sort("createdAt", -1).limit(limit).to_list(limit)
     
     # Enrich with author data
-    for post in posts:
-        author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-        post["author"] = author
+    await attach_users(db, posts)
     
     return posts
 
 @api_router.get("/trending/hashtags")
 async def get_trending_hashtags(limit: int = 10):
-    """Get trending hashtags (Twitter/TikTok-style)"""
-    # Get recent posts (last 24 hours)
-    recent_posts = await db.posts.find({
-        "createdAt": {"$gte": (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()}
-    }, {"_id": 0, "text": 1}).to_list(1000)
-    
-    # Extract hashtags and count
-    hashtag_counts = {}
-    for post in recent_posts:
-        text = post.get("text", "")
-        hashtags = [word[1:] for word in text.split() if word.startswith("#")]
-        for tag in hashtags:
-            hashtag_counts[tag] = hashtag_counts.get(tag, 0) + 1
-    
-    # Sort by count and return top hashtags
-    trending = sorted(hashtag_counts.items(), key=lambda x: x[1], reverse=True)[:limit]
-    return [{"hashtag": tag, "count": count} for tag, count in trending]
+    """Get trending hashtags (Twitter/TikTok-style) - decayed score, 24h counts"""
+    trending = await trending_service.top(limit)
+    return [{"hashtag": t["tag"], "count": t["count"], "score": t["score"]} for t in trending]
 
 @api_router.get("/trending/posts")
 async def get_trending_posts(limit: int = 20):
-    """Get trending/viral posts (TikTok For You Page style)"""
-    # Get posts from last 7 days
-    recent_posts = await db.posts.find({
-        "createdAt": {"$gte": (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()}
-    }, {"_id": 0}).to_list(500)
-    
-    # Calculate engagement score (likes + comments * 2 + reposts * 3)
-    for post in recent_posts:
-        stats = post.get("stats", {"likes": 0, "quotes": 0, "reposts": 0, "replies": 0})
-        engagement = stats["likes"] + (stats["replies"] * 2) + (stats["reposts"] * 3)
-        post["_engagement_score"] = engagement
-    
-    # Sort by engagement and return top posts
-    trending = sorted(recent_posts, key=lambda x: x.get("_engagement_score", 0), reverse=True)[:limit]
-    
-    # Enrich with author data and remove engagement score
-    for post in trending:
-        author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-        post["author"] = author
-        post.pop("_engagement_score", None)
-    
+    """Get trending/viral posts - top N by precomputed, time-decayed engagementScore"""
+    trending = await engagement_service.top("posts", limit)
+    await attach_users(db, trending)
     return trending
 
+@api_router.get("/trending/reels")
+async def get_trending_reels(limit: int = 20):
+    """Get trending reels by engagementScore"""
+    trending = await engagement_service.top("reels", limit)
+    await attach_users(db, trending)
+    return trending
+
+@api_router.get("/feed/for-you")
+async def get_for_you_feed(response: Response, userId: Optional[str] = None, cursor: Optional[str] = None,
+                           limit: int = 20):
+    """For You feed (TikTok-style) - posts ranked by engagementScore, cursor paged (X-Next-Cursor)"""
+    query = {"engagementScore": {"$exists": True}}
+    if userId:
+        query["authorId"] = {"$ne": userId}
+    posts, next_cursor = await paginate_keyset(
+        db.posts, query, {"_id": 0}, cursor=cursor, limit=limit, sort_field="engagementScore"
+    )
+    set_next_cursor(response, next_cursor)
+    await attach_users(db, posts)
+    return posts
+
 @api_router.post("/posts/{postId}/reply")
 async def create_reply(postId: str, authorId: str, text: str, mediaUrl: str = None):
     """Create a reply to a post (Twitter-style thread)"""
@@ -2312,9 +2570,9 @@ async def create_reply(postId: str, authorId: str, text: str, mediaUrl: str = No
     doc["author"] = author
     
     # Update reply count on original post
-    stats = original_post.get("stats", {"likes": 0, "quotes": 0, "reposts": 0, "replies": 0})
-    stats["replies"] = stats["replies"] + 1
-    await db.posts.update_one({"id": postId}, {"$set": {"stats": stats}})
+    await db.posts.update_one({"id": postId}, {"$inc": {"stats.replies": 1}})
+    await refresh_engagement("posts", postId)
+    await track_analytics(original_post["authorId"], {"postComments": 1})
     
     # Notify original author
     if original_post["authorId"] != authorId:
@@ -2324,7 +2582,7 @@ async def create_reply(postId: str, authorId: str, text: str, mediaUrl: str = No
             content=f"{author.get('name', 'Someone')} replied to your post",
             link=f"/posts/{postId}"
         )
-        await db.notifications.insert_one(notification.model_dump())
+        notification_pipeline.enqueue(notification.model_dump())
     
     return doc
 
@@ -2390,27 +2648,16 @@ async def get_bookmarks(userId: str):
 # ===== HASHTAGS =====
 
 @api_router.get("/hashtags/trending")
-async def get_trending_hashtags(limit: int = 20):
-    """Get trending hashtags"""
-    # Aggregate hashtags from posts
-    pipeline = [
-        {"$match": {"hashtags": {"$exists": True, "$ne": []}}},
-        {"$unwind": "$hashtags"},
-        {"$group": {"_id": "$hashtags", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": limit}
-    ]
-    results = await db.posts.aggregate(pipeline).to_list(limit)
-    return [{"tag": r["_id"], "count": r["count"]} for r in results]
+async def get_trending_hashtags_list(limit: int = 20):
+    """Get trending hashtags (same engine as /trending/hashtags)"""
+    trending = await trending_service.top(limit)
+    return [{"tag": t["tag"], "count": t["count"], "score": t["score"]} for t in trending]
 
-@api_router.get("/hashtags/{tag}/posts")
-async def get_posts_by_hashtag(tag: str, limit: int = 50):
-    """Get posts by hashtag"""
-    posts = await db.posts.find({"hashtags": tag}, {"_id": 0}).sort("createdAt", -1).limit(limit).to_list(limit)
-    for post in posts:
-        author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-        post["author"] = author
-    return posts
+@api_router.post("/admin/trending/rebuild")
+async def rebuild_trending_hashtags(adminUserId: str = Depends(require_admin), days: int = 7):
+    """Recount trending hashtags from recent posts (admin only)"""
+    count = await trending_service.rebuild(days)
+    return {"success": True, "posts": count}
 
 # ===== ADVANCED SEARCH =====
 
@@ -2419,51 +2666,40 @@ async def search_all(q: str, type: str = "all", limit: int = 20):
     """Advanced search across all content"""
     results = {"users": [], "posts": [], "hashtags": [], "events": [], "venues": []}
     
+    kinds = [k for k in ("users", "posts", "events", "venues") if type in ("all", k)]
+    if type in ("all", "hashtags") and "posts" not in kinds:
+        kinds.append("posts")
+    ranked = await search_service.search(q, kinds, limit=limit)
+    # Hydrate every requested type concurrently
+    hydrated = await gather_queries({
+        kind: search_service.hydrate(kind, ranked["ids"][kind], SEARCH_PROJECTIONS.get(kind) if kind == "users" else None)
+        for kind in kinds
+    })
+    
     if type in ["all", "users"]:
-        users = await db.users.find({
-            "$or": [
-                {"name": {"$regex": q, "$options": "i"}},
-                {"handle": {"$regex": q, "$options": "i"}}
-            ]
-        }, {"_id": 0}).limit(limit).to_list(limit)
-        results["users"] = users
+        results["users"] = hydrated["users"]
+    
+    posts = hydrated.get("posts", [])
     
     if type in ["all", "posts"]:
-        posts = await db.posts.find({
-            "text": {"$regex": q, "$options": "i"}
-        }, {"_id": 0}).limit(limit).to_list(limit)
-        for post in posts:
-            author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-            post["author"] = author
+        await attach_users(db, posts)
         results["posts"] = posts
     
     if type in ["all", "hashtags"]:
-        hashtags = await db.posts.find({
-            "hashtags": {"$regex": q, "$options": "i"}
-        }, {"_id": 0, "hashtags": 1}).limit(limit).to_list(limit)
         unique_tags = set()
-        for post in hashtags:
+        for post in posts:
+            unique_tags.update([word[1:] for word in post.get("text", "").split()
+                                if word.startswith("#") and q.lower() in word.lower()])
             unique_tags.update([tag for tag in post.get("hashtags", []) if q.lower() in tag.lower()])
         results["hashtags"] = list(unique_tags)[:limit]
     
     if type in ["all", "events"]:
-        events = await db.events.find({
-            "$or": [
-                {"name": {"$regex": q, "$options": "i"}},
-                {"description": {"$regex": q, "$options": "i"}}
-            ]
-        }, {"_id": 0}).limit(limit).to_list(limit)
-        results["events"] = events
+        results["events"] = hydrated["events"]
     
     if type in ["all", "venues"]:
-        venues = await db.venues.find({
-            "$or": [
-                {"name": {"$regex": q, "$options": "i"}},
-                {"location": {"$regex": q, "$options": "i"}}
-            ]
-        }, {"_id": 0}).limit(limit).to_list(limit)
-        results["venues"] = venues
+        results["venues"] = hydrated["venues"]
     
+    results["facets"] = ranked["facets"]
     return results
 
 # ===== STORIES (VIBE CAPSULES) =====
@@ -2494,11 +2730,12 @@ async def get_active_stories(userId: Optional[str] = None):
     }, {"_id": 0}).sort("createdAt", -1).to_list(100)
     
     # Group by author
+    authors = await get_user_loader(db).load_many([s["authorId"] for s in stories])
     grouped = {}
     for story in stories:
         author_id = story["authorId"]
         if author_id not in grouped:
-            author = await db.users.find_one({"id": author_id}, {"_id": 0})
+            author = authors.get(author_id)
             if author:
                 grouped[author_id] = {
                     "author": author,
@@ -2608,25 +2845,6 @@ async def handle_report(reportId: str, action: str, adminId: str):
 
 # ===== TRENDING & ACTIVITY FEED =====
 
-@api_router.get("/trending/posts")
-async def get_trending_posts(limit: int = 20):
-    """Get trending posts based on engagement"""
-    # Get recent posts with high engagement
-    day_ago = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
-    posts = await db.posts.find(
-        {"createdAt": {"$gte": day_ago}},
-        {"_id": 0}
-    ).sort([
-        ("stats.likes", -1),
-        ("stats.reposts", -1),
-        ("stats.replies", -1)
-    ]).limit(limit).to_list(limit)
-    
-    for post in posts:
-        author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-        post["author"] = author
-    return posts
-
 @api_router.get("/activity/{userId}")
 async def get_activity_feed(userId: str, limit: int = 50):
     """Get personalized activity feed"""
@@ -2644,16 +2862,16 @@ async def get_activity_feed(userId: str, limit: int = 50):
 # ===== REEL ROUTES (VIBEZONE) =====
 
 @api_router.get("/reels")
-async def get_reels(limit: int = 50):
-    """Get all reels for VibeZone."""
-    reels = await db.reels.find({}, {"_id": 0}).sort("createdAt", -1).to_list(limit)
+async def get_reels(response: Response, limit: int = 50, cursor: Optional[str] = None):
+    """Get all reels for VibeZone (keyset-paginated, see X-Next-Cursor header)."""
+    reels, next_cursor = await paginate_keyset(db.reels, {}, cursor=cursor, limit=limit)
+    set_next_cursor(response, next_cursor)
     
+    # Add author info
+    authors = await get_user_loader(db).load_many([r.get("authorId") for r in reels])
     for reel in reels:
-        # Add author info
-        if "authorId" in reel:
-            author = await db.users.find_one({"id": reel["authorId"]}, {"_id": 0, "id": 1, "handle": 1, "name": 1, "avatar": 1, "isVerified": 1})
-            if author:
-                reel["author"] = author
+        if reel.get("authorId") in authors:
+            reel["author"] = authors[reel["authorId"]]
     
     return reels
 
@@ -2770,6 +2988,8 @@ async def create_reel(reel: ReelCreate, authorId: str):
     doc = reel_obj.model_dump()
     result = await db.reels.insert_one(doc)
     doc.pop('_id', None)
+    await engagement_service.init("reels", doc)
+    await track_analytics(authorId, {"reels": 1})
     author = await db.users.find_one({"id": authorId}, {"_id": 0})
     doc["author"] = author
     return doc
@@ -2790,9 +3010,10 @@ async def get_active_capsules(userId: Optional[str] = None):
     capsules = await db.vibe_capsules.find(query, {"_id": 0}).sort("createdAt", -1).to_list(100)
     
     # Add author info and group by author
+    authors = await get_user_loader(db).load_many([c["authorId"] for c in capsules])
     capsules_by_author = {}
     for capsule in capsules:
-        author = await db.users.find_one({"id": capsule["authorId"]}, {"_id": 0})
+        author = authors.get(capsule["authorId"])
         if author:
             capsule["author"] = {
                 "id": author["id"],
@@ -2909,24 +3130,17 @@ async def get_capsule_insights(authorId: str):
 
 @api_router.post("/reels/{reelId}/like")
 async def toggle_like_reel(reelId: str, userId: str):
-    reel = await db.reels.find_one({"id": reelId}, {"_id": 0})
-    if not reel:
+    added, reel = await toggle_array_member(
+        db.reels, reelId, "likedBy", userId,
+        counter="stats.likes", projection={"_id": 0, "authorId": 1, "stats.likes": 1}
+    )
+    if reel is None:
         raise HTTPException(status_code=404, detail="Reel not found")
+    await refresh_engagement("reels", reelId)
+    await track_analytics(reel.get("authorId"), {"reelLikes": 1 if added else -1})
     
-    liked_by = reel.get("likedBy", [])
-    stats = reel.get("stats", {"views": 0, "likes": 0, "comments": 0})
-    
-    if userId in liked_by:
-        liked_by.remove(userId)
-        stats["likes"] = max(0, stats["likes"] - 1)
-        action = "unliked"
-    else:
-        liked_by.append(userId)
-        stats["likes"] = stats["likes"] + 1
-        action = "liked"
-    
-    await db.reels.update_one({"id": reelId}, {"$set": {"likedBy": liked_by, "stats": stats}})
-    return {"action": action, "likes": stats["likes"]}
+    action = "liked" if added else "unliked"
+    return {"action": action, "likes": max(0, reel.get("stats", {}).get("likes", 0))}
 
 @api_router.post("/reels/{reelId}/view")
 async def increment_reel_view(reelId: str):
@@ -2948,7 +3162,12 @@ async def create_reel_comment(reelId: str, comment: CommentCreate, authorId: str
     result = await db.comments.insert_one(doc)
     doc.pop('_id', None)
     
-    await db.reels.update_one({"id": reelId}, {"$inc": {"stats.comments": 1}})
+    reel = await db.reels.find_one_and_update(
+        {"id": reelId}, {"$inc": {"stats.comments": 1}}, projection={"_id": 0, "authorId": 1}
+    )
+    await refresh_engagement("reels", reelId)
+    if reel:
+        await track_analytics(reel.get("authorId"), {"reelComments": 1})
     
     author = await db.users.find_one({"id": authorId}, {"_id": 0})
     doc["author"] = author
@@ -2974,6 +3193,7 @@ async def create_tribe(tribe: TribeCreate, ownerId: str):
     doc = tribe_obj.model_dump()
     result = await db.tribes.insert_one(doc)
     doc.pop('_id', None)
+    await index_for_search("tribes", doc)
     return doc
 
 @api_router.put("/tribes/{tribeId}")
@@ -2997,6 +3217,7 @@ async def update_tribe(tribeId: str, updates: TribeUpdate, userId: str):
     
     # Return updated tribe
     updated_tribe = await db.tribes.find_one({"id": tribeId}, {"_id": 0})
+    await index_for_search("tribes", updated_tribe)
     return updated_tribe
 
 @api_router.delete("/tribes/{tribeId}")
@@ -3010,10 +3231,14 @@ async def delete_tribe(tribeId: str, userId: str):
         raise HTTPException(status_code=403, detail="Only the tribe owner can delete the tribe")
     
     # Delete all tribe posts
+    post_ids = await db.posts.distinct("id", {"tribeId": tribeId})
     await db.posts.delete_many({"tribeId": tribeId})
+    for post_id in post_ids:
+        await unindex_for_search("posts", post_id)
     
     # Delete the tribe
     await db.tribes.delete_one({"id": tribeId})
+    await unindex_for_search("tribes", tribeId)
     
     return {"message": "Tribe deleted successfully"}
 
@@ -3065,9 +3290,7 @@ async def get_tribe_posts(tribeId: str, limit: int = 50):
     
     # Get posts that have this tribeId
     posts = await db.posts.find({"tribeId": tribeId}, {"_id": 0}).sort("createdAt", -1).to_list(limit)
-    for post in posts:
-        author = await db.users.find_one({"id": post["authorId"]}, {"_id": 0})
-        post["author"] = author
+    await attach_users(db, posts)
     return posts
 
 @api_router.post("/tribes/{tribeId}/posts")
@@ -3107,6 +3330,11 @@ async def create_tribe_post(tribeId: str, post_data: dict):
     
     # Remove _id and enrich with author
     post_obj.pop("_id", None)
+    await fan_out_to_timelines(post_obj)
+    await index_for_search("posts", post_obj)
+    await record_post_hashtags(post_obj)
+    await engagement_service.init("posts", post_obj)
+    await track_analytics(author_id, {"posts": 1})
     author = await db.users.find_one({"id": author_id}, {"_id": 0})
     post_obj["author"] = {
         "id": author["id"],
@@ -3130,6 +3358,7 @@ async def seed_data():
     await db.wallet_transactions.delete_many({})
     await db.messages.delete_many({})
     await db.notifications.delete_many({})
+    await db.notification_counters.delete_many({})
     await db.venues.delete_many({})
     await db.events.delete_many({})
     await db.creators.delete_many({})
@@ -3253,13 +3482,19 @@ async def seed_data():
     ]
     await db.notifications.insert_many(notifications)
     
+    # The cleared collections are still in the search index; rebuild it from the seed data
+    for kind in ("users", "posts", "tribes", "venues", "events"):
+        await search_service.reindex(kind)
+    
     return {"message": "Data seeded successfully", "users": len(users), "posts": len(posts), "reels": len(reels), "tribes": len(tribes), "wallet_transactions": len(wallet_transactions), "venues": len(venues), "events": len(events), "creators": len(creators), "messages": len(messages), "notifications": len(notifications)}
 
 # ===== FILE UPLOAD ROUTES =====
 
+MAX_UPLOAD_BYTES = 150 * 1024 * 1024
+
 @api_router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    """Upload image, video, or document file - hybrid storage: MongoDB for small files, disk for large files"""
+async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    """Upload image, video, or document file - streamed into chunked GridFS storage"""
     # Validate file type - extended to support documents for resources
     allowed_types = {
         # Images
@@ -3287,68 +3522,34 @@ async def upload_file(file: UploadFile = File(...)):
     if file.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail=f"File type '{file.content_type}' not supported. Supported: images, videos, PDFs, documents, spreadsheets, archives")
     
-    # Read file content
-    file_content = await file.read()
-    
-    # Check file size (now supports up to 150MB)
-    file_size_mb = len(file_content) / (1024 * 1024)
-    if file_size_mb > 150:
-        raise HTTPException(status_code=400, detail=f"File too large ({file_size_mb:.2f}MB). Maximum size is 150MB")
+    # Stream into chunked storage (deduplicated by content hash)
+    try:
+        blob = await media_store.save_upload(file, max_bytes=MAX_UPLOAD_BYTES)
+    except MediaTooLargeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Generate unique ID for the file
     file_id = str(uuid.uuid4())
     file_ext = file.filename.split('.')[-1] if '.' in file.filename else ''
     
-    # Use hybrid storage approach
-    # Small files (<15MB) -> MongoDB (base64)
-    # Large files (15MB-150MB) -> Disk storage
-    
-    if file_size_mb <= 15:
-        # Store in MongoDB for persistence
-        logging.info(f"Storing small file ({file_size_mb:.2f}MB) in MongoDB: {file_id}")
-        
-        file_base64 = base64.b64encode(file_content).decode('utf-8')
-        
-        media_doc = {
-            "id": file_id,
-            "filename": file.filename,
-            "content_type": file.content_type,
-            "file_extension": file_ext,
-            "file_data": file_base64,
-            "file_size": len(file_content),
-            "storage_type": "mongodb",
-            "uploaded_at": datetime.now(timezone.utc).isoformat(),
-        }
-        
-        await db.media_files.insert_one(media_doc)
-        
-    else:
-        # Store large files on disk
-        logging.info(f"Storing large file ({file_size_mb:.2f}MB) on disk: {file_id}")
-        
-        # Ensure upload directory exists
-        UPLOAD_DIR.mkdir(exist_ok=True)
-        
-        # Save to disk
-        file_path = UPLOAD_DIR / f"{file_id}.{file_ext}"
-        with open(file_path, "wb") as f:
-            f.write(file_content)
-        
-        # Store metadata in MongoDB (without file data)
-        media_doc = {
-            "id": file_id,
-            "filename": file.filename,
-            "content_type": file.content_type,
-            "file_extension": file_ext,
-            "file_size": len(file_content),
-            "storage_type": "disk",
-            "disk_path": str(file_path),
-            "uploaded_at": datetime.now(timezone.utc).isoformat(),
-        }
-        
-        await db.media_files.insert_one(media_doc)
-        
-        logging.info(f"Large file saved to disk: {file_path}")
+    media_doc = {
+        "id": file_id,
+        "filename": file.filename,
+        "content_type": file.content_type,
+        "file_extension": file_ext,
+        "file_size": blob["size"],
+        "storage_type": "gridfs",
+        "blob_id": blob["blobId"],
+        "sha256": blob["sha256"],
+        "uploaded_at": datetime.now(timezone.utc).isoformat(),
+    }
+    await db.media_files.insert_one(media_doc)
+    media_doc.pop('_id', None)
+    if is_derivable(media_doc):
+        # Thumb/feed/full WebP+JPEG variants are rendered after the response
+        background_tasks.add_task(image_pipeline.generate, media_doc)
+    logging.info(f"Stored file ({blob['size'] / (1024 * 1024):.2f}MB) in GridFS: {file_id}"
+                 f"{' (deduplicated)' if blob['deduped'] else ''}")
     
     # Return RELATIVE URL so it works on any deployment domain
     file_url = f"/api/media/{file_id}"
@@ -3357,14 +3558,17 @@ async def upload_file(file: UploadFile = File(...)):
         "url": file_url,
         "filename": f"{file_id}.{file_ext}",
         "content_type": file.content_type,
-        "size": len(file_content),
-        "storage_type": "mongodb" if file_size_mb <= 15 else "disk"
+        "size": blob["size"],
+        "storage_type": "gridfs"
     }
 
 
 @api_router.get("/media/{file_id}")
-async def serve_media_file(file_id: str, request: Request):
-    """Serve media file from MongoDB or disk storage with Range request support"""
+async def serve_media_file(file_id: str, request: Request, w: Optional[int] = None):
+    """
+    Serve media file from GridFS, MongoDB or disk storage with Range request support.
+    Images with variants are served resized (?w=) and as WebP when accepted.
+    """
     from fastapi.responses import FileResponse, StreamingResponse
     
     # Retrieve file metadata from MongoDB
@@ -3376,7 +3580,41 @@ async def serve_media_file(file_id: str, request: Request):
     storage_type = media_doc.get("storage_type", "mongodb")
     content_type = media_doc.get("content_type", "application/octet-stream")
     
-    if storage_type == "disk":
+    if storage_type == "gridfs":
+        # Stream only the chunks covering the requested range
+        blob_id, file_size, sha256 = media_doc["blob_id"], media_doc["file_size"], media_doc["sha256"]
+        variant = select_variant(media_doc.get("variants"), w, request.headers.get("accept"), content_type)
+        if variant:
+            blob_id, file_size, sha256 = variant["blobId"], variant["size"], variant["sha256"]
+            content_type = "image/webp" if variant["format"] == "webp" else "image/jpeg"
+        etag = f'"{sha256}"'
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "public, max-age=31536000",
+            "Content-Disposition": f'inline; filename="{media_doc["filename"]}"',
+            "ETag": etag,
+        }
+        if media_doc.get("variants"):
+            headers["Vary"] = "Accept"
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        
+        range_header = request.headers.get("range")
+        byte_range = parse_range_header(range_header, file_size)
+        if range_header and byte_range is None and file_size > 0:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{file_size}"})
+        
+        start, end = byte_range or (0, file_size - 1)
+        headers["Content-Length"] = str(max(0, end - start + 1))
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        return StreamingResponse(
+            media_store.stream(blob_id, start, end),
+            status_code=206 if byte_range else 200,
+            media_type=content_type,
+            headers=headers
+        )
+    elif storage_type == "disk":
         # Serve from disk - FileResponse handles Range requests automatically
         disk_path = media_doc.get("disk_path")
         if not disk_path or not os.path.exists(disk_path):
@@ -3392,7 +3630,7 @@ async def serve_media_file(file_id: str, request: Request):
             }
         )
     else:
-        # Serve from MongoDB with Range request support
+        # Legacy base64 documents (uploads before chunked storage)
         try:
             file_data = base64.b64decode(media_doc["file_data"])
         except Exception as e:
@@ -3494,6 +3732,8 @@ async def update_user_profile(userId: str, updates: UserProfileUpdate):
         
         # Get updated user
         updated_user = await db.users.find_one({"id": userId}, {"_id": 0, "password": 0})
+        await index_for_search("users", updated_user)
+        await invalidate_user_cache(userId)
         
         return {
             "message": "Profile updated successfully",
@@ -3551,18 +3791,20 @@ async def get_thread_messages(userId: str, peerId: str):
 # ===== NOTIFICATION ROUTES =====
 
 @api_router.get("/notifications")
-async def get_notifications(userId: str):
-    notifications = await db.notifications.find({"userId": userId}, {"_id": 0}).sort("createdAt", -1).to_list(100)
+async def get_notifications(response: Response, userId: str, limit: int = 100, cursor: Optional[str] = None):
+    notifications, next_cursor = await paginate_keyset(
+        db.notifications, {"userId": userId}, projection=NOTIFICATION_FIELDS, cursor=cursor, limit=limit
+    )
+    set_next_cursor(response, next_cursor)
+    response.headers["X-Unread-Count"] = str(await notification_pipeline.unread_count(userId))
     
-    # Enrich notifications with fromUser data
-    enriched_notifications = []
-    for notif in notifications:
+    # Notifications carry an actor snapshot; only legacy ones need hydrating
+    legacy = [n for n in notifications if not n.get("fromUser")]
+    from_users = await get_user_loader(db).load_many([n.get("fromUserId") for n in legacy if n.get("fromUserId")])
+    for notif in legacy:
         # Populate fromUser if we have fromUserId
         if notif.get("fromUserId"):
-            from_user = await db.users.find_one(
-                {"id": notif["fromUserId"]}, 
-                {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1}
-            )
+            from_user = from_users.get(notif["fromUserId"])
             if from_user:
                 notif["fromUser"] = from_user
         
@@ -3570,27 +3812,23 @@ async def get_notifications(userId: str):
         if not notif.get("fromUser"):
             payload = notif.get("payload", {})
             if payload.get("fromUser"):
-                user_data = payload["fromUser"]
-                notif["fromUser"] = {
-                    "id": user_data.get("id", ""),
-                    "name": user_data.get("name", "Unknown"),
-                    "handle": user_data.get("handle", "user"),
-                    "avatar": user_data.get("avatar", ""),
-                    "isVerified": user_data.get("isVerified", False)
-                }
+                notif["fromUser"] = actor_snapshot(payload["fromUser"])
             elif notif.get("fromUserName"):
                 notif["fromUser"] = {
                     "name": notif.get("fromUserName", "Unknown"),
                     "avatar": notif.get("fromUserAvatar", ""),
                 }
-        
-        enriched_notifications.append(notif)
     
-    return enriched_notifications
+    return notifications
+
+@api_router.get("/notifications/{userId}/unread-count")
+async def get_unread_notification_count(userId: str):
+    """Unread notification count (maintained counter, no scan)"""
+    return {"unread": await notification_pipeline.unread_count(userId)}
 
 @api_router.post("/notifications/{notificationId}/read")
 async def mark_notification_read(notificationId: str):
-    await db.notifications.update_one({"id": notificationId}, {"$set": {"read": True}})
+    await notification_pipeline.mark_read(notificationId)
     return {"success": True}
 
 # ===== COMPREHENSIVE SHARING ROUTES =====
@@ -3618,7 +3856,13 @@ async def share_post(postId: str, request: ShareRequest, current_user: dict = De
                 originalPost=original_post,
                 shareMessage=request.message
             )
-            await db.posts.insert_one(reshare_post.model_dump())
+            reshare_doc = reshare_post.model_dump()
+            await db.posts.insert_one(reshare_doc)
+            await fan_out_to_timelines(reshare_doc)
+            await index_for_search("posts", reshare_doc)
+            await record_post_hashtags(reshare_doc)
+            await engagement_service.init("posts", reshare_doc)
+            await track_analytics(from_user["id"], {"posts": 1})
             
             # Update original post stats and sharedBy
             await db.posts.update_one(
@@ -3628,6 +3872,8 @@ async def share_post(postId: str, request: ShareRequest, current_user: dict = De
                     "$addToSet": {"sharedBy": from_user["id"]}
                 }
             )
+            await refresh_engagement("posts", postId)
+            await track_analytics(original_post["authorId"], {"postShares": 1})
             
             # Notify original author
             if original_post["authorId"] != from_user["id"]:
@@ -3642,7 +3888,7 @@ async def share_post(postId: str, request: ShareRequest, current_user: dict = De
                     contentType="post",
                     contentId=postId
                 )
-                await db.notifications.insert_one(notification.model_dump())
+                notification_pipeline.enqueue(notification.model_dump())
                 await emit_to_user(original_post["authorId"], 'share_notification', {
                     'type': 'post_shared',
                     'postId': postId,
@@ -3698,13 +3944,10 @@ async def share_post(postId: str, request: ShareRequest, current_user: dict = De
                     mediaUrl=share_link,
                     mediaType="shared_post"
                 )
-                await db.dm_messages.insert_one(share_message.model_dump())
+                await db.messages.insert_one(share_message.model_dump())
                 
-                # Update thread last message
-                await db.dm_threads.update_one(
-                    {"id": thread["id"]},
-                    {"$set": {"lastMessageAt": datetime.now(timezone.utc).isoformat()}}
-                )
+                # Update thread preview and recipient's unread counter
+                await record_dm_thread_message(thread["id"], share_message.model_dump(), to_user_id)
                 
                 # Emit real-time notification
                 await emit_to_user(to_user_id, 'new_message', {
@@ -3722,6 +3965,8 @@ async def share_post(postId: str, request: ShareRequest, current_user: dict = De
                     "$addToSet": {"sharedBy": from_user["id"]}
                 }
             )
+            await refresh_engagement("posts", postId)
+            await track_analytics(original_post["authorId"], {"postShares": shared_count})
             
             # Record share
             share = Share(
@@ -3810,13 +4055,10 @@ async def share_reel(reelId: str, request: ShareRequest, current_user: dict = De
                     mediaUrl=share_link,
                     mediaType="shared_reel"
                 )
-                await db.dm_messages.insert_one(share_message.model_dump())
+                await db.messages.insert_one(share_message.model_dump())
                 
-                # Update thread last message
-                await db.dm_threads.update_one(
-                    {"id": thread["id"]},
-                    {"$set": {"lastMessageAt": datetime.now(timezone.utc).isoformat()}}
-                )
+                # Update thread preview and recipient's unread counter
+                await record_dm_thread_message(thread["id"], share_message.model_dump(), to_user_id)
                 
                 await emit_to_user(to_user_id, 'new_message', {
                     'threadId': thread["id"],
@@ -3833,6 +4075,8 @@ async def share_reel(reelId: str, request: ShareRequest, current_user: dict = De
                     "$addToSet": {"sharedBy": from_user["id"]}
                 }
             )
+            await refresh_engagement("reels", reelId)
+            await track_analytics(reel["authorId"], {"reelShares": shared_count})
             
             # Notify reel author
             if reel["authorId"] != from_user["id"]:
@@ -3847,7 +4091,7 @@ async def share_reel(reelId: str, request: ShareRequest, current_user: dict = De
                     contentType="reel",
                     contentId=reelId
                 )
-                await db.notifications.insert_one(notification.model_dump())
+                notification_pipeline.enqueue(notification.model_dump())
             
             share = Share(
                 fromUserId=from_user["id"],
@@ -3947,12 +4191,10 @@ async def share_tribe(tribeId: str, request: ShareRequest, current_user: dict =
                     mediaUrl=share_link,
                     mediaType="tribe_invite"
                 )
-                await db.dm_messages.insert_one(share_message.model_dump())
+                await db.messages.insert_one(share_message.model_dump())
                 
-                await db.dm_threads.update_one(
-                    {"id": thread["id"]},
-                    {"$set": {"lastMessageAt": datetime.now(timezone.utc).isoformat()}}
-                )
+                # Update thread preview and recipient's unread counter
+                await record_dm_thread_message(thread["id"], share_message.model_dump(), to_user_id)
                 
                 # Create notification
                 notification = Notification(
@@ -3966,7 +4208,7 @@ async def share_tribe(tribeId: str, request: ShareRequest, current_user: dict =
                     contentType="tribe",
                     contentId=tribeId
                 )
-                await db.notifications.insert_one(notification.model_dump())
+                notification_pipeline.enqueue(notification.model_dump())
                 
                 await emit_to_user(to_user_id, 'tribe_invite', {
                     'inviteId': invite.id,
@@ -4079,12 +4321,10 @@ async def share_room(roomId: str, request: ShareRequest, current_user: dict = De
                     mediaUrl=share_link,
                     mediaType="room_invite"
                 )
-                await db.dm_messages.insert_one(share_message.model_dump())
+                await db.messages.insert_one(share_message.model_dump())
                 
-                await db.dm_threads.update_one(
-                    {"id": thread["id"]},
-                    {"$set": {"lastMessageAt": datetime.now(timezone.utc).isoformat()}}
-                )
+                # Update thread preview and recipient's unread counter
+                await record_dm_thread_message(thread["id"], share_message.model_dump(), to_user_id)
                 
                 # Create notification
                 notification = Notification(
@@ -4098,7 +4338,7 @@ async def share_room(roomId: str, request: ShareRequest, current_user: dict = De
                     contentType="room",
                     contentId=roomId
                 )
-                await db.notifications.insert_one(notification.model_dump())
+                notification_pipeline.enqueue(notification.model_dump())
                 
                 await emit_to_user(to_user_id, 'room_invite', {
                     'inviteId': room_invite.id,
@@ -4260,7 +4500,7 @@ async def accept_tribe_invite(inviteId: str, current_user: dict = Depends(get_cu
         contentType="tribe",
         contentId=invite["tribeId"]
     )
-    await db.notifications.insert_one(notification.model_dump())
+    notification_pipeline.enqueue(notification.model_dump())
     
     return {"success": True, "message": "Joined tribe successfully"}
 
@@ -4307,7 +4547,7 @@ async def share_content(fromUserId: str, toUserId: str, contentType: str, conten
             contentId=contentId
         )
         
-        await db.notifications.insert_one(notification.model_dump())
+        notification_pipeline.enqueue(notification.model_dump())
         
         return {"success": True, "message": "Content shared successfully"}
     except Exception as e:
@@ -4376,7 +4616,7 @@ async def create_order(order: OrderCreate, userId: str):
         type="order_placed",
         payload={"orderId": order_obj.id, "total": order.total, "venueId": order.venueId}
     )
-    await db.notifications.insert_one(notif.model_dump())
+    notification_pipeline.enqueue(notif.model_dump())
     
     return doc
 
@@ -4403,7 +4643,7 @@ async def update_order_status(orderId: str, status: str):
             type="order_ready",
             payload={"orderId": orderId}
         )
-        await db.notifications.insert_one(notif.model_dump())
+        notification_pipeline.enqueue(notif.model_dump())
     
     return {"success": True, "status": status}
 
@@ -4447,6 +4687,7 @@ async def create_event(
     
     await db.events.insert_one(event)
     event.pop("_id", None)
+    await index_for_search("events", event)
     
     return event
 
@@ -4458,18 +4699,17 @@ async def get_event(eventId: str):
     return event
 
 @api_router.post("/events/{eventId}/book")
-async def book_event_ticket(eventId: str, userId: str, tier: str = "General", quantity: int = 1):
-    """Book event tickets using wallet balance"""
+async def book_event_ticket(eventId: str, userId: str, tier: str = "General", quantity: int = 1,
+                            idempotencyKey: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Book event tickets using wallet balance (guarded debit, idempotent per Idempotency-Key)"""
+    if quantity < 1:
+        raise HTTPException(status_code=400, detail="Quantity must be at least 1")
+    
     # Get event
     event = await db.events.find_one({"id": eventId}, {"_id": 0})
     if not event:
         raise HTTPException(status_code=404, detail="Event not found")
     
-    # Get user
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
     # Find tier price
     tiers = event.get("tiers", [])
     tier_data = next((t for t in tiers if t.get("name") == tier), None)
@@ -4479,16 +4719,75 @@ async def book_event_ticket(eventId: str, userId: str, tier: str = "General", qu
     price_per_ticket = tier_data.get("price", 0)
     total_amount = price_per_ticket * quantity
     
-    # Check balance
-    current_balance = user.get("walletBalance", 0.0)
-    if current_balance < total_amount:
-        raise HTTPException(status_code=400, detail="Insufficient wallet balance")
+    credits_earned = 20 * quantity  # 20 credits per ticket
+    transaction = None
+    if total_amount > 0:
+        # Charge first - the guarded debit is what decides whether the booking goes through
+        transaction = await charge_wallet(
+            userId,
+            total_amount,
+            f"Ticket purchase: {event.get('name', 'Event')} ({quantity}x {tier})",
+            metadata={"eventId": eventId, "tier": tier, "quantity": quantity},
+            idempotency_key=idempotencyKey,
+            insufficient_detail="Insufficient wallet balance",
+            operation=f"event.book:{eventId}:{tier}:{quantity}"
+        )
+        if transaction["replayed"]:
+            tickets = await db.event_tickets.find(
+                {"transactionId": transaction["id"]}, {"_id": 0}
+            ).to_list(quantity)
+            if len(tickets) < quantity:
+                # The first attempt is still issuing (or died doing so) - ticket ids are
+                # derived from the transaction, so issuing again cannot duplicate them
+                tickets = await issue_event_tickets(event, userId, tier, quantity, price_per_ticket,
+                                                    transaction["id"])
+            return {
+                "success": True,
+                "tickets": tickets,
+                "balance": transaction["balanceAfter"],
+                "creditsEarned": credits_earned,
+                "message": f"Successfully booked {len(tickets)} ticket(s)!"
+            }
+        balance = transaction["balanceAfter"]
+    else:
+        user = await db.users.find_one({"id": userId}, {"_id": 0, "walletBalance": 1})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        balance = user.get("walletBalance", 0.0)
+    
+    try:
+        tickets = await issue_event_tickets(event, userId, tier, quantity, price_per_ticket,
+                                            transaction["id"] if transaction else None)
+    except Exception:
+        if transaction:
+            # Give the money back rather than leave a charge without tickets; this also
+            # releases the Idempotency-Key so a retry books afresh
+            await wallet_service.refund(
+                transaction, f"Refund: {event.get('name', 'Event')} booking failed", metadata={"eventId": eventId}
+            )
+        raise
     
-    # Deduct from wallet
-    new_balance = current_balance - total_amount
-    await db.users.update_one({"id": userId}, {"$set": {"walletBalance": new_balance}})
+    # Award Loop Credits (bonus for ticket purchase)
+    if credits_earned > 0:
+        await credits_service.earn(userId, credits_earned, "event", f"Bonus for buying {quantity} ticket(s)")
+        await track_analytics(userId, {"creditsEarned": credits_earned})
     
-    # Create tickets
+    return {
+        "success": True,
+        "tickets": tickets,
+        "balance": balance,
+        "creditsEarned": credits_earned,
+        "message": f"Successfully booked {quantity} ticket(s)!"
+    }
+
+async def issue_event_tickets(event: dict, userId: str, tier: str, quantity: int,
+                              price_per_ticket: float, transaction_id: Optional[str]) -> list:
+    """
+    Create and store `quantity` tickets (with QR codes) for a booking. Tickets of
+    a paid booking get ids derived from its transaction and are upserted, so
+    issuing twice for one transaction stores (and returns) the same tickets.
+    """
+    eventId = event["id"]
     tickets = []
     for i in range(quantity):
         ticket = EventTicket(
@@ -4499,50 +4798,34 @@ async def book_event_ticket(eventId: str, userId: str, tier: str = "General", qu
             status="active"
         )
         ticket_dict = ticket.model_dump()
+        if transaction_id:
+            ticket_dict["id"] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"ticket:{transaction_id}:{i}"))
         ticket_dict["eventName"] = event.get("name", "Event")
         ticket_dict["eventDate"] = event.get("date", "")
         ticket_dict["eventLocation"] = event.get("location", "")
         ticket_dict["eventImage"] = event.get("image", "")
         ticket_dict["price"] = price_per_ticket
-        
-        # Generate QR code
-        qr_data = f"TICKET:{ticket_dict['id']}:QR:{ticket_dict['qrCode']}:EVENT:{eventId}"
-        ticket_dict['qrCodeImage'] = generate_qr_code_base64(qr_data)
-        
-        await db.event_tickets.insert_one(ticket_dict)
-        # Remove MongoDB ObjectId to avoid serialization issues
-        ticket_dict.pop('_id', None)
+        ticket_dict["transactionId"] = transaction_id
         tickets.append(ticket_dict)
     
-    # Record transaction
-    transaction = WalletTransaction(
-        userId=userId,
-        type="payment",
-        amount=total_amount,
-        description=f"Ticket purchase: {event.get('name', 'Event')} ({quantity}x {tier})",
-        metadata={"eventId": eventId, "tier": tier, "quantity": quantity}
+    # Generate every QR code in one worker round trip
+    images = await generate_qr_codes_base64(
+        [f"TICKET:{t['id']}:QR:{t['qrCode']}:EVENT:{eventId}" for t in tickets]
     )
-    await db.wallet_transactions.insert_one(transaction.model_dump())
+    for ticket_dict, image in zip(tickets, images):
+        ticket_dict['qrCodeImage'] = image
     
-    # Award Loop Credits (bonus for ticket purchase)
-    credits_earned = 20 * quantity  # 20 credits per ticket
-    if credits_earned > 0:
-        credit_entry = LoopCredit(
-            userId=userId,
-            amount=credits_earned,
-            type="earn",
-            source="event",
-            description=f"Bonus for buying {quantity} ticket(s)"
-        )
-        await db.loop_credits.insert_one(credit_entry.model_dump())
+    if not transaction_id:
+        await db.event_tickets.insert_many(tickets)
+        # Remove MongoDB ObjectId to avoid serialization issues
+        for ticket_dict in tickets:
+            ticket_dict.pop('_id', None)
+        return tickets
     
-    return {
-        "success": True,
-        "tickets": tickets,
-        "balance": new_balance,
-        "creditsEarned": credits_earned,
-        "message": f"Successfully booked {quantity} ticket(s)!"
-    }
+    await db.event_tickets.bulk_write(
+        [UpdateOne({"id": t["id"]}, {"$setOnInsert": t}, upsert=True) for t in tickets], ordered=False
+    )
+    return await db.event_tickets.find({"transactionId": transaction_id}, {"_id": 0}).to_list(quantity)
 
 @api_router.get("/tickets/{userId}")
 async def get_user_tickets(userId: str):
@@ -4589,86 +4872,63 @@ async def get_wallet(userId: str):
     }
 
 @api_router.post("/wallet/topup")
-async def topup_wallet(request: TopUpRequest, userId: str):
+async def topup_wallet(request: TopUpRequest, userId: str,
+                       idempotencyKey: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Top up the wallet (atomic $inc; retries with the same Idempotency-Key are not credited twice)"""
     # Mock payment success
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
-    if not user:
+    try:
+        transaction = await wallet_service.credit(
+            userId, request.amount, "topup", "Wallet top-up", idempotency_key=idempotencyKey, operation="wallet.topup"
+        )
+    except WalletNotFoundError:
         raise HTTPException(status_code=404, detail="User not found")
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not transaction["replayed"]:
+        await track_analytics(userId, wallet_metrics(transaction))
     
-    new_balance = user.get("walletBalance", 0.0) + request.amount
-    await db.users.update_one({"id": userId}, {"$set": {"walletBalance": new_balance}})
-    
-    # Record transaction
-    transaction = WalletTransaction(
-        userId=userId,
-        type="topup",
-        amount=request.amount,
-        description="Wallet top-up"
-    )
-    await db.wallet_transactions.insert_one(transaction.model_dump())
-    
-    return {"balance": new_balance, "success": True}
+    return {"balance": transaction["balanceAfter"], "success": True, "transactionId": transaction["id"]}
 
 @api_router.post("/wallet/payment")
-async def make_payment(request: PaymentRequest, userId: str):
-    """Process payment at venue using wallet balance"""
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    current_balance = user.get("walletBalance", 0.0)
-    
-    # Check sufficient balance
-    if current_balance < request.amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    
-    # Deduct amount
-    new_balance = current_balance - request.amount
-    await db.users.update_one({"id": userId}, {"$set": {"walletBalance": new_balance}})
-    
-    # Record transaction
-    transaction = WalletTransaction(
-        userId=userId,
-        type="payment",
-        amount=request.amount,
-        description=request.description or f"Payment at {request.venueName or 'venue'}",
-        metadata={"venueId": request.venueId, "venueName": request.venueName}
+async def make_payment(request: PaymentRequest, userId: str,
+                       idempotencyKey: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Process payment at venue using wallet balance (guarded debit, idempotent per Idempotency-Key)"""
+    transaction = await charge_wallet(
+        userId,
+        request.amount,
+        request.description or f"Payment at {request.venueName or 'venue'}",
+        metadata={"venueId": request.venueId, "venueName": request.venueName},
+        idempotency_key=idempotencyKey,
+        operation=f"venue.payment:{request.venueId}"
     )
-    await db.wallet_transactions.insert_one(transaction.model_dump())
     
-    # Award Loop Credits (2% cashback)
+    # Award Loop Credits (2% cashback) - once per payment, not per retry
     credits_earned = int(request.amount * 0.02)
-    if credits_earned > 0:
-        credit_entry = {
-            "id": str(uuid.uuid4()),
-            "userId": userId,
-            "amount": credits_earned,
-            "type": "earn",
-            "source": "payment_cashback",
-            "description": f"2% cashback on ₹{request.amount} payment",
-            "createdAt": datetime.now(timezone.utc).isoformat()
-        }
-        await db.loop_credits.insert_one(credit_entry)
+    if credits_earned > 0 and not transaction["replayed"]:
+        await credits_service.earn(
+            userId, credits_earned, "payment_cashback", f"2% cashback on ₹{request.amount} payment"
+        )
+        await track_analytics(userId, {"creditsEarned": credits_earned})
     
     return {
         "success": True,
-        "balance": new_balance,
+        "balance": transaction["balanceAfter"],
         "creditsEarned": credits_earned,
-        "transactionId": transaction.id
+        "transactionId": transaction["id"]
     }
 
 
 # ===== LOOP CREDITS ROUTES =====
 
 @api_router.get("/credits/{userId}")
-async def get_user_credits(userId: str):
-    """Get user's Loop Credits balance and history"""
-    # Get total credits
-    credits = await db.loop_credits.find({"userId": userId}, {"_id": 0}).to_list(1000)
-    
-    earned = sum(c["amount"] for c in credits if c["type"] == "earn")
-    spent = sum(c["amount"] for c in credits if c["type"] == "spend")
-    balance = earned - spent
+async def get_user_credits(response: Response, userId: str):
+    """Get user's Loop Credits balance and latest history (older pages via /credits/{userId}/history)"""
+    totals = await credits_service.balance(userId)
+    balance = totals["balance"]
+    history, next_cursor = await credits_service.history(userId, limit=20)
+    set_next_cursor(response, next_cursor)
     
     # Get analytics
     analytics = await db.user_analytics.find_one({"userId": userId}, {"_id": 0})
@@ -4678,24 +4938,28 @@ async def get_user_credits(userId: str):
     
     return {
         "balance": balance,
-        "earned": earned,
-        "spent": spent,
-        "history": credits[:20],  # Last 20 transactions
+        "earned": totals["earned"],
+        "spent": totals["spent"],
+        "history": history,  # Latest 20 ledger entries
         "tier": analytics.get("tier", "Bronze"),
         "vibeRank": analytics.get("vibeRank", 0)
     }
 
+@api_router.get("/credits/{userId}/history")
+async def get_credits_history(response: Response, userId: str, cursor: Optional[str] = None, limit: int = 20):
+    """Page through a user's Loop Credits ledger, newest first (see X-Next-Cursor header)"""
+    history, next_cursor = await credits_service.history(userId, cursor=cursor, limit=min(limit, 100))
+    set_next_cursor(response, next_cursor)
+    return history
+
 @api_router.post("/credits/earn")
 async def earn_credits(userId: str, amount: int, source: str, description: str = ""):
     """Award Loop Credits to user"""
-    credit = LoopCredit(
-        userId=userId,
-        amount=amount,
-        type="earn",
-        source=source,
-        description=description
-    )
-    await db.loop_credits.insert_one(credit.model_dump())
+    try:
+        entry = await credits_service.earn(userId, amount, source, description)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await track_analytics(userId, {"creditsEarned": amount})
     
     # Update analytics
     await db.user_analytics.update_one(
@@ -4704,23 +4968,17 @@ async def earn_credits(userId: str, amount: int, source: str, description: str =
         upsert=True
     )
     
-    return {"success": True, "amount": amount, "balance": await get_credits_balance(userId)}
+    return {"success": True, "amount": amount, "balance": entry["balanceAfter"]}
 
 @api_router.post("/credits/spend")
 async def spend_credits(userId: str, amount: int, source: str, description: str = ""):
-    """Deduct Loop Credits from user"""
-    balance = await get_credits_balance(userId)
-    if balance < amount:
+    """Deduct Loop Credits from user (atomic - concurrent spends cannot overdraw)"""
+    try:
+        entry = await credits_service.spend(userId, amount, source, description)
+    except InsufficientCreditsError:
         raise HTTPException(status_code=400, detail="Insufficient credits")
-    
-    credit = LoopCredit(
-        userId=userId,
-        amount=amount,
-        type="spend",
-        source=source,
-        description=description
-    )
-    await db.loop_credits.insert_one(credit.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Update analytics
     await db.user_analytics.update_one(
@@ -4729,14 +4987,11 @@ async def spend_credits(userId: str, amount: int, source: str, description: str
         upsert=True
     )
     
-    return {"success": True, "amount": amount, "balance": await get_credits_balance(userId)}
+    return {"success": True, "amount": amount, "balance": entry["balanceAfter"]}
 
 async def get_credits_balance(userId: str) -> int:
-    """Helper to get current credits balance"""
-    credits = await db.loop_credits.find({"userId": userId}, {"_id": 0}).to_list(1000)
-    earned = sum(c["amount"] for c in credits if c["type"] == "earn")
-    spent = sum(c["amount"] for c in credits if c["type"] == "spend")
-    return earned - spent
+    """Helper to get current credits balance (materialized, O(1))"""
+    return (await credits_service.balance(userId))["balance"]
 
 # ===== CHECK-IN ROUTES =====
 
@@ -4789,10 +5044,11 @@ async def get_venue_checkins(venueId: str):
     checkins = await db.checkins.find({"venueId": venueId, "status": "active"}, {"_id": 0}).to_list(100)
     
     # Enrich with user data
+    users = await get_user_loader(db).load_many([c["userId"] for c in checkins])
     for checkin in checkins:
-        user = await db.users.find_one({"id": checkin["userId"]}, {"_id": 0})
+        user = users.get(checkin["userId"])
         if user:
-            checkin["user"] = {"id": user["id"], "name": user["name"], "avatar": user["avatar"]}
+            checkin["user"] = {"id": user["id"], "name": user.get("name"), "avatar": user.get("avatar")}
     
     return {"count": len(checkins), "checkins": checkins}
 
@@ -4852,13 +5108,8 @@ async def claim_offer(offerId: str, userId: str):
     if offer["claimedCount"] >= offer["claimLimit"]:
         raise HTTPException(status_code=400, detail="Offer claim limit reached")
     
-    # Check credits
+    # Deduct credits (raises 400 if the balance doesn't cover it)
     if offer["creditsRequired"] > 0:
-        balance = await get_credits_balance(userId)
-        if balance < offer["creditsRequired"]:
-            raise HTTPException(status_code=400, detail="Insufficient credits")
-        
-        # Deduct credits
         await spend_credits(userId, offer["creditsRequired"], "offer", f"Claimed offer: {offer['title']}")
     
     # Create claim
@@ -5153,15 +5404,11 @@ async def remove_tribe_trainer(tribeId: str, trainerId: str, userId: str):
 @api_router.get("/trainers/search")
 async def search_trainers(q: str = "", limit: int = 20):
     """Search for users to add as trainers"""
-    query = {}
     if q:
-        query["$or"] = [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"handle": {"$regex": q, "$options": "i"}},
-            {"email": {"$regex": q, "$options": "i"}}
-        ]
+        ids = await search_user_ids(q, limit)
+        return await search_service.hydrate("users", ids, SEARCH_PROJECTIONS["users"])
     
-    users = await db.users.find(query, {"_id": 0}).limit(limit).to_list(limit)
+    users = await db.users.find({}, {"_id": 0, "password": 0}).limit(limit).to_list(limit)
     return users
     await earn_credits(userId, challenge["reward"], "challenge", f"Completed challenge: {challenge['title']}")
     
@@ -5176,25 +5423,15 @@ async def search_trainers(q: str = "", limit: int = 20):
 
 # ===== QR CODE HELPER =====
 
-def generate_qr_code_base64(data: str) -> str:
+async def generate_qr_codes_base64(payloads: List[str]) -> List[str]:
+    """Render QR codes as base64 PNG data URLs on the QR worker pool (one round trip per batch)"""
+    if not payloads:
+        return []
+    return await qr_pool.run(render_qr_codes, payloads)
+
+async def generate_qr_code_base64(data: str) -> str:
     """Generate QR code and return as base64 string"""
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convert to base64
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    
-    return f"data:image/png;base64,{img_str}"
+    return (await generate_qr_codes_base64([data]))[0]
 
 # ===== EVENT TICKETS ROUTES =====
 
@@ -5220,7 +5457,7 @@ async def claim_event_ticket(eventId: str, userId: str, tier: str = "General"):
     
     # Generate QR code with ticket information
     qr_data = f"TICKET:{ticket_dict['id']}:QR:{ticket_dict['qrCode']}:EVENT:{eventId}"
-    ticket_dict['qrCodeImage'] = generate_qr_code_base64(qr_data)
+    ticket_dict['qrCodeImage'] = await generate_qr_code_base64(qr_data)
     
     await db.event_tickets.insert_one(ticket_dict)
     # Remove MongoDB ObjectId to avoid serialization issues
@@ -5233,16 +5470,19 @@ async def get_user_tickets(userId: str):
     """Get user's event tickets"""
     tickets = await db.event_tickets.find({"userId": userId, "status": "active"}, {"_id": 0}).to_list(100)
     
-    # Enrich with event details and regenerate QR codes if needed
+    # Enrich with event details
     for ticket in tickets:
         event = await db.events.find_one({"id": ticket["eventId"]}, {"_id": 0})
         if event:
             ticket["event"] = event
-        
-        # Regenerate QR code if not present
-        if "qrCodeImage" not in ticket:
-            qr_data = f"TICKET:{ticket['id']}:QR:{ticket['qrCode']}:EVENT:{ticket['eventId']}"
-            ticket['qrCodeImage'] = generate_qr_code_base64(qr_data)
+    
+    # Regenerate missing QR codes in one batch
+    missing = [t for t in tickets if "qrCodeImage" not in t]
+    images = await generate_qr_codes_base64(
+        [f"TICKET:{t['id']}:QR:{t['qrCode']}:EVENT:{t['eventId']}" for t in missing]
+    )
+    for ticket, image in zip(missing, images):
+        ticket['qrCodeImage'] = image
     
     return tickets
 
@@ -5435,60 +5675,52 @@ async def get_user_consents(userId: str):
 
 @api_router.get("/analytics/admin")
 async def get_admin_dashboard(adminUserId: str):
-    """Get platform-wide admin analytics"""
+    """Get platform-wide admin analytics (from pre-aggregated rollups)"""
     # Verify admin (in production, check admin role)
-    admin = await db.users.find_one({"id": adminUserId}, {"_id": 0})
+    admin = await db.users.find_one({"id": adminUserId}, {"_id": 0, "id": 1})
     if not admin:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Count totals
-    total_users = await db.users.count_documents({})
-    total_posts = await db.posts.count_documents({})
-    total_reels = await db.reels.count_documents({})
-    total_tribes = await db.tribes.count_documents({})
-    total_rooms = await db.vibe_rooms.count_documents({})
-    
-    # Get verified users
-    verified_users = await db.users.find(
-        {"isVerified": True}, 
-        {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "email": 1, "isVerified": 1, "verifiedAt": 1}
-    ).to_list(100)
-    
-    # Get pending verification requests
-    pending_requests = await db.verification_requests.find(
-        {"status": "pending"},
-        {"_id": 0}
-    ).to_list(50)
-    
-    # Active users (posted in last 7 days)
-    from datetime import timedelta
-    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
-    active_post_users = await db.posts.distinct("authorId", {"createdAt": {"$gte": week_ago}})
-    active_reel_users = await db.reels.distinct("authorId", {"createdAt": {"$gte": week_ago}})
-    active_users = list(set(active_post_users + active_reel_users))
-    
-    # Platform engagement
-    all_posts = await db.posts.find({}, {"_id": 0, "likes": 1, "comments": 1}).limit(1000).to_list(1000)
-    all_reels = await db.reels.find({}, {"_id": 0, "stats": 1, "likedBy": 1}).limit(1000).to_list(1000)
-    
-    total_post_likes = sum(len(p.get("likes", [])) for p in all_posts)
-    total_reel_likes = sum(r.get("stats", {}).get("likes", 0) for r in all_reels)
-    total_likes = total_post_likes + total_reel_likes
-    
-    total_post_comments = sum(len(p.get("comments", [])) for p in all_posts)
-    total_reel_comments = sum(r.get("stats", {}).get("comments", 0) for r in all_reels)
-    total_comments = total_post_comments + total_reel_comments
+    # Every section is independent - run them concurrently
+    results = await gather_queries({
+        # Totals
+        "users": db.users.estimated_document_count(),
+        "posts": db.posts.estimated_document_count(),
+        "reels": db.reels.estimated_document_count(),
+        "tribes": db.tribes.estimated_document_count(),
+        "rooms": db.vibe_rooms.estimated_document_count(),
+        # Verified users
+        "verified": db.users.find(
+            {"isVerified": True},
+            {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "email": 1, "isVerified": 1, "verifiedAt": 1}
+        ).to_list(100),
+        # Pending verification requests
+        "pending": db.verification_requests.find({"status": "pending"}, {"_id": 0}).to_list(50),
+        # Active users (posted in last 7 days) and platform engagement
+        "active": analytics_service.active_users(7),
+        "totals": analytics_service.totals("platform", PLATFORM_KEY),
+        "daily": analytics_service.daily("platform", PLATFORM_KEY, 30),
+    })
+    total_users = results["users"]
+    total_posts = results["posts"]
+    total_reels = results["reels"]
+    verified_users = results["verified"]
+    pending_requests = results["pending"]
+    active_users = results["active"]
+    totals = results["totals"]
+    total_likes = totals["postLikes"] + totals["reelLikes"]
+    total_comments = totals["postComments"] + totals["reelComments"]
     
     # Calculate real growth rate based on active users percentage
-    growth_rate = round((len(active_users) / max(total_users, 1)) * 100, 1) if total_users > 0 else 0
+    growth_rate = round((active_users / max(total_users, 1)) * 100, 1) if total_users > 0 else 0
     
     return {
         "totalUsers": total_users,
-        "activeUsers": len(active_users),
+        "activeUsers": active_users,
         "totalPosts": total_posts,
         "totalReels": total_reels,
-        "totalTribes": total_tribes,
-        "totalRooms": total_rooms,
+        "totalTribes": results["tribes"],
+        "totalRooms": results["rooms"],
         "totalLikes": total_likes,
         "totalComments": total_comments,
         "platformEngagementRate": round((total_likes + total_comments) / max(total_posts + total_reels, 1), 2),
@@ -5497,68 +5729,61 @@ async def get_admin_dashboard(adminUserId: str):
         "verifiedUsersCount": len(verified_users),
         "pendingVerifications": len(pending_requests),
         "pendingVerificationRequests": pending_requests,
+        "daily": results["daily"],
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
+@api_router.post("/admin/analytics/rebuild")
+async def rebuild_analytics(adminUserId: str = Depends(require_admin), days: int = 30):
+    """Recompute analytics rollups from source collections (admin only)"""
+    totals = await analytics_service.rebuild_totals()
+    await analytics_service.rollup_days(days)
+    return {"success": True, **totals, "days": days}
+
+@api_router.post("/admin/credits/reconcile")
+async def reconcile_credits(adminUserId: str = Depends(require_admin)):
+    """Re-derive every Loop Credits balance from the ledger and repair drift (admin only)"""
+    return {"success": True, **await credits_service.reconcile(lookback_hours=None)}
+
+USER_ANALYTICS_PROJECTION = {
+    "_id": 0, "id": 1, "tier": 1,
+    "followersCount": {"$size": {"$ifNull": ["$followers", []]}},
+    "followingCount": {"$size": {"$ifNull": ["$following", []]}}
+}
+
 @api_router.get("/analytics/{userId}")
 async def get_user_analytics(userId: str):
     """Get comprehensive user analytics dashboard"""
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
+    user = await db.users.find_one({"id": userId}, USER_ANALYTICS_PROJECTION)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get all user posts
-    posts = await db.posts.find({"authorId": userId}, {"_id": 0}).limit(1000).to_list(1000)
-    reels = await db.reels.find({"authorId": userId}, {"_id": 0}).limit(1000).to_list(1000)
-    
-    # Calculate engagement - correctly read from stats for reels
-    total_post_likes = sum(len(p.get("likes", [])) for p in posts)
-    total_reel_likes = sum(r.get("stats", {}).get("likes", 0) for r in reels)
-    total_likes = total_post_likes + total_reel_likes
-    
-    total_post_comments = sum(len(p.get("comments", [])) for p in posts)
-    total_reel_comments = sum(r.get("stats", {}).get("comments", 0) for r in reels)
-    total_comments = total_post_comments + total_reel_comments
-    
-    total_shares = sum(p.get("shares", 0) for p in posts) + sum(r.get("stats", {}).get("shares", 0) for r in reels)
-    
-    # Get follower count
-    followers_count = len(user.get("followers", []))
-    following_count = len(user.get("following", []))
+    totals = await analytics_service.totals("user", userId)
+    total_likes = totals["postLikes"] + totals["reelLikes"]
+    total_comments = totals["postComments"] + totals["reelComments"]
+    total_shares = totals["postShares"] + totals["reelShares"]
     
     # Daily/Weekly engagement (last 7 days)
-    from datetime import timedelta
-    now = datetime.now(timezone.utc)
-    week_ago = now - timedelta(days=7)
-    
-    def parse_date(date_str):
-        try:
-            return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-        except:
-            return now
-    
-    recent_posts = [p for p in posts if parse_date(p.get("createdAt", now.isoformat())) > week_ago]
-    recent_reels = [r for r in reels if parse_date(r.get("createdAt", now.isoformat())) > week_ago]
-    
+    week = AnalyticsService.window(await analytics_service.daily("user", userId, 7))
     weekly_engagement = {
-        "posts": len(recent_posts),
-        "reels": len(recent_reels),
-        "likes": sum(len(p.get("likes", [])) for p in recent_posts) + sum(r.get("stats", {}).get("likes", 0) for r in recent_reels),
-        "comments": sum(len(p.get("comments", [])) for p in recent_posts) + sum(r.get("stats", {}).get("comments", 0) for r in recent_reels)
+        "posts": week["posts"],
+        "reels": week["reels"],
+        "likes": week["postLikes"] + week["reelLikes"],
+        "comments": week["postComments"] + week["reelComments"]
     }
     
-    total_content = len(posts) + len(reels)
+    total_content = totals["posts"] + totals["reels"]
     engagement_rate = round((total_likes + total_comments) / max(total_content, 1), 2) if total_content > 0 else 0
     
     return {
         "userId": userId,
-        "totalPosts": len(posts),
-        "totalReels": len(reels),
+        "totalPosts": totals["posts"],
+        "totalReels": totals["reels"],
         "totalLikes": total_likes,
         "totalComments": total_comments,
         "totalShares": total_shares,
-        "followersCount": followers_count,
-        "followingCount": following_count,
+        "followersCount": user["followersCount"],
+        "followingCount": user["followingCount"],
         "weeklyEngagement": weekly_engagement,
         "engagementRate": engagement_rate,
         "tier": user.get("tier", "Bronze")
@@ -5567,32 +5792,26 @@ async def get_user_analytics(userId: str):
 @api_router.get("/analytics/creator/{userId}")
 async def get_creator_dashboard(userId: str):
     """Get creator-specific analytics"""
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
+    user = await db.users.find_one({"id": userId}, USER_ANALYTICS_PROJECTION)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    posts = await db.posts.find({"authorId": userId}, {"_id": 0}).limit(1000).to_list(1000)
-    reels = await db.reels.find({"authorId": userId}, {"_id": 0}).limit(1000).to_list(1000)
+    totals = await analytics_service.totals("user", userId)
     
-    # Calculate total reach (views) - correctly read from stats.views for reels
-    total_post_views = sum(p.get("views", 0) for p in posts)
-    total_reel_views = sum(r.get("stats", {}).get("views", 0) for r in reels)
-    total_views = total_post_views + total_reel_views
+    # Calculate total reach (views)
+    total_views = totals["postViews"] + totals["reelViews"]
     
     # Follower count
-    followers = user.get("followers", [])
-    followers_count = len(followers)
+    followers_count = user["followersCount"]
     
-    # Top performing content
-    top_posts = sorted(posts, key=lambda x: len(x.get("likes", [])), reverse=True)[:5]
-    top_reels = sorted(reels, key=lambda x: x.get("stats", {}).get("likes", 0) if isinstance(x.get("stats"), dict) else len(x.get("likedBy", [])), reverse=True)[:5]
+    # Top performing content (indexed top-N reads)
+    top_posts = await db.posts.find({"authorId": userId}, {"_id": 0}).sort("stats.likes", -1).limit(5).to_list(5)
+    top_reels = await db.reels.find({"authorId": userId}, {"_id": 0}).sort("stats.likes", -1).limit(5).to_list(5)
     
     # Calculate real engagement metrics
-    total_post_likes = sum(len(p.get("likes", [])) for p in posts)
-    total_reel_likes = sum(r.get("stats", {}).get("likes", 0) for r in reels)
-    total_likes = total_post_likes + total_reel_likes
+    total_likes = totals["postLikes"] + totals["reelLikes"]
     
-    total_content = len(posts) + len(reels)
+    total_content = totals["posts"] + totals["reels"]
     avg_engagement_rate = round((total_likes / max(total_content, 1)) * 100, 1) if total_content > 0 else 0
     
     # Calculate follower growth (based on recent followers - simplified)
@@ -5607,93 +5826,78 @@ async def get_creator_dashboard(userId: str):
         "topPosts": top_posts,
         "topReels": top_reels,
         "contentBreakdown": {
-            "posts": len(posts),
-            "reels": len(reels),
+            "posts": totals["posts"],
+            "reels": totals["reels"],
             "totalEngagement": total_likes
         }
     }
 
 @api_router.get("/analytics/tribe/{tribeId}")
-async def get_tribe_analytics(tribeId: str):
-    """Get tribe-specific analytics"""
-    tribe = await db.tribes.find_one({"id": tribeId}, {"_id": 0})
+async def get_tribe_analytics(tribeId: str, days: int = 30):
+    """Get tribe-specific analytics over the last `days` days"""
+    days = max(1, min(days, 365))
+    tribe = await db.tribes.find_one({"id": tribeId}, {"_id": 0, "id": 1, "name": 1, "members": 1})
     if not tribe:
         raise HTTPException(status_code=404, detail="Tribe not found")
     
     members = tribe.get("members", [])
     
-    # Get tribe posts (limited for performance)
-    tribe_posts = await db.posts.find({"authorId": {"$in": members}}, {"_id": 0}).sort("createdAt", -1).limit(500).to_list(500)
+    daily = await analytics_service.daily("tribe", tribeId, days)
+    window = AnalyticsService.window(daily)
     
     # Most active members
-    member_activity = {}
-    for post in tribe_posts:
-        author_id = post.get("authorId")
-        member_activity[author_id] = member_activity.get(author_id, 0) + 1
-    
-    top_contributors = sorted(member_activity.items(), key=lambda x: x[1], reverse=True)[:5]
+    top_contributors = AnalyticsService.top_contributors(daily, 5)
+    active_members = len({c["userId"] for d in daily for c in d.get("contributors", [])})
     
     # Popular posts
-    popular_posts = sorted(tribe_posts, key=lambda x: len(x.get("likes", [])), reverse=True)[:10]
+    popular_posts = await engagement_service.top("posts", 10, {"authorId": {"$in": members}}, days)
     
     return {
         "tribeId": tribeId,
         "tribeName": tribe.get("name"),
         "memberCount": len(members),
-        "totalPosts": len(tribe_posts),
-        "activeMembers": len(member_activity),
-        "topContributors": [{"userId": uid, "postCount": count} for uid, count in top_contributors],
+        "totalPosts": window["posts"],
+        "activeMembers": active_members,
+        "topContributors": top_contributors,
         "popularPosts": popular_posts,
-        "engagementRate": round(sum(len(p.get("likes", [])) for p in tribe_posts) / max(len(tribe_posts), 1), 2)
+        "engagementRate": round(window["postLikes"] / max(window["posts"], 1), 2),
+        "daily": daily
     }
 
 @api_router.get("/analytics/wallet/{userId}")
 async def get_wallet_analytics(userId: str):
     """Get wallet-specific analytics"""
-    wallet = await db.users.find_one({"id": userId}, {"_id": 0, "walletBalance": 1})
-    if not wallet:
+    results = await gather_queries({
+        "wallet": db.users.find_one({"id": userId}, {"_id": 0, "walletBalance": 1}),
+        "totals": analytics_service.totals("user", userId),
+        "recent": db.wallet_transactions.find(
+            {"userId": userId}, {"_id": 0}
+        ).sort("createdAt", -1).limit(10).to_list(10),
+    })
+    # A user without a balance field projects to {} - only a missing user is a 404
+    wallet = results["wallet"]
+    if wallet is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get transactions
-    transactions = await db.wallet_transactions.find({"userId": userId}, {"_id": 0}).limit(1000).to_list(1000)
+    totals = results["totals"]
     
-    # Calculate spending
-    total_spent = sum(t.get("amount", 0) for t in transactions if t.get("type") == "payment")
-    total_added = sum(t.get("amount", 0) for t in transactions if t.get("type") == "topup")
-    
-    # Get credits earned
-    credits = await db.loop_credits.find({"userId": userId}, {"_id": 0}).limit(1000).to_list(1000)
-    total_credits_earned = sum(c.get("amount", 0) for c in credits if c.get("type") == "earn")
-    
-    # Spending by category (mock)
     spending_breakdown = {
-        "venues": 0,
-        "events": 0,
+        "venues": totals["spendVenues"],
+        "events": totals["spendEvents"],
         "marketplace": 0,
-        "other": 0
+        "other": totals["spendOther"]
     }
     
-    for txn in transactions:
-        if txn.get("type") == "payment":
-            metadata = txn.get("metadata", {})
-            venue_name = metadata.get("venueName", "")
-            if "café" in venue_name.lower() or "restaurant" in venue_name.lower():
-                spending_breakdown["venues"] += txn.get("amount", 0)
-            elif "ticket" in venue_name.lower() or "event" in venue_name.lower():
-                spending_breakdown["events"] += txn.get("amount", 0)
-            else:
-                spending_breakdown["other"] += txn.get("amount", 0)
-    
     return {
         "userId": userId,
         "currentBalance": wallet.get("walletBalance", 0),
-        "totalSpent": total_spent,
-        "totalAdded": total_added,
-        "totalCreditsEarned": total_credits_earned,
-        "transactionCount": len(transactions),
+        "totalSpent": totals["walletSpent"],
+        "totalAdded": totals["walletAdded"],
+        "totalCreditsEarned": totals["creditsEarned"],
+        "transactionCount": totals["walletTransactions"],
         "spendingBreakdown": spending_breakdown,
-        "avgTransactionAmount": round(total_spent / max(len([t for t in transactions if t.get("type") == "payment"]), 1), 2),
-        "recentTransactions": sorted(transactions, key=lambda x: x.get("createdAt", ""), reverse=True)[:10]
+        "avgTransactionAmount": round(totals["walletSpent"] / max(totals["walletPayments"], 1), 2),
+        "recentTransactions": results["recent"]
     }
 
 # ===== USER SETTINGS ROUTES =====
@@ -5713,6 +5917,9 @@ async def update_user_profile(userId: str, updates: dict):
         await db.users.update_one({"id": userId}, {"$set": update_data})
     
     updated_user = await db.users.find_one({"id": userId}, {"_id": 0})
+    if update_data:
+        await index_for_search("users", updated_user)
+        await invalidate_user_cache(userId)
     return updated_user
 
 @api_router.get("/users/{userId}/content")
@@ -5790,7 +5997,7 @@ async def send_friend_request(fromUserId: str, toUserId: str):
         link=f"/profile/{fromUserId}",
         payload={"fromUser": from_user}
     )
-    await db.notifications.insert_one(notification.model_dump())
+    notification_pipeline.enqueue(notification.model_dump())
     
     # Real-time notification via WebSocket
     await emit_to_user(toUserId, 'friend_request', {
@@ -5892,7 +6099,7 @@ async def accept_friend_request(requestId: str):
         link=f"/profile/{request['toUserId']}",
         payload={"toUser": to_user}
     )
-    await db.notifications.insert_one(notification.model_dump())
+    notification_pipeline.enqueue(notification.model_dump())
     
     # Real-time notifications via WebSocket
     await emit_to_user(request["fromUserId"], 'friend_event', {
@@ -5962,37 +6169,40 @@ async def delete_friend_request(requestId: str):
 @api_router.get("/friends/list")
 async def get_friends_list(userId: str, q: str = "", cursor: str = "0", limit: int = 50):
     """Get user's friends list with search"""
-    # Get all friendships
-    friendships = await db.friendships.find({
-        "$or": [{"userId1": userId}, {"userId2": userId}]
-    }, {"_id": 0}).to_list(1000)
+    query = {"$or": [{"userId1": userId}, {"userId2": userId}]}
     
-    friends = []
-    for friendship in friendships:
-        friend_id = friendship["userId2"] if friendship["userId1"] == userId else friendship["userId1"]
-        friend = await db.users.find_one({"id": friend_id}, {"_id": 0})
-        if friend:
-            # Apply search filter
-            if q:
-                if q.lower() in friend.get('name', '').lower() or q.lower() in friend.get('handle', '').lower():
-                    friends.append({
-                        "user": friend,
-                        "friendedAt": friendship.get("createdAt")
-                    })
-            else:
-                friends.append({
-                    "user": friend,
-                    "friendedAt": friendship.get("createdAt")
-                })
+    # Resolve the search filter to friend IDs first so paging happens in the database
+    if q:
+        pattern = {"$regex": re.escape(q), "$options": "i"}
+        matches = await db.users.find(
+            {"friends": userId, "$or": [{"name": pattern}, {"handle": pattern}]},
+            {"_id": 0, "id": 1}
+        ).to_list(1000)
+        match_ids = [m["id"] for m in matches]
+        query = {"$or": [
+            {"userId1": userId, "userId2": {"$in": match_ids}},
+            {"userId2": userId, "userId1": {"$in": match_ids}}
+        ]}
+    
+    friendships, next_cursor = await paginate_keyset(
+        db.friendships, query, {"_id": 0}, cursor=cursor, limit=limit
+    )
+    
+    friend_ids = [f["userId2"] if f["userId1"] == userId else f["userId1"] for f in friendships]
+    users_map = {}
+    async for friend in db.users.find({"id": {"$in": friend_ids}}, {"_id": 0, "password": 0}):
+        users_map[friend["id"]] = friend
     
-    # Simple pagination
-    start_idx = int(cursor)
-    end_idx = start_idx + limit
-    paginated_friends = friends[start_idx:end_idx]
-    next_cursor = str(end_idx) if end_idx < len(friends) else None
+    friends = []
+    for friendship, friend_id in zip(friendships, friend_ids):
+        if friend_id in users_map:
+            friends.append({
+                "user": users_map[friend_id],
+                "friendedAt": friendship.get("createdAt")
+            })
     
     return {
-        "items": paginated_friends,
+        "items": friends,
         "nextCursor": next_cursor
     }
 
@@ -6137,66 +6347,39 @@ async def get_muted_users(userId: str):
 @api_router.get("/dm/threads")
 async def get_dm_threads(userId: str, cursor: str = "0", limit: int = 50):
     """Get user's DM threads with last message and unread count"""
-    # Find all threads where user is participant
-    threads = await db.dm_threads.find({
-        "$or": [{"user1Id": userId}, {"user2Id": userId}]
-    }, {"_id": 0}).sort("lastMessageAt", -1).to_list(1000)
+    # One keyset page of threads where user is participant
+    threads, next_cursor = await paginate_keyset(
+        db.dm_threads,
+        {"$or": [{"user1Id": userId}, {"user2Id": userId}]},
+        cursor=cursor,
+        limit=limit,
+        sort_field="lastMessageAt"
+    )
+    
+    # Batch-load all peers for the page
+    peer_ids = [t["user2Id"] if t["user1Id"] == userId else t["user1Id"] for t in threads]
+    peers = await get_user_loader(db).load_many(peer_ids)
     
     result = []
-    for thread in threads:
-        # Get peer user
-        peer_id = thread["user2Id"] if thread["user1Id"] == userId else thread["user1Id"]
-        peer = await db.users.find_one({"id": peer_id}, {"_id": 0})
+    for thread, peer_id in zip(threads, peer_ids):
+        peer = peers.get(peer_id)
         
         if not peer:
             continue
         
-        # Get last message
-        # Get last message (newest)
-        last_message_cursor = db.messages.find(
-            {"threadId": thread["id"], "deletedAt": None},
-            {"_id": 0}
-        ).sort("createdAt", -1).limit(1)
-        last_message_docs = await last_message_cursor.to_list(length=1)
-        last_message = last_message_docs[0] if last_message_docs else None
-        
-        # Get unread count
-        read_receipt = await db.message_reads.find_one({
-            "threadId": thread["id"],
-            "userId": userId
-        }, {"_id": 0})
-        
-        last_read_id = read_receipt.get("lastReadMessageId") if read_receipt else None
-        
-        if last_read_id:
-            unread_count = await db.messages.count_documents({
-                "threadId": thread["id"],
-                "senderId": {"$ne": userId},
-                "createdAt": {"$gt": last_message.get("createdAt") if last_message else ""},
-                "deletedAt": None
-            })
-        else:
-            unread_count = await db.messages.count_documents({
-                "threadId": thread["id"],
-                "senderId": {"$ne": userId},
-                "deletedAt": None
-            })
+        # lastMessage/unreadCount are maintained on write; legacy threads are backfilled once
+        if "unreadCount" not in thread:
+            thread = await backfill_dm_thread_summary(thread)
         
         result.append({
             "id": thread["id"],
             "peer": peer,
-            "lastMessage": last_message,
-            "unreadCount": unread_count,
+            "lastMessage": thread.get("lastMessage"),
+            "unreadCount": (thread.get("unreadCount") or {}).get(userId, 0),
             "updatedAt": thread.get("lastMessageAt", thread["createdAt"])
         })
     
-    # Pagination
-    start_idx = int(cursor)
-    end_idx = start_idx + limit
-    paginated = result[start_idx:end_idx]
-    next_cursor = str(end_idx) if end_idx < len(result) else None
-    
-    return {"items": paginated, "nextCursor": next_cursor}
+    return {"items": result, "nextCursor": next_cursor}
 
 @api_router.post("/dm/thread")
 async def create_or_get_dm_thread(userId: str, peerUserId: str):
@@ -6293,11 +6476,8 @@ async def send_message(threadId: str, userId: str, payload: SendMessageInput = B
     )
     await db.messages.insert_one(message.model_dump())
     
-    # Update thread's lastMessageAt
-    await db.dm_threads.update_one(
-        {"id": threadId},
-        {"$set": {"lastMessageAt": message.createdAt}}
-    )
+    # Update thread's lastMessage snapshot and the peer's unread counter
+    await record_dm_thread_message(threadId, message.model_dump(), peer_id)
     
     # Real-time: emit to thread participants
     sender = await db.users.find_one({"id": userId}, {"_id": 0})
@@ -6324,7 +6504,7 @@ async def send_message(threadId: str, userId: str, payload: SendMessageInput = B
             link=f"/messenger/{threadId}",
             payload={"sender": sender, "threadId": threadId}
         )
-        await db.notifications.insert_one(notification.model_dump())
+        notification_pipeline.enqueue(notification.model_dump())
     
     return {"messageId": message.id, "timestamp": message.createdAt}
 
@@ -6337,17 +6517,37 @@ async def mark_thread_read(threadId: str, userId: str, lastReadMessageId: str):
         raise HTTPException(status_code=403, detail="Not authorized")
     
     # Update or create read receipt
+    read_at = datetime.now(timezone.utc).isoformat()
     await db.message_reads.update_one(
         {"threadId": threadId, "userId": userId},
         {
             "$set": {
                 "lastReadMessageId": lastReadMessageId,
-                "readAt": datetime.now(timezone.utc).isoformat()
+                "readAt": read_at
             }
         },
         upsert=True
     )
     
+    # Reset the unread counter - only if nothing newer arrived in the meantime
+    reset = await db.dm_threads.update_one(
+        {"id": threadId, "lastMessage.id": lastReadMessageId},
+        {"$set": {f"unreadCount.{userId}": 0}}
+    )
+    if reset.matched_count == 0:
+        last_read = await db.messages.find_one({"id": lastReadMessageId}, {"_id": 0, "createdAt": 1})
+        if last_read:
+            remaining = await db.messages.count_documents({
+                "threadId": threadId,
+                "senderId": {"$ne": userId},
+                "createdAt": {"$gt": last_read["createdAt"]},
+                "deletedAt": None
+            })
+            await db.dm_threads.update_one(
+                {"id": threadId},
+                {"$set": {f"unreadCount.{userId}": remaining}}
+            )
+    
     # Real-time: emit read receipt to peer
     await emit_to_thread(threadId, 'read', {
         "type": "read",
@@ -6371,14 +6571,21 @@ async def edit_message(messageId: str, userId: str, text: str):
     if message.get("deletedAt"):
         raise HTTPException(status_code=400, detail="Cannot edit deleted message")
     
+    edited_at = datetime.now(timezone.utc).isoformat()
     await db.messages.update_one(
         {"id": messageId},
         {"$set": {
             "text": text,
-            "editedAt": datetime.now(timezone.utc).isoformat()
+            "editedAt": edited_at
         }}
     )
     
+    # Keep the thread preview in sync if this is the latest message
+    await db.dm_threads.update_one(
+        {"id": message["threadId"], "lastMessage.id": messageId},
+        {"$set": {"lastMessage.text": text, "lastMessage.editedAt": edited_at}}
+    )
+    
     # Real-time: emit edit to thread
     updated_message = await db.messages.find_one({"id": messageId}, {"_id": 0})
     await emit_to_thread(message["threadId"], 'message_edited', {
@@ -6398,11 +6605,35 @@ async def delete_message(messageId: str, userId: str):
     if message["senderId"] != userId:
         raise HTTPException(status_code=403, detail="Can only delete your own messages")
     
-    await db.messages.update_one(
-        {"id": messageId},
+    deleted = await db.messages.update_one(
+        {"id": messageId, "deletedAt": None},
         {"$set": {"deletedAt": datetime.now(timezone.utc).isoformat()}}
     )
     
+    if deleted.modified_count:
+        thread = await db.dm_threads.find_one({"id": message["threadId"]}, {"_id": 0})
+        if thread:
+            peer_id = thread["user2Id"] if thread["user1Id"] == userId else thread["user1Id"]
+            
+            # Roll the preview back to the previous visible message
+            if (thread.get("lastMessage") or {}).get("id") == messageId:
+                previous = await db.messages.find(
+                    {"threadId": message["threadId"], "deletedAt": None},
+                    {"_id": 0}
+                ).sort("createdAt", -1).limit(1).to_list(1)
+                await db.dm_threads.update_one(
+                    {"id": message["threadId"], "lastMessage.id": messageId},
+                    {"$set": {"lastMessage": dm_message_snapshot(previous[0]) if previous else None}}
+                )
+            
+            # Deleting a message the peer hasn't read yet drops it from their unread count
+            receipt = await db.message_reads.find_one({"threadId": message["threadId"], "userId": peer_id}, {"_id": 0})
+            if not receipt or message["createdAt"] > receipt.get("readAt", ""):
+                await db.dm_threads.update_one(
+                    {"id": message["threadId"], f"unreadCount.{peer_id}": {"$gt": 0}},
+                    {"$inc": {f"unreadCount.{peer_id}": -1}}
+                )
+    
     # Real-time: emit deletion to thread
     await emit_to_thread(message["threadId"], 'message_deleted', {
         "type": "delete",
@@ -6672,11 +6903,23 @@ async def create_order(
     userId: str,
     items: list[dict],  # [{productId, quantity, price}]
     totalAmount: float,
-    shippingAddress: dict
+    shippingAddress: dict,
+    idempotencyKey: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    """Create marketplace order"""
+    """Create marketplace order (paid from the wallet with a guarded, idempotent debit)"""
+    order_id = str(uuid.uuid4())
+    transaction = await charge_wallet(
+        userId, totalAmount, f"Order #{order_id}", metadata={"orderId": order_id}, idempotency_key=idempotencyKey,
+        operation="marketplace.order:" + json.dumps([items, shippingAddress], sort_keys=True, default=str)
+    )
+    order_id = transaction["metadata"]["orderId"]
+    if transaction["replayed"]:
+        order = await db.marketplace_orders.find_one({"id": order_id}, {"_id": 0})
+        if order:
+            return order
+    
     order = {
-        "id": str(uuid.uuid4()),
+        "id": order_id,
         "userId": userId,
         "items": items,
         "totalAmount": totalAmount,
@@ -6684,33 +6927,13 @@ async def create_order(
         "status": "pending",  # pending, processing, shipped, delivered, cancelled
         "createdAt": datetime.now(timezone.utc).isoformat()
     }
-    await db.marketplace_orders.insert_one(order)
-    
-    # Deduct from wallet
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
-    current_balance = user.get("walletBalance", 0.0)
-    if current_balance < totalAmount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    
-    new_balance = current_balance - totalAmount
-    await db.users.update_one({"id": userId}, {"$set": {"walletBalance": new_balance}})
+    # Upsert by id: a replay racing the first request stores the same single order
+    await db.marketplace_orders.update_one({"id": order_id}, {"$setOnInsert": order}, upsert=True)
     
     # Clear cart
     await db.cart.delete_many({"userId": userId})
     
-    # Record transaction
-    transaction = {
-        "id": str(uuid.uuid4()),
-        "userId": userId,
-        "type": "payment",
-        "amount": totalAmount,
-        "description": f"Order #{order['id']}",
-        "createdAt": datetime.now(timezone.utc).isoformat()
-    }
-    await db.wallet_transactions.insert_one(transaction)
-    
-    order.pop("_id", None)
-    return order
+    return await db.marketplace_orders.find_one({"id": order_id}, {"_id": 0})
 
 @api_router.get("/marketplace/orders/{userId}")
 async def get_user_orders(userId: str):
@@ -6801,12 +7024,11 @@ async def initiate_call(req: CallInitiateRequest):
         "createdAt": datetime.now(timezone.utc).isoformat(),
         "read": False
     }
-    await db.notifications.insert_one(notification)
+    notification_pipeline.enqueue(notification)
     
     # Send WebSocket event to recipient
     logging.info(f"📞 Attempting to emit incoming_call to user {req.recipientId}")
-    logging.info(f"📊 Currently connected users: {list(connected_clients.keys())}")
-    logging.info(f"🔍 Is recipient {req.recipientId} connected? {req.recipientId in connected_clients}")
+    logging.info(f"🔍 Recipient {req.recipientId} devices connected: {len(await presence.get_sids(req.recipientId))}")
     
     emit_success = await emit_to_user(req.recipientId, 'incoming_call', {
         'callId': call['id'],
@@ -6929,7 +7151,7 @@ async def send_notification(userId: str, type: str, title: str, message: str, da
         "read": False,
         "createdAt": datetime.now(timezone.utc).isoformat()
     }
-    await db.notifications.insert_one(notification)
+    notification_pipeline.enqueue(notification)
     notification.pop("_id", None)
     
     # In production, this would also trigger browser push notification
@@ -6938,37 +7160,34 @@ async def send_notification(userId: str, type: str, title: str, message: str, da
     return notification
 
 @api_router.get("/notifications/{userId}")
-async def get_notifications(userId: str, limit: int = 50, unreadOnly: bool = False):
-    """Get user notifications"""
+async def get_notifications(response: Response, userId: str, limit: int = 50, unreadOnly: bool = False, cursor: Optional[str] = None):
+    """Get user notifications (keyset-paginated, see X-Next-Cursor header)"""
     query = {"userId": userId}
     if unreadOnly:
         query["read"] = False
     
-    notifications = await db.notifications.find(query, {"_id": 0}).sort("createdAt", -1).limit(limit).to_list(limit)
+    notifications, next_cursor = await paginate_keyset(
+        db.notifications, query, projection=NOTIFICATION_FIELDS, cursor=cursor, limit=limit
+    )
+    set_next_cursor(response, next_cursor)
     return notifications
 
 @api_router.post("/notifications/{notificationId}/read")
 async def mark_notification_read(notificationId: str):
     """Mark notification as read"""
-    await db.notifications.update_one(
-        {"id": notificationId},
-        {"$set": {"read": True, "readAt": datetime.now(timezone.utc).isoformat()}}
-    )
+    await notification_pipeline.mark_read(notificationId)
     return {"success": True}
 
 @api_router.post("/notifications/{userId}/read-all")
 async def mark_all_notifications_read(userId: str):
     """Mark all notifications as read"""
-    await db.notifications.update_many(
-        {"userId": userId, "read": False},
-        {"$set": {"read": True, "readAt": datetime.now(timezone.utc).isoformat()}}
-    )
+    await notification_pipeline.mark_all_read(userId)
     return {"success": True}
 
 @api_router.delete("/notifications/{notificationId}")
 async def delete_notification(notificationId: str):
     """Delete notification"""
-    await db.notifications.delete_one({"id": notificationId})
+    await notification_pipeline.delete(notificationId)
     return {"success": True}
 
     analytics["creditsBalance"] = credits_info["balance"]
@@ -6999,7 +7218,6 @@ async def delete_notification(notificationId: str):
 # AI-powered recommendation and matching system
 
 from emergentintegrations.llm.chat import LlmChat, UserMessage
-import json
 
 # Initialize LLM with Emergent LLM key
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
@@ -7573,11 +7791,7 @@ async def get_products(
     if category:
         query["category"] = category
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$regex": search, "$options": "i"}}
-        ]
+        query["id"] = {"$in": await search_service.search_ids("products", search)}
     if min_price is not None:
         query["price"] = {"$gte": min_price}
     if max_price is not None:
@@ -7595,6 +7809,7 @@ async def create_product(product: ProductCreate, sellerId: str):
     
     product_obj = Product(sellerId=sellerId, sellerName=seller.get("name", ""), **product.model_dump())
     await db.products.insert_one(product_obj.model_dump())
+    await index_for_search("products", product_obj.model_dump())
     return product_obj
 
 @api_router.get("/products/{productId}")
@@ -7652,9 +7867,10 @@ async def add_to_cart(userId: str, item: CartItem):
     return cart
 
 @api_router.post("/orders")
-async def create_order(order_data: OrderCreate, userId: str):
-    """Create order"""
-    user = await db.users.find_one({"id": userId}, {"_id": 0})
+async def create_order(order_data: OrderCreate, userId: str,
+                       idempotencyKey: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Create order (wallet orders are charged with a guarded, idempotent debit)"""
+    user = await db.users.find_one({"id": userId}, {"_id": 0, "id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -7664,9 +7880,6 @@ async def create_order(order_data: OrderCreate, userId: str):
     tax = subtotal * 0.18
     total = subtotal + shipping_cost + tax
     
-    if order_data.paymentMethod == "wallet" and user.get("walletBalance", 0) < total:
-        raise HTTPException(status_code=400, detail="Insufficient wallet balance")
-    
     order_items = []
     for item in order_data.items:
         product = await db.products.find_one({"id": item.productId}, {"_id": 0})
@@ -7695,9 +7908,25 @@ async def create_order(order_data: OrderCreate, userId: str):
     )
     
     if order_data.paymentMethod == "wallet":
-        await db.users.update_one({"id": userId}, {"$inc": {"walletBalance": -total}})
+        transaction = await charge_wallet(
+            userId, total, f"Order {order.orderNumber}", metadata={"orderId": order.id},
+            idempotency_key=idempotencyKey, insufficient_detail="Insufficient wallet balance",
+            operation="orders.create:" + order_data.model_dump_json()
+        )
+        if transaction["replayed"]:
+            existing = await db.orders.find_one({"id": transaction["metadata"]["orderId"]}, {"_id": 0})
+            if existing:
+                return existing
+            order.id = transaction["metadata"]["orderId"]
+        order.paymentId = transaction["id"]
         order.paymentStatus = "paid"
     
+    # Claim the order id before any side effects: a replay racing the first request
+    # finds the order already stored and returns it instead of shipping or moving stock again
+    claimed = await db.orders.update_one({"id": order.id}, {"$setOnInsert": order.model_dump()}, upsert=True)
+    if claimed.upserted_id is None:
+        return await db.orders.find_one({"id": order.id}, {"_id": 0})
+    
     try:
         shipment = await delivery_service.create_shipment(
             "shiprocket", order.orderNumber,
@@ -7716,10 +7945,13 @@ async def create_order(order_data: OrderCreate, userId: str):
             currentStatus="pickup_scheduled"
         )
         order.orderStatus = "confirmed"
+        await db.orders.update_one(
+            {"id": order.id},
+            {"$set": {"deliveryInfo": order.deliveryInfo.model_dump(), "orderStatus": order.orderStatus}}
+        )
     except Exception as e:
         logger.error(f"Shipment creation failed: {e}")
     
-    await db.orders.insert_one(order.model_dump())
     await db.carts.delete_one({"userId": userId})
     
     for item in order_items:
@@ -8037,6 +8269,7 @@ async def assign_user_role(
         {"id": target_user_id},
         {"$set": {"role": role_data.role}}
     )
+    await invalidate_user_cache(target_user_id)
     
     return {"success": True, "message": f"User role updated to {role_data.role}"}
 
@@ -8059,6 +8292,7 @@ async def suspend_user_verification(
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["message"])
     
+    await auth_service.revoke_sessions(target_user_id)
     return result
 
 # ===== PAGE ENDPOINTS =====
@@ -8248,10 +8482,7 @@ async def search_verified_accounts(
     query = {"isVerified": True}
     
     if q:
-        query["$or"] = [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"handle": {"$regex": q, "$options": "i"}}
-        ]
+        query["id"] = {"$in": await search_service.search_ids("users", q)}
     
     if account_type:
         query["accountType"] = account_type
@@ -8283,20 +8514,17 @@ async def get_digital_products(
     author_id: Optional[str] = None,
     sort_by: str = "newest",  # newest, popular, downloads
     skip: int = 0,
-    limit: int = 20
+    limit: int = 20,
+    cursor: Optional[str] = None
 ):
-    """Get digital products with filters"""
+    """Get digital products with filters (cursor paging applies to the newest sort)"""
     query = {}
     
     if category and category != "all":
         query["category"] = category
     
     if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$regex": search, "$options": "i"}}
-        ]
+        query["id"] = {"$in": await search_service.search_ids("digitalProducts", search)}
     
     if featured:
         query["featured"] = True
@@ -8314,16 +8542,18 @@ async def get_digital_products(
     elif sort_by == "rating":
         sort_field = "rating"
     
-    products = await db.digital_products.find(query, {"_id": 0}).sort(sort_field, sort_order).skip(skip).limit(limit).to_list(limit)
+    next_cursor = None
+    if sort_field == "createdAt" and (cursor is not None or skip == 0):
+        products, next_cursor = await paginate_keyset(db.digital_products, query, cursor=cursor, limit=limit)
+    else:
+        products = await db.digital_products.find(query, {"_id": 0}).sort(sort_field, sort_order).skip(skip).limit(limit).to_list(limit)
     
     # Enrich with author info
-    for product in products:
-        author = await db.users.find_one({"id": product.get("authorId")}, {"_id": 0, "password": 0})
-        product["author"] = author
+    await attach_users(db, products)
     
     total = await db.digital_products.count_documents(query)
     
-    return {"products": products, "total": total, "categories": PRODUCT_CATEGORIES}
+    return {"products": products, "total": total, "categories": PRODUCT_CATEGORIES, "nextCursor": next_cursor}
 
 @api_router.get("/digital-products/featured")
 async def get_featured_products(limit: int = 6):
@@ -8378,6 +8608,7 @@ async def create_digital_product(product: DigitalProductCreate, authorId: str):
     doc = product_obj.model_dump()
     await db.digital_products.insert_one(doc)
     doc.pop('_id', None)
+    await index_for_search("digitalProducts", doc)
     return doc
 
 @api_router.put("/digital-products/{productId}")
@@ -8401,6 +8632,7 @@ async def update_digital_product(productId: str, updates: DigitalProductUpdate,
     await db.digital_products.update_one({"id": productId}, {"$set": update_dict})
     
     updated_product = await db.digital_products.find_one({"id": productId}, {"_id": 0})
+    await index_for_search("digitalProducts", updated_product)
     return updated_product
 
 @api_router.delete("/digital-products/{productId}")
@@ -8414,6 +8646,7 @@ async def delete_digital_product(productId: str, userId: str):
         raise HTTPException(status_code=403, detail="Only the author can delete this product")
     
     await db.digital_products.delete_one({"id": productId})
+    await unindex_for_search("digitalProducts", productId)
     return {"message": "Product deleted successfully"}
 
 @api_router.post("/digital-products/{productId}/download")
@@ -8662,8 +8895,8 @@ async def like_certification(certId: str, userId: str):
 # ===== PROJECTS =====
 
 @api_router.get("/projects")
-async def get_all_projects(skip: int = 0, limit: int = 20, skill: str = None, status: str = None, startup: bool = None):
-    """Get all public projects"""
+async def get_all_projects(response: Response, skip: int = 0, limit: int = 20, skill: str = None, status: str = None, startup: bool = None, cursor: Optional[str] = None):
+    """Get all public projects (pass cursor for keyset paging, see X-Next-Cursor header)"""
     query = {"isPublic": True}
     if skill:
         query["skills"] = skill
@@ -8672,12 +8905,14 @@ async def get_all_projects(skip: int = 0, limit: int = 20, skill: str = None, st
     if startup is not None:
         query["isStartup"] = startup
     
-    projects = await db.projects.find(query, {"_id": 0}).sort("createdAt", -1).skip(skip).limit(limit).to_list(limit)
+    if cursor is not None or skip == 0:
+        projects, next_cursor = await paginate_keyset(db.projects, query, cursor=cursor, limit=limit)
+        set_next_cursor(response, next_cursor)
+    else:
+        projects = await db.projects.find(query, {"_id": 0}).sort("createdAt", -1).skip(skip).limit(limit).to_list(limit)
     
     # Add author info
-    for proj in projects:
-        author = await db.users.find_one({"id": proj["userId"]}, {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1})
-        proj["author"] = author
+    await attach_users(db, projects, id_key="userId")
     
     return projects
 
@@ -8973,7 +9208,7 @@ async def apply_to_team(postId: str, userId: str, roleId: str, message: str = ""
     
     # Send notification to team owner
     user = await db.users.find_one({"id": userId}, {"_id": 0, "name": 1, "avatar": 1})
-    await db.notifications.insert_one({
+    notification_pipeline.enqueue({
         "id": str(uuid.uuid4()),
         "userId": post["userId"],
         "type": "team_application",
@@ -9031,7 +9266,7 @@ async def respond_to_application(postId: str, applicantId: str, userId: str, act
     owner = await db.users.find_one({"id": userId}, {"_id": 0, "name": 1, "avatar": 1})
     notification_message = f"Your application was {'accepted' if action == 'accept' else 'rejected'} by {owner['name']}"
     
-    await db.notifications.insert_one({
+    notification_pipeline.enqueue({
         "id": str(uuid.uuid4()),
         "userId": applicantId,
         "type": "team_application_response",
@@ -9109,9 +9344,10 @@ async def discover_students(skill: str = None, college: str = None, year: str =
     
     profiles = await db.student_profiles.find(query, {"_id": 0}).skip(skip).limit(limit).to_list(limit)
     
+    users = await get_user_loader(db).load_many([p["userId"] for p in profiles])
     result = []
     for profile in profiles:
-        user = await db.users.find_one({"id": profile["userId"]}, {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "isVerified": 1, "bio": 1})
+        user = users.get(profile["userId"])
         if user:
             result.append({**user, "studentProfile": profile})
     
@@ -9138,17 +9374,30 @@ async def discover_students_for_companies(
         query["userCategory"] = category
     
     profiles = await db.student_profiles.find(query, {"_id": 0}).skip(skip).limit(limit).to_list(limit)
+    if not profiles:
+        return []
+    
+    # Users, stats and reputation for the whole page: four batched queries, run concurrently
+    user_ids = [p["userId"] for p in profiles]
+    count_by_user = [{"$match": {"userId": {"$in": user_ids}}}, {"$group": {"_id": "$userId", "n": {"$sum": 1}}}]
+    results = await gather_queries({
+        "users": db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "password": 0}).to_list(len(user_ids)),
+        "projects": db.projects.aggregate(count_by_user).to_list(len(user_ids)),
+        "certs": db.certifications.aggregate(count_by_user).to_list(len(user_ids)),
+        "reputation": db.reputation.find({"userId": {"$in": user_ids}}, {"_id": 0}).to_list(len(user_ids)),
+    })
+    users = {u["id"]: u for u in results["users"]}
+    projects_counts = {c["_id"]: c["n"] for c in results["projects"]}
+    certs_counts = {c["_id"]: c["n"] for c in results["certs"]}
+    reputations = {r["userId"]: r for r in results["reputation"]}
     
     result = []
     for profile in profiles:
-        user = await db.users.find_one({"id": profile["userId"]}, {"_id": 0, "password": 0})
+        user = users.get(profile["userId"])
         if user:
-            # Get stats
-            projects_count = await db.projects.count_documents({"userId": profile["userId"]})
-            certs_count = await db.certifications.count_documents({"userId": profile["userId"]})
-            
-            # Get reputation
-            reputation = await db.reputation.find_one({"userId": profile["userId"]}, {"_id": 0})
+            projects_count = projects_counts.get(profile["userId"], 0)
+            certs_count = certs_counts.get(profile["userId"], 0)
+            reputation = reputations.get(profile["userId"])
             
             result.append({
                 **user,
@@ -9288,9 +9537,7 @@ async def get_user_reputation(userId: str):
     ).sort("createdAt", -1).limit(10).to_list(10)
     
     # Enrich with endorser info
-    for e in endorsements:
-        endorser = await db.users.find_one({"id": e.get("endorserId")}, {"_id": 0, "name": 1, "avatar": 1, "handle": 1})
-        e["endorser"] = endorser
+    await attach_users(db, endorsements, id_key="endorserId", out_key="endorser")
     
     reputation["recentEndorsements"] = endorsements
     return reputation
@@ -9836,10 +10083,10 @@ async def send_follow_request(userId: str, fromUserId: str):
     
     # For non-private accounts, auto-accept
     if not target.get("privateAccount", False):
-        await db.users.update_one({"id": userId}, {"$addToSet": {"followers": fromUserId}})
-        await db.users.update_one({"id": fromUserId}, {"$addToSet": {"following": userId}})
+        await set_follow(fromUserId, userId, True)
+        await timeline_service.on_follow(fromUserId, userId)
         # Create notification
-        await db.notifications.insert_one({
+        notification_pipeline.enqueue({
             "id": str(uuid.uuid4()),
             "userId": userId,
             "type": "new_follower",
@@ -9862,7 +10109,7 @@ async def send_follow_request(userId: str, fromUserId: str):
     await db.follow_requests.insert_one(request)
     
     # Create notification
-    await db.notifications.insert_one({
+    notification_pipeline.enqueue({
         "id": str(uuid.uuid4()),
         "userId": userId,
         "type": "follow_request",
@@ -9879,9 +10126,9 @@ async def send_follow_request(userId: str, fromUserId: str):
 async def get_follow_requests(userId: str):
     """Get pending follow requests for a user"""
     requests = await db.follow_requests.find({"toUserId": userId, "status": "pending"}, {"_id": 0}).to_list(100)
+    users = await get_user_loader(db).load_many([req["fromUserId"] for req in requests])
     for req in requests:
-        user = await db.users.find_one({"id": req["fromUserId"]}, {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1})
-        if user: req["fromUser"] = user
+        if req["fromUserId"] in users: req["fromUser"] = users[req["fromUserId"]]
     return requests
 
 @api_router.post("/follow-requests/{requestId}/accept")
@@ -9892,14 +10139,14 @@ async def accept_follow_request(requestId: str, userId: str):
     if request["toUserId"] != userId: raise HTTPException(status_code=403, detail="Not authorized")
     
     # Update follow relationships
-    await db.users.update_one({"id": userId}, {"$addToSet": {"followers": request["fromUserId"]}})
-    await db.users.update_one({"id": request["fromUserId"]}, {"$addToSet": {"following": userId}})
+    await set_follow(request["fromUserId"], userId, True)
+    await timeline_service.on_follow(request["fromUserId"], userId)
     
     # Update request status
     await db.follow_requests.update_one({"id": requestId}, {"$set": {"status": "accepted"}})
     
     # Notify requester
-    await db.notifications.insert_one({
+    notification_pipeline.enqueue({
         "id": str(uuid.uuid4()),
         "userId": request["fromUserId"],
         "type": "follow_accepted",
@@ -9925,8 +10172,8 @@ async def reject_follow_request(requestId: str, userId: str):
 @api_router.delete("/users/{userId}/unfollow")
 async def unfollow_user(userId: str, fromUserId: str):
     """Unfollow a user"""
-    await db.users.update_one({"id": userId}, {"$pull": {"followers": fromUserId}})
-    await db.users.update_one({"id": fromUserId}, {"$pull": {"following": userId}})
+    await set_follow(fromUserId, userId, False)
+    await timeline_service.on_unfollow(fromUserId, userId)
     return {"status": "unfollowed"}
 
 # ============= ENHANCED REPUTATION SYSTEM =============
@@ -9974,7 +10221,7 @@ async def endorse_user(userId: str, fromUserId: str, data: dict = Body(...)):
         await db.reputation.update_one({"userId": userId}, {"$set": {"level": level}})
     
     # Notify user
-    await db.notifications.insert_one({
+    notification_pipeline.enqueue({
         "id": str(uuid.uuid4()),
         "userId": userId,
         "type": "endorsement",
@@ -10461,6 +10708,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "X-User-Queries", "X-Unread-Count"],
 )
 
 logging.basicConfig(
@@ -10473,129 +10721,98 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_db_indexes():
-    """Create database indexes for optimal performance with 100k+ users"""
+    """Build any indexes from the declarative manifest (db_indexes.py) that are missing"""
     try:
-        # Users collection indexes (sparse for optional fields)
-        await db.users.create_index("id", unique=True)
-        await db.users.create_index("email", unique=True, sparse=True)  # sparse allows null values
-        await db.users.create_index("handle", unique=True, sparse=True)
-        await db.users.create_index("friends")  # For friend lookups
-        await db.users.create_index("friendRequestsSent")
-        await db.users.create_index("friendRequestsReceived")
-        await db.users.create_index("followers")  # NEW: For follower lookups
-        await db.users.create_index("following")  # NEW: For following lookups
-        
-        # Posts collection indexes - OPTIMIZED
-        await db.posts.create_index("id", unique=True)
-        await db.posts.create_index("authorId")  # For user's posts
-        await db.posts.create_index([("createdAt", -1)])  # For timeline sorting
-        await db.posts.create_index([("authorId", 1), ("createdAt", -1)])  # NEW: Compound for user feed
-        await db.posts.create_index("likes")  # For like lookups
-        await db.posts.create_index("likedBy")  # NEW: For efficient like queries
-        await db.posts.create_index("hashtags")  # NEW: For hashtag searches
-        await db.posts.create_index([("likeCount", -1)])  # NEW: For trending
-        
-        # Reels collection indexes
-        await db.reels.create_index("id", unique=True)
-        await db.reels.create_index("authorId")
-        await db.reels.create_index([("createdAt", -1)])
-        await db.reels.create_index([("viewCount", -1)])  # NEW: For trending reels
-        
-        # DM threads indexes
-        await db.dm_threads.create_index("id", unique=True)
-        await db.dm_threads.create_index("user1Id")
-        await db.dm_threads.create_index("user2Id")
-        await db.dm_threads.create_index([("lastMessageAt", -1)])
-        await db.threads.create_index("participants")  # NEW: For messenger
-        await db.threads.create_index([("participants", 1), ("lastMessageAt", -1)])  # NEW: Compound
-        
-        # DM messages indexes
-        await db.dm_messages.create_index("id", unique=True)
-        await db.dm_messages.create_index("threadId")
-        await db.dm_messages.create_index([("createdAt", -1)])
-        await db.messages.create_index([("threadId", 1), ("createdAt", -1)])  # NEW: Compound
-        
-        # Calls collection indexes
-        await db.calls.create_index("id", unique=True)
-        await db.calls.create_index("callerId")
-        await db.calls.create_index("recipientId")
-        await db.calls.create_index([("startedAt", -1)])
-        
-        # Notifications indexes - OPTIMIZED
-        await db.notifications.create_index("id", unique=True)
-        await db.notifications.create_index("userId")
-        await db.notifications.create_index([("createdAt", -1)])
-        await db.notifications.create_index([("userId", 1), ("createdAt", -1)])  # NEW: Compound
-        await db.notifications.create_index([("userId", 1), ("read", 1)])  # NEW: For unread count
-        
-        # Events and Venues indexes
-        await db.events.create_index("id", unique=True)
-        await db.venues.create_index("id", unique=True)
-        await db.venues.create_index("type")  # For filtering by type
-        
-        # Tribes indexes
-        await db.tribes.create_index("id", unique=True)
-        await db.tribes.create_index("members")
-        await db.tribes.create_index("category")  # NEW: For category filter
-        
-        # TasteDNA indexes
-        await db.taste_dna.create_index("userId", unique=True)
-        
-        # Vibe Capsules (Stories) indexes with TTL for 24-hour expiration
-        await db.vibe_capsules.create_index("id", unique=True)
-        await db.vibe_capsules.create_index("authorId")
-        await db.vibe_capsules.create_index([("createdAt", -1)])
-        await db.vibe_capsules.create_index([("authorId", 1), ("expiresAt", -1)])  # NEW: Compound
-        await db.vibe_capsules.create_index("expiresAt", expireAfterSeconds=0)  # TTL index for auto-deletion
-        
-        # Student Profile indexes
-        await db.student_profiles.create_index("userId", unique=True)
-        await db.student_profiles.create_index("skills")
-        await db.student_profiles.create_index("collegeName")
-        await db.student_profiles.create_index("graduationYear")
-        await db.student_profiles.create_index("userCategory")
-        
-        # Certifications indexes
-        await db.certifications.create_index("id", unique=True)
-        await db.certifications.create_index("userId")
-        await db.certifications.create_index("skills")
-        await db.certifications.create_index([("createdAt", -1)])
-        
-        # Projects indexes
-        await db.projects.create_index("id", unique=True)
-        await db.projects.create_index("userId")
-        await db.projects.create_index("skills")
-        await db.projects.create_index("status")
-        await db.projects.create_index("isStartup")
-        await db.projects.create_index([("createdAt", -1)])
-        
-        # Team Posts indexes
-        await db.team_posts.create_index("id", unique=True)
-        await db.team_posts.create_index("userId")
-        await db.team_posts.create_index("status")
-        await db.team_posts.create_index("requiredSkills")
-        await db.team_posts.create_index([("createdAt", -1)])
-        
-        # Saved Projects indexes
-        await db.saved_projects.create_index([("userId", 1), ("projectId", 1)], unique=True)
-        
-        # Digital Products indexes - NEW
-        await db.digital_products.create_index("id", unique=True)
-        await db.digital_products.create_index("category")
-        await db.digital_products.create_index([("downloadCount", -1)])
-        await db.digital_products.create_index([("createdAt", -1)])
-        
-        logger.info("✅ Database indexes created successfully - Ready for 100k+ users")
+        await apply_indexes(db)
     except Exception as e:
-        logger.warning(f"⚠️ Some indexes already exist or had issues: {str(e)}")
+        logger.warning(f"⚠️ Index manifest could not be applied: {str(e)}")
         logger.info("✅ Database is ready for operations")
 
 
+@api_router.get("/admin/indexes/drift")
+async def get_index_drift(adminUserId: str = Depends(require_admin)):
+    """Diff live indexes against the manifest (admin only)"""
+    return {"drift": await diff_indexes(db)}
+
+
 # ===== PERFORMANCE MONITORING ENDPOINT =====
 @api_router.get("/performance/stats")
 async def get_performance_stats():
     """Get server performance statistics"""
-    return perf_monitor.get_stats()
+    return {
+        **perf_monitor.get_stats(),
+        "background_jobs": background_jobs.job_stats(),
+        "notifications": notification_pipeline.stats,
+        "routes": metrics_registry.route_snapshot(),
+        "slow_queries": metrics_registry.query_snapshot(),
+        "rate_limits": rate_limiter.stats,
+        "cpu_pools": cpu_offload.pool_stats(),
+        "event_loop": loop_monitor.summary()
+    }
+
+
+@api_router.get("/performance/metrics")
+async def get_prometheus_metrics():
+    """Route latency, MongoDB command, rate limit, CPU pool and event loop metrics in Prometheus text format"""
+    return Response(
+        content=(metrics_registry.prometheus() + rate_limiter.prometheus()
+                 + cpu_offload.prometheus() + loop_monitor.prometheus()),
+        media_type="text/plain; version=0.0.4"
+    )
+
+
+@api_router.get("/performance/loop")
+async def get_loop_stats(limit: int = 20, adminUserId: str = Depends(require_admin)):
+    """Event loop lag, stalls by route and the most recent stalls with their stack samples (admin only)"""
+    return loop_monitor.snapshot(limit=min(limit, 100))
+
+
+@api_router.post("/admin/loop-monitor")
+async def configure_loop_monitor(adminUserId: str = Depends(require_admin), enabled: Optional[bool] = None, thresholdMs: Optional[float] = None):
+    """Switch the event loop monitor on/off or change its stall threshold at runtime (admin only)"""
+    return loop_monitor.configure(enabled=enabled, threshold_ms=thresholdMs)
+
+
+@api_router.post("/admin/profiles/token")
+async def issue_profile_token(adminUserId: str = Depends(require_admin), ttlSeconds: int = 600):
+    """Signed X-Profile header value; requests carrying it are profiled until it expires (admin only)"""
+    return request_profiler.issue_token(ttl_seconds=min(max(ttlSeconds, 1), 86400))
+
+
+@api_router.post("/admin/profiles/config")
+async def configure_profiler(adminUserId: str = Depends(require_admin), sampleRate: Optional[float] = None, minMs: Optional[float] = None):
+    """Set the share of requests profiled at random and the latency a sampled profile must exceed (admin only)"""
+    return request_profiler.configure(sample_rate=sampleRate, min_ms=minMs)
+
+
+@api_router.get("/admin/profiles")
+async def list_profiles(response: Response, adminUserId: str = Depends(require_admin), route: Optional[str] = None,
+                        cursor: Optional[str] = None, limit: int = 50):
+    """Recent request profiles, newest first (summaries; download one for its stacks) (admin only)"""
+    query = {"route": route} if route else {}
+    profiles, next_cursor = await paginate_keyset(
+        db.request_profiles, query, projection=PROFILE_SUMMARY_FIELDS, cursor=cursor, limit=min(limit, 200)
+    )
+    set_next_cursor(response, next_cursor)
+    return profiles
+
+
+@api_router.get("/admin/profiles/{profileId}")
+async def download_profile(profileId: str, adminUserId: str = Depends(require_admin), format: str = "json"):
+    """One full profile: JSON (top frames, folded stacks, Mongo calls) or folded stacks for flamegraph tools (admin only)"""
+    profile = await db.request_profiles.find_one({"id": profileId}, {"_id": 0, "expiresAt": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "folded":
+        return Response(
+            content=request_profiler.to_folded(profile),
+            media_type="text/plain",
+            headers={"Content-Disposition": f'attachment; filename="profile-{profileId}.folded"'}
+        )
+    return JSONResponse(
+        content=profile,
+        headers={"Content-Disposition": f'attachment; filename="profile-{profileId}.json"'}
+    )
 
 
 @api_router.post("/performance/clear-cache")
@@ -10612,6 +10829,48 @@ async def clear_all_caches():
 app.include_router(api_router)
 
 
+@app.on_event("startup")
+async def startup_background_jobs():
+    """Periodic maintenance (one worker at a time per job via leases)"""
+    notification_pipeline.start()
+    background_jobs.start_periodic(db, "engagement_rescore", 900, engagement_service.rescore_all)
+    background_jobs.start_periodic(db, "analytics_rollup_days", 600, analytics_service.rollup_days)
+    background_jobs.start_periodic(db, "analytics_rebuild_totals", 3600, analytics_service.rebuild_totals)
+    background_jobs.start_periodic(db, "credits_reconcile", 3600, credits_service.reconcile)
+    background_jobs.start_periodic(db, "wallet_recover_pending", 300, wallet_service.recover_pending)
+    # Builds the search index after a deploy, and rebuilds a type when it drifts
+    background_jobs.start_periodic(db, "search_backfill", 3600, search_service.backfill)
+    # Trending is empty until something records into it - rebuild after a fresh deploy
+    background_jobs.start_periodic(db, "trending_backfill", 3600, trending_service.backfill)
+    background_jobs.start_periodic(db, "dm_messages_merge", 3600, merge_legacy_dm_messages)
+
+
+@app.on_event("startup")
+async def startup_loop_monitor():
+    """Loop lag / stall detection (runtime switch: POST /api/admin/loop-monitor)"""
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+
+
+@app.on_event("startup")
+async def startup_cache_tier():
+    """Attach the shared Redis L2 cache when REDIS_URL is configured"""
+    try:
+        await start_cache_tier(REDIS_URL)
+    except Exception as e:
+        logger.warning(f"⚠️ Shared cache unavailable, using in-process cache only: {e}")
+    try:
+        await rate_limiter.start(REDIS_URL)
+    except Exception as e:
+        logger.warning(f"⚠️ Shared rate limits unavailable, limiting per worker: {e}")
+
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await notification_pipeline.stop()
+    await background_jobs.stop_all()
+    await stop_cache_tier()
+    await rate_limiter.stop()
+    loop_monitor.stop()
+    cpu_offload.shutdown_pools()
     client.close()
\ No newline at end of file
@@ -0,0 +1,292 @@
+"""
+Timeline Service - Materialized home timelines for Loopync
+Fan-out-on-write into capped per-user timeline documents, with a
+fan-out-on-read fallback for authors with very large follower counts
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import List, Dict, Optional, Tuple
+from pymongo import UpdateOne
+
+from performance import decode_cursor, encode_cursor, keyset_filter
+
+logger = logging.getLogger(__name__)
+
+# Max entries kept per timeline document (older entries are sliced off)
+TIMELINE_MAX_ENTRIES = 800
+
+# Authors above this follower count are not fanned out on write;
+# their posts are merged into followers' timelines at read time instead
+FANOUT_FOLLOWER_LIMIT = 10000
+
+# Posts copied into a follower's timeline when they start following someone
+FOLLOW_BACKFILL_LIMIT = 50
+
+# Bulk write batch size for fan-out
+FANOUT_BATCH_SIZE = 1000
+
+
+def _timeline_entry(post: dict) -> dict:
+    """Slim timeline entry stored per post"""
+    return {
+        "postId": post["id"],
+        "authorId": post["authorId"],
+        "createdAt": post["createdAt"]
+    }
+
+
+def _entry_cursor(entry: dict) -> str:
+    """Keyset cursor for a timeline entry - same (createdAt, id) shape as the global feed"""
+    return encode_cursor({"createdAt": entry["createdAt"], "id": entry["postId"]})
+
+
+def _entry_key(entry: dict) -> tuple:
+    return entry.get("createdAt") or "", entry["postId"]
+
+
+# Entries are kept in (createdAt, postId) descending order so keyset pages are stable
+ENTRY_SORT = {"createdAt": -1, "postId": -1}
+
+
+class TimelineService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== WRITE PATH =====
+
+    async def fan_out_post(self, post: dict) -> int:
+        """
+        Push a new post into the author's and followers' timelines.
+        Returns the number of timelines written.
+        """
+        author_id = post["authorId"]
+        author = await self.db.users.find_one(
+            {"id": author_id}, {"_id": 0, "followers": 1, "highFanout": 1}
+        )
+        followers = author.get("followers", []) if author else []
+
+        recipients = [author_id]
+        if len(followers) > FANOUT_FOLLOWER_LIMIT:
+            # Too many followers - mark author for fan-out-on-read
+            if not author.get("highFanout"):
+                await self.db.users.update_one({"id": author_id}, {"$set": {"highFanout": True}})
+                await self._set_pulled_author(followers, author_id, pulled=True)
+                logger.info(f"Author {author_id} switched to fan-out-on-read ({len(followers)} followers)")
+        else:
+            recipients.extend(f for f in followers if f != author_id)
+            if author and author.get("highFanout"):
+                await self.db.users.update_one({"id": author_id}, {"$unset": {"highFanout": ""}})
+                await self._set_pulled_author(followers, author_id, pulled=False)
+
+        entry = _timeline_entry(post)
+        push = {
+            "$push": {
+                "entries": {
+                    "$each": [entry],
+                    "$sort": ENTRY_SORT,
+                    "$slice": TIMELINE_MAX_ENTRIES
+                }
+            },
+            "$set": {"updatedAt": datetime.now(timezone.utc).isoformat()}
+        }
+
+        # Only existing timelines are updated - missing ones are rebuilt lazily on read
+        for i in range(0, len(recipients), FANOUT_BATCH_SIZE):
+            batch = recipients[i:i + FANOUT_BATCH_SIZE]
+            await self.db.timelines.bulk_write(
+                [UpdateOne({"userId": uid}, push) for uid in batch],
+                ordered=False
+            )
+
+        return len(recipients)
+
+    async def _set_pulled_author(self, followers: List[str], author_id: str, pulled: bool) -> None:
+        """Add/remove a high-fanout author on followers' read-time merge lists (once per switch)"""
+        op = {"$addToSet": {"pullFrom": author_id}} if pulled else {"$pull": {"pullFrom": author_id}}
+        for i in range(0, len(followers), FANOUT_BATCH_SIZE):
+            await self.db.timelines.update_many(
+                {"userId": {"$in": followers[i:i + FANOUT_BATCH_SIZE]}}, op
+            )
+
+    async def on_follow(self, follower_id: str, target_id: str) -> None:
+        """Backfill a followed user's recent posts into the follower's timeline"""
+        target = await self.db.users.find_one({"id": target_id}, {"_id": 0, "highFanout": 1})
+        if target and target.get("highFanout"):
+            # Merged at read time
+            await self.db.timelines.update_one(
+                {"userId": follower_id}, {"$addToSet": {"pullFrom": target_id}}
+            )
+            return
+
+        recent = await self.db.posts.find(
+            {"authorId": target_id},
+            {"_id": 0, "id": 1, "authorId": 1, "createdAt": 1}
+        ).sort([("createdAt", -1), ("id", -1)]).limit(FOLLOW_BACKFILL_LIMIT).to_list(FOLLOW_BACKFILL_LIMIT)
+
+        if not recent:
+            return
+
+        # Clear any stale entries first so a re-follow doesn't duplicate posts
+        await self.on_unfollow(follower_id, target_id)
+        await self.db.timelines.update_one(
+            {"userId": follower_id},
+            {
+                "$push": {
+                    "entries": {
+                        "$each": [_timeline_entry(p) for p in recent],
+                        "$sort": ENTRY_SORT,
+                        "$slice": TIMELINE_MAX_ENTRIES
+                    }
+                },
+                "$set": {"updatedAt": datetime.now(timezone.utc).isoformat()}
+            }
+        )
+
+    async def on_unfollow(self, follower_id: str, target_id: str) -> None:
+        """Drop an unfollowed user's posts from the follower's timeline"""
+        await self.db.timelines.update_one(
+            {"userId": follower_id},
+            {"$pull": {"entries": {"authorId": target_id}, "pullFrom": target_id}}
+        )
+
+    async def remove_post(self, post_id: str) -> None:
+        """Remove a deleted post from every timeline that holds it"""
+        await self.db.timelines.update_many(
+            {"entries.postId": post_id},
+            {"$pull": {"entries": {"postId": post_id}}}
+        )
+
+    # ===== READ PATH =====
+
+    async def rebuild(self, user_id: str, following: Optional[List[str]] = None) -> Dict:
+        """Rebuild a user's timeline from posts (fan-out-on-read) and store it"""
+        if following is None:
+            user = await self.db.users.find_one({"id": user_id}, {"_id": 0, "following": 1})
+            following = user.get("following", []) if user else []
+
+        authors = [user_id] + [f for f in following if f != user_id]
+        entries = await self.db.posts.find(
+            {"authorId": {"$in": authors}},
+            {"_id": 0, "id": 1, "authorId": 1, "createdAt": 1}
+        ).sort([("createdAt", -1), ("id", -1)]).limit(TIMELINE_MAX_ENTRIES).to_list(TIMELINE_MAX_ENTRIES)
+        entries = [_timeline_entry(p) for p in entries]
+        pull_from = await self._high_fanout_following(following)
+
+        timeline = {
+            "entries": entries,
+            "pullFrom": pull_from,
+            "updatedAt": datetime.now(timezone.utc).isoformat()
+        }
+        await self.db.timelines.update_one({"userId": user_id}, {"$set": timeline}, upsert=True)
+        logger.info(f"Rebuilt timeline for {user_id} ({len(entries)} entries)")
+        return timeline
+
+    async def _high_fanout_following(self, following: List[str]) -> List[str]:
+        if not following:
+            return []
+        docs = await self.db.users.find(
+            {"id": {"$in": following}, "highFanout": True}, {"_id": 0, "id": 1}
+        ).to_list(len(following))
+        return [d["id"] for d in docs]
+
+    async def _read_page(self, user_id: str, cursor: Optional[str], skip: int, count: int) -> Optional[Dict]:
+        """
+        One indexed read of the timeline document: entries after the cursor,
+        sliced server-side, plus the total entry count and high-fanout authors
+        """
+        entries = "$entries"
+        decoded = decode_cursor(cursor)
+        if decoded is not None:
+            value, post_id = decoded
+            entries = {"$filter": {
+                "input": "$entries",
+                "as": "e",
+                "cond": {"$or": [
+                    {"$lt": ["$$e.createdAt", value]},
+                    {"$and": [
+                        {"$eq": ["$$e.createdAt", value]},
+                        {"$lt": ["$$e.postId", post_id]}
+                    ]}
+                ]}
+            }}
+
+        docs = await self.db.timelines.aggregate([
+            {"$match": {"userId": user_id}},
+            {"$project": {
+                "_id": 0,
+                "entries": {"$slice": [entries, skip, count]},
+                "size": {"$size": {"$ifNull": ["$entries", []]}},
+                "pullFrom": 1
+            }}
+        ]).to_list(1)
+        return docs[0] if docs else None
+
+    async def get_timeline_entries(
+        self, user_id: str, cursor: Optional[str] = None, skip: int = 0, limit: int = 50
+    ) -> Optional[Tuple[List[Dict], Optional[str]]]:
+        """
+        Return (entries, next_cursor) for one page of the timeline, newest first.
+        Returns None when the user has no materialized timeline (nothing followed or posted).
+        """
+        # One extra entry tells us whether there's a next page
+        window = limit + 1
+        timeline = await self._read_page(user_id, cursor, skip, window)
+
+        if timeline is None or "pullFrom" not in timeline:
+            # First read (or a pre-pullFrom document) - materialize, then page it
+            await self.rebuild(user_id)
+            timeline = await self._read_page(user_id, cursor, skip, window)
+
+        pulled_authors = timeline.get("pullFrom") or []
+        if not timeline.get("size") and not pulled_authors:
+            return None
+
+        page = timeline.get("entries", [])
+        if pulled_authors:
+            # Merge materialized entries with posts pulled from high-fanout authors
+            if skip:
+                # Offset paging over a merged stream needs the whole prefix
+                pushed = await self._read_page(user_id, cursor, 0, skip + window)
+                page = pushed.get("entries", []) if pushed else []
+            pulled = await self.db.posts.find(
+                keyset_filter({"authorId": {"$in": pulled_authors}}, cursor),
+                {"_id": 0, "id": 1, "authorId": 1, "createdAt": 1}
+            ).sort([("createdAt", -1), ("id", -1)]).limit(skip + window).to_list(skip + window)
+
+            seen = set()
+            merged = []
+            for entry in sorted(page + [_timeline_entry(p) for p in pulled], key=_entry_key, reverse=True):
+                if entry["postId"] in seen:
+                    continue
+                seen.add(entry["postId"])
+                merged.append(entry)
+            page = merged[skip:skip + window]
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = _entry_cursor(page[-1])
+        return page, next_cursor
+
+    async def get_timeline(
+        self, user_id: str, cursor: Optional[str] = None, skip: int = 0, limit: int = 50
+    ) -> Optional[Tuple[List[Dict], Optional[str]]]:
+        """
+        Return (posts, next_cursor) for the user's home timeline as full post documents.
+        Returns None when the user has no materialized timeline.
+        """
+        result = await self.get_timeline_entries(user_id, cursor, skip, limit)
+        if result is None:
+            return None
+
+        entries, next_cursor = result
+        if not entries:
+            return [], next_cursor
+
+        post_ids = [e["postId"] for e in entries]
+        docs = await self.db.posts.find({"id": {"$in": post_ids}}, {"_id": 0}).to_list(len(post_ids))
+        by_id = {p["id"]: p for p in docs}
+
+        # Preserve timeline order; deleted posts are simply skipped
+        return [by_id[pid] for pid in post_ids if pid in by_id], next_cursor
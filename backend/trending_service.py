@@ -0,0 +1,161 @@
+"""
+Trending Service - Incremental trending-hashtag engine for Loopync
+Hashtags are counted when a post is written: hourly buckets hold exact
+windowed counts, and a per-tag exponentially decayed score (kept in log space
+against a fixed epoch, so scores of all tags stay directly comparable) is
+indexed for O(K) top-K reads.
+"""
+
+import re
+import math
+import time
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, List
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Decay half-life of a hashtag's trending score
+TRENDING_HALF_LIFE_SECONDS = 6 * 3600
+DECAY_RATE = math.log(2) / TRENDING_HALF_LIFE_SECONDS
+
+# Landmark for forward decay: log-score = ln(sum(exp(rate * (t_i - EPOCH))))
+DECAY_EPOCH = 1704067200  # 2024-01-01T00:00:00Z
+
+# Window reported as "count" and how long hourly buckets are retained
+TRENDING_WINDOW_HOURS = 24
+BUCKET_RETENTION_DAYS = 7
+
+_HASHTAG_RE = re.compile(r"#(\w{1,64})", re.UNICODE)
+
+
+def normalize_tag(tag: str) -> str:
+    return tag.lstrip("#").strip().lower()
+
+
+def extract_hashtags(text: str, explicit: Iterable[str] = ()) -> List[str]:
+    """Unique, lowercased hashtags from post text plus any explicit tags"""
+    tags = [normalize_tag(t) for t in _HASHTAG_RE.findall(text or "")]
+    tags += [normalize_tag(t) for t in explicit or () if t]
+    return list(dict.fromkeys(t for t in tags if t))
+
+
+def hour_bucket(ts: datetime) -> str:
+    return ts.strftime("%Y-%m-%dT%H")
+
+
+def _log_weight(epoch_seconds: float) -> float:
+    return DECAY_RATE * (epoch_seconds - DECAY_EPOCH)
+
+
+def _logaddexp_update(x: float) -> list:
+    """Pipeline update: score = ln(exp(score) + exp(x)), computed stably"""
+    return [{
+        "$set": {
+            "logScore": {
+                "$cond": [
+                    {"$in": [{"$type": "$logScore"}, ["missing", "null"]]},
+                    x,
+                    {"$add": [
+                        {"$max": ["$logScore", x]},
+                        {"$ln": {"$add": [1, {"$exp": {"$subtract": [
+                            {"$min": ["$logScore", x]}, {"$max": ["$logScore", x]}
+                        ]}}]}}
+                    ]}
+                ]
+            },
+            "total": {"$add": [{"$ifNull": ["$total", 0]}, 1]},
+            "lastUsedAt": datetime.now(timezone.utc).isoformat()
+        }
+    }]
+
+
+class TrendingService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== WRITE PATH =====
+
+    async def record(self, tags: List[str], created_at: str = None) -> None:
+        """Count one use of each tag at the post's creation time"""
+        if not tags:
+            return
+        ts = datetime.fromisoformat(created_at) if created_at else datetime.now(timezone.utc)
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        bucket = hour_bucket(ts)
+        expires = ts + timedelta(days=BUCKET_RETENTION_DAYS)
+        x = _log_weight(ts.timestamp())
+
+        await self.db.hashtag_buckets.bulk_write([
+            UpdateOne(
+                {"tag": tag, "bucket": bucket},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expiresAt": expires}},
+                upsert=True
+            ) for tag in tags
+        ], ordered=False)
+        await self.db.hashtag_trends.bulk_write([
+            UpdateOne({"tag": tag}, _logaddexp_update(x), upsert=True) for tag in tags
+        ], ordered=False)
+
+    async def unrecord(self, tags: List[str], created_at: str) -> None:
+        """Remove a deleted post from its windowed counts (the decayed score simply fades)"""
+        if not tags or not created_at:
+            return
+        ts = datetime.fromisoformat(created_at)
+        await self.db.hashtag_buckets.update_many(
+            {"tag": {"$in": tags}, "bucket": hour_bucket(ts), "count": {"$gt": 0}},
+            {"$inc": {"count": -1}}
+        )
+
+    async def rebuild(self, days: int = BUCKET_RETENTION_DAYS) -> int:
+        """Recount trends from recent posts (backfill / repair)"""
+        await self.db.hashtag_buckets.delete_many({})
+        await self.db.hashtag_trends.delete_many({})
+        since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        count = 0
+        async for post in self.db.posts.find(
+            {"createdAt": {"$gte": since}}, {"_id": 0, "text": 1, "hashtags": 1, "createdAt": 1}
+        ).sort("createdAt", 1):
+            tags = extract_hashtags(post.get("text", ""), post.get("hashtags", []))
+            if tags:
+                await self.record(tags, post["createdAt"])
+                count += 1
+        logger.info(f"✅ Trending hashtags rebuilt from {count} posts")
+        return count
+
+    async def backfill(self) -> int:
+        """Rebuild when no trends exist yet (fresh deploy, or counters were dropped)"""
+        if await self.db.hashtag_trends.find_one({}, {"_id": 1}) is not None:
+            return 0
+        return await self.rebuild()
+
+    # ===== READ PATH =====
+
+    async def top(self, limit: int = 10) -> List[Dict]:
+        """Top-K tags by decayed score with their exact counts over the window"""
+        trends = await self.db.hashtag_trends.find(
+            {}, {"_id": 0, "tag": 1, "logScore": 1, "total": 1}
+        ).sort("logScore", -1).limit(limit).to_list(limit)
+        if not trends:
+            return []
+
+        now = datetime.now(timezone.utc)
+        since = hour_bucket(now - timedelta(hours=TRENDING_WINDOW_HOURS))
+        counts: Dict[str, int] = {}
+        async for row in self.db.hashtag_buckets.aggregate([
+            {"$match": {"tag": {"$in": [t["tag"] for t in trends]}, "bucket": {"$gt": since}}},
+            {"$group": {"_id": "$tag", "count": {"$sum": "$count"}}}
+        ]):
+            counts[row["_id"]] = row["count"]
+
+        now_weight = _log_weight(time.time())
+        return [{
+            "tag": t["tag"],
+            "count": counts.get(t["tag"], 0),
+            "total": t.get("total", 0),
+            # Decayed number of uses "as of now"
+            "score": round(math.exp(t["logScore"] - now_weight), 3)
+        } for t in trends]
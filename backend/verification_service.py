@@ -61,9 +61,17 @@ class VerificationService:
             
             requests = await cursor.to_list(length=limit)
             
-            # Fetch user info for each request
+            # Fetch user info for all requests in one query
+            user_ids = list({req["userId"] for req in requests})
+            users = {}
+            async for user in self.db.users.find(
+                {"id": {"$in": user_ids}},
+                {"_id": 0, "id": 1, "name": 1, "handle": 1, "avatar": 1, "email": 1}
+            ):
+                users[user["id"]] = user
+            
             for req in requests:
-                user = await self.db.users.find_one({"id": req["userId"]}, {"_id": 0})
+                user = users.get(req["userId"])
                 if user:
                     req["userInfo"] = {
                         "name": user.get("name"),
@@ -0,0 +1,216 @@
+"""
+Wallet Service - Conditional debits and idempotent wallet transactions for Loopync
+Every balance change is a single guarded find_one_and_update on the user
+document (debits only match while walletBalance covers the amount), so
+concurrent payments can never overdraw or lose an update. Each change is
+tied to its wallet_transactions entry: the entry is written as pending, the
+user document records the transaction id in the same update that moves the
+balance, and the entry is then completed. Client idempotency keys map retries
+onto the original transaction instead of charging twice; each key is stored
+with a fingerprint of the request, and reusing it for a different one fails.
+"""
+
+import uuid
+import hashlib
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Recent transaction ids kept on the user document so re-applying a pending entry is a no-op
+# (only needs to cover one user's transactions within PENDING_GRACE_SECONDS)
+APPLIED_WINDOW = 20
+
+# Pending entries older than this are resolved by recover_pending()
+PENDING_GRACE_SECONDS = 60
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class InsufficientFundsError(ValueError):
+    def __init__(self, balance: float, amount: float):
+        super().__init__(f"Insufficient balance: {balance}, needed {amount}")
+        self.balance = balance
+        self.amount = amount
+
+
+class WalletNotFoundError(LookupError):
+    pass
+
+
+class IdempotencyConflictError(ValueError):
+    """An idempotency key was reused for a different request"""
+
+    def __init__(self, key: str):
+        super().__init__("Idempotency-Key was already used for a different request")
+        self.key = key
+
+
+def request_fingerprint(delta: float, kind: str, operation: Optional[str]) -> str:
+    """Identifies what a keyed request asked for: direction, type, amount and the caller's operation"""
+    raw = f"{'credit' if delta > 0 else 'debit'}|{kind}|{abs(delta)!r}|{operation or ''}"
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+class WalletService:
+    def __init__(self, db):
+        self.db = db
+
+    # ===== WRITE PATH =====
+
+    async def credit(self, user_id: str, amount: float, kind: str, description: str = "",
+                     metadata: Optional[dict] = None, idempotency_key: Optional[str] = None,
+                     operation: Optional[str] = None) -> Dict:
+        """Add to a wallet (topup, refund); returns the completed transaction"""
+        if not amount > 0:  # Also rejects NaN
+            raise ValueError("Wallet amount must be positive")
+        return await self._transact(user_id, amount, kind, description, metadata, idempotency_key, operation)
+
+    async def debit(self, user_id: str, amount: float, kind: str, description: str = "",
+                    metadata: Optional[dict] = None, idempotency_key: Optional[str] = None,
+                    operation: Optional[str] = None) -> Dict:
+        """Take from a wallet only if the balance covers it (atomic); raises InsufficientFundsError"""
+        if not amount > 0:
+            raise ValueError("Wallet amount must be positive")
+        return await self._transact(user_id, -amount, kind, description, metadata, idempotency_key, operation)
+
+    async def refund(self, txn: Dict, description: str, metadata: Optional[dict] = None) -> Dict:
+        """
+        Credit a payment back and release its idempotency key, so a retry with
+        that key charges afresh instead of replaying a refunded payment.
+        """
+        refund = await self.credit(
+            txn["userId"], txn["amount"], "refund", description,
+            {**(metadata or {}), "transactionId": txn["id"]},
+            idempotency_key=f"refund:{txn['id']}", operation=f"refund:{txn['id']}"
+        )
+        await self.db.wallet_transactions.update_one(
+            {"id": txn["id"]},
+            {"$set": {"status": "refunded", "refundTransactionId": refund["id"]}, "$unset": {"idempotencyKey": ""}}
+        )
+        return refund
+
+    async def _transact(self, user_id: str, delta: float, kind: str, description: str,
+                        metadata: Optional[dict], idempotency_key: Optional[str],
+                        operation: Optional[str] = None) -> Dict:
+        """
+        Returns the transaction with a transient "replayed" flag: True when the
+        idempotency key matched an earlier request and nothing was charged again.
+        `operation` names what the caller is paying for (endpoint and request
+        details); a key reused with a different amount, type or operation
+        raises IdempotencyConflictError.
+        """
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise ValueError("Invalid idempotency key")
+        fingerprint = request_fingerprint(delta, kind, operation)
+
+        txn = {
+            "id": str(uuid.uuid4()),
+            "userId": user_id,
+            "type": kind,
+            "amount": abs(delta),
+            "status": "pending",
+            "description": description,
+            "metadata": metadata or {},
+            "createdAt": datetime.now(timezone.utc).isoformat(),
+        }
+        if idempotency_key is not None:
+            txn["idempotencyKey"] = idempotency_key
+            txn["fingerprint"] = fingerprint
+
+        try:
+            await self.db.wallet_transactions.insert_one(txn)
+        except DuplicateKeyError:
+            existing = await self.db.wallet_transactions.find_one(
+                {"userId": user_id, "idempotencyKey": idempotency_key}, {"_id": 0}
+            )
+            if existing is None:
+                # The earlier attempt failed and released its key in the meantime
+                return await self._transact(user_id, delta, kind, description, metadata, idempotency_key, operation)
+            if existing.get("fingerprint") != fingerprint and (
+                "fingerprint" in existing or existing["type"] != kind or existing["amount"] != abs(delta)
+            ):
+                raise IdempotencyConflictError(idempotency_key)
+            if existing["status"] == "completed":
+                return {**existing, "replayed": True}
+            # Still pending: finish it on the caller's behalf (re-applying is a no-op)
+            delta = existing["amount"] if delta > 0 else -existing["amount"]
+            txn = existing
+            replayed = True
+        else:
+            txn.pop("_id", None)
+            replayed = False
+
+        try:
+            balance = await self._apply(user_id, txn["id"], delta)
+        except (InsufficientFundsError, WalletNotFoundError):
+            # Release the idempotency key so the client can retry after a top-up
+            await self.db.wallet_transactions.delete_one({"id": txn["id"], "status": "pending"})
+            raise
+
+        completed = {"status": "completed", "balanceAfter": balance,
+                     "completedAt": datetime.now(timezone.utc).isoformat()}
+        await self.db.wallet_transactions.update_one({"id": txn["id"]}, {"$set": completed})
+        return {**txn, **completed, "replayed": replayed}
+
+    async def _apply(self, user_id: str, txn_id: str, delta: float) -> float:
+        """Move the balance once per transaction id; returns the balance after it"""
+        query = {"id": user_id, "walletApplied": {"$ne": txn_id}}
+        if delta < 0:
+            query["walletBalance"] = {"$gte": -delta}
+        doc = await self.db.users.find_one_and_update(
+            query,
+            {
+                "$inc": {"walletBalance": delta},
+                "$push": {"walletApplied": {"$each": [txn_id], "$slice": -APPLIED_WINDOW}},
+            },
+            projection={"_id": 0, "walletBalance": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is not None:
+            return doc["walletBalance"]
+
+        user = await self.db.users.find_one({"id": user_id}, {"_id": 0, "walletBalance": 1, "walletApplied": 1})
+        if user is None:
+            raise WalletNotFoundError(f"User {user_id} not found")
+        if txn_id in user.get("walletApplied", []):
+            return user.get("walletBalance", 0.0)  # Applied by an earlier attempt
+        raise InsufficientFundsError(user.get("walletBalance", 0.0), -delta)
+
+    # ===== RECOVERY =====
+
+    async def recover_pending(self, grace_seconds: int = PENDING_GRACE_SECONDS) -> Dict[str, int]:
+        """
+        Resolve transactions left pending by a crashed request: completed if the
+        balance moved, otherwise removed (the client's retry starts afresh).
+        """
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)).isoformat()
+        stale = await self.db.wallet_transactions.find(
+            {"status": "pending", "createdAt": {"$lt": cutoff}}, {"_id": 0, "id": 1, "userId": 1}
+        ).to_list(1000)
+        if not stale:
+            return {"completed": 0, "released": 0}
+
+        applied = {u["id"]: set(u.get("walletApplied", [])) for u in await self.db.users.find(
+            {"id": {"$in": list({t["userId"] for t in stale})}}, {"_id": 0, "id": 1, "walletApplied": 1}
+        ).to_list(None)}
+
+        completed = released = 0
+        now = datetime.now(timezone.utc).isoformat()
+        for txn in stale:
+            if txn["id"] in applied.get(txn["userId"], ()):
+                result = await self.db.wallet_transactions.update_one(
+                    {"id": txn["id"], "status": "pending"}, {"$set": {"status": "completed", "completedAt": now}}
+                )
+                completed += result.modified_count
+            else:
+                result = await self.db.wallet_transactions.delete_one({"id": txn["id"], "status": "pending"})
+                released += result.deleted_count
+
+        if completed or released:
+            logger.warning(f"⚠️ Wallet recovery: {completed} pending completed, {released} released")
+        return {"completed": completed, "released": released}
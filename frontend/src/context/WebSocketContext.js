@@ -4,6 +4,9 @@ import { toast } from 'sonner';
 
 const WebSocketContext = createContext(null);
 
+// Presence heartbeat - well inside the server's PRESENCE_SID_TTL
+const HEARTBEAT_INTERVAL_MS = 5 * 60 * 1000;
+
 export const useWebSocket = () => {
   const context = useContext(WebSocketContext);
   if (!context) {
@@ -47,6 +50,13 @@ export const WebSocketProvider = ({ children }) => {
       setConnected(true);
     });
 
+    // Keep this device's presence entry alive on the server
+    const heartbeat = setInterval(() => {
+      if (newSocket.connected) {
+        newSocket.emit('heartbeat');
+      }
+    }, HEARTBEAT_INTERVAL_MS);
+
     newSocket.on('disconnect', () => {
       console.log('❌ WebSocket disconnected');
       setConnected(false);
@@ -199,6 +209,7 @@ export const WebSocketProvider = ({ children }) => {
     // Cleanup
     return () => {
       console.log('Cleaning up WebSocket connection');
+      clearInterval(heartbeat);
       newSocket.close();
     };
   }, []);
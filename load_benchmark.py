@@ -0,0 +1,769 @@
+#!/usr/bin/env python3
+"""
+Load Benchmark for Loopync
+Benchmarks the hot paths against a dedicated, reproducible benchmark database
+and saves req/s and tail latency as JSON so runs can be compared:
+  seed     builds the synthetic data set (users, skewed follow graph, posts with
+           skewed likes, DM threads, notifications, capsules, media)
+  run      drives the hot read endpoints and login of a running server with
+           concurrent clients
+  micro    times the same reads in-process against the database, plus the
+           aggregate endpoints' independent queries awaited one by one versus
+           through gather_queries
+  wallet   fires concurrent payments (with retried idempotency keys) at a few
+           hot wallets and audits every balance against its transaction history
+  compare  diffs two saved result files
+
+The server under test must use the benchmark database, e.g. from backend/:
+  DB_NAME=loopync_bench TRUSTED_PROXIES=127.0.0.1 uvicorn server:app --port 8001 --workers 1
+(TRUSTED_PROXIES lets the login scenario present many client addresses.)
+
+Usage:
+  python load_benchmark.py seed    [--users 2000 --posts 20000 --skew 1.1 --seed 42]
+  python load_benchmark.py run     [--base-url http://localhost:8001 --concurrency 32 --duration 30]
+  python load_benchmark.py micro   [--rounds 200]
+  python load_benchmark.py wallet  [--payments 20000 --users 50 --concurrency 256]
+  python load_benchmark.py compare BASELINE.json CANDIDATE.json
+Results are written to test_reports/benchmarks/ unless --out is given.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("BENCH_DB_NAME", "loopync_bench")
+RESULTS_DIR = os.path.join(ROOT, "test_reports", "benchmarks")
+
+FIRST = ["aarav", "vivaan", "aditya", "ananya", "diya", "isha", "kabir", "meera", "rohan", "saanvi",
+         "arjun", "priya", "rahul", "sneha", "vikram", "zara", "nikhil", "pooja", "karan", "tara"]
+LAST = ["sharma", "verma", "iyer", "reddy", "patel", "singh", "nair", "gupta", "mehta", "rao"]
+WORDS = ["coding", "hackathon", "campus", "startup", "design", "music", "football", "coffee", "exam",
+         "placement", "internship", "python", "react", "travel", "food", "movie", "cricket", "gaming"]
+QUERIES = ["aarav", "priya sharma", "ana", "hackathon campus", "python", "coffee startup", "kab", "zara nair"]
+BENCH_PASSWORD = "bench-password"
+
+# Endpoint mix driven by `run` (name -> relative weight)
+SCENARIO_WEIGHTS = {
+    "feed": 25,
+    "timeline": 15,
+    "dm_threads": 15,
+    "notifications": 15,
+    "search": 10,
+    "media": 10,
+    "capsules": 10,
+    "profile": 10,
+    "wallet_analytics": 5,
+    "login": 5,
+}
+
+
+# ===== HELPERS =====
+
+def percentiles(samples):
+    """Latency summary (ms) of a list of durations in seconds"""
+    if not samples:
+        return {"p50_ms": 0, "p90_ms": 0, "p95_ms": 0, "p99_ms": 0, "max_ms": 0, "mean_ms": 0}
+    ordered = sorted(samples)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {
+        "p50_ms": at(0.50), "p90_ms": at(0.90), "p95_ms": at(0.95), "p99_ms": at(0.99),
+        "max_ms": round(ordered[-1] * 1000, 2),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+
+def zipf_weights(n, skew):
+    return [1.0 / (rank + 1) ** skew for rank in range(n)]
+
+
+def iso(ts):
+    return ts.isoformat()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def save_results(kind, results, out=None):
+    if not out:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        out = os.path.join(RESULTS_DIR, f"{kind}-{stamp}.json")
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results saved to {out}")
+    return out
+
+
+def get_db():
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(MONGO_URL)
+    return client, client[DB_NAME]
+
+
+async def bench_meta(db):
+    meta = await db.bench_meta.find_one({"_id": "seed"})
+    if not meta:
+        raise SystemExit(f"❌ {DB_NAME} has not been seeded - run `python load_benchmark.py seed` first")
+    meta.pop("_id")
+    return meta
+
+
+# ===== SEED =====
+
+def build_dataset(args):
+    """Generate every document in memory from a seeded RNG (same args -> same data)"""
+    from seed_data import MOCK_PRODUCTS
+    from notification_service import actor_snapshot
+
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+
+    def new_id():
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    def recent(days):
+        return now - timedelta(seconds=rng.uniform(0, days * 86400))
+
+    # Users - list order doubles as popularity rank
+    users = []
+    for i in range(args.users):
+        first, last = rng.choice(FIRST), rng.choice(LAST)
+        handle = f"{first}{last}{i}"
+        users.append({
+            "id": new_id(), "handle": handle, "name": f"{first.title()} {last.title()}",
+            "email": f"{handle}@bench.loopync.local",
+            "avatar": f"https://api.dicebear.com/7.x/avataaars/svg?seed={handle}",
+            "bio": " ".join(rng.sample(WORDS, 3)), "isVerified": i < args.users // 100,
+            "followers": [], "following": [], "friends": [],
+            "createdAt": iso(recent(365)),
+        })
+    popularity = zipf_weights(len(users), args.skew)
+
+    # Follow graph - everyone follows ~follows users, picked by popularity
+    for user in users:
+        targets = {id(t): t for t in rng.choices(users, weights=popularity, k=args.follows)}
+        for target in targets.values():
+            if target is not user:
+                user["following"].append(target["id"])
+                target["followers"].append(user["id"])
+
+    # Posts - popular users post more; likes follow a Zipf curve over a shuffled rank
+    posts = []
+    like_rank = list(range(args.posts))
+    rng.shuffle(like_rank)
+    for i in range(args.posts):
+        author = rng.choices(users, weights=popularity)[0]
+        likes = min(len(users), int(args.max_likes / (like_rank[i] + 1) ** args.skew))
+        liked_by = [u["id"] for u in rng.sample(users, min(likes, 200))]
+        tag = rng.choice(WORDS)
+        posts.append({
+            "id": new_id(), "authorId": author["id"],
+            "text": " ".join(rng.choices(WORDS, k=12)) + f" #{tag}",
+            "audience": "public", "hashtags": [tag],
+            "stats": {"likes": likes, "quotes": 0, "reposts": 0,
+                      "replies": rng.randint(0, 5), "shares": rng.randint(0, 3)},
+            "likedBy": liked_by, "repostedBy": [], "sharedBy": [],
+            "createdAt": iso(recent(args.days)),
+        })
+
+    # DM threads between followers, each with a short message history
+    threads, messages = [], []
+    for _ in range(args.threads):
+        user = rng.choices(users, weights=popularity)[0]
+        if not user["following"]:
+            continue
+        peer = rng.choice(user["following"])
+        thread = {"id": new_id(), "user1Id": user["id"], "user2Id": peer,
+                  "createdAt": iso(recent(args.days)), "unreadCount": {}}
+        started = datetime.fromisoformat(thread["createdAt"])
+        history = []
+        for n in range(rng.randint(1, args.messages * 2)):
+            history.append({
+                "id": new_id(), "threadId": thread["id"],
+                "senderId": rng.choice([user["id"], peer]), "text": " ".join(rng.choices(WORDS, k=6)),
+                "readBy": [], "reactions": [], "deletedAt": None,
+                "createdAt": iso(min(now, started + timedelta(minutes=5 * n))),
+            })
+        last = history[-1]
+        thread["lastMessageAt"] = last["createdAt"]
+        thread["lastMessage"] = {k: last.get(k) for k in ("id", "senderId", "text", "createdAt")}
+        recipient = peer if last["senderId"] == user["id"] else user["id"]
+        thread["unreadCount"] = {recipient: rng.randint(0, 3)}
+        threads.append(thread)
+        messages.extend(history)
+
+    # Notifications - likes and follows land on the authors/targets
+    by_id = {u["id"]: u for u in users}
+    notifications = []
+    for post in posts:
+        for liker in post["likedBy"][:args.notify_per_post]:
+            notifications.append({
+                "id": new_id(), "userId": post["authorId"], "type": "post_like",
+                "message": "liked your post", "fromUserId": liker, "fromUser": actor_snapshot(by_id[liker]),
+                "contentType": "post", "contentId": post["id"], "read": rng.random() < 0.6,
+                "createdAt": post["createdAt"],
+            })
+    for user in users:
+        for follower in user["followers"][:args.notify_per_post]:
+            notifications.append({
+                "id": new_id(), "userId": user["id"], "type": "new_follower",
+                "message": "started following you", "fromUserId": follower,
+                "fromUser": actor_snapshot(by_id[follower]), "read": rng.random() < 0.6,
+                "createdAt": iso(recent(args.days)),
+            })
+
+    # Capsules from the most active users, all still live
+    capsules = []
+    for _ in range(args.capsules):
+        author = rng.choices(users, weights=popularity)[0]
+        created = now - timedelta(hours=rng.uniform(0, 20))
+        capsules.append({
+            "id": new_id(), "authorId": author["id"], "mediaType": "image",
+            "mediaUrl": f"https://picsum.photos/seed/{rng.getrandbits(32)}/720/1280",
+            "caption": " ".join(rng.choices(WORDS, k=4)), "duration": 15, "views": [], "reactions": {},
+            "createdAt": iso(created), "expiresAt": iso(created + timedelta(hours=24)),
+        })
+
+    products = [{**p, "id": new_id(), "createdAt": iso(now)} for p in MOCK_PRODUCTS]
+    media_sizes = [rng.choice((32, 128, 512)) * 1024 for _ in range(args.media)]
+    return {
+        "users": users, "posts": posts, "dm_threads": threads, "messages": messages,
+        "notifications": notifications, "vibe_capsules": capsules, "products": products,
+        "media_sizes": media_sizes,
+    }
+
+
+async def insert_chunked(collection, docs, size=5000):
+    for start in range(0, len(docs), size):
+        await collection.insert_many(docs[start:start + size], ordered=False)
+
+
+async def seed(args):
+    from db_indexes import apply_indexes
+    from media_store import MediaStore
+    from search_service import SearchService
+    from engagement_service import EngagementService
+    from timeline_service import TimelineService
+
+    if "bench" not in DB_NAME:
+        raise SystemExit(f"❌ Refusing to reset {DB_NAME!r}: benchmark database names must contain 'bench'")
+
+    client, db = get_db()
+    try:
+        print(f"🌱 Seeding {DB_NAME} (users={args.users}, posts={args.posts}, skew={args.skew}, seed={args.seed})")
+        started = time.perf_counter()
+        data = build_dataset(args)
+        # One bcrypt hash shared by every user (hashing each would dominate seeding)
+        from passlib.context import CryptContext
+        password = CryptContext(schemes=["bcrypt"]).hash(BENCH_PASSWORD)
+        for user in data["users"]:
+            user["password"] = password
+        await client.drop_database(DB_NAME)
+        await apply_indexes(db)
+
+        for name in ("users", "posts", "dm_threads", "messages", "notifications", "vibe_capsules", "products"):
+            await insert_chunked(db[name], data[name])
+            print(f"   {name}: {len(data[name])}")
+
+        rng = random.Random(args.seed)
+        store = MediaStore(db)
+        media_ids = []
+        for size in data["media_sizes"]:
+            blob = await store.save_bytes(rng.randbytes(size), "image/jpeg")
+            media_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            await db.media_files.insert_one({
+                "id": media_id, "filename": f"{media_id}.jpg", "content_type": "image/jpeg",
+                "file_extension": "jpg", "file_size": blob["size"], "storage_type": "gridfs",
+                "blob_id": blob["blobId"], "sha256": blob["sha256"],
+                "uploaded_at": datetime.now(timezone.utc).isoformat(),
+            })
+            media_ids.append(media_id)
+        print(f"   media_files: {len(media_ids)}")
+
+        # Derived state the server normally maintains on write
+        search = SearchService(db)
+        for kind in ("users", "posts", "products"):
+            await search.reindex(kind)
+        await EngagementService(db).rescore_all()
+        timelines = TimelineService(db)
+        sem = asyncio.Semaphore(16)
+
+        async def rebuild(user):
+            async with sem:
+                await timelines.rebuild(user["id"], user["following"])
+
+        await asyncio.gather(*(rebuild(u) for u in data["users"]))
+
+        meta = {
+            "seed": args.seed, "skew": args.skew,
+            "counts": {k: len(v) for k, v in data.items() if k != "media_sizes"},
+            "userIds": [u["id"] for u in data["users"]],
+            "loginEmails": [u["email"] for u in data["users"][:500]],
+            "mediaIds": media_ids,
+            "seededAt": datetime.now(timezone.utc).isoformat(),
+            "seedSeconds": round(time.perf_counter() - started, 2),
+        }
+        meta["counts"]["media_files"] = len(media_ids)
+        await db.bench_meta.replace_one({"_id": "seed"}, meta, upsert=True)
+        print(f"✅ Seeded in {meta['seedSeconds']}s")
+    finally:
+        client.close()
+
+
+# ===== LOAD =====
+
+def scenario_request(name, rng, meta, popularity):
+    """(method, path, request kwargs) for one request of a scenario"""
+    if name == "login":
+        # A distinct client address per login, as from many devices (the auth limit is per IP;
+        # honoured only when the server trusts the benchmark host as a proxy)
+        ip = f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+        return "POST", "/api/auth/login", {
+            "json": {"email": rng.choice(meta["loginEmails"]), "password": BENCH_PASSWORD},
+            "headers": {"X-Forwarded-For": ip},
+        }
+    path, params = scenario_get(name, rng, meta, popularity)
+    return "GET", path, {"params": params}
+
+
+def scenario_get(name, rng, meta, popularity):
+    user = rng.choices(meta["userIds"], weights=popularity)[0]
+    if name == "feed":
+        return "/api/posts", {"limit": 20}
+    if name == "timeline":
+        return "/api/posts", {"userId": user, "limit": 20}
+    if name == "dm_threads":
+        return "/api/dm/threads", {"userId": user, "limit": 20}
+    if name == "notifications":
+        return "/api/notifications", {"userId": user, "limit": 30}
+    if name == "search":
+        return "/api/search", {"q": rng.choice(QUERIES), "currentUserId": user}
+    if name == "media":
+        return f"/api/media/{rng.choice(meta['mediaIds'])}", {}
+    if name == "capsules":
+        return "/api/capsules", {"userId": user}
+    if name == "profile":
+        viewer = rng.choices(meta["userIds"], weights=popularity)[0]
+        return f"/api/users/{user}/profile", {"currentUserId": viewer}
+    if name == "wallet_analytics":
+        return f"/api/analytics/wallet/{user}", {}
+    raise ValueError(name)
+
+
+async def run_load(args):
+    import httpx
+
+    client, db = get_db()
+    try:
+        meta = await bench_meta(db)
+    finally:
+        client.close()
+
+    scenarios = args.scenarios.split(",") if args.scenarios else list(SCENARIO_WEIGHTS)
+    if "login" in scenarios and not meta.get("loginEmails"):
+        print("⚠️ Dataset predates login users - re-seed to include the login scenario")
+        scenarios.remove("login")
+    weights = [SCENARIO_WEIGHTS[s] for s in scenarios]
+    popularity = zipf_weights(len(meta["userIds"]), meta["skew"])
+    samples = {s: [] for s in scenarios}
+    statuses = {s: {} for s in scenarios}
+    errors = {s: 0 for s in scenarios}
+    body_bytes = {s: 0 for s in scenarios}
+    measuring = False
+
+    async def worker(http, n):
+        rng = random.Random(args.seed * 1000 + n)
+        while not stop.is_set():
+            name = rng.choices(scenarios, weights=weights)[0]
+            method, path, kwargs = scenario_request(name, rng, meta, popularity)
+            t0 = time.perf_counter()
+            try:
+                response = await http.request(method, path, **kwargs)
+                elapsed = time.perf_counter() - t0
+            except httpx.HTTPError:
+                if measuring:
+                    errors[name] += 1
+                continue
+            if measuring:
+                samples[name].append(elapsed)
+                statuses[name][response.status_code] = statuses[name].get(response.status_code, 0) + 1
+                body_bytes[name] += len(response.content)
+                if response.status_code >= 400:
+                    errors[name] += 1
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as http:
+        stop = asyncio.Event()
+        print(f"🚀 {args.concurrency} clients against {args.base_url} "
+              f"({args.warmup}s warmup + {args.duration}s measured)")
+        workers = [asyncio.create_task(worker(http, n)) for n in range(args.concurrency)]
+        await asyncio.sleep(args.warmup)
+        measuring = True
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        measuring = False
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*workers)
+
+        try:
+            server_stats = (await http.get("/api/performance/stats")).json()
+        except Exception:
+            server_stats = None
+
+    endpoints = {}
+    for name in scenarios:
+        count = len(samples[name])
+        endpoints[name] = {
+            "requests": count,
+            "rps": round(count / elapsed, 2),
+            "errors": errors[name],
+            "statuses": {str(k): v for k, v in sorted(statuses[name].items())},
+            "bytes_per_response": round(body_bytes[name] / count) if count else 0,
+            **percentiles(samples[name]),
+        }
+    everything = [s for name in scenarios for s in samples[name]]
+    results = {
+        "kind": "load",
+        "meta": run_meta(args, meta),
+        "total": {"requests": len(everything), "rps": round(len(everything) / elapsed, 2),
+                  "errors": sum(errors.values()), **percentiles(everything)},
+        "endpoints": endpoints,
+        "server": {k: server_stats.get(k) for k in ("routes", "slow_queries", "cpu_pools")} if server_stats else None,
+    }
+    print_table(results)
+    save_results("load", results, args.out)
+
+
+def run_meta(args, meta):
+    return {
+        "commit": git_commit(),
+        "startedAt": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "db": DB_NAME,
+        "dataset": {k: meta[k] for k in ("seed", "skew", "counts", "seededAt")},
+        "args": {k: v for k, v in vars(args).items() if k != "func"},
+    }
+
+
+# ===== MICRO =====
+
+async def run_micro(args):
+    from performance import paginate_keyset, batch_get_users, gather_queries
+    from media_store import MediaStore
+    from search_service import SearchService, SEARCH_TYPES
+    from timeline_service import TimelineService
+    from notification_service import HIDDEN_FIELDS
+
+    client, db = get_db()
+    try:
+        meta = await bench_meta(db)
+        rng = random.Random(args.seed)
+        popularity = zipf_weights(len(meta["userIds"]), meta["skew"])
+        search, timelines, store = SearchService(db), TimelineService(db), MediaStore(db)
+        blob_ids = {d["id"]: d["blob_id"] for d in await db.media_files.find(
+            {"id": {"$in": meta["mediaIds"]}}, {"_id": 0, "id": 1, "blob_id": 1}
+        ).to_list(None)}
+
+        def user():
+            return rng.choices(meta["userIds"], weights=popularity)[0]
+
+        async def dm_threads():
+            u = user()
+            await paginate_keyset(db.dm_threads, {"$or": [{"user1Id": u}, {"user2Id": u}]},
+                                  limit=20, sort_field="lastMessageAt")
+
+        async def capsules():
+            now = datetime.now(timezone.utc).isoformat()
+            await db.vibe_capsules.find({"expiresAt": {"$gt": now}}, {"_id": 0}).sort("createdAt", -1).to_list(100)
+
+        def profile_queries():
+            """The independent lookups behind GET /users/{id}/profile (as factories)"""
+            u, viewer = user(), user()
+            return {
+                "user": lambda: db.users.find_one({"id": u}, {"_id": 0}),
+                "posts": lambda: db.posts.find({"authorId": u}, {"_id": 0}).sort("createdAt", -1).to_list(100),
+                "count1": lambda: db.friendships.count_documents({"userId1": u}),
+                "count2": lambda: db.friendships.count_documents({"userId2": u}),
+                "is_friend": lambda: db.users.find_one({"id": viewer}, {"_id": 0, "friends": 1}),
+                "sent": lambda: db.friend_requests.find_one({"fromUserId": viewer, "toUserId": u, "status": "pending"}),
+                "received": lambda: db.friend_requests.find_one({"fromUserId": u, "toUserId": viewer, "status": "pending"}),
+            }
+
+        def hydrate_queries():
+            """The per-type hydrations behind GET /search (as factories)"""
+            ranked = search_results[rng.randrange(len(search_results))]
+            return {kind: (lambda kind=kind: search.hydrate(kind, ranked["ids"][kind])) for kind in SEARCH_TYPES}
+
+        async def sequential(queries):
+            for query in queries.values():
+                await query()
+
+        async def gathered(queries):
+            await gather_queries({name: query() for name, query in queries.items()})
+
+        search_results = [await search.search(q, list(SEARCH_TYPES)) for q in QUERIES]
+
+        cases = {
+            "feed_page": lambda: paginate_keyset(db.posts, {}, projection={"_id": 0}, limit=20),
+            "timeline_page": lambda: timelines.get_timeline(user(), limit=20),
+            "dm_threads_page": dm_threads,
+            "notifications_page": lambda: paginate_keyset(
+                db.notifications, {"userId": user()}, projection=HIDDEN_FIELDS, limit=30
+            ),
+            "search": lambda: search.search(rng.choice(QUERIES), list(SEARCH_TYPES)),
+            "media_read": lambda: store.read_all(blob_ids[rng.choice(meta["mediaIds"])]),
+            "capsules": capsules,
+            "batch_users_50": lambda: batch_get_users(db, rng.sample(meta["userIds"], 50)),
+            "profile_sequential": lambda: sequential(profile_queries()),
+            "profile_gathered": lambda: gathered(profile_queries()),
+            "search_hydrate_sequential": lambda: sequential(hydrate_queries()),
+            "search_hydrate_gathered": lambda: gathered(hydrate_queries()),
+        }
+
+        operations = {}
+        for name, case in cases.items():
+            for _ in range(min(10, args.rounds)):
+                await case()
+            timings = []
+            for _ in range(args.rounds):
+                t0 = time.perf_counter()
+                await case()
+                timings.append(time.perf_counter() - t0)
+            operations[name] = {"rounds": args.rounds,
+                                "ops_per_s": round(args.rounds / sum(timings), 2), **percentiles(timings)}
+    finally:
+        client.close()
+
+    results = {"kind": "micro", "meta": run_meta(args, meta), "endpoints": operations}
+    print_table(results)
+    save_results("micro", results, args.out)
+
+
+# ===== WALLET =====
+
+async def run_wallet(args):
+    """
+    Fire concurrent payments and top-ups at a few hot wallets through WalletService,
+    re-sending some of them with the same idempotency key, then audit every wallet
+    against its transaction history.
+    """
+    from db_indexes import apply_indexes
+    from wallet_service import WalletService, InsufficientFundsError
+
+    if "bench" not in DB_NAME:
+        raise SystemExit(f"❌ Refusing to write to {DB_NAME!r}: benchmark database names must contain 'bench'")
+
+    rng = random.Random(args.seed)
+    run_id = uuid.uuid4().hex[:8]
+    user_ids = [f"wallet-bench-{run_id}-{i}" for i in range(args.users)]
+    # Integer amounts keep the audit exact
+    ops = []
+    for n in range(args.payments):
+        kind = "credit" if rng.random() < args.topup_share else "debit"
+        ops.append((kind, rng.choice(user_ids), rng.randint(1, args.max_amount), f"{run_id}-{n}"))
+    retried = [op for op in ops if rng.random() < args.retry_rate]
+    submissions = ops + retried
+    rng.shuffle(submissions)
+
+    client, db = get_db()
+    try:
+        await apply_indexes(db)
+        await db.users.insert_many([
+            {"id": u, "name": f"Wallet Bench {i}", "walletBalance": args.balance} for i, u in enumerate(user_ids)
+        ])
+        service = WalletService(db)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        samples = {"debit": [], "credit": []}
+        outcomes = {"completed": 0, "replayed": 0, "insufficient": 0, "errors": 0}
+
+        async def submit(kind, user_id, amount, key):
+            method = service.debit if kind == "debit" else service.credit
+            async with semaphore:
+                t0 = time.perf_counter()
+                try:
+                    txn = await method(user_id, amount, "payment" if kind == "debit" else "topup",
+                                       idempotency_key=key)
+                    outcomes["replayed" if txn["replayed"] else "completed"] += 1
+                except InsufficientFundsError:
+                    outcomes["insufficient"] += 1
+                except Exception as e:
+                    outcomes["errors"] += 1
+                    print(f"⚠️ {kind} failed: {e}")
+                samples[kind].append(time.perf_counter() - t0)
+
+        print(f"💳 {len(submissions)} submissions ({len(retried)} retries) across {args.users} wallets, "
+              f"concurrency {args.concurrency}")
+        started = time.perf_counter()
+        await asyncio.gather(*(submit(*op) for op in submissions))
+        elapsed = time.perf_counter() - started
+
+        # ===== AUDIT =====
+        balances = {u["id"]: u.get("walletBalance", 0) for u in await db.users.find(
+            {"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "walletBalance": 1}
+        ).to_list(None)}
+        txns = await db.wallet_transactions.find(
+            {"userId": {"$in": user_ids}}, {"_id": 0, "userId": 1, "type": 1, "amount": 1, "status": 1, "idempotencyKey": 1}
+        ).to_list(None)
+        expected = {u: args.balance for u in user_ids}
+        keys = {}
+        for txn in txns:
+            if txn["status"] == "completed":
+                expected[txn["userId"]] += txn["amount"] if txn["type"] == "topup" else -txn["amount"]
+            keys[txn.get("idempotencyKey")] = keys.get(txn.get("idempotencyKey"), 0) + 1
+        audit = {
+            "wallets": len(user_ids),
+            "mismatched_balances": sum(1 for u in user_ids if balances.get(u) != expected[u]),
+            "negative_balances": sum(1 for b in balances.values() if b < 0),
+            "pending_transactions": sum(1 for t in txns if t["status"] != "completed"),
+            "double_charged_keys": sum(1 for n in keys.values() if n > 1),
+            "transactions": len(txns),
+            **outcomes,
+        }
+
+        if not args.keep:
+            await db.users.delete_many({"id": {"$in": user_ids}})
+            await db.wallet_transactions.delete_many({"userId": {"$in": user_ids}})
+    finally:
+        client.close()
+
+    results = {
+        "kind": "wallet",
+        "meta": {
+            "commit": git_commit(),
+            "startedAt": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "db": DB_NAME,
+            "args": {k: v for k, v in vars(args).items() if k != "func"},
+        },
+        "total": {"requests": len(submissions), "rps": round(len(submissions) / elapsed, 2),
+                  "errors": outcomes["errors"], **percentiles(samples["debit"] + samples["credit"])},
+        "endpoints": {kind: {"requests": len(s), "ops_per_s": round(len(s) / elapsed, 2), **percentiles(s)}
+                      for kind, s in samples.items()},
+        "audit": audit,
+    }
+    print_table(results)
+    print("🔎 Audit: " + ", ".join(f"{k}={v}" for k, v in audit.items()))
+    save_results("wallet", results, args.out)
+    if audit["mismatched_balances"] or audit["negative_balances"] or audit["double_charged_keys"]:
+        raise SystemExit("❌ Wallet audit failed")
+
+
+# ===== REPORTING =====
+
+def print_table(results):
+    rate = "rps" if results["kind"] == "load" else "ops_per_s"
+    print(f"{'endpoint':<20}{rate:>12}{'p50 (ms)':>12}{'p95 (ms)':>12}{'p99 (ms)':>12}{'max (ms)':>12}")
+    for name, r in results["endpoints"].items():
+        print(f"{name:<20}{r[rate]:>12}{r['p50_ms']:>12}{r['p95_ms']:>12}{r['p99_ms']:>12}{r['max_ms']:>12}")
+    if "total" in results:
+        t = results["total"]
+        print(f"{'TOTAL':<20}{t['rps']:>12}{t['p50_ms']:>12}{t['p95_ms']:>12}{t['p99_ms']:>12}{t['max_ms']:>12}"
+              f"   errors={t['errors']}")
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        base = json.load(f)
+    with open(args.candidate) as f:
+        cand = json.load(f)
+    rate = "rps" if cand["kind"] == "load" else "ops_per_s"
+
+    def delta(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"baseline  {base['meta'].get('commit')}  {base['meta']['startedAt']}")
+    print(f"candidate {cand['meta'].get('commit')}  {cand['meta']['startedAt']}")
+    print(f"{'endpoint':<20}{rate:>12}{'Δ':>9}{'p50 (ms)':>12}{'Δ':>9}{'p99 (ms)':>12}{'Δ':>9}")
+    for name, new in cand["endpoints"].items():
+        old = base["endpoints"].get(name)
+        if not old:
+            continue
+        print(f"{name:<20}{new[rate]:>12}{delta(old[rate], new[rate]):>9}"
+              f"{new['p50_ms']:>12}{delta(old['p50_ms'], new['p50_ms']):>9}"
+              f"{new['p99_ms']:>12}{delta(old['p99_ms'], new['p99_ms']):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopync load and microbenchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("seed", help="(re)build the synthetic benchmark database")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--follows", type=int, default=50, help="accounts followed per user")
+    p.add_argument("--posts", type=int, default=20000)
+    p.add_argument("--days", type=int, default=14, help="age spread of posts and threads")
+    p.add_argument("--max-likes", type=int, default=1000, help="likes on the most liked post")
+    p.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for popularity and likes")
+    p.add_argument("--threads", type=int, default=5000)
+    p.add_argument("--messages", type=int, default=20, help="mean messages per DM thread")
+    p.add_argument("--notify-per-post", type=int, default=5)
+    p.add_argument("--capsules", type=int, default=300)
+    p.add_argument("--media", type=int, default=100)
+    p.add_argument("--seed", type=int, default=42)
+    p.set_defaults(func=seed)
+
+    p = sub.add_parser("run", help="drive a running server with concurrent clients")
+    p.add_argument("--base-url", default=os.environ.get("BENCH_BASE_URL", "http://localhost:8001"))
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--duration", type=float, default=30)
+    p.add_argument("--warmup", type=float, default=5)
+    p.add_argument("--timeout", type=float, default=30)
+    p.add_argument("--scenarios", help=f"comma-separated subset of {','.join(SCENARIO_WEIGHTS)}")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--out")
+    p.set_defaults(func=run_load)
+
+    p = sub.add_parser("micro", help="time the underlying reads in-process")
+    p.add_argument("--rounds", type=int, default=200)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--out")
+    p.set_defaults(func=run_micro)
+
+    p = sub.add_parser("wallet", help="concurrent payments against hot wallets, then audit balances")
+    p.add_argument("--payments", type=int, default=20000)
+    p.add_argument("--users", type=int, default=50, help="wallets the payments are spread over")
+    p.add_argument("--concurrency", type=int, default=256)
+    p.add_argument("--balance", type=int, default=1000, help="starting balance per wallet")
+    p.add_argument("--max-amount", type=int, default=50)
+    p.add_argument("--topup-share", type=float, default=0.1)
+    p.add_argument("--retry-rate", type=float, default=0.05, help="share re-sent with the same idempotency key")
+    p.add_argument("--keep", action="store_true", help="leave the wallets and transactions in place")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--out")
+    p.set_defaults(func=run_wallet)
+
+    p = sub.add_parser("compare", help="diff two saved result files")
+    p.add_argument("baseline")
+    p.add_argument("candidate")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    if asyncio.iscoroutinefunction(args.func):
+        asyncio.run(args.func(args))
+    else:
+        args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Search Benchmark for Loopync
+Seeds a scratch database with synthetic users/posts, then compares the old
+unanchored $regex queries against the inverted-index SearchService.
+
+Usage: MONGO_URL=mongodb://localhost:27017 python search_benchmark.py [num_users] [num_posts]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import statistics
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from search_service import SearchService
+
+FIRST = ["aarav", "vivaan", "aditya", "ananya", "diya", "isha", "kabir", "meera", "rohan", "saanvi",
+         "arjun", "priya", "rahul", "sneha", "vikram", "zara", "nikhil", "pooja", "karan", "tara"]
+LAST = ["sharma", "verma", "iyer", "reddy", "patel", "singh", "nair", "gupta", "mehta", "rao"]
+WORDS = ["coding", "hackathon", "campus", "startup", "design", "music", "football", "coffee", "exam",
+         "placement", "internship", "python", "react", "travel", "food", "movie", "cricket", "gaming"]
+QUERIES = ["aarav", "priya sharma", "ana", "hackathon campus", "python", "coffee startup", "kab", "zara nair"]
+
+
+def timed(samples):
+    return {
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(sorted(samples)[int(len(samples) * 0.95) - 1] * 1000, 2),
+        "mean_ms": round(statistics.mean(samples) * 1000, 2),
+    }
+
+
+async def seed(db, num_users, num_posts):
+    users = []
+    for i in range(num_users):
+        first, last = random.choice(FIRST), random.choice(LAST)
+        users.append({"id": str(uuid.uuid4()), "name": f"{first.title()} {last.title()}",
+                      "handle": f"{first}{last}{i}", "bio": " ".join(random.sample(WORDS, 3))})
+    posts = [{"id": str(uuid.uuid4()), "authorId": random.choice(users)["id"],
+              "text": " ".join(random.choices(WORDS, k=12)) + f" #{random.choice(WORDS)}",
+              "createdAt": f"2025-01-01T00:00:{i % 60:02d}"}
+             for i in range(num_posts)]
+    await db.users.insert_many(users)
+    await db.posts.insert_many(posts)
+
+
+async def regex_search(db, q, limit=20):
+    pattern = {"$regex": q, "$options": "i"}
+    await db.users.find({"$or": [{"name": pattern}, {"handle": pattern}]}, {"_id": 0}).limit(limit).to_list(limit)
+    await db.posts.find({"text": pattern}, {"_id": 0}).limit(limit).to_list(limit)
+
+
+async def index_search(service, q, limit=20):
+    result = await service.search(q, ["users", "posts"], limit=limit)
+    await service.hydrate("users", result["ids"]["users"])
+    await service.hydrate("posts", result["ids"]["posts"])
+
+
+async def main():
+    num_users = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_posts = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    rounds = 5
+
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db_name = f"loopync_search_bench_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    service = SearchService(db)
+
+    try:
+        print(f"Seeding {num_users} users / {num_posts} posts into {db_name}...")
+        await seed(db, num_users, num_posts)
+        await db.users.create_index("id", unique=True)
+        await db.posts.create_index("id", unique=True)
+        await db.search_postings.create_index([("t", 1), ("k", 1)])
+        await db.search_postings.create_index([("k", 1), ("d", 1)])
+        await db.search_docs.create_index([("k", 1), ("d", 1)], unique=True)
+
+        start = time.perf_counter()
+        await service.reindex("users")
+        await service.reindex("posts")
+        print(f"Index build: {time.perf_counter() - start:.2f}s")
+
+        results = {}
+        for name, run in (("regex", lambda q: regex_search(db, q)), ("index", lambda q: index_search(service, q))):
+            samples = []
+            for _ in range(rounds):
+                for q in QUERIES:
+                    t0 = time.perf_counter()
+                    await run(q)
+                    samples.append(time.perf_counter() - t0)
+            results[name] = timed(samples)
+
+        print(f"{'path':<8}{'p50 (ms)':>12}{'p95 (ms)':>12}{'mean (ms)':>12}")
+        for name, r in results.items():
+            print(f"{name:<8}{r['p50_ms']:>12}{r['p95_ms']:>12}{r['mean_ms']:>12}")
+    finally:
+        await client.drop_database(db_name)
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,252 @@
+"""
+Loopync Notification Pipeline Tests
+Coalesces bursts through NotificationPipeline against an in-memory stand-in
+for the Motor collections it uses (including pipeline-style updates), then
+checks read state and the per-user unread counter.
+"""
+import os
+import sys
+import copy
+import asyncio
+import itertools
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+pytest.importorskip("pymongo")
+from notification_service import NotificationPipeline  # noqa: E402
+
+
+# ===== In-memory Motor stand-in =====
+
+def _path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _eval(expr, doc, variables=None):
+    """Evaluate the aggregation expressions used by the pipeline's updates"""
+    variables = variables or {}
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, rest = expr[2:].partition(".")
+        value = variables[name]
+        return _path(value, rest) if rest else value
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _path(doc, expr[1:])
+    if isinstance(expr, list):
+        return [_eval(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1 and next(iter(expr)).startswith("$"):
+        op, arg = next(iter(expr.items()))
+        if op == "$literal":
+            return arg
+        if op == "$filter":
+            items = _eval(arg["input"], doc, variables) or []
+            return [x for x in items if _eval(arg["cond"], doc, {**variables, "this": x})]
+        args = _eval(arg, doc, variables)
+        ops = {
+            "$ifNull": lambda a: a[0] if a[0] is not None else a[1],
+            "$setUnion": lambda a: list(dict.fromkeys(itertools.chain(*a))),
+            "$concatArrays": lambda a: list(itertools.chain(*a)),
+            "$slice": lambda a: a[0][:a[1]],
+            "$size": lambda a: len(a),
+            "$not": lambda a: not a[0],
+            "$in": lambda a: a[0] in a[1],
+            "$cond": lambda a: a[1] if a[0] else a[2],
+            "$gt": lambda a: a[0] > a[1],
+            "$eq": lambda a: a[0] == a[1],
+            "$concat": lambda a: "".join(a),
+            "$toString": lambda a: str(a),
+            "$subtract": lambda a: a[0] - a[1],
+            "$max": lambda a: max(a),
+        }
+        return ops[op](args)
+    return {k: _eval(v, doc, variables) for k, v in expr.items()}
+
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(doc, q) for q in cond):
+                return False
+            continue
+        value = _path(doc, key)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$lt" and (value is None or value >= arg):
+                    return False
+                if op == "$gte" and (value is None or value < arg):
+                    return False
+                if op == "$exists" and (value is not None) != arg:
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _apply(doc, update):
+    if isinstance(update, list):
+        for stage in update:
+            doc.update(_eval(stage["$set"], doc))
+        return
+    for key, value in update.get("$set", {}).items():
+        doc[key] = value
+    for key in update.get("$unset", {}):
+        doc.pop(key, None)
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+
+    def _project(self, doc, projection):
+        doc = copy.deepcopy(doc)
+        if projection and any(v == 1 for v in projection.values()):
+            return {k: v for k, v in doc.items() if projection.get(k) == 1}
+        for key, value in (projection or {}).items():
+            if value == 0:
+                doc.pop(key, None)
+        return doc
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(copy.deepcopy(d) for d in docs)
+
+    async def _update(self, query, update, upsert=False, many=False):
+        matched = [d for d in self.docs if _matches(d, query)]
+        for doc in matched if many else matched[:1]:
+            _apply(doc, update)
+        if matched or not upsert:
+            return Result(matched_count=len(matched), modified_count=len(matched), upserted_id=None)
+        doc = {k: v for k, v in query.items()
+               if not k.startswith("$") and not isinstance(v, dict)}
+        _apply(doc, update)
+        self.docs.append(doc)
+        return Result(matched_count=0, modified_count=0, upserted_id=len(self.docs))
+
+    async def update_one(self, query, update, upsert=False):
+        return await self._update(query, update, upsert)
+
+    async def update_many(self, query, update):
+        return await self._update(query, update, many=True)
+
+    async def bulk_write(self, ops, ordered=True):
+        upserted = {}
+        for index, op in enumerate(ops):
+            result = await self._update(op._filter, op._doc, op._upsert)
+            if result.upserted_id is not None:
+                upserted[index] = result.upserted_id
+        return Result(upserted_ids=upserted)
+
+    async def find_one(self, query, projection=None):
+        for doc in self.docs:
+            if _matches(doc, query):
+                return self._project(doc, projection)
+        return None
+
+    async def find_one_and_update(self, query, update, projection=None):
+        for doc in self.docs:
+            if _matches(doc, query):
+                _apply(doc, update)
+                return self._project(doc, projection)
+        return None
+
+    async def count_documents(self, query):
+        return sum(1 for d in self.docs if _matches(d, query))
+
+    def find(self, query, projection=None):
+        docs = [self._project(d, projection) for d in self.docs if _matches(d, query)]
+
+        async def iterate():
+            for doc in docs:
+                yield doc
+        return iterate()
+
+
+class FakeDB:
+    def __init__(self):
+        self.notifications = FakeCollection()
+        self.notification_counters = FakeCollection()
+        self.users = FakeCollection()
+
+
+# ===== Scenarios =====
+
+def like(user_id, actor_id, post_id="post-1"):
+    return {"userId": user_id, "type": "post_like", "fromUserId": actor_id,
+            "contentType": "post", "contentId": post_id, "link": f"/post/{post_id}"}
+
+
+def make_pipeline():
+    db = FakeDB()
+    db.users.docs = [{"id": uid, "name": uid.title(), "handle": uid, "avatar": ""}
+                     for uid in ("ana", "ben", "cal", "dev")]
+    return db, NotificationPipeline(db)
+
+
+async def flush(pipeline, *notifications):
+    for notification in notifications:
+        pipeline.enqueue(notification)
+    await pipeline.stop()
+
+
+def test_burst_coalesces_into_one_unread_group():
+    db, pipeline = make_pipeline()
+
+    async def scenario():
+        await flush(pipeline, like("u1", "ana"), like("u1", "ben"), like("u1", "cal"))
+        assert len(db.notifications.docs) == 1
+        group = db.notifications.docs[0]
+        assert group["read"] is False
+        assert group["actorCount"] == 3
+        assert group["message"].endswith("and 2 others liked your post")
+        assert await pipeline.unread_count("u1") == 1
+
+    asyncio.run(scenario())
+
+
+def test_mark_read_clears_group_and_counter():
+    db, pipeline = make_pipeline()
+
+    async def scenario():
+        await flush(pipeline, like("u1", "ana"), like("u1", "ben"))
+        group = db.notifications.docs[0]
+
+        assert await pipeline.mark_read(group["id"])
+        assert group["read"] is True
+        assert "openGroup" not in group
+        assert await pipeline.unread_count("u1") == 0
+        assert await pipeline.recount("u1") == 0
+
+        # A new actor after reading starts a fresh unread group
+        await flush(pipeline, like("u1", "cal"))
+        assert len(db.notifications.docs) == 2
+        assert await pipeline.unread_count("u1") == 1
+        assert await pipeline.recount("u1") == 1
+
+    asyncio.run(scenario())
+
+
+def test_mark_all_read_covers_groups():
+    db, pipeline = make_pipeline()
+
+    async def scenario():
+        await flush(pipeline, like("u1", "ana"), like("u1", "ben", post_id="post-2"))
+        assert await pipeline.unread_count("u1") == 2
+        assert await pipeline.mark_all_read("u1") == 2
+        assert await pipeline.unread_count("u1") == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,222 @@
+"""
+Loopync Presence Store Tests
+Exercises RedisPresenceStore (connect, disconnect, multiple devices, expiry
+and heartbeat refresh) against an in-memory stand-in for redis.asyncio.
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from presence_service import (  # noqa: E402
+    RedisPresenceStore, LocalPresenceStore, ONLINE_USERS_KEY, USER_SIDS_KEY, SID_USER_KEY
+)
+
+
+class FakeRedis:
+    """The subset of redis.asyncio used by the presence store, with a manual clock"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.strings = {}
+        self.sets = {}
+        self.expires = {}
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+    def _alive(self, key: str) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= self.now:
+            self.strings.pop(key, None)
+            del self.expires[key]
+        return key in self.strings
+
+    async def set(self, key, value, ex=None):
+        self.strings[key] = value
+        if ex is not None:
+            self.expires[key] = self.now + ex
+        else:
+            self.expires.pop(key, None)
+
+    async def get(self, key):
+        return self.strings[key] if self._alive(key) else None
+
+    async def getdel(self, key):
+        value = await self.get(key)
+        self.strings.pop(key, None)
+        self.expires.pop(key, None)
+        return value
+
+    async def mget(self, keys):
+        return [await self.get(k) for k in keys]
+
+    async def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self.expires[key] = self.now + seconds
+        return True
+
+    async def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    async def srem(self, key, *members):
+        members_set = self.sets.get(key, set())
+        members_set.difference_update(members)
+        if not members_set:
+            self.sets.pop(key, None)
+
+    async def smembers(self, key):
+        return set(self.sets.get(key, ()))
+
+    async def scard(self, key):
+        return len(self.sets.get(key, ()))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return queue
+
+    async def execute(self):
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+TTL = 60
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_store():
+    redis = FakeRedis()
+    return redis, RedisPresenceStore(redis, sid_ttl=TTL)
+
+
+def test_connect_registers_sid_and_user():
+    redis, store = make_store()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        assert await store.get_user("sid-a") == "u1"
+        assert await store.get_sids("u1") == {"sid-a"}
+        assert await store.is_online("u1")
+        assert await store.online_users() == ["u1"]
+
+    run(scenario())
+
+
+def test_disconnect_removes_sid_and_user():
+    redis, store = make_store()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        assert await store.remove("sid-a") == "u1"
+        assert await store.get_user("sid-a") is None
+        assert not await store.is_online("u1")
+        assert await store.online_users() == []
+        # Disconnecting an unknown sid is a no-op
+        assert await store.remove("sid-a") is None
+
+    run(scenario())
+
+
+def test_multiple_devices_stay_online_until_last_disconnects():
+    redis, store = make_store()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        await store.add("u1", "sid-b")
+        assert await store.get_sids("u1") == {"sid-a", "sid-b"}
+
+        await store.remove("sid-a")
+        assert await store.get_sids("u1") == {"sid-b"}
+        assert await store.online_users() == ["u1"]
+
+        await store.remove("sid-b")
+        assert not await store.is_online("u1")
+        assert await store.online_users() == []
+
+    run(scenario())
+
+
+def test_expired_sid_is_pruned():
+    redis, store = make_store()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        await store.add("u1", "sid-b")
+        redis.advance(TTL / 2)
+        await store.touch("sid-b")
+        redis.advance(TTL / 2 + 1)
+
+        # sid-a's node died without a disconnect; sid-b kept refreshing
+        assert await store.get_sids("u1") == {"sid-b"}
+        assert redis.sets[USER_SIDS_KEY.format("u1")] == {"sid-b"}
+
+        redis.advance(TTL)
+        assert not await store.is_online("u1")
+        assert ONLINE_USERS_KEY not in redis.sets
+
+    run(scenario())
+
+
+def test_heartbeat_keeps_idle_sid_alive():
+    redis, store = make_store()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        for _ in range(5):
+            redis.advance(TTL - 1)
+            await store.touch("sid-a", "u1")
+        assert await store.get_sids("u1") == {"sid-a"}
+
+    run(scenario())
+
+
+def test_heartbeat_reregisters_expired_sid():
+    redis, store = make_store()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        redis.advance(TTL + 1)
+        assert not await store.is_online("u1")
+
+        # The socket is still connected - its next heartbeat brings it back
+        await store.touch("sid-a", "u1")
+        assert await store.get_user("sid-a") == "u1"
+        assert await store.is_online("u1")
+        assert await store.online_users() == ["u1"]
+        # Without a user id a refresh can't resurrect the sid
+        redis.advance(TTL + 1)
+        await store.touch("sid-a")
+        assert SID_USER_KEY.format("sid-a") not in redis.strings
+
+    run(scenario())
+
+
+def test_local_store_matches_redis_store():
+    store = LocalPresenceStore()
+
+    async def scenario():
+        await store.add("u1", "sid-a")
+        await store.add("u1", "sid-b")
+        assert await store.get_sids("u1") == {"sid-a", "sid-b"}
+        assert await store.remove("sid-a") == "u1"
+        assert await store.is_online("u1")
+        assert await store.remove("sid-b") == "u1"
+        assert not await store.is_online("u1")
+        await store.touch("sid-c", "u2")
+        assert await store.get_user("sid-c") == "u2"
+
+    run(scenario())
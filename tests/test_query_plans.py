@@ -0,0 +1,154 @@
+"""
+Loopync Query Plan Tests
+Builds the index manifest in a scratch database, then explains the query
+shape behind each hot endpoint and fails if any of them needs a COLLSCAN.
+Requires a reachable MongoDB (MONGO_URL, default mongodb://localhost:27017).
+"""
+import os
+import sys
+import uuid
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+motor_asyncio = pytest.importorskip("motor.motor_asyncio")
+from db_indexes import INDEX_MANIFEST, apply_indexes, diff_indexes  # noqa: E402
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+
+U, P, T = "user-1", "post-1", "thread-1"
+SINCE = "2025-01-01T00:00:00+00:00"
+
+# (endpoint, collection, filter, sort)
+QUERY_SHAPES = [
+    # Users & social graph
+    ("GET /users/{id}", "users", {"id": U}, None),
+    ("POST /auth/login", "users", {"email": "a@b.c"}, None),
+    ("GET /users/handle/{handle}", "users", {"handle": "demo"}, None),
+    ("GET /users/{userId}/followers", "users", {"id": {"$in": [U, "user-2"]}}, None),
+    ("GET /friends/list", "friendships", {"$or": [{"userId1": U}, {"userId2": U}]}, [("createdAt", -1)]),
+    ("friend count", "friendships", {"userId1": U}, None),
+    ("unfriend", "friendships", {"userId1": U, "userId2": "user-2"}, None),
+    ("GET /users/{id}/follow-requests", "follow_requests", {"toUserId": U, "status": "pending"}, None),
+    ("POST /users/{id}/follow-request", "follow_requests", {"fromUserId": U, "toUserId": "user-2", "status": "pending"}, None),
+    ("block check", "user_blocks", {"blockerId": U, "blockedId": "user-2"}, None),
+    ("GET /users/{userId}/blocked", "user_blocks", {"blockerId": U}, None),
+    ("mute check", "user_mutes", {"muterId": U, "mutedId": "user-2"}, None),
+    # Content
+    ("GET /posts", "posts", {}, [("createdAt", -1), ("id", -1)]),
+    ("GET /posts/{id}", "posts", {"id": P}, None),
+    ("GET /users/{userId}/posts", "posts", {"authorId": U}, [("createdAt", -1)]),
+    ("GET /hashtags/{tag}/posts", "posts", {"hashtags": {"$in": ["loop"]}}, [("createdAt", -1)]),
+    ("GET /trending/posts", "posts", {"createdAt": {"$gte": SINCE}}, [("engagementScore", -1), ("createdAt", -1)]),
+    ("GET /feed/for-you", "posts", {"authorId": {"$ne": U}}, [("engagementScore", -1), ("id", -1)]),
+    ("GET /analytics/creator/{userId}", "posts", {"authorId": U}, [("stats.likes", -1)]),
+    ("GET /reels", "reels", {}, [("createdAt", -1), ("id", -1)]),
+    ("GET /trending/reels", "reels", {"createdAt": {"$gte": SINCE}}, [("engagementScore", -1), ("createdAt", -1)]),
+    ("GET /posts/{id}/comments", "comments", {"postId": P}, [("createdAt", -1)]),
+    ("GET /reels/{id}/comments", "comments", {"reelId": "reel-1"}, [("createdAt", -1)]),
+    ("home timeline", "timelines", {"userId": U}, None),
+    ("GET /capsules", "vibe_capsules", {"authorId": U}, [("expiresAt", -1)]),
+    # Media
+    ("GET /media/{file_id}", "media_files", {"id": "file-1"}, None),
+    ("upload dedupe", "media.files", {"metadata.sha256": "ab" * 32}, None),
+    # Search / trending / analytics
+    ("GET /search", "search_postings", {"t": "w:loop", "k": {"$in": ["posts", "users"]}}, [("tf", -1), ("d", 1)]),
+    ("GET /search df", "search_terms", {"k": {"$in": ["posts"]}, "t": {"$in": ["w:loop"]}}, None),
+    ("GET /trending/hashtags", "hashtag_trends", {}, [("logScore", -1)]),
+    ("GET /analytics/{userId}", "analytics_daily", {"scope": "user", "key": U, "day": {"$gte": "2025-01-01"}}, [("day", 1)]),
+    ("GET /analytics/{userId} (totals)", "analytics_totals", {"scope": "user", "key": U}, None),
+    # Messaging & notifications
+    ("GET /dm/threads", "dm_threads", {"$or": [{"user1Id": U}, {"user2Id": U}]}, [("lastMessageAt", -1), ("id", -1)]),
+    ("GET /dm/threads/{threadId}/messages", "dm_messages", {"threadId": T}, None),
+    ("read receipts", "message_reads", {"threadId": T, "userId": U}, None),
+    ("GET /notifications", "notifications", {"userId": U}, [("createdAt", -1), ("id", -1)]),
+    ("GET /notifications/{userId}?unreadOnly", "notifications", {"userId": U, "read": False}, None),
+    ("GET /notifications/{userId}/unread-count", "notification_counters", {"userId": U}, None),
+    ("notification coalesce", "notifications", {"userId": U, "openGroup": "post_like:post:" + P}, None),
+    # Students
+    ("GET /students/discover", "users", {"id": {"$in": [U, "user-2"]}}, None),
+    ("GET /students/discover reputation", "reputation", {"userId": {"$in": [U, "user-2"]}}, None),
+    ("GET /students/discover projects", "projects", {"userId": {"$in": [U, "user-2"]}}, None),
+    ("GET /students/discover certifications", "certifications", {"userId": {"$in": [U, "user-2"]}}, None),
+    # Places, wallet, commerce
+    ("GET /checkins/venue/{venueId}", "checkins", {"venueId": "venue-1", "status": "active"}, None),
+    ("GET /checkins/user/{userId}/active", "checkins", {"userId": U, "status": "active"}, None),
+    ("GET /tickets/{userId}", "event_tickets", {"userId": U}, [("purchasedAt", -1)]),
+    ("ticket check", "event_tickets", {"eventId": "event-1", "userId": U, "status": "active"}, None),
+    ("GET /wallet", "wallet_transactions", {"userId": U}, [("createdAt", -1)]),
+    ("wallet idempotency replay", "wallet_transactions", {"userId": U, "idempotencyKey": "key-1"}, None),
+    ("wallet pending recovery", "wallet_transactions", {"status": "pending", "createdAt": {"$lt": SINCE}}, None),
+    ("ticket booking replay", "event_tickets", {"transactionId": "txn-1"}, None),
+    ("GET /credits/{userId}", "credit_balances", {"userId": U}, None),
+    ("GET /credits/{userId}/history", "loop_credits", {"userId": U}, [("createdAt", -1), ("id", -1)]),
+    ("credits reconcile", "loop_credits", {"createdAt": {"$gte": SINCE}}, None),
+    ("GET /orders/user/{userId}", "orders", {"userId": U}, [("createdAt", -1)]),
+    ("GET /cart/{userId}", "cart", {"userId": U}, None),
+    ("GET /tribes/{tribeId}", "tribes", {"id": "tribe-1"}, None),
+    # Admin / ops
+    ("GET /admin/profiles", "request_profiles", {}, [("createdAt", -1), ("id", -1)]),
+    ("GET /admin/profiles?route", "request_profiles", {"route": "/api/search"}, [("createdAt", -1), ("id", -1)]),
+    ("GET /admin/profiles/{profileId}", "request_profiles", {"id": "profile-1"}, None),
+]
+
+
+def plan_stages(node):
+    """Every stage name in an explain() plan tree"""
+    if isinstance(node, dict):
+        if "stage" in node:
+            yield node["stage"]
+        for value in node.values():
+            yield from plan_stages(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from plan_stages(value)
+
+
+@pytest.fixture(scope="module")
+def scratch_db():
+    loop = asyncio.new_event_loop()
+    client = motor_asyncio.AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=2000, io_loop=loop)
+    try:
+        loop.run_until_complete(client.admin.command("ping"))
+    except Exception:
+        client.close()
+        loop.close()
+        pytest.skip(f"MongoDB not reachable at {MONGO_URL}")
+    db_name = f"loopync_plans_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    loop.run_until_complete(apply_indexes(db))
+    yield loop, db
+    loop.run_until_complete(client.drop_database(db_name))
+    client.close()
+    loop.close()
+
+
+class TestIndexManifest:
+    """Manifest applies cleanly and leaves no drift"""
+
+    def test_manifest_applies_without_drift(self, scratch_db):
+        loop, db = scratch_db
+        assert loop.run_until_complete(diff_indexes(db)) == {}
+
+    def test_manifest_is_idempotent(self, scratch_db):
+        loop, db = scratch_db
+        summary = loop.run_until_complete(apply_indexes(db))
+        assert summary["created"] == 0
+        assert summary["failed"] == {}
+
+
+class TestQueryPlans:
+    """No hot query shape may fall back to a collection scan"""
+
+    @pytest.mark.parametrize("endpoint,collection,query,sort", QUERY_SHAPES, ids=[s[0] for s in QUERY_SHAPES])
+    def test_no_collscan(self, scratch_db, endpoint, collection, query, sort):
+        loop, db = scratch_db
+        assert collection in INDEX_MANIFEST, f"{collection} has no manifest entry"
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = loop.run_until_complete(cursor.limit(20).explain())
+        stages = set(plan_stages(explain["queryPlanner"]["winningPlan"]))
+        assert "COLLSCAN" not in stages, f"{endpoint}: {collection}.find({query}) sort={sort} -> {stages}"